@@ -0,0 +1,78 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Compare how many concurrent container operations the threaded
+``DockerClient`` and the Twisted-native ``TwistedDockerClient`` sustain,
+against a fake Docker daemon on a Unix socket.
+
+Run with ``python benchmark/docker_clients.py`` from the root of a
+checkout.
+"""
+
+from shutil import rmtree
+from sys import argv
+from tempfile import mkdtemp
+from timeit import default_timer
+
+from twisted.internet.defer import (
+    gatherResults, inlineCallbacks, returnValue,
+)
+from twisted.internet.task import react
+
+from flocker.node._docker import DockerClient
+from flocker.node._txdocker import TwistedDockerClient
+from flocker.node.testtools import FakeDockerServer
+
+
+def add_and_remove(client, name):
+    """
+    Add a container, check it exists and remove it again.
+
+    :return: ``Deferred`` that fires when the container has been removed.
+    """
+    d = client.add(name, u"busybox")
+    d.addCallback(lambda _: client.exists(name))
+    d.addCallback(lambda _: client.remove(name))
+    return d
+
+
+@inlineCallbacks
+def measure(client, concurrency):
+    """
+    Run ``add_and_remove`` for many containers at once.
+
+    :return: ``Deferred`` firing with the number of operations completed
+        per second.
+    """
+    start = default_timer()
+    yield gatherResults([
+        add_and_remove(client, u"container-%d" % (i,))
+        for i in range(concurrency)])
+    # Each cycle is an add, an exists and a remove:
+    returnValue(concurrency * 3 / (default_timer() - start))
+
+
+@inlineCallbacks
+def main(reactor, *concurrencies):
+    concurrencies = [int(c) for c in concurrencies] or [8, 64, 256]
+    print "%12s %-10s %14s" % ("concurrency", "client", "operations/s")
+    directory = mkdtemp()
+    server = FakeDockerServer(directory + b"/docker.sock")
+    server.start()
+    try:
+        clients = [
+            ("threaded", DockerClient(base_url=server.base_url)),
+            ("twisted", TwistedDockerClient(base_url=server.base_url)),
+        ]
+        for concurrency in concurrencies:
+            for name, client in clients:
+                rate = yield measure(client, concurrency)
+                print "%12d %-10s %14.0f" % (concurrency, name, rate)
+        yield clients[1][1].close()
+    finally:
+        server.stop()
+        rmtree(directory)
+
+
+if __name__ == '__main__':
+    react(main, argv[1:])
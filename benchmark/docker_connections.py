@@ -0,0 +1,102 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Compare the request throughput of ``docker-py``'s client with the pooled
+connections used by ``DockerClient``, against a fake Docker daemon on a
+Unix socket.
+
+Run with ``python benchmark/docker_connections.py`` from the root of a
+checkout.
+"""
+
+from shutil import rmtree
+from sys import argv
+from tempfile import mkdtemp
+from threading import Thread
+from timeit import default_timer
+
+from docker import Client
+
+from flocker.node._docker import DockerClient, SHORT_OPERATION_THREADS
+from flocker.node.testtools import FakeDockerServer, fake_container
+
+
+def make_containers(count):
+    """
+    Create the inspection data for some containers.
+
+    :param int count: The number of containers.
+
+    :return: ``dict`` mapping container IDs to inspection data.
+    """
+    return {
+        u"%064x" % (i,): fake_container(
+            u"%064x" % (i,), u"flocker--app-%d" % (i,))
+        for i in range(count)}
+
+
+def discover(client, container_ids):
+    """
+    List the containers and inspect each of them, as ``DockerClient.list``
+    does when it has nothing cached.
+
+    :param docker.Client client: The client to use.
+    :param list container_ids: The IDs of the containers to inspect.
+    """
+    client.containers(all=True)
+    for container_id in container_ids:
+        client.inspect_container(container_id)
+
+
+def measure(client, server, threads, rounds):
+    """
+    Run ``discover`` concurrently from several threads.
+
+    :return: Tuple of requests per second and the number of connections
+        the server accepted.
+    """
+    container_ids = sorted(server.containers)
+    server.connections = server.requests = 0
+    workers = [
+        Thread(target=lambda: [discover(client, container_ids)
+                               for _ in range(rounds)])
+        for _ in range(threads)]
+    start = default_timer()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = default_timer() - start
+    return server.requests / elapsed, server.connections
+
+
+def main(container_counts, rounds=5):
+    threads = SHORT_OPERATION_THREADS
+    print "%10s %-8s %12s %12s" % (
+        "containers", "client", "requests/s", "connections")
+    directory = mkdtemp()
+    try:
+        for count in container_counts:
+            server = FakeDockerServer(
+                directory + b"/docker.sock", make_containers(count))
+            server.start()
+            try:
+                clients = [
+                    ("docker-py",
+                     Client(version="1.15", base_url=server.base_url)),
+                    ("pooled",
+                     DockerClient(base_url=server.base_url)._client),
+                ]
+                for name, client in clients:
+                    rate, connections = measure(
+                        client, server, threads, rounds)
+                    print "%10d %-8s %12.0f %12d" % (
+                        count, name, rate, connections)
+            finally:
+                server.stop()
+    finally:
+        rmtree(directory)
+
+
+if __name__ == '__main__':
+    main([int(count) for count in argv[1:]] or [10, 100])
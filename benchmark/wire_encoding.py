@@ -0,0 +1,93 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Compare the speed and output size of the configuration codecs.
+
+Run with ``python benchmark/wire_encoding.py`` from the root of a checkout.
+"""
+
+from sys import argv
+from timeit import default_timer
+from uuid import uuid4
+
+from twisted.python.filepath import FilePath
+
+from flocker.control._model import (
+    Deployment, Node, Application, DockerImage, Port, Link, Dataset,
+    Manifestation, AttachedVolume,
+)
+from flocker.control._persistence import (
+    CODECS, InternPool, wire_encode, wire_decode,
+)
+
+
+def make_deployment(node_count, applications_per_node=3):
+    """
+    Create a ``Deployment`` with a realistic mixture of records.
+
+    :param int node_count: The number of nodes.
+    :param int applications_per_node: The number of applications, each with
+        its own dataset, on every node.
+
+    :return Deployment: The new deployment.
+    """
+    nodes = []
+    for node_index in range(node_count):
+        applications = []
+        manifestations = {}
+        for app_index in range(applications_per_node):
+            dataset = Dataset(dataset_id=unicode(uuid4()),
+                              metadata={u"name": u"data-%d" % (app_index,)})
+            manifestation = Manifestation(dataset=dataset, primary=True)
+            manifestations[dataset.dataset_id] = manifestation
+            applications.append(Application(
+                name=u"app-%d-%d" % (node_index, app_index),
+                image=DockerImage.from_string(u"postgres:9.%d" % (
+                    app_index,)),
+                ports=[Port(internal_port=5432,
+                            external_port=10000 + node_index * 10 +
+                            app_index)],
+                links=[Link(local_port=80, remote_port=8080, alias=u"web")],
+                environment={u"USER": u"flocker"},
+                volume=AttachedVolume(
+                    manifestation=manifestation,
+                    mountpoint=FilePath(b"/var/lib/data"))))
+        nodes.append(Node(hostname=u"node%d.example.com" % (node_index,),
+                          applications=applications,
+                          manifestations=manifestations))
+    return Deployment(nodes=nodes)
+
+
+def measure(function, *args):
+    """
+    Time a single call to a function.
+
+    :return: Tuple of the result and the number of seconds the call took.
+    """
+    start = default_timer()
+    result = function(*args)
+    return result, default_timer() - start
+
+
+def main(node_counts):
+    print "%6s %-12s %10s %10s %10s %10s" % (
+        "nodes", "codec", "bytes", "encode(s)", "decode(s)", "pooled(s)")
+    for node_count in node_counts:
+        deployment = make_deployment(node_count)
+        for codec in CODECS:
+            encoded, encode_time = measure(wire_encode, deployment, codec)
+            decoded, decode_time = measure(wire_decode, encoded)
+            assert decoded == deployment
+            # Decoding the same data again with a pool populated by an
+            # earlier decode, as happens with repeated broadcasts:
+            pool = InternPool(max_size=100000)
+            wire_decode(encoded, pool)
+            decoded, pooled_time = measure(wire_decode, encoded, pool)
+            assert decoded == deployment
+            print "%6d %-12s %10d %10.4f %10.4f %10.4f" % (
+                node_count, codec.name, len(encoded), encode_time,
+                decode_time, pooled_time)
+
+
+if __name__ == '__main__':
+    main([int(count) for count in argv[1:]] or [10, 100, 1000])
@@ -4,7 +4,8 @@
 Shared flocker components.
 """
 
-__all__ = ['INode', 'FakeNode', 'ProcessNode', 'gather_deferreds']
+__all__ = ['INode', 'IStreamingInput', 'FakeNode', 'ProcessNode',
+           'gather_deferreds']
 
-from ._ipc import INode, FakeNode, ProcessNode
+from ._ipc import INode, IStreamingInput, FakeNode, ProcessNode
 from ._defer import gather_deferreds
@@ -4,6 +4,7 @@
 Inter-process communication for flocker.
 """
 
+import os
 from subprocess import Popen, PIPE, check_output, CalledProcessError
 from contextlib import contextmanager
 from io import BytesIO
@@ -14,6 +15,11 @@ from zope.interface import Interface, implementer
 
 from characteristic import with_cmp, with_repr
 
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+from twisted.internet.error import ProcessDone
+from twisted.internet.interfaces import IConsumer
+from twisted.internet.protocol import ProcessProtocol
+
 
 class INode(Interface):
     """
@@ -31,6 +37,16 @@ class INode(Interface):
         :return: file-like object that can be written to.
         """
 
+    def run_streaming(remote_command):
+        """Start a remote command whose stdin is fed without blocking.
+
+        :param remote_command: ``list`` of ``bytes``, the command to run
+            remotely along with its arguments.
+
+        :return: An ``IStreamingInput`` provider which writes to the
+            command's stdin.
+        """
+
     def get_output(remote_command):
         """Run a remote command and return its stdout.
 
@@ -42,6 +58,105 @@ class INode(Interface):
         :return: ``bytes`` of stdout from the remote command.
         """
 
+    def get_output_async(remote_command):
+        """Run a remote command without blocking and return its stdout.
+
+        :param remote_command: ``list`` of ``bytes``, the command to run
+            remotely along with its arguments.
+
+        :return: ``Deferred`` that fires with ``bytes`` of stdout from the
+            remote command, or errbacks with ``IOError`` if it failed.
+        """
+
+
+class IStreamingInput(IConsumer):
+    """
+    The stdin of a command started by ``INode.run_streaming``.
+
+    A streaming producer registered with it is paused while the data
+    written so far has not yet been read by the command, so memory use is
+    bounded no matter how fast the producer is.
+    """
+
+    def finish():
+        """
+        Indicate that all the data has been written, closing the command's
+        stdin.
+
+        :return: ``Deferred`` that fires when the command has exited
+            successfully, or errbacks with ``IOError`` if it failed.
+        """
+
+
+@implementer(IStreamingInput)
+class _StreamingInputProtocol(ProcessProtocol):
+    """
+    Feed the data written to it to a process's stdin.
+    """
+    def __init__(self, remote_command):
+        """
+        :param remote_command: ``list`` of ``bytes``, the command being run
+            remotely, for error reporting.
+        """
+        self._remote_command = remote_command
+        self._ended = Deferred()
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def registerProducer(self, producer, streaming):
+        self.transport.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self.transport.unregisterProducer()
+
+    def processEnded(self, reason):
+        if reason.check(ProcessDone):
+            self._ended.callback(None)
+        else:
+            # We should really capture this and stderr better:
+            # https://clusterhq.atlassian.net/browse/FLOC-155
+            self._ended.errback(IOError(
+                "Bad exit", self._remote_command, reason.value.exitCode))
+
+    def finish(self):
+        self.transport.closeStdin()
+        return self._ended
+
+
+class _OutputProtocol(ProcessProtocol):
+    """
+    Collect a process's stdout.
+
+    :ivar Deferred result: Fires with the stdout once the process has exited
+        successfully, or errbacks with ``IOError`` if it failed.
+    """
+    def __init__(self, remote_command):
+        """
+        :param remote_command: ``list`` of ``bytes``, the command being run
+            remotely, for error reporting.
+        """
+        self._remote_command = remote_command
+        self._output = []
+        self.result = Deferred()
+
+    def connectionMade(self):
+        self.transport.closeStdin()
+
+    def outReceived(self, data):
+        self._output.append(data)
+
+    def processEnded(self, reason):
+        output = b"".join(self._output)
+        if reason.check(ProcessDone):
+            self.result.callback(output)
+        else:
+            # We should really capture this and stderr better:
+            # https://clusterhq.atlassian.net/browse/FLOC-155
+            self.result.errback(IOError(
+                "Bad exit", self._remote_command, reason.value.exitCode,
+                output))
+
 
 @with_cmp(["initial_command_arguments"])
 @with_repr(["initial_command_arguments"])
@@ -50,7 +165,8 @@ class ProcessNode(object):
     """
     Communicate with a remote node using a subprocess.
     """
-    def __init__(self, initial_command_arguments, quote=lambda d: d):
+    def __init__(self, initial_command_arguments, quote=lambda d: d,
+                 reactor=None):
         """
         :param initial_command_arguments: ``tuple`` of ``bytes``, initial
             command arguments to prefix to whatever arguments get passed to
@@ -59,9 +175,16 @@ class ProcessNode(object):
         :param quote: Callable that transforms the non-initial command
             arguments, converting a list of ``bytes`` to a list of
             ``bytes``. By default does nothing.
+
+        :param reactor: The ``IReactorProcess`` provider used by
+            ``run_streaming()`` and ``get_output_async()``, by default the
+            global reactor.
         """
         self.initial_command_arguments = tuple(initial_command_arguments)
         self._quote = quote
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
 
     @contextmanager
     def run(self, remote_command):
@@ -79,6 +202,16 @@ class ProcessNode(object):
                 # https://clusterhq.atlassian.net/browse/FLOC-155
                 raise IOError("Bad exit", remote_command, exit_code)
 
+    def run_streaming(self, remote_command):
+        arguments = (self.initial_command_arguments +
+                     tuple(map(self._quote, remote_command)))
+        protocol = _StreamingInputProtocol(remote_command)
+        # Like ``run()``, leave stdout and stderr connected to ours:
+        self._reactor.spawnProcess(
+            protocol, arguments[0], arguments, env=os.environ,
+            childFDs={0: "w", 1: 1, 2: 2})
+        return protocol
+
     def get_output(self, remote_command):
         try:
             return check_output(
@@ -89,6 +222,16 @@ class ProcessNode(object):
             # https://clusterhq.atlassian.net/browse/FLOC-155
             raise IOError("Bad exit", remote_command, e.returncode, e.output)
 
+    def get_output_async(self, remote_command):
+        arguments = (self.initial_command_arguments +
+                     tuple(map(self._quote, remote_command)))
+        protocol = _OutputProtocol(remote_command)
+        # Like ``get_output()``, leave stderr connected to ours:
+        self._reactor.spawnProcess(
+            protocol, arguments[0], arguments, env=os.environ,
+            childFDs={0: "w", 1: "r", 2: 2})
+        return protocol.result
+
     @classmethod
     def using_ssh(cls, host, port, username, private_key):
         """Create a ``ProcessNode`` that communicate over SSH.
@@ -132,19 +275,21 @@ class FakeNode(object):
 
     This is useful for testing.
 
-    :ivar remote_command: The arguments to the last call to ``run()`` or
-        ``get_output()``.
+    :ivar remote_command: The arguments to the last call to ``run()``,
+        ``run_streaming()``, ``get_output()`` or ``get_output_async()``.
 
-    :ivar stdin: `BytesIO` returned from last call to ``run()``.
+    :ivar stdin: `BytesIO` returned from last call to ``run()``, or
+        written to by the result of the last call to ``run_streaming()``.
 
     :ivar thread_id: The ID of the thread ``run()`` or ``get_output()``
         ran in.
     """
     def __init__(self, outputs=()):
         """
-        :param outputs: Sequence of results for ``get_output()``, either
-            exceptions or ``bytes``. Exceptions will be raised, otherwise the
-            object will be returned.
+        :param outputs: Sequence of results for ``get_output()`` and
+            ``get_output_async()``, either exceptions or ``bytes``.
+            Exceptions will be raised, otherwise the object will be
+            returned.
         """
         self._outputs = list(outputs)
 
@@ -159,6 +304,16 @@ class FakeNode(object):
         yield self.stdin
         self.stdin.seek(0, 0)
 
+    def run_streaming(self, remote_command):
+        """
+        Store arguments and return a consumer that writes to an in-memory
+        "stdin".
+        """
+        self.thread_id = current_thread().ident
+        self.stdin = BytesIO()
+        self.remote_command = remote_command
+        return _FakeStreamingInput(self.stdin)
+
     def get_output(self, remote_command):
         """
         Return (or if an exception, raise) the next remaining output of the
@@ -171,3 +326,35 @@ class FakeNode(object):
             raise result
         else:
             return result
+
+    def get_output_async(self, remote_command):
+        """
+        Like ``get_output()``, but return a ``Deferred`` which fires with (or
+        if an exception, errbacks with) the next remaining output.
+        """
+        return maybeDeferred(self.get_output, remote_command)
+
+
+@implementer(IStreamingInput)
+class _FakeStreamingInput(object):
+    """
+    Write to an in-memory "stdin", never pausing its producer.
+    """
+    def __init__(self, stdin):
+        """
+        :param BytesIO stdin: The file to write to.
+        """
+        self._stdin = stdin
+
+    def write(self, data):
+        self._stdin.write(data)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def finish(self):
+        self._stdin.seek(0, 0)
+        return succeed(None)
@@ -66,6 +66,32 @@ class ProcessNodeTests(TestCase):
         else:
             self.fail("No IOError")
 
+    def test_run_streaming_stdin(self):
+        """
+        ``ProcessNode.run_streaming()`` returns a consumer which writes to
+        the subprocess' stdin, and whose ``finish()`` result fires once the
+        subprocess has exited.
+        """
+        node = ProcessNode(initial_command_arguments=[b"sh", b"-c"])
+        temp_file = FilePath(self.mktemp())
+        stdin = node.run_streaming([b"cat > " + temp_file.path])
+        stdin.write(b"hello ")
+        stdin.write(b"world")
+        d = stdin.finish()
+        d.addCallback(lambda _: temp_file.getContent())
+        d.addCallback(self.assertEqual, b"hello world")
+        return d
+
+    def test_run_streaming_bad_exit(self):
+        """
+        The ``Deferred`` returned by ``finish()`` on the result of
+        ``run_streaming()`` errbacks with ``IOError`` if the subprocess has
+        a non-zero exit code.
+        """
+        node = ProcessNode(initial_command_arguments=[])
+        stdin = node.run_streaming([b"ls", self.mktemp()])
+        return self.assertFailure(stdin.finish(), IOError)
+
     def test_get_output_runs_command(self):
         """
         ``ProcessNode.get_output()`` runs a command that is the combination of
@@ -93,6 +119,25 @@ class ProcessNodeTests(TestCase):
         nonexistent = self.mktemp()
         self.assertRaises(IOError, node.get_output, [b"ls", nonexistent])
 
+    def test_get_output_async_result(self):
+        """
+        ``get_output_async()`` returns a ``Deferred`` that fires with the
+        output of the command.
+        """
+        node = ProcessNode(initial_command_arguments=[b"sh", b"-c"])
+        d = node.get_output_async([b"echo -n hello"])
+        d.addCallback(self.assertEqual, b"hello")
+        return d
+
+    def test_get_output_async_bad_exit(self):
+        """
+        The ``Deferred`` returned by ``get_output_async()`` errbacks with
+        ``IOError`` if the subprocess has a non-zero exit code.
+        """
+        node = ProcessNode(initial_command_arguments=[])
+        return self.assertFailure(
+            node.get_output_async([b"ls", self.mktemp()]), IOError)
+
 
 def make_sshnode(test_case):
     """
@@ -208,5 +253,12 @@ class MutatingProcessNode(ProcessNode):
     def run(self, remote_command):
         return ProcessNode.run(self, self._mutate(remote_command))
 
+    def run_streaming(self, remote_command):
+        return ProcessNode.run_streaming(self, self._mutate(remote_command))
+
     def get_output(self, remote_command):
         return ProcessNode.get_output(self, self._mutate(remote_command))
+
+    def get_output_async(self, remote_command):
+        return ProcessNode.get_output_async(
+            self, self._mutate(remote_command))
@@ -10,7 +10,9 @@ from unittest import TestCase as PyTestCase
 
 from zope.interface.verify import verifyObject
 
-from .. import INode, FakeNode
+from twisted.trial.unittest import SynchronousTestCase
+
+from .. import INode, IStreamingInput, FakeNode
 from ...testtools import assertNoFDsLeaked
 
 
@@ -95,3 +97,40 @@ def make_inode_tests(fixture):
 
 class FakeINodeTests(make_inode_tests(lambda t: FakeNode([b"hello"]))):
     """``INode`` tests for ``FakeNode``."""
+
+
+class FakeNodeTests(SynchronousTestCase):
+    """Tests for ``FakeNode``."""
+
+    def test_run_streaming(self):
+        """
+        ``FakeNode.run_streaming()`` records the command and returns an
+        ``IStreamingInput`` which writes to ``FakeNode.stdin``.
+        """
+        node = FakeNode()
+        stdin = node.run_streaming([b"cat"])
+        stdin.write(b"hello ")
+        stdin.write(b"there")
+        self.assertEqual(
+            (True, [b"cat"], None, b"hello there"),
+            (IStreamingInput.providedBy(stdin), node.remote_command,
+             self.successResultOf(stdin.finish()), node.stdin.read()))
+
+    def test_get_output_async(self):
+        """
+        ``FakeNode.get_output_async()`` records the command and returns a
+        ``Deferred`` that fires with the next output.
+        """
+        node = FakeNode([b"hello"])
+        d = node.get_output_async([b"echo", b"hello"])
+        self.assertEqual(
+            ([b"echo", b"hello"], b"hello"),
+            (node.remote_command, self.successResultOf(d)))
+
+    def test_get_output_async_exception(self):
+        """
+        ``FakeNode.get_output_async()`` returns a ``Deferred`` that errbacks
+        with the next output if it's an exception.
+        """
+        node = FakeNode([IOError("Bad exit")])
+        self.failureResultOf(node.get_output_async([b"false"]), IOError)
@@ -17,9 +17,18 @@ class ClusterStateService(Service):
     https://clusterhq.atlassian.net/browse/FLOC-1269 will deal with
     semantics of expiring data, which should happen so stale information
     isn't treated as correct.
+
+    :ivar int generation: Incremented every time the known cluster state
+        changes.
     """
     def __init__(self):
         self._nodes = {}
+        # The ``Node`` each ``NodeState`` in ``_nodes`` was converted to,
+        # and a ``Deployment`` combining all of them, both kept up to date
+        # as updates arrive so ``as_deployment`` needn't convert anything:
+        self._converted_nodes = {}
+        self._deployment = Deployment(nodes=frozenset())
+        self.generation = 0
 
     def update_node_state(self, node_state):
         """
@@ -29,8 +38,23 @@ class ClusterStateService(Service):
         consistency here. See https://clusterhq.atlassian.net/browse/FLOC-1303
 
         :param NodeState node_state: The state of the node.
+
+        :return bool: ``True`` if the state of the node changed, ``False``
+            if it is identical to the previously known state.
         """
-        self._nodes[node_state.hostname] = node_state
+        hostname = node_state.hostname
+        if self._nodes.get(hostname) == node_state:
+            return False
+        self._nodes[hostname] = node_state
+
+        node = node_state.to_node()
+        nodes = self._deployment.nodes
+        if hostname in self._converted_nodes:
+            nodes = nodes.remove(self._converted_nodes[hostname])
+        self._converted_nodes[hostname] = node
+        self._deployment = self._deployment.set("nodes", nodes.add(node))
+        self.generation += 1
+        return True
 
     def manifestation_path(self, hostname, dataset_id):
         """
@@ -47,7 +71,9 @@ class ClusterStateService(Service):
         """
         Return cluster state as a Deployment object.
 
+        The result is only recalculated when the cluster state changes, so
+        this is cheap to call repeatedly.
+
         :return Deployment: Current state of the cluster.
         """
-        return Deployment(nodes=frozenset(
-            (node_state.to_node() for node_state in self._nodes.values())))
+        return self._deployment
@@ -18,7 +18,7 @@ from characteristic import attributes
 
 from twisted.python.filepath import FilePath
 from pyrsistent import (
-    pmap, PRecord, field, PMap, CheckedPSet, CheckedPMap,
+    pmap, pset, PRecord, field, PMap, CheckedPSet, CheckedPMap,
     )
 
 from zope.interface import Interface, implementer
@@ -333,14 +333,265 @@ class Deployment(PRecord):
         ``Node`` with updated version, or just adds given ``Node`` if no
         existing ones have matching hostname.
 
+        Finding the existing ``Node`` takes time proportional to the number
+        of nodes; ``DeploymentIndex.update_node`` avoids that.  The other
+        nodes are not copied, since the new set shares them with this one.
+
         :param Node node: An update for ``Node`` with same hostname in
              this ``Deployment``.
 
         :return Deployment: Updated with new ``Node``.
         """
+        nodes = self.nodes
+        for existing in nodes:
+            if existing.hostname == node.hostname:
+                nodes = nodes.remove(existing)
+                break
+        return self.set("nodes", nodes.add(node))
+
+
+def _add_owner(index, key, hostname):
+    """
+    Record that a node owns an index entry.
+
+    :param PMap index: Map keys to a ``PSet`` of the hostnames of the nodes
+        owning them.
+    :param key: The key to add an owner for.
+    :param unicode hostname: The hostname of the owning node.
+
+    :return PMap: The updated map.
+    """
+    return index.set(key, index.get(key, pset()).add(hostname))
+
+
+def _remove_owner(index, key, hostname):
+    """
+    Record that a node no longer owns an index entry, removing the entry
+    once no nodes own it.
+
+    :param PMap index: Map keys to a ``PSet`` of the hostnames of the nodes
+        owning them.
+    :param key: The key to remove an owner of.
+    :param unicode hostname: The hostname of the node that no longer owns it.
+
+    :return PMap: The updated map.
+    """
+    hostnames = index.get(key, pset()).discard(hostname)
+    if hostnames:
+        return index.set(key, hostnames)
+    return index.discard(key)
+
+
+class DeploymentIndex(PRecord):
+    """
+    A ``Deployment`` together with indexes of its contents, so that nodes,
+    applications, datasets and ports can be found without scanning the whole
+    deployment.
+
+    Like the ``Deployment`` itself the indexes are persistent: updating a
+    node creates a new ``DeploymentIndex`` that shares everything except the
+    entries for that node with the old one.
+
+    :ivar Deployment deployment: The indexed deployment.
+    :ivar PMap nodes: Map ``unicode`` hostnames to ``Node`` instances.
+    :ivar PMap applications: Map ``unicode`` application names to a
+        ``PSet`` of the hostnames of nodes the application is configured on.
+    :ivar PMap datasets: Map ``unicode`` dataset IDs to a ``PSet`` of the
+        hostnames of nodes with a manifestation of that dataset.
+    :ivar PMap external_ports: Map ``int`` external ports to a ``PSet`` of
+        the hostnames of nodes with an application exposing them.
+    """
+    deployment = field(type=Deployment, mandatory=True,
+                       initial=Deployment(nodes=frozenset()))
+    nodes = field(type=PMap, initial=pmap(), factory=pmap, mandatory=True)
+    applications = field(type=PMap, initial=pmap(), factory=pmap,
+                         mandatory=True)
+    datasets = field(type=PMap, initial=pmap(), factory=pmap, mandatory=True)
+    external_ports = field(type=PMap, initial=pmap(), factory=pmap,
+                           mandatory=True)
+
+    @classmethod
+    def from_deployment(cls, deployment):
+        """
+        Index a ``Deployment``.
+
+        :param Deployment deployment: The deployment to index.
+
+        :return DeploymentIndex: Index of the deployment.
+        """
+        index = cls()
+        for node in deployment.nodes:
+            index = index._add_entries(node)
+        return index.set(deployment=deployment)
+
+    def _add_entries(self, node):
+        """
+        Add index entries for a node, without changing the deployment.
+
+        :param Node node: The node to add.
+
+        :return DeploymentIndex: The updated index.
+        """
+        hostname = node.hostname
+        applications = self.applications
+        external_ports = self.external_ports
+        for application in node.applications:
+            applications = _add_owner(
+                applications, application.name, hostname)
+            for port in application.ports:
+                external_ports = _add_owner(
+                    external_ports, port.external_port, hostname)
+        datasets = self.datasets
+        for dataset_id in node.manifestations:
+            datasets = _add_owner(datasets, dataset_id, hostname)
+        return self.set(
+            nodes=self.nodes.set(node.hostname, node),
+            applications=applications, datasets=datasets,
+            external_ports=external_ports)
+
+    def _remove_entries(self, hostname):
+        """
+        Remove the index entries for a node, without changing the deployment.
+
+        :param unicode hostname: The hostname of the node to remove.
+
+        :return DeploymentIndex: The updated index.
+        """
+        node = self.nodes.get(hostname)
+        if node is None:
+            return self
+        applications = self.applications
+        external_ports = self.external_ports
+        for application in node.applications:
+            applications = _remove_owner(
+                applications, application.name, hostname)
+            for port in application.ports:
+                external_ports = _remove_owner(
+                    external_ports, port.external_port, hostname)
+        datasets = self.datasets
+        for dataset_id in node.manifestations:
+            datasets = _remove_owner(datasets, dataset_id, hostname)
+        return self.set(
+            nodes=self.nodes.remove(hostname),
+            applications=applications, datasets=datasets,
+            external_ports=external_ports)
+
+    def update_node(self, node):
+        """
+        Create a new index whose deployment has the ``Node`` with the same
+        hostname replaced by the given one, or the given one added if there
+        is no such node.
+
+        Unlike ``Deployment.update_node`` this takes time proportional to the
+        size of the node rather than the size of the deployment.
+
+        :param Node node: An update for ``Node`` with same hostname in
+             this ``Deployment``.
+
+        :return DeploymentIndex: Index of the updated deployment.
+        """
+        nodes = self.deployment.nodes
+        existing = self.nodes.get(node.hostname)
+        if existing is not None:
+            nodes = nodes.remove(existing)
+        index = self._remove_entries(node.hostname)._add_entries(node)
+        return index.set(
+            deployment=self.deployment.set("nodes", nodes.add(node)))
+
+    def reindex(self, deployment):
+        """
+        Create an index for a different version of the indexed deployment.
+
+        Nodes are compared by identity first, so when ``deployment`` shares
+        most of its nodes with the indexed one, as is the case when it was
+        derived from it, only the nodes that actually changed are reindexed.
+
+        :param Deployment deployment: The deployment to index.
+
+        :return DeploymentIndex: Index of ``deployment``.
+        """
+        if deployment is self.deployment:
+            return self
+        index = self
+        hostnames = set()
+        for node in deployment.nodes:
+            hostnames.add(node.hostname)
+            existing = self.nodes.get(node.hostname)
+            if existing is not node and existing != node:
+                index = index._remove_entries(node.hostname)._add_entries(node)
+        for hostname in self.nodes:
+            if hostname not in hostnames:
+                index = index._remove_entries(hostname)
+        return index.set(deployment=deployment)
+
+    def manifestations(self, dataset_id):
+        """
+        Find all manifestations of a dataset.
+
+        :param unicode dataset_id: The ID of the dataset.
+
+        :return: Iterable of (``Manifestation``, ``Node``) pairs.
+        """
+        for hostname in self.datasets.get(dataset_id, ()):
+            node = self.nodes[hostname]
+            yield node.manifestations[dataset_id], node
+
+
+class DeploymentDiff(PRecord):
+    """
+    The changes necessary to turn one ``Deployment`` into another, at the
+    granularity of whole ``Node``\ s.
+
+    :ivar PSet changed_nodes: ``Node`` instances that were added or whose
+        contents changed.
+    :ivar PSet removed_hostnames: The hostnames of nodes that are no longer
+        present.
+    """
+    changed_nodes = pset_field(Node)
+    removed_hostnames = pset_field(unicode)
+
+    @classmethod
+    def between(cls, original, updated):
+        """
+        Calculate the difference between two ``Deployment`` instances.
+
+        :param Deployment original: The starting deployment.
+        :param Deployment updated: The deployment to end up with.
+
+        :return DeploymentDiff: Changes that when applied to ``original``
+            result in ``updated``.
+        """
+        if original is updated:
+            return cls()
+        # Versions of a configuration share unchanged ``Node`` instances, so
+        # recognise those by identity and only compare the rest by value.
+        original_ids = {id(node) for node in original.nodes}
+        updated_ids = {id(node) for node in updated.nodes}
+        original_rest = frozenset(
+            node for node in original.nodes if id(node) not in updated_ids)
+        updated_rest = frozenset(
+            node for node in updated.nodes if id(node) not in original_ids)
+        return cls(
+            changed_nodes=updated_rest - original_rest,
+            removed_hostnames=(
+                {node.hostname for node in original_rest} -
+                {node.hostname for node in updated_rest}))
+
+    def apply(self, deployment):
+        """
+        Apply the changes to a ``Deployment``.
+
+        :param Deployment deployment: The deployment to change.
+
+        :return Deployment: Updated deployment.
+        """
+        if not self.changed_nodes and not self.removed_hostnames:
+            return deployment
+        replaced = self.removed_hostnames | {
+            node.hostname for node in self.changed_nodes}
         return Deployment(nodes=frozenset(
-            list(n for n in self.nodes if n.hostname != node.hostname) +
-            [node]))
+            [node for node in deployment.nodes
+             if node.hostname not in replaced] + list(self.changed_nodes)))
 
 
 @attributes(["dataset", "hostname"])
@@ -439,5 +690,5 @@ class NodeState(PRecord):
 SERIALIZABLE_CLASSES = [
     Deployment, Node, DockerImage, Port, Link, RestartNever, RestartAlways,
     RestartOnFailure, Application, Dataset, Manifestation, AttachedVolume,
-    NodeState,
+    NodeState, DeploymentDiff,
 ]
@@ -4,14 +4,25 @@
 Persistence of cluster configuration.
 """
 
-from pyrsistent import PRecord, PVector, PMap, PSet
+import os
+
+from collections import deque
+from functools import partial
 from json import dumps, loads, JSONEncoder
 
+from pyrsistent import PRecord, PVector, PMap, PSet
+
+from twisted.python.failure import Failure
 from twisted.python.filepath import FilePath
 from twisted.application.service import Service
-from twisted.internet.defer import succeed
+from twisted.internet.defer import Deferred, DeferredLock
+from twisted.internet.threads import deferToThreadPool
 
-from ._model import SERIALIZABLE_CLASSES, Deployment
+from ._model import (
+    SERIALIZABLE_CLASSES, Deployment, DeploymentDiff, DeploymentIndex,
+    DockerImage, Port, Link, Dataset, Manifestation, RestartNever,
+    RestartAlways, RestartOnFailure,
+)
 
 
 # Serialization marker storing the class name:
@@ -37,63 +48,444 @@ class _ConfigurationEncoder(JSONEncoder):
         return JSONEncoder.default(self, obj)
 
 
-def wire_encode(obj):
+# Records that are decoded often with identical contents, and are small
+# enough that looking them up in an ``InternPool`` is cheaper than
+# creating them:
+_INTERNED_CLASSES = frozenset([
+    DockerImage, Port, Link, Dataset, Manifestation, RestartNever,
+    RestartAlways, RestartOnFailure,
+])
+
+
+def _intern_key(value):
     """
-    Encode the given configuration object into bytes.
+    Convert decoded field values into something hashable.
 
-    :param obj: An object from the configuration model, e.g. ``Deployment``.
-    :return bytes: Encoded object.
+    :param value: A value decoded from JSON, possibly containing ``list``
+        and ``dict`` instances.
+
+    :return: A hashable equivalent of ``value``.
     """
-    return dumps(obj, cls=_ConfigurationEncoder)
+    if isinstance(value, list):
+        return tuple(_intern_key(item) for item in value)
+    elif isinstance(value, dict):
+        return frozenset((key, _intern_key(item))
+                         for (key, item) in value.items())
+    return value
 
 
-def wire_decode(data):
+class InternPool(object):
     """
-    Decode the given configuration object from bytes.
+    A bounded pool of recently decoded records.
 
-    :param bytes data: Encoded object.
-    :param obj: An object from the configuration model, e.g. ``Deployment``.
+    Decoding a record identical to one already in the pool returns the
+    existing instance rather than creating a new one, so repeatedly decoded
+    configuration shares its small sub-records and doesn't pay for
+    constructing them again. Once ``max_size`` records are pooled the pool
+    is emptied and starts over.
+
+    :ivar int hits: The number of records that were found in the pool.
+    :ivar int misses: The number of records that had to be created.
     """
-    classes = {cls.__name__: cls for cls in SERIALIZABLE_CLASSES}
+    def __init__(self, max_size=10000):
+        """
+        :param int max_size: The maximum number of records to keep.
+        """
+        self._max_size = max_size
+        self._records = {}
+        self.hits = 0
+        self.misses = 0
 
-    def decode_object(dictionary):
+    def __len__(self):
+        return len(self._records)
+
+    def create(self, cls, fields):
+        """
+        Create a record, or return an identical existing one.
+
+        :param cls: The ``PRecord`` subclass to create.
+        :param dict fields: The decoded values of the record's fields.
+
+        :return: An instance of ``cls``.
+        """
+        if cls not in _INTERNED_CLASSES:
+            return cls.create(fields)
+        key = (cls, _intern_key(fields))
+        record = self._records.get(key)
+        if record is None:
+            self.misses += 1
+            record = cls.create(fields)
+            if len(self._records) >= self._max_size:
+                self._records.clear()
+            self._records[key] = record
+        else:
+            self.hits += 1
+        return record
+
+
+class _JSONCodec(object):
+    """
+    Encode configuration objects as JSON, storing the class name in every
+    encoded record.
+
+    :ivar unicode name: The name of this codec.
+    :ivar bytes prefix: Bytes that all encoded objects start with.
+    """
+    name = u"json"
+    prefix = b""
+
+    def __init__(self):
+        self._classes = {cls.__name__: cls for cls in SERIALIZABLE_CLASSES}
+
+    def encode(self, obj):
+        """
+        Encode the given configuration object into bytes.
+
+        :param obj: An object from the configuration model.
+        :return bytes: Encoded object.
+        """
+        return dumps(obj, cls=_ConfigurationEncoder)
+
+    def _decode_object(self, dictionary, pool=None):
+        """
+        Decode a JSON object, ``object_hook`` for ``loads``.
+
+        :param dict dictionary: The decoded JSON object.
+        :param InternPool pool: Pool to create records with, or ``None``.
+        """
         class_name = dictionary.get(_CLASS_MARKER, None)
         if class_name == u"FilePath":
             return FilePath(dictionary.get(u"path").encode("utf-8"))
-        elif class_name in classes:
+        elif class_name in self._classes:
             dictionary = dictionary.copy()
             dictionary.pop(_CLASS_MARKER)
-            return classes[class_name].create(dictionary)
+            cls = self._classes[class_name]
+            if pool is None:
+                return cls.create(dictionary)
+            return pool.create(cls, dictionary)
         else:
             return dictionary
-    return loads(data, object_hook=decode_object)
+
+    def decode(self, data, pool=None):
+        """
+        Decode the given configuration object from bytes.
+
+        :param bytes data: Encoded object.
+        :param InternPool pool: Pool to create records with, or ``None``.
+        :return: The decoded object.
+        """
+        if pool is None:
+            object_hook = self._decode_object
+        else:
+            object_hook = partial(self._decode_object, pool=pool)
+        return loads(data, object_hook=object_hook)
+
+
+# Tags used by ``_CompactCodec`` for things other than records:
+_COMPACT_SEQUENCE = 0
+_COMPACT_FILEPATH = 1
+# Negative, so that the tags of records stay the same:
+_COMPACT_UNSET = -1
+
+
+class _CompactCodec(object):
+    """
+    Encode configuration objects as compact JSON arrays.
+
+    Records are encoded positionally as ``[tag, value, value, ...]`` where
+    the tag is derived from the record class's position in
+    ``SERIALIZABLE_CLASSES`` and the values are in the order of the sorted
+    field names, so neither class nor field names are repeated for every
+    record. Fields that are not set are encoded as ``[-1]``, so they are
+    left unset when decoded rather than being set to ``None``. Sets and
+    vectors are encoded as ``[0, item, item, ...]`` and ``FilePath`` as
+    ``[1, path]``. Maps are encoded as JSON objects.
+
+    Both ends of a connection must therefore agree on
+    ``SERIALIZABLE_CLASSES`` and the fields of each class; new classes must
+    be appended, and changing the fields of an existing class requires a
+    new codec name.
+
+    :ivar unicode name: The name of this codec.
+    :ivar bytes prefix: Bytes that all encoded objects start with.
+    """
+    name = u"compact-v1"
+    prefix = b"\x01"
+
+    def __init__(self, classes=SERIALIZABLE_CLASSES):
+        """
+        :param classes: The ``PRecord`` subclasses that can be encoded, in
+            the order that determines their tags.
+        """
+        self._tags = {
+            cls: (tag, sorted(cls._precord_fields))
+            for tag, cls in enumerate(classes, _COMPACT_FILEPATH + 1)}
+        self._records = {tag: (cls, fields)
+                         for (cls, (tag, fields)) in self._tags.items()}
+
+    def _encode_object(self, obj):
+        """
+        Convert an object into the compact representation.
+
+        :param obj: An object from the configuration model.
+        :return: Object that can be serialized by ``dumps``.
+        """
+        record = self._tags.get(obj.__class__)
+        if record is not None:
+            tag, fields = record
+            values = dict(obj.iteritems())
+            return [tag] + [self._encode_object(values[field])
+                            if field in values else [_COMPACT_UNSET]
+                            for field in fields]
+        elif isinstance(obj, PRecord):
+            raise TypeError("{} is not serializable".format(obj))
+        elif isinstance(obj, (PMap, dict)):
+            return {key: self._encode_object(value)
+                    for key, value in obj.items()}
+        elif isinstance(obj, (PSet, PVector, set, frozenset, list)):
+            return [_COMPACT_SEQUENCE] + [self._encode_object(item)
+                                          for item in obj]
+        elif isinstance(obj, FilePath):
+            return [_COMPACT_FILEPATH, obj.path.decode("utf-8")]
+        return obj
+
+    def encode(self, obj):
+        """
+        Encode the given configuration object into bytes.
+
+        :param obj: An object from the configuration model.
+        :return bytes: Encoded object.
+        """
+        return self.prefix + dumps(self._encode_object(obj),
+                                   separators=(",", ":"))
+
+    def _decode_object(self, value, pool):
+        """
+        Convert the compact representation back into an object.
+
+        :param value: Object decoded by ``loads``.
+        :param InternPool pool: Pool to create records with, or ``None``.
+        :return: An object from the configuration model.
+        """
+        if isinstance(value, list):
+            tag = value[0]
+            if tag == _COMPACT_SEQUENCE:
+                return [self._decode_object(item, pool)
+                        for item in value[1:]]
+            elif tag == _COMPACT_FILEPATH:
+                return FilePath(value[1].encode("utf-8"))
+            cls, fields = self._records[tag]
+            values = {field: self._decode_object(item, pool)
+                      for (field, item) in zip(fields, value[1:])
+                      if item != [_COMPACT_UNSET]}
+            if pool is None:
+                return cls.create(values)
+            return pool.create(cls, values)
+        elif isinstance(value, dict):
+            return {key: self._decode_object(item, pool)
+                    for key, item in value.items()}
+        return value
+
+    def decode(self, data, pool=None):
+        """
+        Decode the given configuration object from bytes.
+
+        :param bytes data: Encoded object.
+        :param InternPool pool: Pool to create records with, or ``None``.
+        :return: The decoded object.
+        """
+        return self._decode_object(loads(data[len(self.prefix):]), pool)
+
+
+JSON_CODEC = _JSONCodec()
+COMPACT_CODEC = _CompactCodec()
+
+# All supported codecs, in order of preference:
+CODECS = [COMPACT_CODEC, JSON_CODEC]
+
+
+def wire_encode(obj, codec=JSON_CODEC):
+    """
+    Encode the given configuration object into bytes.
+
+    :param obj: An object from the configuration model, e.g. ``Deployment``.
+    :param codec: The codec to use, one of ``CODECS``.
+    :return bytes: Encoded object.
+    """
+    return codec.encode(obj)
+
+
+def wire_decode(data, pool=None):
+    """
+    Decode the given configuration object from bytes.
+
+    The codec used to encode the data is detected automatically.
+
+    :param bytes data: Encoded object.
+    :param InternPool pool: If given, small records identical to ones
+        recently decoded using the same pool are reused rather than
+        created anew.
+    :param obj: An object from the configuration model, e.g. ``Deployment``.
+    """
+    for codec in CODECS:
+        if data.startswith(codec.prefix):
+            return codec.decode(data, pool)
+
+
+# Number of configuration versions retained by default:
+HISTORY_SIZE = 100
+
+
+class UnknownVersion(Exception):
+    """
+    The requested configuration version is not, or no longer, retained.
+    """
+
+
+# Number of entries appended to the journal before it is compacted into a
+# new snapshot:
+JOURNAL_COMPACTION_THRESHOLD = 100
+
+
+def _fsync_write(path, data):
+    """
+    Atomically replace the contents of a file, flushing them to disk first.
+
+    :param FilePath path: The file to write.
+    :param bytes data: The new contents.
+    """
+    temporary = path.temporarySibling()
+    with temporary.open("wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    temporary.moveTo(path)
 
 
 class ConfigurationPersistenceService(Service):
     """
     Persist configuration to disk, and load it back.
 
+    The configuration is stored as a snapshot of the whole ``Deployment``
+    plus a journal of ``DeploymentDiff`` entries, one per line, describing
+    the changes made since the snapshot was written. Saving appends a single
+    entry to the journal, so the cost of a save is proportional to the size
+    of the change rather than the size of the cluster. Once the journal has
+    grown long enough it is compacted by writing a new snapshot and
+    emptying the journal.
+
+    Replaying a diff only ever replaces whole nodes, so replaying journal
+    entries on top of a snapshot that already includes them gives the same
+    result; a crash between writing a snapshot and emptying the journal is
+    therefore harmless.
+
+    Saves can also be grouped: with a batch window all saves made within the
+    window are written as one journal entry, change callbacks are called
+    once for the whole batch, and the ``Deferred``\ s returned by ``save``
+    all fire together once the write is finished.
+
     :ivar Deployment _deployment: The current desired deployment configuration.
+    :ivar Deployment _committed: The configuration as of the last commit.
+    :ivar int batched_saves: The number of saves committed as part of a
+        batch.
+    :ivar int version: The version of the current configuration. The
+        configuration loaded at startup is version 0 and every save
+        increments it; versions are not preserved across restarts.
+    :ivar deque _history: The most recent configurations, oldest first,
+        ending with the current one.
     """
-    def __init__(self, reactor, path):
+    def __init__(self, reactor, path, codec=JSON_CODEC,
+                 compaction_threshold=JOURNAL_COMPACTION_THRESHOLD,
+                 batch_window=None, history_size=HISTORY_SIZE):
         """
-        :param reactor: Reactor to use for thread pool.
+        :param reactor: Reactor to use for thread pool, or ``None`` to do all
+            writes synchronously.
         :param FilePath path: Directory where desired deployment will be
             persisted.
+        :param codec: The codec used to write the configuration, one of
+            ``CODECS``. Configuration written with any codec can be loaded.
+        :param int compaction_threshold: The number of journal entries after
+            which a new snapshot is written.
+        :param batch_window: ``None`` to commit every save on its own, or the
+            number of seconds to wait for further saves before committing
+            them all with a single write and a single call of each change
+            callback; ``0`` batches saves made in the same reactor
+            iteration. Requires a reactor.
+        :param int history_size: The number of configuration versions to
+            retain, including the current one.
         """
+        self._reactor = reactor
         self._path = path
+        self._codec = codec
+        self._compaction_threshold = compaction_threshold
         self._change_callbacks = []
+        # Serializes writes so they reach the disk in the order they were
+        # made:
+        self._write_lock = DeferredLock()
+        self._batch_window = batch_window
+        self._history_size = history_size
+        self._scheduled_commit = None
+        self._pending_saves = []
+        self.batched_saves = 0
 
     def startService(self):
         if not self._path.exists():
             self._path.makedirs()
         self._config_path = self._path.child(b"current_configuration.v1.json")
+        self._journal_path = self._path.child(
+            b"current_configuration.v1.journal")
         if self._config_path.exists():
             self._deployment = wire_decode(
                 self._config_path.getContent())
         else:
             self._deployment = Deployment(nodes=frozenset())
             self._sync_save(self._deployment)
+        if self._journal_path.exists() and self._journal_path.getsize():
+            self._deployment = self._replay(self._journal_path.getContent())
+            # Fold the journal into the snapshot; this also discards a
+            # partially written final entry, if any:
+            self._sync_save(self._deployment)
+        self._committed = self._deployment
+        self._history = deque([self._deployment], self._history_size)
+        self._index = DeploymentIndex.from_deployment(self._deployment)
+        self.version = 0
+        self._journal = self._journal_path.open("wb")
+        self._journal_entries = 0
+
+    def stopService(self):
+        """
+        Stop the service once all outstanding writes have finished.
+
+        :return Deferred: Fires when the journal has been closed.
+        """
+        Service.stopService(self)
+        if self._scheduled_commit is not None:
+            self._scheduled_commit.cancel()
+            self._commit_batch()
+        # A compaction queued before this replaces ``_journal``, so only
+        # look it up once the previous writes have finished:
+        return self._write_lock.run(lambda: self._journal.close())
+
+    def _replay(self, journal):
+        """
+        Apply the entries of a journal to the current configuration.
+
+        :param bytes journal: The contents of the journal file.
+
+        :return Deployment: The resulting configuration.
+        """
+        deployment = self._deployment
+        for line in journal.split(b"\n"):
+            if not line:
+                continue
+            try:
+                diff = wire_decode(line)
+            except ValueError:
+                # A crash part way through appending the final entry; the
+                # corresponding save was never acknowledged.
+                break
+            deployment = diff.apply(deployment)
+        return deployment
 
     def register(self, change_callback):
         """
@@ -106,18 +498,93 @@ class ConfigurationPersistenceService(Service):
 
     def _sync_save(self, deployment):
         """
-        Save and flush new deployment to disk synchronously.
+        Save and flush new deployment snapshot to disk synchronously.
+        """
+        _fsync_write(self._config_path, wire_encode(deployment, self._codec))
+
+    def _sync_append(self, entry):
+        """
+        Append an entry to the journal and flush it to disk synchronously.
+
+        :param bytes entry: An encoded ``DeploymentDiff``.
+        """
+        self._journal.write(entry + b"\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _sync_compact(self, deployment):
+        """
+        Write a new snapshot and empty the journal synchronously.
+
+        :param Deployment deployment: The configuration including all
+            changes in the journal.
+        """
+        self._sync_save(deployment)
+        self._journal.close()
+        self._journal = self._journal_path.open("wb")
+
+    def _write(self, f, *args):
         """
-        self._config_path.setContent(wire_encode(deployment))
+        Run a write in the reactor's thread pool, after all previous writes
+        have finished.
+
+        :param f: Callable that does the write.
+        :param args: Arguments for ``f``.
 
-    def save(self, deployment):
+        :return Deferred: Fires when the write is finished.
+        """
+        if self._reactor is None:
+            return self._write_lock.run(f, *args)
+        return self._write_lock.run(
+            deferToThreadPool, self._reactor, self._reactor.getThreadPool(),
+            f, *args)
+
+    def save(self, deployment, index=None):
         """
         Save and flush new deployment to disk.
 
+        The new configuration is visible to ``get`` immediately. Without a
+        batch window change callbacks are also called immediately; with one
+        they are called once for all saves in the batch, when it is
+        committed. Either way the write to disk happens asynchronously.
+
+        :param Deployment deployment: The new configuration.
+        :param index: ``None``, or a ``DeploymentIndex`` of ``deployment``,
+            e.g. as returned by ``DeploymentIndex.update_node``, which
+            ``get_index`` will then return without reindexing.
+
         :return Deferred: Fires when write is finished.
         """
-        self._sync_save(deployment)
         self._deployment = deployment
+        if index is not None and index.deployment is deployment:
+            self._index = index
+        self._history.append(deployment)
+        self.version += 1
+        if self._batch_window is None:
+            return self._commit()
+        result = Deferred()
+        self._pending_saves.append(result)
+        if self._scheduled_commit is None:
+            self._scheduled_commit = self._reactor.callLater(
+                self._batch_window, self._commit_batch)
+        return result
+
+    def _commit(self):
+        """
+        Write all changes made since the last commit and notify the change
+        callbacks.
+
+        :return Deferred: Fires when write is finished.
+        """
+        diff = DeploymentDiff.between(self._committed, self._deployment)
+        self._committed = self._deployment
+        self._journal_entries += 1
+        if self._journal_entries >= self._compaction_threshold:
+            self._journal_entries = 0
+            writing = self._write(self._sync_compact, self._committed)
+        else:
+            writing = self._write(
+                self._sync_append, wire_encode(diff, self._codec))
         # At some future point this will likely involve talking to a
         # distributed system (e.g. ZooKeeper or etcd), so the API doesn't
         # guarantee immediate saving of the data.
@@ -125,14 +592,94 @@ class ConfigurationPersistenceService(Service):
             # Handle errors by catching and logging them
             # https://clusterhq.atlassian.net/browse/FLOC-1311
             callback()
-        return succeed(None)
+        writing.addCallback(lambda _: None)
+        return writing
 
-    def get(self):
+    def _commit_batch(self):
         """
-        Retrieve current configuration.
+        Commit all saves made since the last batch, and fire their
+        ``Deferred``\ s once the write is finished.
+
+        :return Deferred: Fires when write is finished.
+        """
+        self._scheduled_commit = None
+        pending, self._pending_saves = self._pending_saves, []
+        self.batched_saves += len(pending)
+        writing = self._commit()
+
+        def written(result):
+            for d in pending:
+                if isinstance(result, Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+        writing.addBoth(written)
+        return writing
+
+    def get(self, version=None):
+        """
+        Retrieve current configuration, or a recent earlier one.
 
         It should not be mutated.
 
+        :param version: ``None`` for the current configuration, otherwise
+            the ``int`` version of a retained configuration.
+
+        :raise UnknownVersion: If the requested version is not retained.
+
         :return Deployment: The current desired configuration.
         """
-        return self._deployment
+        if version is None:
+            return self._deployment
+        index = len(self._history) - 1 - (self.version - version)
+        if not 0 <= index < len(self._history):
+            raise UnknownVersion(version)
+        return self._history[index]
+
+    def get_index(self):
+        """
+        Retrieve the current configuration together with indexes of its
+        contents.
+
+        If the current configuration was saved together with its index that
+        index is returned as is. Otherwise the index is kept from one call to
+        the next and only the nodes that changed in between are reindexed.
+
+        :return DeploymentIndex: Index of the current desired configuration.
+        """
+        if self._index.deployment is not self._deployment:
+            self._index = self._index.reindex(self._deployment)
+        return self._index
+
+    def diff(self, from_version, to_version=None):
+        """
+        Calculate the changes between two retained configurations.
+
+        Unchanged nodes are shared between versions, so they are recognised
+        by identity and only the remaining nodes are compared by value.
+
+        :param int from_version: The earlier version.
+        :param to_version: The later version, or ``None`` for the current
+            configuration.
+
+        :raise UnknownVersion: If either version is not retained.
+
+        :return DeploymentDiff: The changes that turn the configuration at
+            ``from_version`` into the one at ``to_version``.
+        """
+        return DeploymentDiff.between(
+            self.get(from_version), self.get(to_version))
+
+    def retained_nodes(self):
+        """
+        Count the ``Node`` instances kept alive by the configuration history.
+
+        Since versions share unchanged nodes this is usually far smaller
+        than the sum of the number of nodes in each version.
+
+        :return int: The number of distinct ``Node`` instances in all
+            retained versions.
+        """
+        return len({id(node)
+                    for deployment in self._history
+                    for node in deployment.nodes})
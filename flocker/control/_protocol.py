@@ -15,40 +15,74 @@ Interactions:
 * The control service knows the desired configuration for the cluster.
   Every time it changes it notifies the convergence agents using the
   ClusterStatusCommand.
+* Only the first ClusterStatusCommand sent on a connection contains the
+  full configuration and state; later updates are sent as
+  ClusterStatusDiffCommand, a generation-numbered patch against whatever
+  was last sent on that connection. If an agent notices a gap in the
+  generation numbers it rejects the patch and the control service falls
+  back to sending a full ClusterStatusCommand.
 * The convergence agents know the state of nodes. Whenever node state
-  changes they notify the control service with a NodeStateCommand.
+  changes they notify the control service with a NodeStateCommand. While it
+  stays the same they periodically send a NodeStateHeartbeatCommand with
+  the token the control service returned for the last NodeStateCommand,
+  so the control service knows the node is alive and the agent learns if
+  it needs to send its state again.
 * The control service caches the current state of all nodes. Whenever the
   control service receives an update to the state of a specific node via a
   NodeStateCommand, the control service then aggregates that update with
   the rest of the nodes' state and sends a ClusterStatusCommand to all
-  convergence agents.
+  convergence agents. Updates arriving within a short window of each other
+  are coalesced into a single broadcast, and a connection that has not yet
+  acknowledged the previous update only gets the latest status once it
+  does.
+
+Configuration objects are encoded using one of the codecs in
+``flocker.control._persistence.CODECS``. When an agent connects it sends
+the codecs it supports in a VersionCommand and the control service picks
+one for the connection; until then, and with agents that don't send any
+codecs, JSON is used. Encoded objects identify their codec so the
+receiving side can always decode them.
 
 Eliot contexts are transferred along with AMP commands, allowing tracing
 of logged actions across processes (see
 http://eliot.readthedocs.org/en/0.6.0/threads.html).
 """
 
-from eliot import Logger, ActionType, Action, Field
+from uuid import uuid4
 
-from characteristic import with_cmp
+from eliot import Logger, ActionType, Action, Field, write_failure
+
+from characteristic import with_cmp, attributes
 
 from zope.interface import Interface, Attribute
 
 from twisted.application.service import Service
 from twisted.protocols.amp import (
-    Argument, Command, Integer, CommandLocator, AMP, Unicode,
+    Argument, Command, Integer, CommandLocator, AMP, Unicode, ListOf, Boolean,
+    MAX_VALUE_LENGTH,
 )
 from twisted.internet.protocol import ServerFactory
 from twisted.application.internet import StreamServerEndpointService
 
-from ._persistence import wire_encode, wire_decode
-from ._model import Deployment, NodeState
+from ._persistence import (
+    wire_encode, wire_decode, CODECS, JSON_CODEC, InternPool,
+)
+from ._model import Deployment, DeploymentDiff, NodeState
+
+
+# Shared by all decoded arguments, so identical sub-records received
+# repeatedly, e.g. in every cluster status update, are only created once:
+_DECODE_POOL = InternPool()
 
 
 class SerializableArgument(Argument):
     """
     AMP argument that takes an object that can be serialized by the
     configuration persistence layer.
+
+    AMP limits values to ``MAX_VALUE_LENGTH`` bytes, so larger encoded
+    objects are split into chunks stored under the keys ``name``,
+    ``name.2``, ``name.3`` and so on.
     """
     def __init__(self, cls):
         """
@@ -58,15 +92,53 @@ class SerializableArgument(Argument):
         self._expected_class = cls
 
     def fromString(self, in_bytes):
-        obj = wire_decode(in_bytes)
+        obj = wire_decode(in_bytes, _DECODE_POOL)
         if not isinstance(obj, self._expected_class):
             raise TypeError("{} is not a {}".format(obj, self._expected_class))
         return obj
 
     def toString(self, obj):
+        return self.toStringProto(obj, None)
+
+    def toStringProto(self, obj, proto):
+        """
+        Encode using the codec negotiated for the connection, if any.
+
+        :param obj: The object to encode.
+        :param proto: The ``AMP`` instance sending the object.
+        """
         if not isinstance(obj, self._expected_class):
             raise TypeError("{} is not a {}".format(obj, self._expected_class))
-        return wire_encode(obj)
+        return wire_encode(obj, getattr(proto, "codec", JSON_CODEC))
+
+    def _chunk_keys(self, name):
+        """
+        :param bytes name: The name of the argument.
+
+        :return: Iterator of keys under which the chunks of the argument's
+            value are stored, in order.
+        """
+        yield name
+        index = 2
+        while True:
+            yield b"%s.%d" % (name, index)
+            index += 1
+
+    def toBox(self, name, strings, objects, proto):
+        data = self.toStringProto(self.retrieve(objects, name, proto), proto)
+        keys = self._chunk_keys(name)
+        strings[next(keys)] = data[:MAX_VALUE_LENGTH]
+        for offset in range(MAX_VALUE_LENGTH, len(data), MAX_VALUE_LENGTH):
+            strings[next(keys)] = data[offset:offset + MAX_VALUE_LENGTH]
+
+    def fromBox(self, name, strings, objects, proto):
+        keys = self._chunk_keys(name)
+        chunks = [strings.pop(next(keys))]
+        for key in keys:
+            if key not in strings:
+                break
+            chunks.append(strings.pop(key))
+        objects[name] = self.fromStringProto(b"".join(chunks), proto)
 
 
 class _EliotActionArgument(Unicode):
@@ -87,9 +159,20 @@ class VersionCommand(Command):
     Return configuration protocol version of the control service.
 
     Semantic versioning: Major version changes implies incompatibility.
+
+    The caller may also list the codecs it supports, in order of
+    preference; the response includes the one chosen for the connection.
+    """
+    arguments = [('codecs', ListOf(Unicode(), optional=True))]
+    response = [('major', Integer()),
+                ('codec', Unicode())]
+
+
+class GenerationGap(Exception):
+    """
+    A ``ClusterStatusDiffCommand`` could not be applied because the agent
+    did not receive the update immediately preceding it.
     """
-    arguments = []
-    response = [('major', Integer())]
 
 
 class ClusterStatusCommand(Command):
@@ -99,61 +182,128 @@ class ClusterStatusCommand(Command):
 
     Having both as a single command simplifies the decision making process
     in the convergence agent during startup.
+
+    The ``generation`` identifies this update; subsequent
+    ``ClusterStatusDiffCommand``\ s are relative to it.
     """
     arguments = [('configuration', SerializableArgument(Deployment)),
                  ('state', SerializableArgument(Deployment)),
+                 ('generation', Integer()),
                  ('eliot_context', _EliotActionArgument())]
     response = []
 
 
+class ClusterStatusDiffCommand(Command):
+    """
+    Used by the control service to inform a convergence agent of changes
+    to the cluster state and desired configuration since the update with
+    generation ``generation - 1``.
+    """
+    arguments = [('configuration', SerializableArgument(DeploymentDiff)),
+                 ('state', SerializableArgument(DeploymentDiff)),
+                 ('generation', Integer()),
+                 ('eliot_context', _EliotActionArgument())]
+    response = []
+    errors = {GenerationGap: b"GENERATION_GAP"}
+
+
 class NodeStateCommand(Command):
     """
     Used by a convergence agent to update the control service about the
     status of a particular node.
+
+    The response includes a token identifying the state as stored by the
+    control service, for use with ``NodeStateHeartbeatCommand``.
     """
     arguments = [('node_state', SerializableArgument(NodeState)),
                  ('eliot_context', _EliotActionArgument())]
-    response = []
+    response = [('state_token', Unicode(optional=True))]
+
+
+class NodeStateHeartbeatCommand(Command):
+    """
+    Used by a convergence agent whose state hasn't changed since it was last
+    sent, instead of sending the whole state again.
+
+    The response says whether the control service still has the state
+    identified by the token; if not, the agent needs to send it again.
+    """
+    arguments = [('hostname', Unicode()),
+                 ('state_token', Unicode())]
+    response = [('current', Boolean())]
+
+
+def _choose_codec(names):
+    """
+    Choose the codec to use for a connection.
+
+    :param names: ``list`` of ``unicode`` names of codecs supported by the
+        peer in order of preference, or ``None`` if it didn't say.
+
+    :return: The first codec in ``names`` that is also supported locally,
+        falling back to JSON.
+    """
+    supported = {codec.name: codec for codec in CODECS}
+    for name in names or []:
+        if name in supported:
+            return supported[name]
+    return JSON_CODEC
 
 
 class ControlServiceLocator(CommandLocator):
     """
     Control service side of the protocol.
     """
-    def __init__(self, control_amp_service):
+    def __init__(self, control_amp_service, connection=None):
         """
         :param ControlAMPService control_amp_service: The service managing AMP
              connections to the control service.
+        :param ControlAMP connection: The connection this locator handles
+             commands for, if any; the negotiated codec is set on it.
         """
         CommandLocator.__init__(self)
         self.control_amp_service = control_amp_service
+        self.connection = connection
 
     @property
     def logger(self):
         return self.control_amp_service.logger
 
     @VersionCommand.responder
-    def version(self):
-        return {"major": 1}
+    def version(self, codecs=None):
+        codec = _choose_codec(codecs)
+        if self.connection is not None:
+            self.connection.codec = codec
+        return {"major": 2, "codec": codec.name}
 
     @NodeStateCommand.responder
     def node_changed(self, eliot_context, node_state):
         with eliot_context:
-            self.control_amp_service.node_changed(node_state)
-            return {}
+            token = self.control_amp_service.node_changed(node_state)
+            return {"state_token": token}
+
+    @NodeStateHeartbeatCommand.responder
+    def heartbeat(self, hostname, state_token):
+        return {"current": self.control_amp_service.heartbeat(
+            hostname, state_token)}
 
 
 class ControlAMP(AMP):
     """
     AMP protocol for control service server.
+
+    :ivar codec: The codec used to encode configuration objects sent on
+        this connection.
     """
     def __init__(self, control_amp_service):
         """
         :param ControlAMPService control_amp_service: The service managing AMP
              connections to the control service.
         """
-        AMP.__init__(self, locator=ControlServiceLocator(control_amp_service))
+        AMP.__init__(self, locator=ControlServiceLocator(control_amp_service,
+                                                         self))
         self.control_amp_service = control_amp_service
+        self.codec = JSON_CODEC
 
     def connectionMade(self):
         AMP.connectionMade(self)
@@ -184,23 +334,68 @@ LOG_SEND_TO_AGENT = ActionType(
     "Send the configuration and state of the cluster to a specific agent.")
 
 
+@attributes(["generation", "snapshot_generation", "configuration", "state"])
+class _SentStatus(object):
+    """
+    The cluster status most recently sent over a particular connection.
+
+    :ivar int generation: The generation of the latest update.
+    :ivar int snapshot_generation: The generation of the latest full
+        snapshot.
+    :ivar Deployment configuration: The desired configuration sent.
+    :ivar Deployment state: The cluster state sent.
+    """
+
+
+# Default number of seconds to wait for further node state updates before
+# broadcasting cluster status:
+BROADCAST_DELAY = 0.1
+
+
 class ControlAMPService(Service):
     """
     Control Service AMP server.
 
     Convergence agents connect to this server.
+
+    :ivar int coalesced_broadcasts: The number of node state updates that
+        were merged into an already scheduled broadcast.
+    :ivar int superseded_sends: The number of sends to a connection that
+        were skipped because the connection had not yet acknowledged a
+        previous update.
+    :ivar dict last_seen: Map hostnames to the time, according to the
+        reactor, of the most recent state update or heartbeat from that
+        node.
     """
     logger = Logger()
 
-    def __init__(self, cluster_state, configuration_service, endpoint):
+    def __init__(self, reactor, cluster_state, configuration_service,
+                 endpoint, broadcast_delay=BROADCAST_DELAY):
         """
+        :param IReactorTime reactor: Used to schedule broadcasts.
         :param ClusterStateService cluster_state: Object that records known
             cluster state.
         :param ConfigurationPersistenceService configuration_service:
             Persistence service for desired cluster configuration.
         :param endpoint: Endpoint to listen on.
+        :param float broadcast_delay: Number of seconds node state updates
+            are collected for before being broadcast to all connections.
         """
+        self._reactor = reactor
+        self._broadcast_delay = broadcast_delay
+        self._scheduled_broadcast = None
+        self.coalesced_broadcasts = 0
+        self.superseded_sends = 0
         self.connections = set()
+        self._sent_status = {}
+        self._unacknowledged = {}
+        self._superseded = set()
+        # Tokens identifying the stored state of each node; the prefix
+        # ensures tokens handed out by a previous run of the control
+        # service are never mistaken for current ones:
+        self._token_prefix = uuid4().hex
+        self._state_tokens = {}
+        self.last_seen = {}
         self.cluster_state = cluster_state
         self.configuration_service = configuration_service
         self.endpoint_service = StreamServerEndpointService(
@@ -214,6 +409,9 @@ class ControlAMPService(Service):
 
     def stopService(self):
         self.endpoint_service.stopService()
+        if self._scheduled_broadcast is not None:
+            self._scheduled_broadcast.cancel()
+            self._scheduled_broadcast = None
         for connection in self.connections:
             connection.transport.loseConnection()
 
@@ -221,25 +419,128 @@ class ControlAMPService(Service):
         """
         Send desired configuration and cluster state to all given connections.
 
+        Connections that have not yet acknowledged the previous update are
+        skipped; they will be sent the latest status once they do.
+
         :param connections: A collection of ``AMP`` instances.
         """
+        if connections is self.connections and (
+                self._scheduled_broadcast is not None):
+            # This broadcast supersedes the scheduled one:
+            self._scheduled_broadcast.cancel()
+            self._scheduled_broadcast = None
         configuration = self.configuration_service.get()
         state = self.cluster_state.as_deployment()
         with LOG_SEND_CLUSTER_STATE(self.logger,
                                     configuration=configuration,
                                     state=state):
             for connection in connections:
+                if connection in self._unacknowledged:
+                    self._superseded.add(connection)
+                    self.superseded_sends += 1
+                    continue
                 with LOG_SEND_TO_AGENT(
                         self.logger, agent=connection) as action:
-                    connection.callRemote(
-                        ClusterStatusCommand,
-                        configuration=configuration,
-                        state=state,
-                        eliot_context=action
-                    )
+                    self._send_state(
+                        connection, configuration, state, action)
                 # Handle errors from callRemote by logging them
                 # https://clusterhq.atlassian.net/browse/FLOC-1311
 
+    def _send_state(self, connection, configuration, state, eliot_context,
+                    snapshot=False):
+        """
+        Send desired configuration and cluster state to a single connection.
+
+        The first update on a connection is a full snapshot, later ones are
+        ``DeploymentDiff``\ s against what was previously sent.
+
+        :param ControlAMP connection: The connection to send to.
+        :param Deployment configuration: The desired configuration.
+        :param Deployment state: The cluster state.
+        :param eliot_context: The Eliot action to continue remotely.
+        :param bool snapshot: If true, send a full snapshot even if a diff
+            could be sent instead.
+
+        :return Deferred: Fires with the result of the remote call.
+        """
+        previous = self._sent_status.get(connection)
+        if previous is None:
+            generation = 0
+        else:
+            generation = previous.generation + 1
+
+        if previous is None or snapshot:
+            self._sent_status[connection] = _SentStatus(
+                generation=generation, snapshot_generation=generation,
+                configuration=configuration, state=state)
+            d = connection.callRemote(
+                ClusterStatusCommand,
+                configuration=configuration,
+                state=state,
+                generation=generation,
+                eliot_context=eliot_context
+            )
+        else:
+            self._sent_status[connection] = _SentStatus(
+                generation=generation,
+                snapshot_generation=previous.snapshot_generation,
+                configuration=configuration, state=state)
+            d = connection.callRemote(
+                ClusterStatusDiffCommand,
+                configuration=DeploymentDiff.between(
+                    previous.configuration, configuration),
+                state=DeploymentDiff.between(previous.state, state),
+                generation=generation,
+                eliot_context=eliot_context
+            )
+            d.addErrback(self._diff_rejected, connection, generation)
+        self._unacknowledged[connection] = generation
+        d.addBoth(self._acknowledged, connection, generation)
+        return d
+
+    def _acknowledged(self, result, connection, generation):
+        """
+        A connection has responded to an update; if later updates were
+        skipped while waiting for it, send the latest status now.
+
+        :param result: The result of the remote call, passed through.
+        :param ControlAMP connection: The connection that responded.
+        :param int generation: The generation of the update it responded to.
+        """
+        if self._unacknowledged.get(connection) == generation:
+            del self._unacknowledged[connection]
+            if connection in self._superseded:
+                self._superseded.remove(connection)
+                self._send_state_to_connections([connection])
+        return result
+
+    def _broadcast(self):
+        """
+        Send the scheduled broadcast to all connections.
+        """
+        self._scheduled_broadcast = None
+        self._send_state_to_connections(self.connections)
+
+    def _diff_rejected(self, failure, connection, generation):
+        """
+        Fall back to a full snapshot if a connection rejected a diff.
+
+        :param Failure failure: The reason the diff was rejected.
+        :param ControlAMP connection: The connection the diff was sent to.
+        :param int generation: The generation of the rejected diff.
+        """
+        failure.trap(GenerationGap)
+        sent = self._sent_status.get(connection)
+        # Diffs sent before the latest snapshot will be rejected too, but
+        # the snapshot already makes up for them:
+        if sent is None or sent.snapshot_generation > generation:
+            return
+        self._superseded.discard(connection)
+        with LOG_SEND_TO_AGENT(self.logger, agent=connection) as action:
+            self._send_state(connection, self.configuration_service.get(),
+                             self.cluster_state.as_deployment(), action,
+                             snapshot=True)
+
     def connected(self, connection):
         """
         A new connection has been made to the server.
@@ -256,16 +557,50 @@ class ControlAMPService(Service):
         :param ControlAMP connection: The lost connection.
         """
         self.connections.remove(connection)
+        self._sent_status.pop(connection, None)
+        self._unacknowledged.pop(connection, None)
+        self._superseded.discard(connection)
 
     def node_changed(self, node_state):
         """
         We've received a node state update from a connected client.
 
-        :param bytes hostname: The hostname of the node.
+        The new state is broadcast to all connections after a short delay,
+        so that updates arriving from multiple nodes in quick succession
+        result in a single broadcast. Nothing is broadcast if the node's
+        state has not actually changed.
+
         :param NodeState node_state: The changed state for the node.
+
+        :return unicode: Token identifying the stored state of the node.
         """
-        self.cluster_state.update_node_state(node_state)
-        self._send_state_to_connections(self.connections)
+        hostname = node_state.hostname
+        self.last_seen[hostname] = self._reactor.seconds()
+        if not self.cluster_state.update_node_state(node_state):
+            if hostname in self._state_tokens:
+                return self._state_tokens[hostname]
+        elif self._scheduled_broadcast is None:
+            self._scheduled_broadcast = self._reactor.callLater(
+                self._broadcast_delay, self._broadcast)
+        else:
+            self.coalesced_broadcasts += 1
+        token = u"%s-%d" % (self._token_prefix, self.cluster_state.generation)
+        self._state_tokens[hostname] = token
+        return token
+
+    def heartbeat(self, hostname, state_token):
+        """
+        We've received a heartbeat from a node whose state hasn't changed.
+
+        :param unicode hostname: The node's hostname.
+        :param unicode state_token: The token returned when the node last
+            sent its state.
+
+        :return bool: Whether the node's state as identified by the token is
+            still the current known state of the node.
+        """
+        self.last_seen[hostname] = self._reactor.seconds()
+        return self._state_tokens.get(hostname) == state_token
 
 
 class IConvergenceAgent(Interface):
@@ -311,6 +646,9 @@ class _AgentLocator(CommandLocator):
         """
         CommandLocator.__init__(self)
         self.agent = agent
+        self._generation = None
+        self._configuration = None
+        self._state = None
 
     @property
     def logger(self):
@@ -319,10 +657,35 @@ class _AgentLocator(CommandLocator):
         """
         return self.agent.logger
 
+    def _update(self, generation, configuration, state):
+        """
+        Record the latest cluster status and notify the agent.
+        """
+        self._generation = generation
+        self._configuration = configuration
+        self._state = state
+        self.agent.cluster_updated(configuration, state)
+
     @ClusterStatusCommand.responder
-    def cluster_updated(self, eliot_context, configuration, state):
+    def cluster_updated(self, eliot_context, configuration, state,
+                        generation):
+        with eliot_context:
+            self._update(generation, configuration, state)
+            return {}
+
+    @ClusterStatusDiffCommand.responder
+    def cluster_changed(self, eliot_context, configuration, state,
+                        generation):
         with eliot_context:
-            self.agent.cluster_updated(configuration, state)
+            if (self._generation is None or
+                    generation != self._generation + 1):
+                raise GenerationGap(
+                    "Expected generation {} but got {}".format(
+                        None if self._generation is None
+                        else self._generation + 1, generation))
+            self._update(generation,
+                         configuration.apply(self._configuration),
+                         state.apply(self._state))
             return {}
 
 
@@ -331,6 +694,9 @@ class AgentAMP(AMP):
     AMP protocol for convergence agent side of the protocol.
 
     This is the client protocol that will connect to the control service.
+
+    :ivar codec: The codec used to encode configuration objects sent on
+        this connection.
     """
     def __init__(self, agent):
         """
@@ -339,11 +705,25 @@ class AgentAMP(AMP):
         locator = _AgentLocator(agent)
         AMP.__init__(self, locator=locator)
         self.agent = agent
+        self.codec = JSON_CODEC
 
     def connectionMade(self):
         AMP.connectionMade(self)
+        d = self.callRemote(VersionCommand,
+                            codecs=[codec.name for codec in CODECS])
+        d.addCallback(self._version_received)
+        d.addErrback(write_failure, self.agent.logger,
+                     u"flocker:agent:version")
         self.agent.connected(self)
 
+    def _version_received(self, response):
+        """
+        Start using the codec chosen by the control service.
+
+        :param dict response: The response to ``VersionCommand``.
+        """
+        self.codec = _choose_codec([response["codec"]])
+
     def connectionLost(self, reason):
         AMP.connectionLost(self, reason)
         self.agent.disconnected()
@@ -83,17 +83,17 @@ class ConfigurationAPIUserV1(object):
         self.persistence_service = persistence_service
         self.cluster_state_service = cluster_state_service
 
-    def _find_node_by_host(self, host, deployment):
+    def _find_node_by_host(self, host, deployment_index):
         """
         Find a Node matching the specified host, or create a new one if it does
         not already exist.
         :param node: A ``unicode`` representing a host / IP address.
-        :param deployment: A ``Deployment`` instance.
+        :param deployment_index: A ``DeploymentIndex`` instance.
         :return: A ``Node`` instance.
         """
-        for node in deployment.nodes:
-            if host == node.hostname:
-                return node
+        node = deployment_index.nodes.get(host)
+        if node is not None:
+            return node
 
         # The node wasn't found in the configuration so create a new node.
         # FLOC-1278 will make sure we're not creating nonsense
@@ -196,11 +196,9 @@ class ConfigurationAPIUserV1(object):
 
         # Use persistence_service to get a Deployment for the cluster
         # configuration.
-        deployment = self.persistence_service.get()
-        for node in deployment.nodes:
-            for manifestation in node.manifestations.values():
-                if manifestation.dataset.dataset_id == dataset_id:
-                    raise DATASET_ID_COLLISION
+        deployment_index = self.persistence_service.get_index()
+        if dataset_id in deployment_index.datasets:
+            raise DATASET_ID_COLLISION
 
         # XXX Check cluster state to determine if the given primary node
         # actually exists.  If not, raise PRIMARY_NODE_NOT_FOUND.
@@ -213,12 +211,13 @@ class ConfigurationAPIUserV1(object):
         )
         manifestation = Manifestation(dataset=dataset, primary=True)
 
-        primary_node = self._find_node_by_host(primary, deployment)
+        primary_node = self._find_node_by_host(primary, deployment_index)
 
         new_node_config = primary_node.transform(
             ("manifestations", manifestation.dataset_id), manifestation)
-        new_deployment = deployment.update_node(new_node_config)
-        saving = self.persistence_service.save(new_deployment)
+        new_index = deployment_index.update_node(new_node_config)
+        saving = self.persistence_service.save(
+            new_index.deployment, new_index)
 
         def saved(ignored):
             result = api_dataset_from_dataset_and_node(dataset, primary)
@@ -238,10 +237,10 @@ class ConfigurationAPIUserV1(object):
             ``Node`` it is on.
         """
         # Get the current configuration.
-        deployment = self.persistence_service.get()
+        deployment_index = self.persistence_service.get_index()
 
         manifestations_and_nodes = manifestations_from_deployment(
-            deployment, dataset_id)
+            deployment_index, dataset_id)
         index = 0
         for index, (manifestation, node) in enumerate(
                 manifestations_and_nodes):
@@ -293,7 +292,7 @@ class ConfigurationAPIUserV1(object):
             information if this is not possible.
         """
         # Get the current configuration.
-        deployment = self.persistence_service.get()
+        deployment_index = self.persistence_service.get_index()
 
         # XXX this doesn't handle replicas
         # https://clusterhq.atlassian.net/browse/FLOC-1240
@@ -302,9 +301,10 @@ class ConfigurationAPIUserV1(object):
 
         new_node = origin_node.transform(
             ("manifestations", dataset_id, "dataset", "deleted"), True)
-        deployment = deployment.update_node(new_node)
+        deployment_index = deployment_index.update_node(new_node)
 
-        saving = self.persistence_service.save(deployment)
+        saving = self.persistence_service.save(
+            deployment_index.deployment, deployment_index)
 
         def saved(ignored):
             result = api_dataset_from_dataset_and_node(
@@ -353,7 +353,7 @@ class ConfigurationAPIUserV1(object):
             possible.
         """
         # Get the current configuration.
-        deployment = self.persistence_service.get()
+        deployment_index = self.persistence_service.get_index()
 
         primary_manifestation, origin_node = self._find_manifestation_and_node(
             dataset_id)
@@ -365,12 +365,10 @@ class ConfigurationAPIUserV1(object):
         # dataset is on the requested primary node.
         new_origin_node = origin_node.transform(
             ("manifestations", dataset_id), discard)
-        deployment = deployment.update_node(new_origin_node)
+        deployment_index = deployment_index.update_node(new_origin_node)
 
-        primary_nodes = list(
-            node for node in deployment.nodes if primary == node.hostname
-        )
-        if len(primary_nodes) == 0:
+        target_node = deployment_index.nodes.get(primary)
+        if target_node is None:
             # `primary` is not in cluster. Add it.
             # XXX Check cluster state to determine if the given primary node
             # actually exists.  If not, raise PRIMARY_NODE_NOT_FOUND.
@@ -380,15 +378,13 @@ class ConfigurationAPIUserV1(object):
                 manifestations={dataset_id: primary_manifestation},
             )
         else:
-            # There should only be one node with the requested primary
-            # hostname. ``ValueError`` here if that's not the case.
-            (target_node,) = primary_nodes
             new_target_node = target_node.transform(
                 ("manifestations", dataset_id), primary_manifestation)
 
-        deployment = deployment.update_node(new_target_node)
+        deployment_index = deployment_index.update_node(new_target_node)
 
-        saving = self.persistence_service.save(deployment)
+        saving = self.persistence_service.save(
+            deployment_index.deployment, deployment_index)
 
         # Return an API response dictionary containing the dataset with updated
         # primary address.
@@ -490,29 +486,24 @@ class ConfigurationAPIUserV1(object):
         :return: An ``EndpointResponse`` describing the container which has
             been added to the cluster configuration.
         """
-        deployment = self.persistence_service.get()
+        deployment_index = self.persistence_service.get_index()
 
         # Check if container by this name already exists, if it does
         # return error.
 
-        for node in deployment.nodes:
-            for application in node.applications:
-                if application.name == name:
-                    raise CONTAINER_NAME_COLLISION
+        if name in deployment_index.applications:
+            raise CONTAINER_NAME_COLLISION
 
         # Find the node.
-        node = self._find_node_by_host(host, deployment)
+        node = self._find_node_by_host(host, deployment_index)
 
         # Check if we have any ports in the request. If we do, check existing
         # external ports exposed to ensure there is no conflict. If there is a
         # conflict, return an error.
 
         for port in ports:
-            for current_node in deployment.nodes:
-                for application in current_node.applications:
-                    for application_port in application.ports:
-                        if application_port.external_port == port['external']:
-                            raise CONTAINER_PORT_COLLISION
+            if port['external'] in deployment_index.external_ports:
+                raise CONTAINER_PORT_COLLISION
 
         # If we have ports specified, add these to the Application instance.
         application_ports = []
@@ -547,8 +538,9 @@ class ConfigurationAPIUserV1(object):
             lambda s: s.add(application)
         )
 
-        new_deployment = deployment.update_node(new_node_config)
-        saving = self.persistence_service.save(new_deployment)
+        new_index = deployment_index.update_node(new_node_config)
+        saving = self.persistence_service.save(
+            new_index.deployment, new_index)
 
         # Return passed in dictionary with CREATED response code.
         def saved(_):
@@ -584,37 +576,38 @@ class ConfigurationAPIUserV1(object):
 
         :return: An ``EndpointResponse``.
         """
-        deployment = self.persistence_service.get()
-
-        for node in deployment.nodes:
-            for application in node.applications:
-                if application.name == name:
-                    updated_node = node.transform(
-                        ["applications"], lambda s: s.remove(application))
-                    d = self.persistence_service.save(
-                        deployment.update_node(updated_node))
-                    d.addCallback(lambda _: None)
-                    return d
-
-        # Didn't find the application:
-        raise CONTAINER_NOT_FOUND
-
-
-def manifestations_from_deployment(deployment, dataset_id):
+        deployment_index = self.persistence_service.get_index()
+
+        hostnames = deployment_index.applications.get(name)
+        if not hostnames:
+            # Didn't find the application:
+            raise CONTAINER_NOT_FOUND
+
+        node = deployment_index.nodes[next(iter(hostnames))]
+        for application in node.applications:
+            if application.name == name:
+                updated_node = node.transform(
+                    ["applications"], lambda s: s.remove(application))
+                new_index = deployment_index.update_node(updated_node)
+                d = self.persistence_service.save(
+                    new_index.deployment, new_index)
+                d.addCallback(lambda _: None)
+                return d
+
+
+def manifestations_from_deployment(deployment_index, dataset_id):
     """
     Extract all other manifestations of the supplied dataset_id from the
     supplied deployment.
 
-    :param Deployment deployment: A ``Deployment`` describing the state
-        of the cluster.
+    :param DeploymentIndex deployment_index: Index of a ``Deployment``
+        describing the state of the cluster.
     :param unicode dataset_id: The uuid of the ``Dataset`` for the
         ``Manifestation`` s that are to be returned.
     :return: Iterable returning all manifestations of the supplied
         ``dataset_id``.
     """
-    for node in deployment.nodes:
-        if dataset_id in node.manifestations:
-                yield node.manifestations[dataset_id], node
+    return deployment_index.manifestations(dataset_id)
 
 
 def datasets_from_deployment(deployment):
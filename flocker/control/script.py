@@ -40,14 +40,14 @@ class ControlScript(object):
     def main(self, reactor, options):
         top_service = MultiService()
         persistence = ConfigurationPersistenceService(
-            reactor, options["data-path"])
+            reactor, options["data-path"], batch_window=0)
         persistence.setServiceParent(top_service)
         cluster_state = ClusterStateService()
         cluster_state.setServiceParent(top_service)
         create_api_service(persistence, cluster_state, TCP4ServerEndpoint(
             reactor, options["port"])).setServiceParent(top_service)
         amp_service = ControlAMPService(
-            cluster_state, persistence, TCP4ServerEndpoint(
+            reactor, cluster_state, persistence, TCP4ServerEndpoint(
                 reactor, options["agent-port"]))
         amp_service.setServiceParent(top_service)
         return main_for_service(reactor, top_service)
@@ -112,3 +112,80 @@ class ClusterStateServiceTests(SynchronousTestCase):
         self.assertEqual(
             service.manifestation_path(u"host1", MANIFESTATION.dataset_id),
             FilePath(b"/xxx/yyy"))
+
+    def test_update_returns_changed(self):
+        """
+        ``ClusterStateService.update_node_state`` returns ``True`` when the
+        given state differs from the previously known state of that node.
+        """
+        service = self.service()
+        results = [
+            service.update_node_state(NodeState(hostname=u"host1",
+                                                running=[APP1])),
+            service.update_node_state(NodeState(hostname=u"host1",
+                                                running=[APP2])),
+            service.update_node_state(NodeState(hostname=u"host2",
+                                                running=[APP2])),
+        ]
+        self.assertEqual(results, [True, True, True])
+
+    def test_update_unchanged(self):
+        """
+        ``ClusterStateService.update_node_state`` returns ``False`` when the
+        given state is equal to the previously known state of that node.
+        """
+        service = self.service()
+        service.update_node_state(NodeState(hostname=u"host1",
+                                            running=[APP1]))
+        self.assertFalse(
+            service.update_node_state(NodeState(hostname=u"host1",
+                                                running=[APP1])))
+
+    def test_generation(self):
+        """
+        ``ClusterStateService.generation`` is incremented only by updates
+        that change the cluster state.
+        """
+        service = self.service()
+        initial = service.generation
+        service.update_node_state(NodeState(hostname=u"host1",
+                                            running=[APP1]))
+        service.update_node_state(NodeState(hostname=u"host1",
+                                            running=[APP1]))
+        service.update_node_state(NodeState(hostname=u"host2",
+                                            running=[APP1]))
+        self.assertEqual((initial, service.generation), (0, 2))
+
+    def test_as_deployment_cached(self):
+        """
+        ``ClusterStateService.as_deployment`` returns the same object if the
+        cluster state has not changed in between calls.
+        """
+        service = self.service()
+        service.update_node_state(NodeState(hostname=u"host1",
+                                            running=[APP1]))
+        first = service.as_deployment()
+        service.update_node_state(NodeState(hostname=u"host1",
+                                            running=[APP1]))
+        self.assertIs(first, service.as_deployment())
+
+    def test_only_changed_node_converted(self):
+        """
+        Only the ``NodeState`` that was updated is converted to a ``Node``
+        when the cluster state changes.
+        """
+        service = self.service()
+        service.update_node_state(NodeState(hostname=u"host1",
+                                            running=[APP1]))
+        converted = []
+        original_to_node = NodeState.to_node
+
+        def to_node(node_state):
+            converted.append(node_state.hostname)
+            return original_to_node(node_state)
+        self.patch(NodeState, "to_node", to_node)
+        service.update_node_state(NodeState(hostname=u"host2",
+                                            running=[APP2]))
+        service.as_deployment()
+        service.as_deployment()
+        self.assertEqual(converted, [u"host2"])
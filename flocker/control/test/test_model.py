@@ -15,7 +15,7 @@ from ...testtools import make_with_init_tests
 from .._model import (
     Application, DockerImage, Node, Deployment, AttachedVolume, Dataset,
     RestartOnFailure, RestartAlways, RestartNever, Manifestation,
-    NodeState, pset_field,
+    NodeState, DeploymentDiff, DeploymentIndex, Port, pset_field,
 )
 
 
@@ -318,6 +318,216 @@ class DeploymentTests(SynchronousTestCase):
                               updated_node, another_node]))))
 
 
+class DeploymentDiffTests(SynchronousTestCase):
+    """
+    Tests for ``DeploymentDiff``.
+    """
+    NODE1 = Node(hostname=u"node1.example.com",
+                 applications=frozenset([APP1]))
+    NODE2 = Node(hostname=u"node2.example.com",
+                 applications=frozenset([APP2]))
+    NODE3 = Node(hostname=u"node3.example.com")
+
+    def assertRoundtrip(self, original, updated):
+        """
+        Assert that the diff between two deployments turns the first into
+        the second.
+
+        :param Deployment original: Starting deployment.
+        :param Deployment updated: Desired deployment.
+        """
+        diff = DeploymentDiff.between(original, updated)
+        self.assertEqual(diff.apply(original), updated)
+
+    def test_unchanged(self):
+        """
+        The difference between equal deployments is empty.
+        """
+        deployment = Deployment(nodes=frozenset([self.NODE1, self.NODE2]))
+        self.assertEqual(
+            DeploymentDiff.between(
+                deployment, Deployment(nodes=frozenset([self.NODE1,
+                                                        self.NODE2]))),
+            DeploymentDiff())
+
+    def test_apply_empty(self):
+        """
+        Applying an empty ``DeploymentDiff`` returns the same ``Deployment``.
+        """
+        deployment = Deployment(nodes=frozenset([self.NODE1]))
+        self.assertIs(DeploymentDiff().apply(deployment), deployment)
+
+    def test_only_changed_nodes(self):
+        """
+        Only nodes which were added or changed are included in the
+        difference.
+        """
+        changed = self.NODE1.set("applications", frozenset([APP2]))
+        diff = DeploymentDiff.between(
+            Deployment(nodes=frozenset([self.NODE1, self.NODE2])),
+            Deployment(nodes=frozenset([changed, self.NODE2, self.NODE3])))
+        self.assertEqual(
+            diff, DeploymentDiff(changed_nodes=frozenset([changed,
+                                                          self.NODE3])))
+
+    def test_shared_nodes_not_compared(self):
+        """
+        Nodes shared by both deployments are recognised by identity rather
+        than being compared by value.
+        """
+        compared = []
+
+        class RecordingNode(Node):
+            def __eq__(self, other):
+                compared.append(self)
+                return Node.__eq__(self, other)
+
+            def __ne__(self, other):
+                return not self == other
+
+            __hash__ = Node.__hash__
+
+        shared = RecordingNode(hostname=u"node4.example.com")
+        changed = self.NODE1.set("applications", frozenset([APP2]))
+        DeploymentDiff.between(
+            Deployment(nodes=frozenset([self.NODE1, shared])),
+            Deployment(nodes=frozenset([changed, shared])))
+        self.assertEqual([], [node for node in compared if node is shared])
+
+    def test_added_node(self):
+        """
+        A new node is added when the difference is applied.
+        """
+        self.assertRoundtrip(
+            Deployment(nodes=frozenset([self.NODE1])),
+            Deployment(nodes=frozenset([self.NODE1, self.NODE2])))
+
+    def test_changed_node(self):
+        """
+        A changed node replaces the node with the same hostname when the
+        difference is applied.
+        """
+        self.assertRoundtrip(
+            Deployment(nodes=frozenset([self.NODE1, self.NODE2])),
+            Deployment(nodes=frozenset([
+                self.NODE1.set("applications", frozenset([APP2])),
+                self.NODE2])))
+
+    def test_removed_node(self):
+        """
+        A node that is no longer present is removed when the difference is
+        applied.
+        """
+        self.assertRoundtrip(
+            Deployment(nodes=frozenset([self.NODE1, self.NODE2])),
+            Deployment(nodes=frozenset([self.NODE2])))
+
+
+class DeploymentIndexTests(SynchronousTestCase):
+    """
+    Tests for ``DeploymentIndex``.
+    """
+    def setUp(self):
+        self.app = APP1.set("ports", [Port(internal_port=80,
+                                           external_port=8080)])
+        self.node = Node(hostname=u"node1", applications=[self.app],
+                         manifestations={MANIFESTATION.dataset_id:
+                                         MANIFESTATION})
+        self.other_node = Node(hostname=u"node2", applications=[APP2])
+        self.deployment = Deployment(nodes=[self.node, self.other_node])
+        self.index = DeploymentIndex.from_deployment(self.deployment)
+
+    def test_nodes(self):
+        """
+        Nodes are indexed by hostname.
+        """
+        self.assertEqual(self.index.nodes, {u"node1": self.node,
+                                            u"node2": self.other_node})
+
+    def test_applications(self):
+        """
+        Applications are indexed by name.
+        """
+        self.assertEqual(self.index.applications,
+                         {APP1.name: pset([u"node1"]),
+                          APP2.name: pset([u"node2"])})
+
+    def test_datasets(self):
+        """
+        Datasets are indexed by ID.
+        """
+        self.assertEqual(self.index.datasets,
+                         {MANIFESTATION.dataset_id: pset([u"node1"])})
+
+    def test_external_ports(self):
+        """
+        External ports are indexed by port number.
+        """
+        self.assertEqual(self.index.external_ports, {8080: pset([u"node1"])})
+
+    def test_update_node_keeps_shared_entries(self):
+        """
+        Updating a node keeps the entries for applications and external
+        ports that another node also has.
+        """
+        other_node = self.other_node.set("applications", [self.app])
+        index = DeploymentIndex.from_deployment(
+            Deployment(nodes=[self.node, other_node]))
+        updated = index.update_node(self.node.set("applications", []))
+        self.assertEqual(
+            (updated.applications[self.app.name],
+             updated.external_ports[8080]),
+            (pset([u"node2"]), pset([u"node2"])))
+
+    def test_manifestations(self):
+        """
+        ``DeploymentIndex.manifestations`` returns the manifestations of a
+        dataset with the node they are on.
+        """
+        self.assertEqual(
+            list(self.index.manifestations(MANIFESTATION.dataset_id)),
+            [(MANIFESTATION, self.node)])
+
+    def test_update_node(self):
+        """
+        ``DeploymentIndex.update_node`` returns an index of the deployment
+        updated with ``Deployment.update_node``.
+        """
+        updated = Node(hostname=u"node1", applications=[APP2.set(
+            "name", u"other")])
+        self.assertEqual(
+            self.index.update_node(updated),
+            DeploymentIndex.from_deployment(
+                self.deployment.update_node(updated)))
+
+    def test_update_node_new(self):
+        """
+        ``DeploymentIndex.update_node`` with a node whose hostname is not in
+        the deployment adds it.
+        """
+        new = Node(hostname=u"node3")
+        self.assertEqual(
+            self.index.update_node(new),
+            DeploymentIndex.from_deployment(
+                self.deployment.update_node(new)))
+
+    def test_reindex(self):
+        """
+        ``DeploymentIndex.reindex`` returns an index of the given deployment.
+        """
+        deployment = Deployment(nodes=[
+            self.node.set("applications", []), Node(hostname=u"node3")])
+        self.assertEqual(self.index.reindex(deployment),
+                         DeploymentIndex.from_deployment(deployment))
+
+    def test_reindex_same(self):
+        """
+        ``DeploymentIndex.reindex`` with the indexed deployment returns the
+        same index.
+        """
+        self.assertIs(self.index.reindex(self.deployment), self.index)
+
+
 class RestartOnFailureTests(SynchronousTestCase):
     """
     Tests for ``RestartOnFailure``.
@@ -6,17 +6,20 @@ Tests for ``flocker.control._persistence``.
 
 from uuid import uuid4
 from twisted.internet import reactor
+from twisted.internet.defer import gatherResults
 from twisted.trial.unittest import TestCase, SynchronousTestCase
 from twisted.python.filepath import FilePath
 
-from pyrsistent import PRecord
+from pyrsistent import PRecord, field
 
 from .._persistence import (
     ConfigurationPersistenceService, wire_decode, wire_encode,
+    JSON_CODEC, COMPACT_CODEC, InternPool, UnknownVersion, _CompactCodec,
     )
 from .._model import (
     Deployment, Application, DockerImage, Node, Dataset, Manifestation,
-    AttachedVolume, SERIALIZABLE_CLASSES)
+    AttachedVolume, Port, Link, RestartOnFailure, RestartAlways, NodeState,
+    DeploymentDiff, DeploymentIndex, SERIALIZABLE_CLASSES)
 
 
 DATASET = Dataset(dataset_id=unicode(uuid4()),
@@ -102,6 +105,229 @@ class ConfigurationPersistenceServiceTests(TestCase):
         d.addCallback(retrieve_in_new_service)
         return d
 
+    def test_codec(self):
+        """
+        The configuration is saved using the codec given to the service.
+        """
+        path = FilePath(self.mktemp())
+        service = ConfigurationPersistenceService(reactor, path,
+                                                  COMPACT_CODEC,
+                                                  compaction_threshold=1)
+        service.startService()
+        self.addCleanup(service.stopService)
+        d = service.save(TEST_DEPLOYMENT)
+
+        def saved(_):
+            self.assertEqual(
+                path.child(b"current_configuration.v1.json").getContent(),
+                COMPACT_CODEC.encode(TEST_DEPLOYMENT))
+        d.addCallback(saved)
+        return d
+
+    def test_load_other_codec(self):
+        """
+        A configuration saved using one codec can be loaded by a service
+        using a different codec.
+        """
+        path = FilePath(self.mktemp())
+        service = ConfigurationPersistenceService(reactor, path, JSON_CODEC)
+        service.startService()
+        d = service.save(TEST_DEPLOYMENT)
+        d.addCallback(lambda _: service.stopService())
+
+        def retrieve_in_new_service(_):
+            new_service = ConfigurationPersistenceService(
+                reactor, path, COMPACT_CODEC)
+            new_service.startService()
+            self.addCleanup(new_service.stopService)
+            self.assertEqual(new_service.get(), TEST_DEPLOYMENT)
+        d.addCallback(retrieve_in_new_service)
+        return d
+
+    def test_save_appends_to_journal(self):
+        """
+        Saving a configuration appends the changes to the journal rather
+        than rewriting the snapshot.
+        """
+        path = FilePath(self.mktemp())
+        service = self.service(path)
+        snapshot = path.child(b"current_configuration.v1.json").getContent()
+        d = service.save(TEST_DEPLOYMENT)
+
+        def saved(_):
+            self.assertEqual(
+                (path.child(b"current_configuration.v1.json").getContent(),
+                 path.child(b"current_configuration.v1.journal").getContent()),
+                (snapshot, wire_encode(DeploymentDiff.between(
+                    Deployment(nodes=frozenset()), TEST_DEPLOYMENT)) + b"\n"))
+        d.addCallback(saved)
+        return d
+
+    def test_compaction(self):
+        """
+        Once the journal reaches the compaction threshold a new snapshot is
+        written and the journal is emptied.
+        """
+        path = FilePath(self.mktemp())
+        service = ConfigurationPersistenceService(
+            reactor, path, compaction_threshold=2)
+        service.startService()
+        self.addCleanup(service.stopService)
+        service.save(TEST_DEPLOYMENT)
+        updated = TEST_DEPLOYMENT.update_node(Node(hostname=u"node2"))
+        d = service.save(updated)
+
+        def saved(_):
+            self.assertEqual(
+                (wire_decode(path.child(
+                    b"current_configuration.v1.json").getContent()),
+                 path.child(b"current_configuration.v1.journal").getContent()),
+                (updated, b""))
+        d.addCallback(saved)
+        return d
+
+    def test_stop_after_queued_compaction(self):
+        """
+        Stopping the service while a compaction is waiting to be written
+        closes the journal the compaction opened.
+        """
+        path = FilePath(self.mktemp())
+        service = ConfigurationPersistenceService(
+            None, path, compaction_threshold=1)
+        service.startService()
+        # Hold up the writes, as if an earlier one was still in progress:
+        service._write_lock.acquire()
+        original = service._journal
+        service.save(TEST_DEPLOYMENT)
+        stopping = service.stopService()
+        service._write_lock.release()
+        self.successResultOf(stopping)
+        self.assertEqual((True, True, False),
+                         (original.closed, service._journal.closed,
+                          service._journal is original))
+
+    def test_replay_journal(self):
+        """
+        Changes in the journal that were not yet compacted are applied when
+        a new service is started.
+        """
+        path = FilePath(self.mktemp())
+        service = self.service(path)
+        updated = TEST_DEPLOYMENT.update_node(Node(hostname=u"node2"))
+        service.save(TEST_DEPLOYMENT)
+        d = service.save(updated)
+        d.addCallback(lambda _: service.stopService())
+
+        def retrieve_in_new_service(_):
+            new_service = self.service(path)
+            self.assertEqual(new_service.get(), updated)
+        d.addCallback(retrieve_in_new_service)
+        return d
+
+    def test_replay_is_idempotent(self):
+        """
+        Journal entries that are already included in the snapshot, e.g.
+        because of a crash during compaction, don't change the loaded
+        configuration.
+        """
+        path = FilePath(self.mktemp())
+        path.makedirs()
+        updated = TEST_DEPLOYMENT.update_node(Node(hostname=u"node2"))
+        path.child(b"current_configuration.v1.json").setContent(
+            wire_encode(updated))
+        path.child(b"current_configuration.v1.journal").setContent(
+            wire_encode(DeploymentDiff.between(
+                Deployment(nodes=frozenset()), TEST_DEPLOYMENT)) + b"\n")
+        service = self.service(path)
+        self.assertEqual(service.get(), updated)
+
+    def test_truncated_journal_entry_ignored(self):
+        """
+        A partially written final journal entry is ignored when the
+        configuration is loaded, and discarded from the journal.
+        """
+        path = FilePath(self.mktemp())
+        path.makedirs()
+        entry = wire_encode(DeploymentDiff.between(
+            Deployment(nodes=frozenset()), TEST_DEPLOYMENT))
+        journal = path.child(b"current_configuration.v1.journal")
+        journal.setContent(entry + b"\n" + entry[:10])
+        service = self.service(path)
+        self.assertEqual((service.get(), journal.getContent()),
+                         (TEST_DEPLOYMENT, b""))
+
+    def test_no_reactor(self):
+        """
+        If no reactor is given writes happen synchronously.
+        """
+        path = FilePath(self.mktemp())
+        service = ConfigurationPersistenceService(None, path)
+        service.startService()
+        self.addCleanup(service.stopService)
+        service.save(TEST_DEPLOYMENT)
+        self.assertNotEqual(
+            path.child(b"current_configuration.v1.journal").getContent(), b"")
+
+    def test_batch_written_once(self):
+        """
+        With a batch window, saves made together are written as a single
+        journal entry.
+        """
+        path = FilePath(self.mktemp())
+        service = ConfigurationPersistenceService(
+            reactor, path, batch_window=0)
+        service.startService()
+        self.addCleanup(service.stopService)
+        updated = TEST_DEPLOYMENT.update_node(Node(hostname=u"node2"))
+        d = gatherResults([service.save(TEST_DEPLOYMENT),
+                           service.save(updated)])
+
+        def saved(_):
+            self.assertEqual(
+                (path.child(b"current_configuration.v1.journal").getContent(),
+                 service.batched_saves),
+                (wire_encode(DeploymentDiff.between(
+                    Deployment(nodes=frozenset()), updated)) + b"\n", 2))
+        d.addCallback(saved)
+        return d
+
+    def test_batch_callbacks(self):
+        """
+        With a batch window, change callbacks are called once per batch, after
+        the window has passed, while ``get`` reflects saves immediately.
+        """
+        service = ConfigurationPersistenceService(
+            reactor, FilePath(self.mktemp()), batch_window=0)
+        service.startService()
+        self.addCleanup(service.stopService)
+        called = []
+        service.register(lambda: called.append(service.get()))
+        updated = TEST_DEPLOYMENT.update_node(Node(hostname=u"node2"))
+        d = gatherResults([service.save(TEST_DEPLOYMENT),
+                           service.save(updated)])
+        before = (list(called), service.get())
+        d.addCallback(lambda _: self.assertEqual((before, called),
+                                                 (([], updated), [updated])))
+        return d
+
+    def test_batch_committed_on_stop(self):
+        """
+        Stopping the service commits any outstanding batch.
+        """
+        path = FilePath(self.mktemp())
+        service = ConfigurationPersistenceService(
+            reactor, path, batch_window=60)
+        service.startService()
+        saving = service.save(TEST_DEPLOYMENT)
+        d = service.stopService()
+        d.addCallback(lambda _: saving)
+
+        def retrieve_in_new_service(_):
+            new_service = self.service(path)
+            self.assertEqual(new_service.get(), TEST_DEPLOYMENT)
+        d.addCallback(retrieve_in_new_service)
+        return d
+
     def test_register_for_callback(self):
         """
         Callbacks can be registered that are called every time there is a
@@ -124,6 +350,111 @@ class ConfigurationPersistenceServiceTests(TestCase):
         return d
 
 
+class ConfigurationHistoryTests(SynchronousTestCase):
+    """
+    Tests for the configuration history of ``ConfigurationPersistenceService``.
+    """
+    def service(self, history_size=3):
+        """
+        Start a service that writes synchronously, schedule its stop.
+
+        :param int history_size: Number of versions to retain.
+
+        :return: Started ``ConfigurationPersistenceService``.
+        """
+        service = ConfigurationPersistenceService(
+            None, FilePath(self.mktemp()), history_size=history_size)
+        service.startService()
+        self.addCleanup(service.stopService)
+        return service
+
+    def test_initial_version(self):
+        """
+        The configuration loaded at startup is version 0.
+        """
+        service = self.service()
+        self.assertEqual((service.version, service.get(0)),
+                         (0, Deployment(nodes=frozenset())))
+
+    def test_get_version(self):
+        """
+        Every save creates a new version that can be retrieved with ``get``.
+        """
+        service = self.service()
+        updated = TEST_DEPLOYMENT.update_node(Node(hostname=u"node2"))
+        service.save(TEST_DEPLOYMENT)
+        service.save(updated)
+        self.assertEqual(
+            (service.version, service.get(1), service.get(2), service.get()),
+            (2, TEST_DEPLOYMENT, updated, updated))
+
+    def test_bounded(self):
+        """
+        Only the most recent ``history_size`` versions are retained.
+        """
+        service = self.service(history_size=2)
+        service.save(TEST_DEPLOYMENT)
+        service.save(TEST_DEPLOYMENT.update_node(Node(hostname=u"node2")))
+        self.assertRaises(UnknownVersion, service.get, 0)
+
+    def test_future_version(self):
+        """
+        Versions later than the current one are unknown.
+        """
+        service = self.service()
+        self.assertRaises(UnknownVersion, service.get, 1)
+
+    def test_get_index(self):
+        """
+        ``get_index`` returns an index of the current configuration.
+        """
+        service = self.service()
+        service.save(TEST_DEPLOYMENT)
+        self.assertEqual(service.get_index(),
+                         DeploymentIndex.from_deployment(TEST_DEPLOYMENT))
+
+    def test_get_saved_index(self):
+        """
+        ``get_index`` returns the index a configuration was saved with,
+        without reindexing it.
+        """
+        service = self.service()
+        index = DeploymentIndex.from_deployment(TEST_DEPLOYMENT)
+        service.save(index.deployment, index)
+        self.patch(DeploymentIndex, "reindex",
+                   lambda *args: self.fail("Reindexed"))
+        self.assertIs(index, service.get_index())
+
+    def test_get_index_mismatched(self):
+        """
+        An index saved with a different configuration is ignored.
+        """
+        service = self.service()
+        service.save(TEST_DEPLOYMENT, DeploymentIndex())
+        self.assertEqual(service.get_index(),
+                         DeploymentIndex.from_deployment(TEST_DEPLOYMENT))
+
+    def test_diff(self):
+        """
+        ``diff`` returns the changes between two versions.
+        """
+        service = self.service()
+        service.save(TEST_DEPLOYMENT)
+        node = Node(hostname=u"node2")
+        service.save(TEST_DEPLOYMENT.update_node(node))
+        self.assertEqual(
+            service.diff(1), DeploymentDiff(changed_nodes=[node]))
+
+    def test_retained_nodes(self):
+        """
+        ``retained_nodes`` counts nodes shared between versions only once.
+        """
+        service = self.service()
+        service.save(TEST_DEPLOYMENT)
+        service.save(TEST_DEPLOYMENT.update_node(Node(hostname=u"node2")))
+        self.assertEqual(service.retained_nodes(), 2)
+
+
 class WireEncodeDecodeTests(SynchronousTestCase):
     """
     Tests for ``wire_encode`` and ``wire_decode``.
@@ -160,3 +491,174 @@ class WireEncodeDecodeTests(SynchronousTestCase):
         # Possibly future versions might throw exception, the key point is
         # that the returned object is not a Temp instance.
         self.assertFalse(isinstance(wire_decode(data), Temp))
+
+
+class CompactCodecTests(SynchronousTestCase):
+    """
+    Tests for ``COMPACT_CODEC``.
+    """
+    def test_encode_to_bytes(self):
+        """
+        ``wire_encode`` with ``COMPACT_CODEC`` converts the given object to
+        ``bytes``.
+        """
+        self.assertIsInstance(wire_encode(TEST_DEPLOYMENT, COMPACT_CODEC),
+                              bytes)
+
+    def test_smaller(self):
+        """
+        ``COMPACT_CODEC`` encodes objects into fewer bytes than
+        ``JSON_CODEC``.
+        """
+        self.assertTrue(
+            len(wire_encode(TEST_DEPLOYMENT, COMPACT_CODEC)) <
+            len(wire_encode(TEST_DEPLOYMENT, JSON_CODEC)))
+
+    def test_roundtrip(self):
+        """
+        ``wire_decode`` returns object passed to ``wire_encode`` with
+        ``COMPACT_CODEC``.
+        """
+        self.assertEqual(
+            TEST_DEPLOYMENT,
+            wire_decode(wire_encode(TEST_DEPLOYMENT, COMPACT_CODEC)))
+
+    def test_roundtrip_all_classes(self):
+        """
+        Every class in ``SERIALIZABLE_CLASSES`` round-trips through
+        ``COMPACT_CODEC``.
+        """
+        deployment = TEST_DEPLOYMENT.update_node(Node(
+            hostname=u"node2.example.com",
+            applications=[Application(
+                name=u"another",
+                image=DockerImage.from_string(u"nginx"),
+                ports=[Port(internal_port=80, external_port=8080)],
+                links=[Link(local_port=5432, remote_port=5432,
+                            alias=u"db")],
+                environment={u"KEY": u"value"},
+                restart_policy=RestartOnFailure(maximum_retry_count=2))]))
+        node_state = NodeState(
+            hostname=u"node1.example.com",
+            used_ports=[1, 2], running=deployment.applications(),
+            manifestations=[MANIFESTATION],
+            paths={DATASET.dataset_id: FilePath(b"/xxx")})
+        diff = DeploymentDiff(changed_nodes=deployment.nodes,
+                              removed_hostnames=[u"node3.example.com"])
+        objects = [deployment, node_state, diff, RestartAlways()]
+        self.assertEqual(
+            objects,
+            [wire_decode(wire_encode(obj, COMPACT_CODEC))
+             for obj in objects])
+
+    def test_roundtrip_unset_field(self):
+        """
+        A field that is not set is still not set after a round trip,
+        rather than being set to ``None``.
+        """
+        class Optional(PRecord):
+            """A record with an optional field that can't be ``None``."""
+            name = field(type=unicode, mandatory=True)
+            size = field(type=int)
+
+        codec = _CompactCodec([Optional])
+        decoded = codec.decode(codec.encode(Optional(name=u"x")))
+        self.assertEqual((Optional(name=u"x"), False),
+                         (decoded, "size" in decoded))
+
+    def test_no_arbitrary_encoding(self):
+        """
+        ``wire_encode`` will not encode records whose classes are not in
+        ``SERIALIZABLE_CLASSES``.
+        """
+        class Temp(PRecord):
+            """A class."""
+        self.assertRaises(TypeError, wire_encode, Temp(), COMPACT_CODEC)
+
+    def test_no_arbitrary_decoding(self):
+        """
+        ``wire_decode`` will not decode records with tags that don't
+        correspond to a class in ``SERIALIZABLE_CLASSES``.
+        """
+        data = COMPACT_CODEC.prefix + b"[%d]" % (
+            len(SERIALIZABLE_CLASSES) + 2,)
+        self.assertRaises(KeyError, wire_decode, data)
+
+
+class InternPoolTests(SynchronousTestCase):
+    """
+    Tests for ``InternPool`` and its use by ``wire_decode``.
+    """
+    def assert_shared(self, codec):
+        """
+        Decoding the same data twice with the same pool results in equal
+        objects sharing their small sub-records.
+
+        :param codec: The codec to encode with.
+        """
+        pool = InternPool()
+        data = wire_encode(TEST_DEPLOYMENT, codec)
+        first = wire_decode(data, pool)
+        second = wire_decode(data, pool)
+        ((first_app,),) = [node.applications for node in first.nodes]
+        ((second_app,),) = [node.applications for node in second.nodes]
+        self.assertEqual(
+            (first, second, first_app.image is second_app.image,
+             first_app.volume.manifestation is
+             second_app.volume.manifestation),
+            (TEST_DEPLOYMENT, TEST_DEPLOYMENT, True, True))
+
+    def test_json_shared(self):
+        """
+        Records decoded from JSON using the same pool are shared.
+        """
+        self.assert_shared(JSON_CODEC)
+
+    def test_compact_shared(self):
+        """
+        Records decoded from the compact codec using the same pool are
+        shared.
+        """
+        self.assert_shared(COMPACT_CODEC)
+
+    def test_no_pool_not_shared(self):
+        """
+        Without a pool, decoding the same data twice creates new records.
+        """
+        data = wire_encode(TEST_DEPLOYMENT)
+        first = wire_decode(data)
+        second = wire_decode(data)
+        ((first_app,),) = [node.applications for node in first.nodes]
+        ((second_app,),) = [node.applications for node in second.nodes]
+        self.assertIsNot(first_app.image, second_app.image)
+
+    def test_hits_and_misses(self):
+        """
+        ``InternPool`` counts how many records were found in the pool and
+        how many had to be created.
+        """
+        pool = InternPool()
+        for i in range(3):
+            pool.create(Port, {u"internal_port": 1, u"external_port": 2})
+        pool.create(Port, {u"internal_port": 1, u"external_port": 3})
+        self.assertEqual((pool.hits, pool.misses), (2, 2))
+
+    def test_large_records_not_pooled(self):
+        """
+        Records whose classes are not meant to be interned are not added to
+        the pool.
+        """
+        pool = InternPool()
+        pool.create(Node, {u"hostname": u"node1"})
+        self.assertEqual(len(pool), 0)
+
+    def test_bounded(self):
+        """
+        ``InternPool`` never holds more than ``max_size`` records.
+        """
+        pool = InternPool(max_size=3)
+        sizes = []
+        for i in range(5):
+            pool.create(Port, {u"internal_port": i, u"external_port": i})
+            sizes.append(len(pool))
+        self.assertEqual(sizes, [1, 2, 3, 1, 2])
@@ -16,26 +16,36 @@ from eliot.testing import validate_logging, assertHasAction
 
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.test.proto_helpers import StringTransport, MemoryReactor
-from twisted.protocols.amp import UnknownRemoteError, RemoteAmpError, AMP
+from twisted.protocols.amp import (
+    UnknownRemoteError, RemoteAmpError, AMP, MAX_VALUE_LENGTH,
+)
 from twisted.python.failure import Failure
 from twisted.internet.error import ConnectionLost
 from twisted.internet.endpoints import TCP4ServerEndpoint
-from twisted.internet.defer import succeed
+from twisted.internet.defer import succeed, fail, Deferred
+from twisted.internet.task import Clock
 from twisted.python.filepath import FilePath
 from twisted.application.internet import StreamServerEndpointService
+from twisted.test.iosim import connect, FakeTransport
 
 from .._protocol import (
     SerializableArgument,
-    VersionCommand, ClusterStatusCommand, NodeStateCommand, IConvergenceAgent,
+    VersionCommand, ClusterStatusCommand, ClusterStatusDiffCommand,
+    NodeStateCommand, NodeStateHeartbeatCommand, IConvergenceAgent,
+    GenerationGap,
     AgentAMP, ControlAMPService, ControlAMP, _AgentLocator,
     ControlServiceLocator, LOG_SEND_CLUSTER_STATE, LOG_SEND_TO_AGENT,
+    BROADCAST_DELAY,
 )
 from .._clusterstate import ClusterStateService
 from .._model import (
     Deployment, Application, DockerImage, Node, NodeState, Manifestation,
-    Dataset,
+    Dataset, DeploymentDiff,
+)
+from .._persistence import (
+    ConfigurationPersistenceService, CODECS, COMPACT_CODEC, JSON_CODEC,
+    wire_encode,
 )
-from .._persistence import ConfigurationPersistenceService
 
 
 class LoopbackAMPClient(object):
@@ -98,6 +108,19 @@ NODE_STATE = NodeState(hostname=u'node1.example.com',
                        manifestations=frozenset([MANIFESTATION]))
 
 
+def huge_deployment():
+    """
+    Return a configuration that encodes to multiple megabytes.
+    """
+    manifestation = Manifestation(
+        dataset=Dataset(dataset_id=unicode(uuid4()),
+                        metadata={u"name": u"x" * 2 * 1024 * 1024}),
+        primary=True)
+    return Deployment(nodes=[
+        Node(hostname=u"node2.example.com",
+             manifestations={manifestation.dataset_id: manifestation})])
+
+
 class SerializationTests(SynchronousTestCase):
     """
     Tests for argument serialization.
@@ -140,15 +163,116 @@ class SerializationTests(SynchronousTestCase):
         self.assertRaises(
             TypeError, SerializableArgument(NodeState).fromString, as_bytes)
 
+    def test_deployment_diff(self):
+        """
+        ``SerializableArgument`` can round-trip a ``DeploymentDiff`` instance.
+        """
+        diff = DeploymentDiff(changed_nodes=TEST_DEPLOYMENT.nodes,
+                              removed_hostnames=[u"node2.example.com"])
+        argument = SerializableArgument(DeploymentDiff)
+        as_bytes = argument.toString(diff)
+        deserialized = argument.fromString(as_bytes)
+        self.assertEqual([bytes, diff], [type(as_bytes), deserialized])
+
+    def test_shared_records(self):
+        """
+        ``SerializableArgument`` reuses identical small records across
+        multiple decodes.
+        """
+        argument = SerializableArgument(Deployment)
+        as_bytes = argument.toString(TEST_DEPLOYMENT)
+        first = argument.fromString(as_bytes)
+        second = argument.fromString(as_bytes)
+        self.assertEqual(
+            [{app.image for app in deployment.applications()}
+             for deployment in (first, second)],
+            [{APP1.image, APP2.image}] * 2)
+        self.assertEqual(
+            {id(app.image) for app in first.applications()},
+            {id(app.image) for app in second.applications()})
+
+    def test_small_single_value(self):
+        """
+        ``SerializableArgument`` stores objects that encode to less than
+        ``MAX_VALUE_LENGTH`` bytes in a single value named after the
+        argument.
+        """
+        strings = {}
+        SerializableArgument(Deployment).toBox(
+            b"configuration", strings, {"configuration": TEST_DEPLOYMENT},
+            None)
+        self.assertEqual(strings,
+                         {b"configuration": wire_encode(TEST_DEPLOYMENT)})
+
+    def test_large_chunked(self):
+        """
+        ``SerializableArgument`` splits objects that encode to more than
+        ``MAX_VALUE_LENGTH`` bytes across multiple values, none longer than
+        ``MAX_VALUE_LENGTH``.
+        """
+        deployment = huge_deployment()
+        strings = {}
+        SerializableArgument(Deployment).toBox(
+            b"configuration", strings, {"configuration": deployment}, None)
+        expected_keys = {b"configuration"} | {
+            b"configuration.%d" % (i,) for i in range(2, len(strings) + 1)}
+        self.assertEqual(
+            (set(strings), len(strings) > 1,
+             max(len(value) for value in strings.values()) <=
+             MAX_VALUE_LENGTH),
+            (expected_keys, True, True))
+
+    def test_large_roundtrip(self):
+        """
+        Objects split across multiple values by ``SerializableArgument`` are
+        reassembled when decoded.
+        """
+        deployment = huge_deployment()
+        argument = SerializableArgument(Deployment)
+        strings = {}
+        argument.toBox(
+            b"configuration", strings, {"configuration": deployment}, None)
+        objects = {}
+        argument.fromBox(b"configuration", strings, objects, None)
+        self.assertEqual((objects, strings),
+                         ({b"configuration": deployment}, {}))
+
+    def test_protocol_codec(self):
+        """
+        ``SerializableArgument`` encodes using the codec of the protocol it
+        is sending on, and the result can be decoded.
+        """
+        argument = SerializableArgument(Deployment)
+        proto = AMP()
+        proto.codec = COMPACT_CODEC
+        as_bytes = argument.toStringProto(TEST_DEPLOYMENT, proto)
+        self.assertEqual(
+            [as_bytes, argument.fromString(as_bytes)],
+            [COMPACT_CODEC.encode(TEST_DEPLOYMENT), TEST_DEPLOYMENT])
+
+    def test_default_codec(self):
+        """
+        ``SerializableArgument`` encodes using JSON if the protocol has no
+        codec.
+        """
+        argument = SerializableArgument(Deployment)
+        self.assertEqual(
+            argument.toStringProto(TEST_DEPLOYMENT, AMP()),
+            JSON_CODEC.encode(TEST_DEPLOYMENT))
+
 
-def build_control_amp_service(test):
+def build_control_amp_service(test, reactor=None):
     """
     Create a new ``ControlAMPService``.
 
     :param TestCase test: The test this service is for.
+    :param reactor: The reactor to use for scheduling broadcasts, or
+        ``None`` to use a new ``Clock``.
 
     :return ControlAMPService: Not started.
     """
+    if reactor is None:
+        reactor = Clock()
     cluster_state = ClusterStateService()
     cluster_state.startService()
     test.addCleanup(cluster_state.stopService)
@@ -156,7 +280,7 @@ def build_control_amp_service(test):
         None, FilePath(test.mktemp()))
     persistence_service.startService()
     test.addCleanup(persistence_service.stopService)
-    return ControlAMPService(cluster_state, persistence_service,
+    return ControlAMPService(reactor, cluster_state, persistence_service,
                              TCP4ServerEndpoint(MemoryReactor(), 1234))
 
 
@@ -197,7 +321,9 @@ class ControlAMPTests(ControlTestCase):
     Tests for ``ControlAMP`` and ``ControlServiceLocator``.
     """
     def setUp(self):
-        self.control_amp_service = build_control_amp_service(self)
+        self.reactor = Clock()
+        self.control_amp_service = build_control_amp_service(
+            self, self.reactor)
         self.protocol = ControlAMP(self.control_amp_service)
         self.client = LoopbackAMPClient(self.protocol.locator)
 
@@ -228,7 +354,8 @@ class ControlAMPTests(ControlTestCase):
             sent[0],
             (((ClusterStatusCommand,),
               dict(configuration=TEST_DEPLOYMENT,
-                   state=cluster_state))))
+                   state=cluster_state,
+                   generation=0))))
 
     def test_connection_lost(self):
         """
@@ -243,6 +370,26 @@ class ControlAMPTests(ControlTestCase):
         self.protocol.connectionLost(Failure(ConnectionLost()))
         self.assertEqual(self.control_amp_service.connections, {marker})
 
+    def test_reconnect_sends_snapshot(self):
+        """
+        After a connection is lost, what was sent to it is forgotten, so if
+        the same protocol instance is reconnected it is sent a full
+        snapshot again.
+        """
+        self.patch(self.protocol, "callRemote",
+                   lambda *args, **kwargs: succeed(None))
+        self.protocol.makeConnection(StringTransport())
+        self.protocol.connectionLost(Failure(ConnectionLost()))
+        sent = []
+        self.patch_call_remote(sent, self.protocol)
+        self.protocol.makeConnection(StringTransport())
+        self.assertEqual(
+            sent,
+            [((ClusterStatusCommand,),
+              dict(configuration=Deployment(nodes=frozenset()),
+                   state=Deployment(nodes=frozenset()),
+                   generation=0))])
+
     def test_version(self):
         """
         ``VersionCommand`` to the control service returns the current internal
@@ -250,7 +397,31 @@ class ControlAMPTests(ControlTestCase):
         """
         self.assertEqual(
             self.successResultOf(self.client.callRemote(VersionCommand)),
-            {"major": 1})
+            {"major": 2, "codec": JSON_CODEC.name})
+
+    def test_version_codec(self):
+        """
+        ``VersionCommand`` to the control service chooses the first of the
+        given codecs that the control service supports and uses it for
+        subsequent commands sent on the connection.
+        """
+        response = self.successResultOf(self.client.callRemote(
+            VersionCommand, codecs=[u"unknown", COMPACT_CODEC.name,
+                                    JSON_CODEC.name]))
+        self.assertEqual((response, self.protocol.codec),
+                         ({"major": 2, "codec": COMPACT_CODEC.name},
+                          COMPACT_CODEC))
+
+    def test_version_unknown_codecs(self):
+        """
+        If none of the codecs given to ``VersionCommand`` are supported,
+        JSON is used.
+        """
+        response = self.successResultOf(self.client.callRemote(
+            VersionCommand, codecs=[u"unknown"]))
+        self.assertEqual((response, self.protocol.codec),
+                         ({"major": 2, "codec": JSON_CODEC.name},
+                          JSON_CODEC))
 
     def test_nodestate_updates_node_state(self):
         """
@@ -269,32 +440,234 @@ class ControlAMPTests(ControlTestCase):
                          manifestations={MANIFESTATION.dataset_id:
                                          MANIFESTATION})])))
 
+    def test_nodestate_returns_token(self):
+        """
+        The response to ``NodeStateCommand`` includes a token for the stored
+        state, which is unchanged if the same state is sent again.
+        """
+        first = self.successResultOf(
+            self.client.callRemote(NodeStateCommand,
+                                   node_state=NODE_STATE,
+                                   eliot_context=TEST_ACTION))
+        second = self.successResultOf(
+            self.client.callRemote(NodeStateCommand,
+                                   node_state=NODE_STATE,
+                                   eliot_context=TEST_ACTION))
+        self.assertEqual(first["state_token"], second["state_token"])
+
+    def test_nodestate_changed_token(self):
+        """
+        Sending different state results in a different token.
+        """
+        first = self.successResultOf(
+            self.client.callRemote(NodeStateCommand,
+                                   node_state=NODE_STATE,
+                                   eliot_context=TEST_ACTION))
+        second = self.successResultOf(
+            self.client.callRemote(NodeStateCommand,
+                                   node_state=NODE_STATE.set(
+                                       "used_ports", [1234]),
+                                   eliot_context=TEST_ACTION))
+        self.assertNotEqual(first["state_token"], second["state_token"])
+
+    def test_heartbeat_current(self):
+        """
+        ``NodeStateHeartbeatCommand`` with the token of the node's current
+        state indicates the state is current, and records when the node was
+        last seen.
+        """
+        token = self.successResultOf(
+            self.client.callRemote(NodeStateCommand,
+                                   node_state=NODE_STATE,
+                                   eliot_context=TEST_ACTION))["state_token"]
+        self.reactor.advance(30)
+        response = self.successResultOf(
+            self.client.callRemote(NodeStateHeartbeatCommand,
+                                   hostname=NODE_STATE.hostname,
+                                   state_token=token))
+        self.assertEqual(
+            (response, self.control_amp_service.last_seen),
+            ({"current": True}, {NODE_STATE.hostname: 30}))
+
+    def test_heartbeat_outdated(self):
+        """
+        ``NodeStateHeartbeatCommand`` with the token of a state which is no
+        longer the current state of the node indicates the state needs to be
+        sent again.
+        """
+        token = self.successResultOf(
+            self.client.callRemote(NodeStateCommand,
+                                   node_state=NODE_STATE,
+                                   eliot_context=TEST_ACTION))["state_token"]
+        self.successResultOf(
+            self.client.callRemote(NodeStateCommand,
+                                   node_state=NODE_STATE.set(
+                                       "used_ports", [1234]),
+                                   eliot_context=TEST_ACTION))
+        response = self.successResultOf(
+            self.client.callRemote(NodeStateHeartbeatCommand,
+                                   hostname=NODE_STATE.hostname,
+                                   state_token=token))
+        self.assertEqual(response, {"current": False})
+
+    def test_heartbeat_other_service(self):
+        """
+        A token handed out by a different control service, e.g. before a
+        restart, is not current.
+        """
+        token = self.successResultOf(
+            self.client.callRemote(NodeStateCommand,
+                                   node_state=NODE_STATE,
+                                   eliot_context=TEST_ACTION))["state_token"]
+        other_service = build_control_amp_service(self)
+        other_service.node_changed(NODE_STATE)
+        self.assertFalse(other_service.heartbeat(NODE_STATE.hostname, token))
+
     def test_nodestate_notifies_all_connected(self):
         """
         ``NodeStateCommand`` results in all connected ``ControlAMP``
-        connections getting the updated cluster state along with the
-        desired configuration.
+        connections getting the changes to the cluster state along with the
+        changes to the desired configuration.
         """
         self.control_amp_service.configuration_service.save(TEST_DEPLOYMENT)
-        self.protocol.makeConnection(StringTransport())
         another_protocol = ControlAMP(self.control_amp_service)
-        another_protocol.makeConnection(StringTransport())
         sent1 = []
         sent2 = []
 
         self.patch_call_remote(sent1, self.protocol)
         self.patch_call_remote(sent2, protocol=another_protocol)
+        self.protocol.makeConnection(StringTransport())
+        another_protocol.makeConnection(StringTransport())
 
         self.successResultOf(
             self.client.callRemote(NodeStateCommand,
                                    node_state=NODE_STATE,
                                    eliot_context=TEST_ACTION))
+        self.reactor.advance(BROADCAST_DELAY)
         cluster_state = self.control_amp_service.cluster_state.as_deployment()
         self.assertListEqual(
             [sent1[-1], sent2[-1]],
-            [(((ClusterStatusCommand,),
-              dict(configuration=TEST_DEPLOYMENT,
-                   state=cluster_state)))] * 2)
+            [(((ClusterStatusDiffCommand,),
+              dict(configuration=DeploymentDiff(),
+                   state=DeploymentDiff(changed_nodes=cluster_state.nodes),
+                   generation=1)))] * 2)
+
+    def test_nodestate_broadcast_delayed(self):
+        """
+        The cluster state is not broadcast until ``BROADCAST_DELAY`` seconds
+        after a ``NodeStateCommand`` is received.
+        """
+        sent = []
+        self.patch_call_remote(sent, self.protocol)
+        self.protocol.makeConnection(StringTransport())
+        self.successResultOf(
+            self.client.callRemote(NodeStateCommand,
+                                   node_state=NODE_STATE,
+                                   eliot_context=TEST_ACTION))
+        self.reactor.advance(BROADCAST_DELAY * 0.9)
+        self.assertEqual([args for (args, kwargs) in sent],
+                         [(ClusterStatusCommand,)])
+
+    def test_nodestate_coalesced(self):
+        """
+        Multiple ``NodeStateCommand`` received within ``BROADCAST_DELAY`` of
+        the first one result in a single broadcast including all of the
+        updates, and are counted in ``coalesced_broadcasts``.
+        """
+        sent = []
+        self.patch_call_remote(sent, self.protocol)
+        self.protocol.makeConnection(StringTransport())
+        for hostname in [u"node1", u"node2", u"node3"]:
+            self.successResultOf(
+                self.client.callRemote(
+                    NodeStateCommand,
+                    node_state=NODE_STATE.set("hostname", hostname),
+                    eliot_context=TEST_ACTION))
+        self.reactor.advance(BROADCAST_DELAY)
+        cluster_state = self.control_amp_service.cluster_state.as_deployment()
+        self.assertEqual(
+            (sent[1:], self.control_amp_service.coalesced_broadcasts),
+            ([((ClusterStatusDiffCommand,),
+               dict(configuration=DeploymentDiff(),
+                    state=DeploymentDiff(changed_nodes=cluster_state.nodes),
+                    generation=1))], 2))
+
+    def test_nodestate_unchanged_not_broadcast(self):
+        """
+        A ``NodeStateCommand`` that doesn't change the node's state does not
+        result in a broadcast.
+        """
+        self.control_amp_service.cluster_state.update_node_state(NODE_STATE)
+        sent = []
+        self.patch_call_remote(sent, self.protocol)
+        self.protocol.makeConnection(StringTransport())
+        self.successResultOf(
+            self.client.callRemote(NodeStateCommand,
+                                   node_state=NODE_STATE,
+                                   eliot_context=TEST_ACTION))
+        self.reactor.advance(BROADCAST_DELAY)
+        self.assertEqual(
+            ([args for (args, kwargs) in sent],
+             self.reactor.getDelayedCalls()),
+            ([(ClusterStatusCommand,)], []))
+
+    def test_configuration_change_supersedes_broadcast(self):
+        """
+        A configuration change sends the latest cluster state immediately,
+        so any broadcast already scheduled by a ``NodeStateCommand`` is
+        cancelled.
+        """
+        sent = []
+        self.patch_call_remote(sent, self.protocol)
+        self.protocol.makeConnection(StringTransport())
+        self.successResultOf(
+            self.client.callRemote(NodeStateCommand,
+                                   node_state=NODE_STATE,
+                                   eliot_context=TEST_ACTION))
+        self.control_amp_service.configuration_service.save(TEST_DEPLOYMENT)
+        self.reactor.advance(BROADCAST_DELAY)
+        self.assertEqual([args for (args, kwargs) in sent],
+                         [(ClusterStatusCommand,),
+                          (ClusterStatusDiffCommand,)])
+
+    def test_unacknowledged_connection_skipped(self):
+        """
+        A connection that has not yet responded to the previous update is
+        not sent the new cluster state; the skipped send is counted in
+        ``superseded_sends``.
+        """
+        self.patch(self.protocol, "callRemote",
+                   lambda *args, **kwargs: Deferred())
+        self.protocol.makeConnection(StringTransport())
+        sent = []
+        self.patch_call_remote(sent, self.protocol)
+        self.control_amp_service.configuration_service.save(TEST_DEPLOYMENT)
+        self.assertEqual(
+            (sent, self.control_amp_service.superseded_sends), ([], 1))
+
+    def test_superseded_sent_on_acknowledgement(self):
+        """
+        Once a connection responds to an update, it is sent the latest
+        cluster state if sends were skipped in the meantime.
+        """
+        response = Deferred()
+        self.patch(self.protocol, "callRemote",
+                   lambda *args, **kwargs: response)
+        self.protocol.makeConnection(StringTransport())
+        sent = []
+        self.patch_call_remote(sent, self.protocol)
+        self.control_amp_service.configuration_service.save(TEST_DEPLOYMENT)
+        self.control_amp_service.configuration_service.save(
+            Deployment(nodes=frozenset()))
+        self.control_amp_service.configuration_service.save(TEST_DEPLOYMENT)
+        response.callback({})
+        self.assertEqual(
+            sent,
+            [((ClusterStatusDiffCommand,),
+              dict(configuration=DeploymentDiff(
+                  changed_nodes=TEST_DEPLOYMENT.nodes),
+                  state=DeploymentDiff(),
+                  generation=1))])
 
 
 class ControlAMPServiceTests(ControlTestCase):
@@ -325,6 +698,17 @@ class ControlAMPServiceTests(ControlTestCase):
         service.stopService()
         self.assertEqual(service.endpoint_service.running, False)
 
+    def test_stop_service_cancels_broadcast(self):
+        """
+        Stopping the service cancels any scheduled broadcast.
+        """
+        reactor = Clock()
+        service = build_control_amp_service(self, reactor)
+        service.startService()
+        service.node_changed(NODE_STATE)
+        service.stopService()
+        self.assertEqual(reactor.getDelayedCalls(), [])
+
     def test_stop_service_connections(self):
         """
         Stopping the service closes all connections.
@@ -366,24 +750,88 @@ class ControlAMPServiceTests(ControlTestCase):
         service = build_control_amp_service(self)
         service.startService()
         protocol = ControlAMP(service)
-        protocol.makeConnection(StringTransport())
         sent = []
         self.patch_call_remote(sent, protocol=protocol)
+        protocol.makeConnection(StringTransport())
 
         service.configuration_service.save(TEST_DEPLOYMENT)
-        # Should only be one callRemote call.
-        (sent,) = sent
+        # Should only be one callRemote call after the initial snapshot.
+        (sent,) = sent[1:]
         self.assertArgsEqual(
             sent,
             (
-                (ClusterStatusCommand,),
+                (ClusterStatusDiffCommand,),
                 dict(
-                    configuration=TEST_DEPLOYMENT,
-                    state=Deployment(nodes=frozenset())
+                    configuration=DeploymentDiff(
+                        changed_nodes=TEST_DEPLOYMENT.nodes),
+                    state=DeploymentDiff(),
+                    generation=1,
                 )
             )
         )
 
+    def connect_rejecting_diffs(self, service):
+        """
+        Connect a ``ControlAMP`` whose peer rejects all diffs.
+
+        :param ControlAMPService service: The service to connect to.
+
+        :return: ``list`` that will have the names of sent commands and
+            their generation appended to it.
+        """
+        protocol = ControlAMP(service)
+        sent = []
+
+        def call_remote(command, **kwargs):
+            sent.append((command, kwargs["generation"]))
+            if command is ClusterStatusDiffCommand:
+                return fail(GenerationGap())
+            return succeed(None)
+        self.patch(protocol, "callRemote", call_remote)
+        protocol.makeConnection(StringTransport())
+        return sent
+
+    def test_diff_rejected(self):
+        """
+        If a connection rejects a ``ClusterStatusDiffCommand`` a full
+        snapshot of the current cluster status is sent instead.
+        """
+        service = build_control_amp_service(self)
+        service.startService()
+        sent = self.connect_rejecting_diffs(service)
+        service.configuration_service.save(TEST_DEPLOYMENT)
+        self.assertEqual(sent, [(ClusterStatusCommand, 0),
+                                (ClusterStatusDiffCommand, 1),
+                                (ClusterStatusCommand, 2)])
+
+    def test_diff_before_snapshot_rejected(self):
+        """
+        If a connection rejects a ``ClusterStatusDiffCommand`` that was sent
+        before the most recent snapshot no additional snapshot is sent.
+        """
+        service = build_control_amp_service(self)
+        service.startService()
+        sent = self.connect_rejecting_diffs(service)
+        service.configuration_service.save(TEST_DEPLOYMENT)
+        (connection,) = service.connections
+        service._diff_rejected(Failure(GenerationGap()), connection, 1)
+        self.assertEqual(sent, [(ClusterStatusCommand, 0),
+                                (ClusterStatusDiffCommand, 1),
+                                (ClusterStatusCommand, 2)])
+
+    def test_other_diff_errors_not_handled(self):
+        """
+        Errors other than ``GenerationGap`` from sending a
+        ``ClusterStatusDiffCommand`` are passed on.
+        """
+        service = build_control_amp_service(self)
+        service.startService()
+        self.connect_rejecting_diffs(service)
+        (connection,) = service.connections
+        d = fail(ConnectionLost())
+        d.addErrback(service._diff_rejected, connection, 1)
+        self.failureResultOf(d, ConnectionLost)
+
 
 @implementer(IConvergenceAgent)
 @attributes([Attribute("is_connected", default_value=False),
@@ -441,6 +889,25 @@ class AgentClientTests(SynchronousTestCase):
         self.assertEqual(self.agent, FakeAgent(is_connected=True,
                                                client=self.client))
 
+    def test_connection_made_negotiates_codec(self):
+        """
+        When a connection is made ``VersionCommand`` is sent with all
+        supported codecs, and the codec chosen by the control service is
+        used for subsequent commands.
+        """
+        sent = []
+
+        def call_remote(command, **kwargs):
+            sent.append((command, kwargs))
+            return succeed({"major": 2, "codec": COMPACT_CODEC.name})
+        self.patch(self.client, "callRemote", call_remote)
+        self.client.makeConnection(StringTransport())
+        self.assertEqual(
+            (sent, self.client.codec),
+            ([(VersionCommand,
+               dict(codecs=[codec.name for codec in CODECS]))],
+             COMPACT_CODEC))
+
     def test_connection_lost(self):
         """
         Connection lost events are passed on to the agent.
@@ -461,6 +928,7 @@ class AgentClientTests(SynchronousTestCase):
             ClusterStatusCommand,
             configuration=TEST_DEPLOYMENT,
             state=actual,
+            generation=0,
             eliot_context=TEST_ACTION
         )
 
@@ -470,6 +938,136 @@ class AgentClientTests(SynchronousTestCase):
                                                desired=TEST_DEPLOYMENT,
                                                actual=actual))
 
+    def test_cluster_changed(self):
+        """
+        ``ClusterStatusDiffCommand`` sent to the ``AgentClient`` results in
+        the agent having the changes applied to the previously received
+        cluster state and configuration.
+        """
+        self.client.makeConnection(StringTransport())
+        self.successResultOf(self.server.callRemote(
+            ClusterStatusCommand,
+            configuration=Deployment(nodes=frozenset()),
+            state=TEST_DEPLOYMENT,
+            generation=3,
+            eliot_context=TEST_ACTION
+        ))
+        d = self.server.callRemote(
+            ClusterStatusDiffCommand,
+            configuration=DeploymentDiff(changed_nodes=TEST_DEPLOYMENT.nodes),
+            state=DeploymentDiff(removed_hostnames=[u'node1.example.com']),
+            generation=4,
+            eliot_context=TEST_ACTION
+        )
+
+        self.successResultOf(d)
+        self.assertEqual(
+            self.agent, FakeAgent(is_connected=True,
+                                  client=self.client,
+                                  desired=TEST_DEPLOYMENT,
+                                  actual=Deployment(nodes=frozenset())))
+
+    def test_cluster_changed_without_snapshot(self):
+        """
+        ``ClusterStatusDiffCommand`` sent to the ``AgentClient`` before any
+        ``ClusterStatusCommand`` fails with ``GenerationGap``.
+        """
+        self.client.makeConnection(StringTransport())
+        d = self.server.callRemote(
+            ClusterStatusDiffCommand,
+            configuration=DeploymentDiff(),
+            state=DeploymentDiff(),
+            generation=1,
+            eliot_context=TEST_ACTION
+        )
+
+        self.failureResultOf(d, GenerationGap)
+        self.assertEqual(self.agent, FakeAgent(is_connected=True,
+                                               client=self.client))
+
+    def test_cluster_changed_gap(self):
+        """
+        ``ClusterStatusDiffCommand`` sent to the ``AgentClient`` with a
+        generation that doesn't immediately follow the last one received
+        fails with ``GenerationGap`` and doesn't notify the agent.
+        """
+        self.client.makeConnection(StringTransport())
+        actual = Deployment(nodes=frozenset())
+        self.successResultOf(self.server.callRemote(
+            ClusterStatusCommand,
+            configuration=TEST_DEPLOYMENT,
+            state=actual,
+            generation=0,
+            eliot_context=TEST_ACTION
+        ))
+        d = self.server.callRemote(
+            ClusterStatusDiffCommand,
+            configuration=DeploymentDiff(),
+            state=DeploymentDiff(changed_nodes=TEST_DEPLOYMENT.nodes),
+            generation=2,
+            eliot_context=TEST_ACTION
+        )
+
+        self.failureResultOf(d, GenerationGap)
+        self.assertEqual(self.agent, FakeAgent(is_connected=True,
+                                               client=self.client,
+                                               desired=TEST_DEPLOYMENT,
+                                               actual=actual))
+
+
+class LargeClusterStatusTests(SynchronousTestCase):
+    """
+    Tests for sending cluster status that doesn't fit in a single AMP value
+    between ``ControlAMP`` and ``AgentAMP`` over a loopback connection.
+    """
+    def setUp(self):
+        self.control_amp_service = build_control_amp_service(self)
+        self.agent = FakeAgent()
+        server = ControlAMP(self.control_amp_service)
+        client = AgentAMP(self.agent)
+        self.pump = connect(server, FakeTransport(server, isServer=True),
+                            client, FakeTransport(client, isServer=False))
+
+    def test_snapshot(self):
+        """
+        A multi-megabyte configuration is sent to the agent when it
+        connects.
+        """
+        deployment = huge_deployment()
+        self.control_amp_service.configuration_service.save(deployment)
+        server = ControlAMP(self.control_amp_service)
+        client = AgentAMP(self.agent)
+        connect(server, FakeTransport(server, isServer=True),
+                client, FakeTransport(client, isServer=False))
+        self.assertEqual(self.agent.desired, deployment)
+
+    def test_diff(self):
+        """
+        A multi-megabyte configuration change is sent to an already
+        connected agent.
+        """
+        deployment = huge_deployment()
+        self.control_amp_service.configuration_service.save(deployment)
+        self.pump.flush()
+        self.assertEqual(self.agent.desired, deployment)
+
+    def test_node_state(self):
+        """
+        A multi-megabyte node state is sent by the agent to the control
+        service.
+        """
+        (node,) = huge_deployment().nodes
+        node_state = NodeState(hostname=node.hostname,
+                               manifestations=node.manifestations.values())
+        d = self.agent.client.callRemote(
+            NodeStateCommand, node_state=node_state,
+            eliot_context=TEST_ACTION)
+        self.pump.flush()
+        self.successResultOf(d)
+        self.assertEqual(
+            self.control_amp_service.cluster_state.as_deployment(),
+            Deployment(nodes=[node]))
+
 
 def iconvergence_agent_tests_factory(fixture):
     """
@@ -560,10 +1158,23 @@ class ClusterStatusCommandTests(SynchronousTestCase):
         ClusterStatusCommand requires the following arguments.
         """
         self.assertItemsEqual(
-            ['configuration', 'state', 'eliot_context'],
+            ['configuration', 'state', 'generation', 'eliot_context'],
             (v[0] for v in ClusterStatusCommand.arguments))
 
 
+class ClusterStatusDiffCommandTests(SynchronousTestCase):
+    """
+    Tests for ``ClusterStatusDiffCommand``.
+    """
+    def test_command_arguments(self):
+        """
+        ClusterStatusDiffCommand requires the following arguments.
+        """
+        self.assertItemsEqual(
+            ['configuration', 'state', 'generation', 'eliot_context'],
+            (v[0] for v in ClusterStatusDiffCommand.arguments))
+
+
 class AgentLocatorTests(SynchronousTestCase):
     """
     Tests for ``_AgentLocator``.
@@ -15,7 +15,9 @@ from pyrsistent import pmap, PRecord, field
 
 from eliot import write_failure, Logger
 
-from twisted.internet.defer import gatherResults, fail, succeed
+from twisted.internet.defer import (
+    gatherResults, fail, succeed, DeferredSemaphore,
+)
 
 from ._docker import DockerClient, PortMap, Environment, Volume as DockerVolume
 from ..control._model import (
@@ -138,6 +140,34 @@ class InParallel(object):
             [change.run(deployer) for change in self.changes])
 
 
+# The maximum number of images ``PullImages`` pulls at once:
+PULL_CONCURRENCY = 4
+
+
+@implementer(IStateChange)
+@attributes(["images"])
+class PullImages(object):
+    """
+    Make sure Docker images are available locally before the applications
+    using them are started, so that application downtime doesn't include
+    the time it takes to download them.
+
+    Failures are logged but otherwise ignored, since starting the
+    application will try to pull the image again.
+
+    :ivar frozenset images: The full names of the images to pull, e.g.
+        ``u"busybox:latest"``.
+    """
+    def run(self, deployer):
+        pulling = DeferredSemaphore(PULL_CONCURRENCY)
+        pulls = []
+        for image in sorted(self.images):
+            d = pulling.run(deployer.docker_client.pull, image)
+            d.addErrback(write_failure, _logger, u"flocker:p2pdeployer:pull")
+            pulls.append(d)
+        return gatherResults(pulls)
+
+
 @implementer(IStateChange)
 @attributes(["application", "hostname"])
 class StartApplication(object):
@@ -393,10 +423,20 @@ class P2PNodeDeployer(object):
         deployment operations. Default ``DockerClient``.
     :ivar INetwork network: The network routing API to use in
         deployment operations. Default is iptables-based implementation.
+    :ivar int calculation_hits: The number of times
+        ``calculate_necessary_state_changes`` returned the previous result
+        because its inputs were unchanged.
+    :ivar int calculation_misses: The number of times
+        ``calculate_necessary_state_changes`` had to calculate the changes.
     """
     def __init__(self, hostname, volume_service, docker_client=None,
                  network=None):
         self.hostname = hostname
+        # The inputs to and result of the last calculation of necessary
+        # state changes:
+        self._last_calculation = None
+        self.calculation_hits = 0
+        self.calculation_misses = 0
         if docker_client is None:
             docker_client = DockerClient()
         self.docker_client = docker_client
@@ -528,11 +568,12 @@ class P2PNodeDeployer(object):
 
         1. Change proxies to point to new addresses (should really be
            last, see https://clusterhq.atlassian.net/browse/FLOC-380)
-        2. Stop all relevant containers.
-        3. Handoff volumes.
-        4. Wait for volumes.
-        5. Create volumes.
-        6. Start and restart any relevant containers.
+        2. Pull the images of containers that will be started.
+        3. Stop all relevant containers.
+        4. Handoff volumes.
+        5. Wait for volumes.
+        6. Create volumes.
+        7. Start and restart any relevant containers.
 
         :param NodeState local_state: The local state of the node.
         :param Deployment desired_configuration: The intended
@@ -544,6 +585,41 @@ class P2PNodeDeployer(object):
         :param unicode hostname: The hostname of the node that this is running
             on.
 
+        :return: A ``IStateChange`` provider.
+        """
+        # The result only depends on the arguments and the current proxies.
+        # In a converged cluster these are the same from one iteration of
+        # the convergence loop to the next, and mostly share their structure
+        # with the previous ones, so comparing them is much cheaper than
+        # calculating the changes again:
+        inputs = (local_state, desired_configuration, current_cluster_state,
+                  frozenset(self.network.enumerate_proxies()))
+        if self._last_calculation is not None:
+            last_inputs, last_result = self._last_calculation
+            if all(a is b or a == b for (a, b) in zip(inputs, last_inputs)):
+                self.calculation_hits += 1
+                return last_result
+        self.calculation_misses += 1
+        result = self._calculate_necessary_state_changes(*inputs)
+        self._last_calculation = (inputs, result)
+        return result
+
+    def _calculate_necessary_state_changes(self, local_state,
+                                           desired_configuration,
+                                           current_cluster_state,
+                                           current_proxies):
+        """
+        Work out which changes need to happen to the local state to match
+        the given desired state.
+
+        :param NodeState local_state: The local state of the node.
+        :param Deployment desired_configuration: The intended
+            configuration of all nodes.
+        :param Deployment current_cluster_state: The current configuration
+            of all nodes.
+        :param frozenset current_proxies: The ``Proxy`` instances currently
+            configured on this node.
+
         :return: A ``IStateChange`` provider.
         """
         phases = []
@@ -560,8 +636,9 @@ class P2PNodeDeployer(object):
                         # https://clusterhq.atlassian.net/browse/FLOC-322
                         desired_proxies.add(Proxy(ip=node.hostname,
                                                   port=port.external_port))
-        if desired_proxies != set(self.network.enumerate_proxies()):
+        if desired_proxies != current_proxies:
             phases.append(SetProxies(ports=desired_proxies))
+        pull_phase = len(phases)
 
         # We are a node-specific IDeployer:
         current_node_state = local_state
@@ -671,6 +748,13 @@ class P2PNodeDeployer(object):
         start_restart = start_containers + restart_containers
         if start_restart:
             phases.append(InParallel(changes=start_restart))
+            # Pull the images of all the applications that are about to be
+            # started before anything is stopped:
+            images = frozenset(
+                change.application.image.full_name
+                for change in start_containers + [
+                    sequence.changes[-1] for sequence in restart_containers])
+            phases.insert(pull_phase, PullImages(images=images))
         return Sequentially(changes=phases)
 
 
@@ -7,20 +7,37 @@ Docker API client.
 
 from __future__ import absolute_import
 
-from time import sleep
+from httplib import HTTPConnection
+from json import JSONDecoder
+from threading import local
+from time import sleep, time
+from urlparse import urlparse
 
 from zope.interface import Interface, implementer
 
 from docker import Client
 from docker.errors import APIError
+from docker.unixconn.unixconn import UnixHTTPConnection
 from docker.utils import create_host_config
 
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool
+
+from eliot import Logger, MessageType, fields, write_failure
+
 from characteristic import attributes, Attribute
 
+from twisted.application.service import Service
 from twisted.python.components import proxyForInterface
 from twisted.python.filepath import FilePath
-from twisted.internet.defer import succeed, fail
-from twisted.internet.threads import deferToThread
+from twisted.internet.defer import (
+    Deferred, CancelledError, succeed, fail, gatherResults,
+    DeferredSemaphore, FirstError,
+)
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 from twisted.web.http import NOT_FOUND, INTERNAL_SERVER_ERROR
 
 from ..control._model import RestartNever, RestartAlways, RestartOnFailure
@@ -30,6 +47,10 @@ class AlreadyExists(Exception):
     """A unit with the given name already exists."""
 
 
+class NeverCreated(Exception):
+    """Docker never reported a newly created container as existing."""
+
+
 @attributes(["variables"])
 class Environment(object):
     """
@@ -202,6 +223,39 @@ class IDockerClient(Interface):
         :return: ``Deferred`` firing with ``set`` of :class:`Unit`.
         """
 
+    def pull(image_name):
+        """
+        Make sure the given image is available locally, pulling it if it
+        isn't. Images that are already present are not pulled again, and
+        images this client already made sure of are not even checked again.
+
+        :param unicode image_name: The Docker image to pull, e.g.
+            ``u"busybox:latest"``.
+
+        :return: ``Deferred`` that fires once the image is available.
+        """
+
+
+class IDockerEventSource(Interface):
+    """
+    A source of the events reported by Docker's events API.
+    """
+    def subscribe(event_received):
+        """
+        Start receiving events.
+
+        Events reported shortly before the subscription was made may be
+        delivered too, so that none are missed while it is being set up.
+
+        :param event_received: Callable called in the reactor thread with
+            the ``dict`` describing each event, e.g. ``{u"id": u"abc",
+            u"status": u"die", u"from": u"busybox:latest", u"time": 1}``.
+
+        :return: ``Deferred`` that fires when the subscription ends, e.g.
+            because the connection to Docker was lost. Cancelling it ends
+            the subscription.
+        """
+
 
 @implementer(IDockerClient)
 class FakeDockerClient(object):
@@ -210,6 +264,7 @@ class FakeDockerClient(object):
     The state the the simulated units is stored in memory.
 
     :ivar dict _units: See ``units`` of ``__init__``\ .
+    :ivar set pulled_images: The names of the images that were pulled.
     """
 
     def __init__(self, units=None):
@@ -222,6 +277,7 @@ class FakeDockerClient(object):
         if units is None:
             units = {}
         self._units = units
+        self.pulled_images = set()
 
     def add(self, unit_name, image_name, ports=frozenset(), environment=None,
             volumes=frozenset(), mem_limit=None, cpu_shares=None,
@@ -254,6 +310,65 @@ class FakeDockerClient(object):
         units = set(self._units.values())
         return succeed(units)
 
+    def pull(self, image_name):
+        self.pulled_images.add(image_name)
+        return succeed(None)
+
+
+@implementer(IDockerEventSource)
+class FakeDockerEventSource(object):
+    """
+    In-memory fake of a source of Docker events, which delivers the events
+    it is told to.
+
+    :ivar list subscriptions: The ``Deferred`` returned by each call to
+        ``subscribe``.
+    """
+    def __init__(self):
+        self.subscriptions = []
+        self._event_received = None
+
+    def subscribe(self, event_received):
+        d = Deferred(lambda _: self._ended())
+        self.subscriptions.append(d)
+        self._event_received = event_received
+        return d
+
+    @property
+    def subscribed(self):
+        """
+        Whether there is a current subscription.
+        """
+        return self._event_received is not None
+
+    def _ended(self):
+        self._event_received = None
+
+    def event(self, container_id, status):
+        """
+        Deliver an event to the current subscriber, if any.
+
+        :param unicode container_id: The ID of the container.
+        :param unicode status: The status of the event, e.g. ``u"die"``.
+        """
+        if self._event_received is not None:
+            self._event_received({u"id": container_id, u"status": status})
+
+    def disconnect(self, reason=None):
+        """
+        End the current subscription as if the connection to Docker was
+        lost.
+
+        :param reason: ``Failure`` to fail the subscription with, or
+            ``None`` to end it successfully.
+        """
+        self._ended()
+        d = self.subscriptions[-1]
+        if reason is None:
+            d.callback(None)
+        else:
+            d.errback(reason)
+
 
 @attributes(['internal_port', 'external_port'])
 class PortMap(object):
@@ -270,24 +385,235 @@ class PortMap(object):
 BASE_NAMESPACE = u"flocker--"
 BASE_DOCKER_API_URL = u'unix://var/run/docker.sock'
 
+# The maximum number of containers ``DockerClient.list`` inspects at once:
+INSPECT_CONCURRENCY = 8
+
+# ``DockerClient`` runs operations that can block for a long time (pulling
+# images, stopping containers) in a separate thread pool ("lane") from the
+# short ones (listing and inspecting) so the former cannot starve the
+# latter. These are the default number of threads in each lane:
+LONG_OPERATION_THREADS = 4
+SHORT_OPERATION_THREADS = 8
+
+LONG_LANE = u"long"
+SHORT_LANE = u"short"
+# The lane running event subscriptions, which occupy their thread for as
+# long as they last:
+EVENTS_LANE = u"events"
+EVENTS_THREADS = 1
+
+# Seconds to wait before subscribing to Docker events again after a
+# subscription ended unexpectedly:
+RESUBSCRIBE_DELAY = 1.0
+
+# The statuses of Docker events that may change the state of a container:
+CONTAINER_STATE_EVENTS = frozenset([
+    u"create", u"start", u"die", u"destroy", u"pause", u"unpause",
+])
+
+# An event subscription asks Docker for the events of consecutive windows
+# of this many seconds, so that it notices being cancelled in between:
+EVENTS_WINDOW = 1
+
+LOG_DOCKER_OPERATION = MessageType(
+    u"flocker:node:docker:operation",
+    fields(operation=unicode, lane=unicode, queue_depth=int,
+           wait=float, duration=float, succeeded=bool, round_trips=int),
+    u"A Docker operation finished. The queue depth is the number of "
+    u"operations that were waiting for a thread in the same lane when it "
+    u"was submitted; wait and duration are in seconds; round trips is the "
+    u"number of Docker API requests the operation made.")
+
+# Seconds to wait for Docker to report an event telling us a container is
+# ready before falling back to polling:
+READINESS_EVENT_TIMEOUT = 5
+# Seconds between polls of the fallback start at the minimum and double up
+# to the maximum. Polling gives up after the timeout:
+MINIMUM_POLL_DELAY = 0.001
+MAXIMUM_POLL_DELAY = 0.5
+READINESS_TIMEOUT = 60.0
+
+
+def _backoff(minimum=MINIMUM_POLL_DELAY, maximum=MAXIMUM_POLL_DELAY,
+             timeout=READINESS_TIMEOUT):
+    """
+    Generate exponentially increasing delays.
 
-@implementer(IDockerClient)
-class DockerClient(object):
+    :param float minimum: The first delay.
+    :param float maximum: The largest delay.
+    :param float timeout: Stop once sleeping for all the delays generated
+        so far would take longer than this.
+
+    :return: Iterator of ``float`` delays in seconds.
     """
-    Talk to the real Docker server directly.
+    delay = minimum
+    total = 0
+    while total + delay <= timeout:
+        yield delay
+        total += delay
+        delay = min(delay * 2, maximum)
 
-    Some operations can take a while (e.g. stopping a container), so we
-    use a thread pool. See https://clusterhq.atlassian.net/browse/FLOC-718
-    for using a custom thread pool.
+
+class _UnixConnection(UnixHTTPConnection):
+    """
+    A connection to the Docker daemon's Unix socket.
+
+    Unlike ``docker-py``'s connections, which always request the URL they
+    were created for, this sends the path of each request so that the
+    connection can be reused for different requests.
+    """
+    def __init__(self, base_url, timeout):
+        """
+        :param bytes base_url: The ``http+unix://`` URL of the socket.
+        :param timeout: Socket timeout in seconds.
+        """
+        UnixHTTPConnection.__init__(self, base_url, base_url, timeout)
+        # ``requests`` treats the first segment of the socket path as the
+        # host name and the rest as the start of the request path:
+        self._path_prefix = urlparse(base_url).path
+
+    def request(self, method, url, **kwargs):
+        if url.startswith(self._path_prefix):
+            url = url[len(self._path_prefix):]
+        HTTPConnection.request(self, method, url, **kwargs)
+
+
+class _UnixConnectionPool(HTTPConnectionPool):
+    """
+    A pool of keep-alive connections to the Docker daemon's Unix socket.
+    """
+    def __init__(self, base_url, timeout, maxsize):
+        """
+        :param bytes base_url: The ``http+unix://`` URL of the socket.
+        :param timeout: Socket timeout in seconds.
+        :param int maxsize: The maximum number of idle connections kept.
+        """
+        HTTPConnectionPool.__init__(
+            self, "localhost", timeout=timeout, maxsize=maxsize)
+        self._base_url = base_url
+        self._socket_timeout = timeout
+
+    def _new_conn(self):
+        return _UnixConnection(self._base_url, self._socket_timeout)
+
+
+class _UnixAdapter(HTTPAdapter):
+    """
+    A ``requests`` transport adapter that sends all requests through one
+    ``_UnixConnectionPool``.
+
+    ``docker-py``'s own adapter keys its pools by request URL and keeps a
+    single connection in each, so most requests open a new connection.
+    """
+    def __init__(self, base_url, timeout, maxsize):
+        self._pool = _UnixConnectionPool(base_url, timeout, maxsize)
+        HTTPAdapter.__init__(self)
+
+    def get_connection(self, url, proxies=None):
+        return self._pool
+
+    def close(self):
+        self._pool.close()
+
+
+class _PooledClient(Client):
+    """
+    A Docker API client that keeps a pool of keep-alive connections to the
+    daemon and counts the requests made by each thread.
+    """
+    def __init__(self, base_url, pool_size, **kwargs):
+        """
+        :param unicode base_url: The URL of the Docker API.
+        :param int pool_size: The maximum number of connections kept open;
+            this should be the number of threads using the client.
+        """
+        Client.__init__(self, base_url=base_url, **kwargs)
+        if self.base_url.startswith("http+unix://"):
+            self.mount("http+unix://",
+                       _UnixAdapter(self.base_url, self._timeout, pool_size))
+        else:
+            self.mount("http://", HTTPAdapter(pool_connections=1,
+                                              pool_maxsize=pool_size))
+        self._counts = local()
+
+    def request(self, *args, **kwargs):
+        self._counts.round_trips = self.round_trips() + 1
+        return Client.request(self, *args, **kwargs)
+
+    def round_trips(self):
+        """
+        :return: The number of requests made by the current thread since the
+            last call to ``reset_round_trips``.
+        """
+        return getattr(self._counts, "round_trips", 0)
+
+    def reset_round_trips(self):
+        """
+        Start counting requests made by the current thread from zero.
+        """
+        self._counts.round_trips = 0
+
+
+class OperationStatistics(object):
+    """
+    Statistics for one type of operation performed by ``DockerClient``.
+
+    :ivar int pending: Number of operations submitted that have not yet
+        finished.
+    :ivar int maximum_pending: The largest value ``pending`` has had.
+    :ivar int succeeded: Number of operations that succeeded.
+    :ivar int failed: Number of operations that failed.
+    :ivar float wait_time: Total seconds operations spent waiting for a
+        thread.
+    :ivar float run_time: Total seconds operations spent running.
+    :ivar int round_trips: Total number of Docker API requests made by
+        operations.
+    """
+    def __init__(self):
+        self.pending = 0
+        self.maximum_pending = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+        self.round_trips = 0
+
+    def submitted(self):
+        """
+        Record the submission of an operation.
+        """
+        self.pending += 1
+        self.maximum_pending = max(self.maximum_pending, self.pending)
+
+    def finished(self, wait_time, run_time, succeeded, round_trips):
+        """
+        Record the completion of an operation.
+
+        :param float wait_time: Seconds the operation waited for a thread.
+        :param float run_time: Seconds the operation ran for.
+        :param bool succeeded: Whether the operation succeeded.
+        :param int round_trips: The number of Docker API requests the
+            operation made.
+        """
+        self.pending -= 1
+        self.wait_time += wait_time
+        self.run_time += run_time
+        self.round_trips += round_trips
+        if succeeded:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+
+
+class _DockerAPIHelpers(object):
+    """
+    Conversions between Flocker's model and the data of the Docker API,
+    shared by the ``IDockerClient`` implementations talking to a real Docker
+    server.
 
     :ivar unicode namespace: A namespace prefix to add to container names
         so we don't clobber other applications interacting with Docker.
     """
-    def __init__(self, namespace=BASE_NAMESPACE,
-                 base_url=BASE_DOCKER_API_URL):
-        self.namespace = namespace
-        self._client = Client(version="1.15", base_url=base_url)
-
     def _to_container_name(self, unit_name):
         """
         Add the namespace to the container name.
@@ -387,6 +713,203 @@ class DockerClient(object):
         except KeyError:
             raise ValueError("Unknown restart policy: %r" % (restart_policy,))
 
+    def _is_namespaced(self, name):
+        """
+        :param unicode name: A container name as reported by Docker,
+            e.g. ``u"/flocker--myapp"``.
+
+        :return: ``True`` if the name is that of a container in our
+            namespace. Names of link aliases (``u"/other/alias"``) are
+            never ours.
+        """
+        return (name.startswith(u"/" + self.namespace)
+                and u"/" not in name[1:])
+
+    def _unit_from_inspection(self, data):
+        """
+        Convert the result of inspecting a container to a ``Unit``.
+
+        :param dict data: The container as returned by Docker's inspect API.
+
+        :return: The ``Unit`` for the container or ``None`` if it is not in
+            our namespace.
+        """
+        name = data[u"Name"]
+        if not self._is_namespaced(name):
+            return None
+        name = name[1 + len(self.namespace):]
+        state = (u"active" if data[u"State"][u"Running"]
+                 else u"inactive")
+        image = data[u"Config"][u"Image"]
+        port_bindings = data[u"HostConfig"][u"PortBindings"]
+        if port_bindings is not None:
+            ports = self._parse_container_ports(port_bindings)
+        else:
+            ports = list()
+        volumes = []
+        binds = data[u"HostConfig"]['Binds']
+        if binds is not None:
+            for bind_config in binds:
+                parts = bind_config.split(':', 2)
+                node_path, container_path = parts[:2]
+                volumes.append(
+                    Volume(container_path=FilePath(container_path),
+                           node_path=FilePath(node_path))
+                )
+        # Our Unit model counts None as the value for cpu_shares and
+        # mem_limit in containers without specified limits, however
+        # Docker returns the values in these cases as zero, so we
+        # manually convert.
+        cpu_shares = data[u"Config"][u"CpuShares"]
+        cpu_shares = None if cpu_shares == 0 else cpu_shares
+        mem_limit = data[u"Config"][u"Memory"]
+        mem_limit = None if mem_limit == 0 else mem_limit
+        restart_policy = self._parse_restart_policy(
+            data[U"HostConfig"][u"RestartPolicy"])
+        return Unit(
+            name=name,
+            container_name=self._to_container_name(name),
+            activation_state=state,
+            container_image=image,
+            ports=frozenset(ports),
+            volumes=frozenset(volumes),
+            mem_limit=mem_limit,
+            cpu_shares=cpu_shares,
+            restart_policy=restart_policy)
+
+
+@implementer(IDockerClient, IDockerEventSource)
+class DockerClient(_DockerAPIHelpers):
+    """
+    Talk to the real Docker server directly.
+
+    Some operations can take a while (e.g. stopping a container), so we
+    use thread pools owned by the client: one lane for long operations
+    (pulling, adding, which may pull an image, and removing, which stops
+    the container) and one for short ones (checking existence, listing and
+    inspecting). Neither competes with the reactor's shared thread pool.
+    Requests are sent over a pool of keep-alive connections with one
+    connection per thread.
+
+    ``list`` only inspects containers in the namespace, does so with at most
+    ``INSPECT_CONCURRENCY`` inspections at a time, and remembers the
+    results until the Docker events API reports a change to the container.
+
+    It is also an ``IDockerEventSource``; subscriptions run in a lane of
+    their own.
+
+    :ivar unicode namespace: A namespace prefix to add to container names
+        so we don't clobber other applications interacting with Docker.
+    :ivar dict statistics: Maps operation names (e.g. ``u"list"``) to the
+        ``OperationStatistics`` for that operation.
+    """
+    logger = Logger()
+
+    def __init__(self, namespace=BASE_NAMESPACE,
+                 base_url=BASE_DOCKER_API_URL, reactor=None,
+                 long_operation_threads=LONG_OPERATION_THREADS,
+                 short_operation_threads=SHORT_OPERATION_THREADS):
+        """
+        :param unicode namespace: See ``namespace``.
+        :param unicode base_url: The URL of the Docker API.
+        :param reactor: The reactor to use; the global reactor by default.
+        :param int long_operation_threads: Maximum number of threads
+            running long operations.
+        :param int short_operation_threads: Maximum number of threads
+            running short operations.
+        """
+        self.namespace = namespace
+        self._client = _PooledClient(
+            version="1.15", base_url=base_url,
+            pool_size=(long_operation_threads + short_operation_threads +
+                       EVENTS_THREADS))
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._lane_sizes = {
+            LONG_LANE: long_operation_threads,
+            SHORT_LANE: short_operation_threads,
+            EVENTS_LANE: EVENTS_THREADS,
+        }
+        self._thread_pools = {}
+        self.statistics = {}
+        # Units for containers that have already been inspected, keyed by
+        # container ID. Entries are dropped when Docker reports events for
+        # the container.
+        self._units = {}
+        # Full names of the images known to be present locally. ``add``
+        # discards an image if Docker turns out not to have it after all.
+        self._local_images = set()
+        self._events_checked = None
+        self._inspecting = DeferredSemaphore(INSPECT_CONCURRENCY)
+
+    def _thread_pool(self, lane):
+        """
+        Get the thread pool for a lane, starting it if necessary. The pool
+        is stopped when the reactor shuts down.
+
+        :param unicode lane: ``LONG_LANE``, ``SHORT_LANE`` or
+            ``EVENTS_LANE``.
+
+        :return: A running ``ThreadPool``.
+        """
+        pool = self._thread_pools.get(lane)
+        if pool is None:
+            pool = ThreadPool(minthreads=0, maxthreads=self._lane_sizes[lane],
+                              name="docker-%s" % (lane,))
+            pool.start()
+            self._reactor.addSystemEventTrigger(
+                "during", "shutdown", pool.stop)
+            self._thread_pools[lane] = pool
+        return pool
+
+    def _run_in_lane(self, lane, operation, f, *args, **kwargs):
+        """
+        Run a blocking function in a thread of the given lane, recording
+        its queueing and running time.
+
+        :param unicode lane: ``LONG_LANE``, ``SHORT_LANE`` or
+            ``EVENTS_LANE``.
+        :param unicode operation: The name of the operation, used as key
+            in ``statistics`` and for logging.
+        :param f: The function to call with the remaining arguments.
+
+        :return: ``Deferred`` that fires with the result of ``f``.
+        """
+        pool = self._thread_pool(lane)
+        statistics = self.statistics.setdefault(
+            operation, OperationStatistics())
+        statistics.submitted()
+        queue_depth = pool.q.qsize()
+        submitted = time()
+        started = []
+        round_trips = []
+
+        def run():
+            started.append(time())
+            self._client.reset_round_trips()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                round_trips.append(self._client.round_trips())
+        d = deferToThreadPool(self._reactor, pool, run)
+
+        def finished(result):
+            now = time()
+            start = started[0] if started else now
+            succeeded = not isinstance(result, Failure)
+            requests = round_trips[0] if round_trips else 0
+            statistics.finished(
+                start - submitted, now - start, succeeded, requests)
+            LOG_DOCKER_OPERATION(
+                operation=operation, lane=lane, queue_depth=queue_depth,
+                wait=start - submitted, duration=now - start,
+                succeeded=succeeded, round_trips=requests,
+            ).write(self.logger)
+            return result
+        d.addBoth(finished)
+        return d
+
     def add(self, unit_name, image_name, ports=None, environment=None,
             volumes=(), mem_limit=None, cpu_shares=None,
             restart_policy=RestartNever()):
@@ -416,7 +939,7 @@ class DockerClient(object):
                 port_bindings=port_bindings,
                 restart_policy=restart_policy_dict,
             )
-            self._client.create_container(
+            return self._client.create_container(
                 name=container_name,
                 image=image_name,
                 command=None,
@@ -428,25 +951,28 @@ class DockerClient(object):
             )
 
         def _add():
+            since = int(time()) - 1
             try:
-                _create()
+                container = _create()
             except APIError as e:
                 if e.response.status_code == NOT_FOUND:
                     # Image was not found, so we need to pull it first:
+                    self._local_images.discard(image_name)
                     self._client.pull(image_name)
-                    _create()
+                    container = _create()
                 else:
                     raise
             # Just because we got a response doesn't mean Docker has
             # actually updated any internal state yet! So if e.g. we did a
             # stop on this container Docker might well complain it knows
-            # not the container of which we speak. To prevent this we poll
+            # not the container of which we speak. To prevent this we wait
             # until it does exist.
-            while not self._blocking_exists(container_name):
-                sleep(0.001)
-                continue
+            if not self._wait_until_ready(
+                    lambda: self._blocking_exists(container_name),
+                    container[u"Id"], {u"create"}, since):
+                raise NeverCreated(unit_name)
             self._client.start(container_name)
-        d = deferToThread(_add)
+        d = self._run_in_lane(LONG_LANE, u"add", _add)
 
         def _extract_error(failure):
             failure.trap(APIError)
@@ -472,14 +998,80 @@ class DockerClient(object):
         except APIError:
             return False
 
+    def _wait_for_event(self, container_id, statuses, since,
+                        timeout=READINESS_EVENT_TIMEOUT):
+        """
+        Blocking API to wait for Docker to report an event for a container.
+
+        :param unicode container_id: The ID of the container.
+        :param set statuses: The statuses of the events to wait for, e.g.
+            ``{u"create"}``.
+        :param int since: Timestamp from which to consider events.
+        :param timeout: Seconds to wait for the event.
+
+        :return: ``True`` if the event was reported, ``False`` if it was
+            not reported within the timeout or the events could not be
+            retrieved.
+        """
+        try:
+            response = self._client._get(
+                self._client._url("/events"),
+                params={"since": since, "until": int(time() + timeout) + 1},
+                stream=True)
+            try:
+                self._client._raise_for_status(response)
+                for event in _iter_events(
+                        self._client._stream_helper(response)):
+                    if (event.get(u"id") == container_id
+                            and event.get(u"status") in statuses):
+                        return True
+            finally:
+                # The rest of the stream hasn't been read, so the
+                # connection can't be reused:
+                _discard_connection(response)
+        except (APIError, RequestException):
+            pass
+        return False
+
+    def _wait_until_ready(self, ready, container_id, statuses, since):
+        """
+        Blocking API to wait until a container is ready.
+
+        If it isn't ready immediately, wait for Docker to report one of the
+        given events for the container and check again, falling back to
+        polling with exponential backoff if that doesn't help.
+
+        :param ready: Callable returning whether the container is ready.
+        :param unicode container_id: The ID of the container.
+        :param set statuses: The statuses of the events which may indicate
+            readiness.
+        :param int since: Timestamp from which to consider events.
+
+        :return: ``True`` if the container became ready, ``False`` if it
+            didn't before the polling gave up.
+        """
+        if ready():
+            return True
+        if self._wait_for_event(container_id, statuses, since) and ready():
+            return True
+        for delay in _backoff():
+            sleep(delay)
+            if ready():
+                return True
+        return False
+
     def exists(self, unit_name):
         container_name = self._to_container_name(unit_name)
-        return deferToThread(self._blocking_exists, container_name)
+        return self._run_in_lane(
+            SHORT_LANE, u"exists", self._blocking_exists, container_name)
 
     def remove(self, unit_name):
         container_name = self._to_container_name(unit_name)
 
         def _remove():
+            since = int(time()) - 1
+            delays = _backoff()
+            waited_for_death = False
             while True:
                 # There is a race condition between a process dying and
                 # docker noticing that fact.
@@ -496,8 +1088,26 @@ class DockerClient(object):
                         break
                     elif e.response.status_code == INTERNAL_SERVER_ERROR:
                         # Docker returns this if the process had died, but
-                        # hasn't noticed it yet.
-                        continue
+                        # hasn't noticed it yet. Wait for Docker to report
+                        # the death, and after that back off between
+                        # attempts.
+                        if not waited_for_death:
+                            waited_for_death = True
+                            try:
+                                container_id = self._client.inspect_container(
+                                    container_name)[u"Id"]
+                            except APIError:
+                                continue
+                            if self._wait_for_event(
+                                    container_id, {u"die"}, since):
+                                continue
+                        delay = next(delays, None)
+                        if delay is None:
+                            # The bare form would re-raise whichever
+                            # exception was handled most recently while
+                            # waiting, not this one:
+                            raise e
+                        sleep(delay)
                     else:
                         raise
                 else:
@@ -513,70 +1123,237 @@ class DockerClient(object):
                 # Can't figure out how to get test coverage for this, but
                 # it's definitely necessary:
                 raise
-        d = deferToThread(_remove)
+        d = self._run_in_lane(LONG_LANE, u"remove", _remove)
         return d
 
+    def _blocking_pull(self, image_name):
+        """
+        Blocking API to pull an image unless it is already present.
+
+        :param unicode image_name: The name of the image to pull.
+        """
+        if image_name in self._local_images:
+            return
+        try:
+            self._client.inspect_image(image_name)
+        except APIError as e:
+            if e.response.status_code != NOT_FOUND:
+                raise
+            self._client.pull(image_name)
+        self._local_images.add(image_name)
+
+    def pull(self, image_name):
+        return self._run_in_lane(
+            LONG_LANE, u"pull", self._blocking_pull, image_name)
+
+    def _container_events(self, since, until):
+        """
+        Blocking API to find the containers Docker reported events for in
+        the given time range.
+
+        :param int since: Timestamp of the start of the range.
+        :param int until: Timestamp of the end of the range.
+
+        :return: ``set`` of IDs of containers that had events, or ``None``
+            if the events could not be retrieved.
+        """
+        try:
+            response = self._client._get(
+                self._client._url("/events"),
+                params={"since": since, "until": until})
+            self._client._raise_for_status(response)
+        except APIError:
+            return None
+        return {event[u"id"] for event in _parse_events(response.text)
+                if u"id" in event}
+
+    def _blocking_list(self, since):
+        """
+        Blocking API to list containers in our namespace.
+
+        :param since: Timestamp from which container events should be
+            retrieved or ``None`` if no events are needed.
+
+        :return: Tuple of the timestamp the listing was made at, the
+            ``set`` of IDs of containers that changed since ``since`` (or
+            ``None`` if that is not known) and the IDs of containers in our
+            namespace.
+        """
+        now = int(time())
+        changed = None
+        if since is not None:
+            changed = self._container_events(since, now)
+        ids = [container[u"Id"]
+               for container in self._client.containers(all=True)
+               if any(self._is_namespaced(name)
+                      for name in container.get(u"Names") or ())]
+        return now, changed, ids
+
+    def _blocking_inspect(self, container_id):
+        """
+        Blocking API to inspect a container and convert it to a ``Unit``.
+
+        :param unicode container_id: The ID of the container to inspect.
+
+        :return: The ``Unit`` for the container or ``None`` if it no longer
+            exists or is not in our namespace.
+        """
+        try:
+            data = self._client.inspect_container(container_id)
+        except APIError as e:
+            # The container ID returned by the list API call may have been
+            # removed in the meantime.
+            if e.response.status_code == NOT_FOUND:
+                return None
+            raise
+        return self._unit_from_inspection(data)
+
     def list(self):
-        def _list():
-            result = set()
-            ids = [d[u"Id"] for d in
-                   self._client.containers(quiet=True, all=True)]
-            for i in ids:
+        since = None
+        if self._units and self._events_checked is not None:
+            since = self._events_checked
+        d = self._run_in_lane(
+            SHORT_LANE, u"list", self._blocking_list, since)
+
+        def inspect((now, changed, ids)):
+            # Go back a second, since event timestamps have a granularity
+            # of one second and we may otherwise miss events that happened
+            # in the same second as the listing.
+            self._events_checked = now - 1
+            if changed is None:
+                self._units.clear()
+            units = {}
+            for container_id in ids:
+                if (container_id in self._units
+                        and container_id not in changed):
+                    units[container_id] = self._units[container_id]
+            self._units = units
+
+            missing = [i for i in ids if i not in units]
+            inspecting = gatherResults(
+                [self._inspecting.run(
+                    self._run_in_lane, SHORT_LANE, u"inspect",
+                    self._blocking_inspect, container_id)
+                 for container_id in missing],
+                consumeErrors=True)
+            inspecting.addErrback(_unwrap_first_error)
+
+            def inspected(results):
+                for container_id, unit in zip(missing, results):
+                    if unit is not None:
+                        self._units[container_id] = unit
+                return {self._units[container_id] for container_id in ids
+                        if container_id in self._units}
+            inspecting.addCallback(inspected)
+            return inspecting
+        d.addCallback(inspect)
+        return d
 
-                try:
-                    data = self._client.inspect_container(i)
-                except APIError as e:
-                    # The container ID returned by the list API call above, may
-                    # have been removed in another thread.
-                    if e.response.status_code == NOT_FOUND:
-                        continue
-
-                state = (u"active" if data[u"State"][u"Running"]
-                         else u"inactive")
-                name = data[u"Name"]
-                image = data[u"Config"][u"Image"]
-                port_bindings = data[u"HostConfig"][u"PortBindings"]
-                if port_bindings is not None:
-                    ports = self._parse_container_ports(port_bindings)
-                else:
-                    ports = list()
-                volumes = []
-                binds = data[u"HostConfig"]['Binds']
-                if binds is not None:
-                    for bind_config in binds:
-                        parts = bind_config.split(':', 2)
-                        node_path, container_path = parts[:2]
-                        volumes.append(
-                            Volume(container_path=FilePath(container_path),
-                                   node_path=FilePath(node_path))
-                        )
-                if name.startswith(u"/" + self.namespace):
-                    name = name[1 + len(self.namespace):]
-                else:
-                    continue
-                # Our Unit model counts None as the value for cpu_shares and
-                # mem_limit in containers without specified limits, however
-                # Docker returns the values in these cases as zero, so we
-                # manually convert.
-                cpu_shares = data[u"Config"][u"CpuShares"]
-                cpu_shares = None if cpu_shares == 0 else cpu_shares
-                mem_limit = data[u"Config"][u"Memory"]
-                mem_limit = None if mem_limit == 0 else mem_limit
-                restart_policy = self._parse_restart_policy(
-                    data[U"HostConfig"][u"RestartPolicy"])
-                result.add(Unit(
-                    name=name,
-                    container_name=self._to_container_name(name),
-                    activation_state=state,
-                    container_image=image,
-                    ports=frozenset(ports),
-                    volumes=frozenset(volumes),
-                    mem_limit=mem_limit,
-                    cpu_shares=cpu_shares,
-                    restart_policy=restart_policy)
-                )
-            return result
-        return deferToThread(_list)
+    def _blocking_events(self, event_received, cancelled):
+        """
+        Blocking API to deliver Docker events to the reactor thread until
+        the subscription is cancelled.
+
+        :param event_received: See ``IDockerEventSource.subscribe``.
+        :param list cancelled: Becomes non-empty when the subscription is
+            cancelled.
+        """
+        since = int(time()) - 1
+        while not cancelled:
+            until = int(time()) + EVENTS_WINDOW
+            response = self._client._get(
+                self._client._url("/events"),
+                params={"since": since, "until": until},
+                stream=True, timeout=None)
+            try:
+                self._client._raise_for_status(response)
+                for event in _iter_events(
+                        self._client._stream_helper(response)):
+                    if cancelled:
+                        break
+                    self._reactor.callFromThread(event_received, event)
+            finally:
+                if cancelled:
+                    _discard_connection(response)
+            # Events in the second at the boundary may be delivered twice,
+            # which is better than not at all:
+            since = until
+
+    def subscribe(self, event_received):
+        cancelled = []
+        result = Deferred(lambda _: cancelled.append(True))
+        d = self._run_in_lane(EVENTS_LANE, u"events", self._blocking_events,
+                              event_received, cancelled)
+
+        def finished(value):
+            if result.called:
+                # Already cancelled.
+                return
+            if isinstance(value, Failure):
+                result.errback(value)
+            else:
+                result.callback(value)
+        d.addBoth(finished)
+        return result
+
+
+def _discard_connection(response):
+    """
+    Close the connection of a partially read streaming response before it
+    is returned to its pool, so that it is not reused.
+
+    :param requests.Response response: The response.
+    """
+    connection = getattr(response.raw, "_connection", None)
+    if connection is not None:
+        connection.close()
+    response.close()
+
+
+def _unwrap_first_error(failure):
+    """
+    Unwrap the ``FirstError`` from ``gatherResults`` so callers see the
+    original failure.
+    """
+    failure.trap(FirstError)
+    return failure.value.subFailure
+
+
+def _iter_events(chunks):
+    """
+    Parse a streamed response of the Docker events API.
+
+    :param chunks: Iterable of ``bytes`` chunks of the response body. JSON
+        objects may be split across chunks.
+
+    :return: Iterator of ``dict`` for the events.
+    """
+    decoder = JSONDecoder()
+    buffered = u""
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode("utf-8")
+        buffered = (buffered + chunk).lstrip()
+        while buffered:
+            try:
+                event, index = decoder.raw_decode(buffered)
+            except ValueError:
+                # Incomplete object; wait for the rest of it:
+                break
+            yield event
+            buffered = buffered[index:].lstrip()
+
+
+def _parse_events(text):
+    """
+    Parse the response of the Docker events API, which is a sequence of
+    concatenated JSON objects.
+
+    :param unicode text: The body of the response.
+
+    :return: ``list`` of ``dict`` for the events.
+    """
+    return list(_iter_events([text]))
 
 
 class NamespacedDockerClient(proxyForInterface(IDockerClient, "_client")):
@@ -594,6 +1371,181 @@ class NamespacedDockerClient(proxyForInterface(IDockerClient, "_client")):
     def __init__(self, namespace, base_url=BASE_DOCKER_API_URL):
         """
         :param unicode namespace: Namespace to restrict containers to.
+        :param unicode base_url: The URL of the Docker API.
         """
         self._client = DockerClient(
-            namespace=BASE_NAMESPACE + namespace + u"--")
+            namespace=BASE_NAMESPACE + namespace + u"--", base_url=base_url)
+
+
+class DockerStateWatcher(proxyForInterface(IDockerClient, "_client"),
+                         Service):
+    """
+    A Docker client whose ``list`` answers from an in-memory map of units
+    kept current by following Docker's events.
+
+    While running it is subscribed to an ``IDockerEventSource``. Events
+    that may change the state of a container cause the map to be
+    refreshed by listing the wrapped client's units, as does every
+    ``add`` and ``remove`` made through the watcher. Whenever
+    (re)subscribing it resynchronises the map with a full list. ``list``
+    returns the map once it is in sync, waiting for pending refreshes, and
+    falls back to the wrapped client while it is not.
+
+    :ivar dict units: Maps unit names to the ``Unit`` last seen.
+    :ivar bool synchronised: Whether ``units`` is kept current by events.
+    """
+    logger = Logger()
+
+    def __init__(self, client, event_source, reactor=None,
+                 resubscribe_delay=RESUBSCRIBE_DELAY):
+        """
+        :param IDockerClient client: The client to wrap.
+        :param IDockerEventSource event_source: The source of the events
+            about the containers of ``client``.
+        :param reactor: The reactor to use; the global reactor by default.
+        :param float resubscribe_delay: Seconds to wait before subscribing
+            again after a subscription ended unexpectedly.
+        """
+        self._client = client
+        self._event_source = event_source
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._resubscribe_delay = resubscribe_delay
+        self.units = {}
+        self.synchronised = False
+        self._subscription = None
+        self._resubscribe_call = None
+        # Whether a listing is in progress, whether another one is needed
+        # once it is done and whether the next successful listing puts
+        # ``units`` in sync:
+        self._refreshing = False
+        self._stale = False
+        self._resynchronise = False
+        self._waiting = []
+        self._callbacks = []
+
+    def notify_on_change(self, callback):
+        """
+        Call a function whenever the units change.
+
+        :param callback: Callable taking no arguments, called in the
+            reactor thread.
+        """
+        self._callbacks.append(callback)
+
+    def startService(self):
+        Service.startService(self)
+        self._subscribe()
+
+    def stopService(self):
+        Service.stopService(self)
+        self.synchronised = False
+        if self._resubscribe_call is not None:
+            self._resubscribe_call.cancel()
+            self._resubscribe_call = None
+        if self._subscription is not None:
+            self._subscription.cancel()
+
+    def _subscribe(self):
+        """
+        Subscribe to events and resynchronise the units, arranging to
+        subscribe again if the subscription ends while running.
+        """
+        self._resubscribe_call = None
+        self._subscription = self._event_source.subscribe(
+            self._event_received)
+
+        def ended(result):
+            self._subscription = None
+            self.synchronised = False
+            if isinstance(result, Failure):
+                # Stopping cancels the subscription, which isn't an error:
+                if self.running or not result.check(CancelledError):
+                    write_failure(result, self.logger,
+                                  u"flocker:node:docker:events")
+            if not self.running:
+                return
+            self._resubscribe_call = self._reactor.callLater(
+                self._resubscribe_delay, self._subscribe)
+        self._subscription.addBoth(ended)
+        if self._subscription is not None:
+            self._resynchronise = True
+            self._refresh()
+
+    def _event_received(self, event):
+        if event.get(u"status") in CONTAINER_STATE_EVENTS:
+            self._refresh()
+
+    def _refresh(self):
+        """
+        Replace ``units`` with a new listing from the wrapped client. If a
+        listing is already in progress another one is made once it is
+        done, since it may have started before the change we were told
+        about.
+        """
+        if self._refreshing:
+            self._stale = True
+            return
+        self._refreshing = True
+        self._stale = False
+        resynchronise = self._resynchronise
+        d = self._client.list()
+
+        def listed(units):
+            units = {unit.name: unit for unit in units}
+            changed = units != self.units
+            self.units = units
+            if resynchronise and self._subscription is not None:
+                self._resynchronise = False
+                self.synchronised = True
+            if changed:
+                for callback in self._callbacks:
+                    callback()
+
+        def failed(reason):
+            write_failure(reason, self.logger, u"flocker:node:docker:list")
+            return reason
+
+        def done(result):
+            self._refreshing = False
+            if self._stale:
+                self._refresh()
+                return
+            waiting, self._waiting = self._waiting, []
+            for waiter in waiting:
+                if isinstance(result, Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(set(self.units.values()))
+        d.addCallbacks(listed, failed)
+        d.addBoth(done)
+
+    def _refresh_after(self, d):
+        """
+        Refresh the units once an operation is done, whether or not it
+        succeeded.
+
+        :param Deferred d: The result of the operation.
+
+        :return: ``d``.
+        """
+        def refresh(result):
+            self._refresh()
+            return result
+        return d.addBoth(refresh)
+
+    def add(self, *args, **kwargs):
+        return self._refresh_after(self._client.add(*args, **kwargs))
+
+    def remove(self, unit_name):
+        return self._refresh_after(self._client.remove(unit_name))
+
+    def list(self):
+        if not self.synchronised:
+            return self._client.list()
+        if not self._refreshing:
+            return succeed(set(self.units.values()))
+        d = Deferred()
+        self._waiting.append(d)
+        return d
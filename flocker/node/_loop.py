@@ -15,7 +15,7 @@ control service, and sends inputs to the ConvergenceLoop state machine.
 
 from zope.interface import implementer
 
-from eliot import ActionType, Field
+from eliot import ActionType, Field, write_failure
 from eliot.twisted import DeferredContext
 
 from characteristic import attributes
@@ -30,7 +30,8 @@ from twisted.python.constants import Names, NamedConstant
 from twisted.internet.protocol import ReconnectingClientFactory
 
 from ..control._protocol import (
-    NodeStateCommand, IConvergenceAgent, AgentAMP,
+    NodeStateCommand, NodeStateHeartbeatCommand, IConvergenceAgent,
+    AgentAMP,
     )
 
 
@@ -195,6 +196,11 @@ class ConvergenceLoopInputs(Names):
     # Finished applying necessary changes to local state, a single
     # iteration of the convergence loop:
     ITERATION_DONE = NamedConstant()
+    # The delay between iterations has passed:
+    WAKEUP = NamedConstant()
+    # Something, e.g. a Docker or ZFS event, indicates the local state may
+    # have changed:
+    LOCAL_STATE_CHANGED = NamedConstant()
 
 
 @attributes(["client", "configuration", "state"])
@@ -221,6 +227,9 @@ class ConvergenceLoopStates(Names):
     # Local state is being converged, and once that is done we will
     # immediately stop:
     CONVERGING_STOPPING = NamedConstant()
+    # Waiting for either the next scheduled iteration or a change that
+    # should be reacted to immediately:
+    SLEEPING = NamedConstant()
 
 
 class ConvergenceLoopOutputs(Names):
@@ -232,6 +241,13 @@ class ConvergenceLoopOutputs(Names):
     STORE_INFO = NamedConstant()
     # Start an iteration of the covergence loop:
     CONVERGE = NamedConstant()
+    # Remember that something changed during the current iteration, so the
+    # next one should follow promptly:
+    NOTE_CHANGE = NamedConstant()
+    # Schedule the next iteration:
+    SCHEDULE_WAKEUP = NamedConstant()
+    # Cancel the scheduled iteration:
+    CANCEL_WAKEUP = NamedConstant()
 
 
 _FIELD_CONNECTION = Field(
@@ -245,11 +261,34 @@ LOG_SEND_TO_CONTROL_SERVICE = ActionType(
     "Send the local state to the control service.")
 
 
+# Poll intervals, in seconds, of the convergence loop when nothing is
+# happening. The interval starts at the minimum and doubles with every
+# iteration that sees no change, up to the maximum:
+MINIMUM_POLL_INTERVAL = 1.0
+MAXIMUM_POLL_INTERVAL = 10.0
+
+# Seconds between heartbeats sent to the control service instead of the
+# unchanged local state:
+HEARTBEAT_INTERVAL = 30.0
+
+
 class ConvergenceLoop(object):
     """
     World object for the convergence loop state machine, executing the actions
     indicated by the outputs from the state machine.
 
+    Rather than sleeping a fixed amount of time between iterations, the
+    loop reacts to changes: a status update or local state change received
+    while sleeping starts a new iteration immediately, and one received
+    during an iteration makes the next one start as soon as the current one
+    is done. Otherwise the loop polls, backing off exponentially from
+    ``minimum_poll_interval`` to ``maximum_poll_interval`` while the local
+    state stays the same.
+
+    Local state is only sent to the control service when it changes; while
+    it stays the same a ``NodeStateHeartbeatCommand`` is sent every
+    ``heartbeat_interval`` seconds instead.
+
     :ivar AMP client: An AMP client connected to the control
         service. Initially ``None``.
 
@@ -259,59 +298,163 @@ class ConvergenceLoop(object):
     :ivar Deployment state: Actual cluster state.  Initially ``None``.
 
     :ivar fsm: The finite state machine this is part of.
+
+    :ivar float poll_interval: The delay before the next iteration if
+        nothing changes.
     """
-    def __init__(self, reactor, deployer):
+    def __init__(self, reactor, deployer,
+                 minimum_poll_interval=MINIMUM_POLL_INTERVAL,
+                 maximum_poll_interval=MAXIMUM_POLL_INTERVAL,
+                 heartbeat_interval=HEARTBEAT_INTERVAL):
         """
         :param IReactorTime reactor: Used to schedule delays in the loop.
 
         :param IDeployer deployer: Used to discover local state and calculate
             necessary changes to match desired configuration.
+
+        :param float minimum_poll_interval: Delay in seconds between
+            iterations while the local state is changing.
+
+        :param float maximum_poll_interval: Longest delay in seconds between
+            iterations while nothing is changing.
+
+        :param float heartbeat_interval: Seconds between heartbeats sent to
+            the control service while the local state is unchanged.
         """
         self.reactor = reactor
+        self.heartbeat_interval = heartbeat_interval
         self.deployer = deployer
+        self.minimum_poll_interval = minimum_poll_interval
+        self.maximum_poll_interval = maximum_poll_interval
+        self.poll_interval = minimum_poll_interval
+        # Whether a change was noted during the current iteration, which
+        # therefore may have been working with outdated information:
+        self._pending_change = False
+        # Whether the current iteration was started by a change or
+        # discovered a different local state than the previous one:
+        self._active = False
+        self._last_local_state = None
+        self._wakeup = None
+        # The last state acknowledged by the control service, the connection
+        # it was sent on and the token identifying it:
+        self._sent_state = None
+        self._sent_client = None
+        self._state_token = None
+        self._last_contact = None
 
     def output_STORE_INFO(self, context):
         self.client, self.configuration, self.cluster_state = (
             context.client, context.configuration, context.state)
+        self._pending_change = True
+
+    def output_NOTE_CHANGE(self, context):
+        self._pending_change = True
+
+    def output_SCHEDULE_WAKEUP(self, context):
+        if self._pending_change:
+            delay = 0
+            self.poll_interval = self.minimum_poll_interval
+        elif self._active:
+            delay = self.poll_interval = self.minimum_poll_interval
+        else:
+            delay = self.poll_interval = min(self.poll_interval * 2,
+                                             self.maximum_poll_interval)
+        self._active = False
+        self._wakeup = self.reactor.callLater(
+            delay, self.fsm.receive, ConvergenceLoopInputs.WAKEUP)
+
+    def output_CANCEL_WAKEUP(self, context):
+        if self._wakeup is not None and self._wakeup.active():
+            self._wakeup.cancel()
+        self._wakeup = None
+        self._active = True
+
+    def _report_local_state(self, local_state):
+        """
+        Tell the control service about the local state.
+
+        The whole state is only sent if it differs from the last state the
+        control service acknowledged on the current connection. Otherwise a
+        heartbeat is sent once ``heartbeat_interval`` seconds have passed
+        since the last contact.
+
+        :param NodeState local_state: The discovered local state.
+        """
+        if (self._state_token is None or self._sent_client is not self.client
+                or self._sent_state != local_state):
+            self._send_local_state(local_state)
+        elif (self.reactor.seconds() - self._last_contact >=
+              self.heartbeat_interval):
+            self._last_contact = self.reactor.seconds()
+            client = self.client
+            sending = client.callRemote(
+                NodeStateHeartbeatCommand, hostname=local_state.hostname,
+                state_token=self._state_token)
+
+            def heartbeat_answered(response):
+                if not response["current"] and client is self.client:
+                    # The control service no longer has our state, e.g.
+                    # because it was restarted:
+                    self._send_local_state(local_state)
+            sending.addCallback(heartbeat_answered)
+            sending.addErrback(write_failure, self.fsm.logger,
+                               u"flocker:agent:heartbeat")
+
+    def _send_local_state(self, local_state):
+        """
+        Send the whole local state to the control service, and remember it
+        once the control service has acknowledged it.
+
+        :param NodeState local_state: The discovered local state.
+        """
+        client = self.client
+        self._state_token = None
+        self._last_contact = self.reactor.seconds()
+        with LOG_SEND_TO_CONTROL_SERVICE(
+                self.fsm.logger, connection=client) as context:
+            sending = client.callRemote(NodeStateCommand,
+                                        node_state=local_state,
+                                        eliot_context=context)
+
+        def acknowledged(response):
+            self._sent_client = client
+            self._sent_state = local_state
+            # Control services that don't support heartbeats don't return
+            # a token, in which case we keep sending the whole state:
+            self._state_token = response.get("state_token")
+        sending.addCallback(acknowledged)
+        sending.addErrback(write_failure, self.fsm.logger,
+                           u"flocker:agent:send_state")
 
     def output_CONVERGE(self, context):
+        self._pending_change = False
         d = DeferredContext(self.deployer.discover_local_state())
 
         def got_local_state(local_state):
+            if local_state != self._last_local_state:
+                self._active = True
+            self._last_local_state = local_state
             # Current cluster state is likely out of date as regards the local
             # state, so update it accordingly:
             self.cluster_state = self.cluster_state.update_node(
                 local_state.to_node()
             )
-            with LOG_SEND_TO_CONTROL_SERVICE(
-                    self.fsm.logger, connection=self.client) as context:
-                self.client.callRemote(NodeStateCommand,
-                                       node_state=local_state,
-                                       eliot_context=context)
+            self._report_local_state(local_state)
             action = self.deployer.calculate_necessary_state_changes(
                 local_state, self.configuration, self.cluster_state
             )
             return action.run(self.deployer)
         d.addCallback(got_local_state)
-
-        # It would be better to have a "quiet time" state in the FSM and
-        # transition to that next, then have a timeout input kick the machine
-        # back around to the beginning of the loop in the FSM.  However, we're
-        # not going to keep this sleep-for-a-bit solution in the long term.
-        # Instead, we'll be more event driven.  So just going with the simple
-        # solution and inserting a side-effect-y delay directly here.
-
         d.addCallback(
-            lambda _:
-                self.reactor.callLater(
-                    1.0, self.fsm.receive, ConvergenceLoopInputs.ITERATION_DONE
-                )
-        )
+            lambda _: self.fsm.receive(ConvergenceLoopInputs.ITERATION_DONE))
         # This needs error handling:
         # https://clusterhq.atlassian.net/browse/FLOC-1357
 
 
-def build_convergence_loop_fsm(reactor, deployer):
+def build_convergence_loop_fsm(reactor, deployer,
+                               minimum_poll_interval=MINIMUM_POLL_INTERVAL,
+                               maximum_poll_interval=MAXIMUM_POLL_INTERVAL,
+                               heartbeat_interval=HEARTBEAT_INTERVAL):
     """
     Create a convergence loop FSM.
 
@@ -319,27 +462,55 @@ def build_convergence_loop_fsm(reactor, deployer):
 
     :param IDeployer deployer: Used to discover local state and calcualte
         necessary changes to match desired configuration.
+
+    :param float minimum_poll_interval: Delay in seconds between iterations
+        while the local state is changing.
+
+    :param float maximum_poll_interval: Longest delay in seconds between
+        iterations while nothing is changing.
+
+    :param float heartbeat_interval: Seconds between heartbeats sent to the
+        control service while the local state is unchanged.
     """
     I = ConvergenceLoopInputs
     O = ConvergenceLoopOutputs
     S = ConvergenceLoopStates
 
     table = TransitionTable()
-    table = table.addTransition(
-        S.STOPPED, I.STATUS_UPDATE, [O.STORE_INFO, O.CONVERGE], S.CONVERGING)
+    table = table.addTransitions(
+        S.STOPPED, {
+            I.STATUS_UPDATE: ([O.STORE_INFO, O.CONVERGE], S.CONVERGING),
+            I.LOCAL_STATE_CHANGED: ([], S.STOPPED),
+        })
     table = table.addTransitions(
         S.CONVERGING, {
+            # Make sure the next iteration follows promptly, since this one
+            # may be using outdated information:
             I.STATUS_UPDATE: ([O.STORE_INFO], S.CONVERGING),
+            I.LOCAL_STATE_CHANGED: ([O.NOTE_CHANGE], S.CONVERGING),
             I.STOP: ([], S.CONVERGING_STOPPING),
-            I.ITERATION_DONE: ([O.CONVERGE], S.CONVERGING),
+            I.ITERATION_DONE: ([O.SCHEDULE_WAKEUP], S.SLEEPING),
         })
     table = table.addTransitions(
         S.CONVERGING_STOPPING, {
             I.STATUS_UPDATE: ([O.STORE_INFO], S.CONVERGING),
+            I.LOCAL_STATE_CHANGED: ([], S.CONVERGING_STOPPING),
             I.ITERATION_DONE: ([], S.STOPPED),
         })
+    table = table.addTransitions(
+        S.SLEEPING, {
+            # React to changes immediately rather than waiting for the
+            # scheduled iteration:
+            I.STATUS_UPDATE: ([O.STORE_INFO, O.CANCEL_WAKEUP, O.CONVERGE],
+                              S.CONVERGING),
+            I.LOCAL_STATE_CHANGED: ([O.CANCEL_WAKEUP, O.CONVERGE],
+                                    S.CONVERGING),
+            I.WAKEUP: ([O.CONVERGE], S.CONVERGING),
+            I.STOP: ([O.CANCEL_WAKEUP], S.STOPPED),
+        })
 
-    loop = ConvergenceLoop(reactor, deployer)
+    loop = ConvergenceLoop(reactor, deployer, minimum_poll_interval,
+                           maximum_poll_interval, heartbeat_interval)
     fsm = constructFiniteStateMachine(
         inputs=I, outputs=O, states=S, initial=S.STOPPED, table=table,
         richInputs=[_ClientStatusUpdate], inputContext={},
@@ -359,17 +530,18 @@ class AgentLoopService(object, MultiService):
             then changing it.
     :ivar host: Host to connect to.
     :ivar port: Port to connect to.
+    :ivar convergence_loop: A convergence loop FSM.
     :ivar cluster_status: A cluster status FSM.
     :ivar factory: The factory used to connect to the control service.
     """
 
     def __init__(self):
         MultiService.__init__(self)
-        convergence_loop = build_convergence_loop_fsm(
+        self.convergence_loop = build_convergence_loop_fsm(
             self.reactor, self.deployer
         )
-        self.logger = convergence_loop.logger
-        self.cluster_status = build_cluster_status_fsm(convergence_loop)
+        self.logger = self.convergence_loop.logger
+        self.cluster_status = build_cluster_status_fsm(self.convergence_loop)
         self.factory = ReconnectingClientFactory.forProtocol(
             lambda: AgentAMP(self))
 
@@ -382,6 +554,15 @@ class AgentLoopService(object, MultiService):
         self.factory.stopTrying()
         self.cluster_status.receive(ClusterStatusInputs.SHUTDOWN)
 
+    def local_state_changed(self):
+        """
+        Notify the convergence loop that the local state may have changed,
+        e.g. because a Docker container stopped, so it can start a new
+        iteration without waiting for the next poll.
+        """
+        self.convergence_loop.receive(
+            ConvergenceLoopInputs.LOCAL_STATE_CHANGED)
+
     # IConvergenceAgent methods:
 
     def connected(self, client):
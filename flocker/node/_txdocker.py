@@ -0,0 +1,349 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.node.test.test_txdocker -*-
+
+"""
+Docker API client built on Twisted's HTTP client, which needs no threads.
+"""
+
+from json import dumps, loads
+from urllib import quote
+
+from zope.interface import implementer
+
+from docker.utils import parse_repository_tag
+
+from twisted.internet.defer import DeferredSemaphore, gatherResults, succeed
+from twisted.internet.endpoints import UNIXClientEndpoint
+from twisted.internet.task import deferLater
+from twisted.web.client import Agent, HTTPConnectionPool
+from twisted.web.http import NOT_FOUND, CONFLICT, INTERNAL_SERVER_ERROR
+from twisted.web.iweb import IAgentEndpointFactory
+
+from treq import content
+from treq.client import HTTPClient
+
+from ..control._model import RestartNever
+from ._docker import (
+    IDockerClient, AlreadyExists, BASE_NAMESPACE, BASE_DOCKER_API_URL,
+    _DockerAPIHelpers, _backoff, _parse_events, _unwrap_first_error,
+)
+
+# The maximum number of requests ``TwistedDockerClient`` has in progress,
+# and so of connections it has open, at once:
+MAXIMUM_CONNECTIONS = 16
+
+
+class DockerAPIError(Exception):
+    """
+    The Docker API responded with an error.
+
+    :ivar int code: The HTTP response code.
+    :ivar bytes body: The body of the response.
+    """
+    def __init__(self, code, body):
+        Exception.__init__(self, code, body)
+        self.code = code
+        self.body = body
+
+
+@implementer(IAgentEndpointFactory)
+class _FixedEndpointFactory(object):
+    """
+    Connect to the same endpoint regardless of the URI.
+    """
+    def __init__(self, endpoint):
+        self._endpoint = endpoint
+
+    def endpointForURI(self, uri):
+        return self._endpoint
+
+
+def _ignore_code(code, result=None):
+    """
+    Create an errback which turns a ``DockerAPIError`` with the given
+    response code into a result.
+
+    :param int code: The response code to ignore.
+    :param result: The result to return instead.
+
+    :return: An errback.
+    """
+    def ignore(failure):
+        failure.trap(DockerAPIError)
+        if failure.value.code != code:
+            return failure
+        return result
+    return ignore
+
+
+@implementer(IDockerClient)
+class TwistedDockerClient(_DockerAPIHelpers):
+    """
+    Talk to the real Docker server directly using Twisted's HTTP client.
+
+    Unlike ``DockerClient`` no operation blocks a thread, so the number of
+    operations in progress is not limited by the size of a thread pool.
+    At most ``MAXIMUM_CONNECTIONS`` requests are sent at once and the
+    connections are kept alive for reuse.
+
+    :ivar unicode namespace: A namespace prefix to add to container names
+        so we don't clobber other applications interacting with Docker.
+    """
+    def __init__(self, namespace=BASE_NAMESPACE,
+                 base_url=BASE_DOCKER_API_URL, reactor=None,
+                 maximum_connections=MAXIMUM_CONNECTIONS):
+        """
+        :param unicode namespace: See ``namespace``.
+        :param unicode base_url: The URL of the Docker API, either
+            ``unix://<path>`` or ``tcp://<host>:<port>``.
+        :param reactor: The reactor to use; the global reactor by default.
+        :param int maximum_connections: The maximum number of requests in
+            progress at once.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.namespace = namespace
+        self._reactor = reactor
+        self._pool = HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = maximum_connections
+        self._requesting = DeferredSemaphore(maximum_connections)
+        scheme, address = base_url.split(u"://", 1)
+        if scheme == u"unix":
+            endpoint = UNIXClientEndpoint(
+                reactor, b"/" + address.lstrip(u"/").encode("utf-8"))
+            agent = Agent.usingEndpointFactory(
+                reactor, _FixedEndpointFactory(endpoint), pool=self._pool)
+            self._url = b"http://docker/v1.15"
+        else:
+            agent = Agent(reactor, pool=self._pool)
+            self._url = b"http://%s/v1.15" % (address.encode("ascii"),)
+        self._http = HTTPClient(agent)
+        # Full names of the images known to be present locally. ``add``
+        # discards an image if Docker turns out not to have it after all.
+        self._local_images = set()
+
+    def close(self):
+        """
+        Close the connections kept alive for reuse.
+
+        :return: ``Deferred`` that fires when the connections are closed.
+        """
+        return self._pool.closeCachedConnections()
+
+    def _request(self, method, path, params=None, data=None):
+        """
+        Send a request to the Docker API.
+
+        :param bytes method: The HTTP method.
+        :param unicode path: The path of the API endpoint, e.g.
+            ``u"/containers/json"``.
+        :param dict params: Query arguments.
+        :param data: Object to send JSON encoded as the request body.
+
+        :return: ``Deferred`` that fires with the body of the response, or
+            fails with ``DockerAPIError`` if the response was an error.
+        """
+        url = self._url + quote(path.encode("utf-8"), safe=b"/:")
+        if params is not None:
+            params = {key: unicode(value).encode("utf-8")
+                      for key, value in params.items()}
+        body = None if data is None else dumps(data)
+
+        def request():
+            d = self._http.request(
+                method, url, params=params, data=body,
+                headers={b"Content-Type": [b"application/json"]},
+                allow_redirects=False)
+            d.addCallback(lambda response: content(response).addCallback(
+                lambda body: (response.code, body)))
+            return d
+        d = self._requesting.run(request)
+
+        def check_code((code, body)):
+            if code >= 400:
+                raise DockerAPIError(code, body)
+            return body
+        d.addCallback(check_code)
+        return d
+
+    def _retrying(self, attempt, code):
+        """
+        Make an attempt, retrying with exponential backoff while it fails
+        with the given response code.
+
+        :param attempt: Callable returning a ``Deferred``.
+        :param int code: The response code to retry on.
+
+        :return: ``Deferred`` with the result of the last attempt.
+        """
+        delays = _backoff()
+
+        def retry(failure):
+            failure.trap(DockerAPIError)
+            delay = next(delays, None)
+            if failure.value.code != code or delay is None:
+                return failure
+            return deferLater(self._reactor, delay, run)
+
+        def run():
+            d = attempt()
+            d.addErrback(retry)
+            return d
+        return run()
+
+    def _container_config(self, image_name, ports, environment, volumes,
+                          mem_limit, cpu_shares, restart_policy):
+        """
+        Create the configuration of a container for the Docker API from
+        the arguments of ``IDockerClient.add``.
+
+        :return: ``dict`` to send to Docker's create API.
+        """
+        config = {
+            u"Image": image_name,
+            u"ExposedPorts": {
+                u"%d/tcp" % (port.internal_port,): {} for port in ports},
+            u"Memory": mem_limit or 0,
+            u"CpuShares": cpu_shares or 0,
+            u"HostConfig": {
+                u"Binds": [
+                    u"%s:%s:rw" % (volume.node_path.path,
+                                   volume.container_path.path)
+                    for volume in volumes],
+                u"PortBindings": {
+                    u"%d/tcp" % (port.internal_port,): [{
+                        u"HostIp": u"",
+                        u"HostPort": unicode(port.external_port)}]
+                    for port in ports},
+                u"RestartPolicy": self._serialize_restart_policy(
+                    restart_policy),
+            },
+        }
+        if environment is not None:
+            config[u"Env"] = [
+                u"%s=%s" % item for item in environment.to_dict().items()]
+        return config
+
+    def add(self, unit_name, image_name, ports=None, environment=None,
+            volumes=(), mem_limit=None, cpu_shares=None,
+            restart_policy=RestartNever()):
+        container_name = self._to_container_name(unit_name)
+        config = self._container_config(
+            image_name, ports or [], environment, volumes, mem_limit,
+            cpu_shares, restart_policy)
+
+        def create():
+            return self._request(b"POST", u"/containers/create",
+                                 params={u"name": container_name},
+                                 data=config)
+        d = create()
+
+        def image_missing(failure):
+            failure.trap(DockerAPIError)
+            if failure.value.code != NOT_FOUND:
+                return failure
+            self._local_images.discard(image_name)
+            pulling = self.pull(image_name)
+            pulling.addCallback(lambda _: create())
+            return pulling
+        d.addErrback(image_missing)
+
+        # Docker may not know the container by name immediately after
+        # creating it, so retry starting it until it does:
+        d.addCallback(lambda _: self._retrying(
+            lambda: self._request(
+                b"POST", u"/containers/%s/start" % (container_name,),
+                data={}),
+            NOT_FOUND))
+
+        def already_exists(failure):
+            failure.trap(DockerAPIError)
+            if failure.value.code == CONFLICT:
+                raise AlreadyExists(unit_name)
+            return failure
+        d.addErrback(already_exists)
+        d.addCallback(lambda _: None)
+        return d
+
+    def exists(self, unit_name):
+        d = self._request(
+            b"GET", u"/containers/%s/json" % (
+                self._to_container_name(unit_name),))
+        d.addCallback(lambda _: True)
+        d.addErrback(_ignore_code(NOT_FOUND, False))
+        return d
+
+    def remove(self, unit_name):
+        path = u"/containers/" + self._to_container_name(unit_name)
+        # Docker responds with an internal server error if the process had
+        # died but Docker hasn't noticed yet, so retry until it has. If the
+        # container doesn't exist there is nothing to do, since this method
+        # is supposed to be idempotent.
+        d = self._retrying(
+            lambda: self._request(b"POST", path + u"/stop",
+                                  params={u"t": 10}),
+            INTERNAL_SERVER_ERROR)
+        d.addErrback(_ignore_code(NOT_FOUND))
+        d.addCallback(lambda _: self._request(b"DELETE", path))
+        d.addErrback(_ignore_code(NOT_FOUND))
+        d.addCallback(lambda _: None)
+        return d
+
+    def _inspect(self, container_id):
+        """
+        Inspect a container and convert it to a ``Unit``.
+
+        :param unicode container_id: The ID of the container to inspect.
+
+        :return: ``Deferred`` that fires with the ``Unit`` for the container
+            or ``None`` if it no longer exists or is not in our namespace.
+        """
+        d = self._request(b"GET", u"/containers/%s/json" % (container_id,))
+        d.addCallback(lambda body: self._unit_from_inspection(loads(body)))
+        d.addErrback(_ignore_code(NOT_FOUND))
+        return d
+
+    def list(self):
+        d = self._request(b"GET", u"/containers/json", params={u"all": 1})
+
+        def inspect(body):
+            inspecting = gatherResults(
+                [self._inspect(container[u"Id"])
+                 for container in loads(body)
+                 if any(self._is_namespaced(name)
+                        for name in container.get(u"Names") or ())],
+                consumeErrors=True)
+            inspecting.addErrback(_unwrap_first_error)
+            return inspecting
+        d.addCallback(inspect)
+        d.addCallback(lambda units: {unit for unit in units
+                                     if unit is not None})
+        return d
+
+    def pull(self, image_name):
+        if image_name in self._local_images:
+            return succeed(None)
+        d = self._request(b"GET", u"/images/%s/json" % (image_name,))
+
+        def missing(failure):
+            failure.trap(DockerAPIError)
+            if failure.value.code != NOT_FOUND:
+                return failure
+            repository, tag = parse_repository_tag(image_name)
+            params = {u"fromImage": repository}
+            if tag is not None:
+                params[u"tag"] = tag
+            pulling = self._request(b"POST", u"/images/create",
+                                    params=params)
+            pulling.addCallback(check_progress)
+            return pulling
+
+        def check_progress(body):
+            # Docker reports failures to pull in the progress messages
+            # rather than in the response code:
+            for message in _parse_events(body.decode("utf-8")):
+                if u"error" in message:
+                    raise DockerAPIError(INTERNAL_SERVER_ERROR, body)
+        d.addErrback(missing)
+        d.addCallback(lambda _: self._local_images.add(image_name))
+        return d
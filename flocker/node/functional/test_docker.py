@@ -655,6 +655,86 @@ class DockerClientTests(TestCase):
 
         return running_assertions
 
+    def test_list_only_inspects_namespace(self):
+        """
+        ``DockerClient.list`` does not inspect containers outside its
+        namespace.
+        """
+        namespace = namespace_for_test(self)
+        flocker_docker_client = DockerClient(namespace=namespace)
+        other_client = DockerClient(namespace=namespace + u"-other")
+        name = random_name()
+        d = other_client.add(name, u"busybox")
+        self.addCleanup(other_client.remove, name)
+
+        inspected = []
+        docker_client = flocker_docker_client._client
+        inspect_container = docker_client.inspect_container
+
+        def record_inspect(container):
+            inspected.append(container)
+            return inspect_container(container)
+        self.patch(docker_client, "inspect_container", record_inspect)
+
+        d.addCallback(lambda _: flocker_docker_client.list())
+        d.addCallback(lambda units: self.assertEqual(
+            (set(), []), (units, inspected)))
+        return d
+
+    def test_list_caches_inspection(self):
+        """
+        ``DockerClient.list`` does not inspect a container again if it has
+        not changed since the previous listing.
+        """
+        namespace = namespace_for_test(self)
+        flocker_docker_client = DockerClient(namespace=namespace)
+        name = random_name()
+        d = flocker_docker_client.add(name, u"openshift/busybox-http-app")
+        self.addCleanup(flocker_docker_client.remove, name)
+        d.addCallback(lambda _: flocker_docker_client.list())
+
+        inspected = []
+        docker_client = flocker_docker_client._client
+        inspect_container = docker_client.inspect_container
+
+        def record_inspect(container):
+            inspected.append(container)
+            return inspect_container(container)
+
+        def list_again(first):
+            self.patch(docker_client, "inspect_container", record_inspect)
+            # Don't fall within the window in which the events from adding
+            # the container are still reported:
+            time.sleep(2)
+            listing = flocker_docker_client.list()
+            listing.addCallback(lambda second: self.assertEqual(
+                (first, []), (second, inspected)))
+            return listing
+        d.addCallback(list_again)
+        return d
+
+    def test_list_invalidated_by_events(self):
+        """
+        ``DockerClient.list`` notices changes made to a container after it
+        was previously listed.
+        """
+        namespace = namespace_for_test(self)
+        flocker_docker_client = DockerClient(namespace=namespace)
+        name = random_name()
+        d = flocker_docker_client.add(name, u"openshift/busybox-http-app")
+        self.addCleanup(flocker_docker_client.remove, name)
+        d.addCallback(lambda _: wait_for_unit_state(
+            flocker_docker_client, name, [u"active"]))
+
+        def stop(_):
+            flocker_docker_client._client.stop(
+                flocker_docker_client._to_container_name(name))
+            return flocker_docker_client.list()
+        d.addCallback(stop)
+        d.addCallback(lambda units: self.assertEqual(
+            [u"inactive"], [unit.activation_state for unit in units]))
+        return d
+
 
 class NamespacedDockerClientTests(GenericDockerClientTests):
     """
@@ -31,6 +31,7 @@ from ..control import (
 )
 from . import P2PNodeDeployer, change_node_state
 from ._loop import AgentLoopService
+from ._docker import DockerClient, DockerStateWatcher
 
 
 __all__ = [
@@ -252,15 +253,40 @@ class ZFSAgentScript(object):
     """
     A command to start a long-running process to manage volumes on one node of
     a Flocker cluster.
+
+    :ivar IDockerClient _docker_client: See the ``docker_client`` parameter
+        to ``__init__``.
+    :ivar IDockerEventSource _event_source: See the ``event_source``
+        parameter to ``__init__``.
     """
+    def __init__(self, docker_client=None, event_source=None):
+        """
+        :param IDockerClient docker_client: The object to use to talk to the
+            Docker server. By default a ``DockerClient``.
+        :param IDockerEventSource event_source: The source of the Docker
+            server's events. By default the ``DockerClient`` in use.
+        """
+        self._docker_client = docker_client
+        self._event_source = event_source
+
     def main(self, reactor, options, volume_service):
         host = options["destination-host"]
         port = options["destination-port"]
+        docker_client = self._docker_client
+        if docker_client is None:
+            docker_client = DockerClient(reactor=reactor)
+        event_source = self._event_source
+        if event_source is None:
+            event_source = docker_client
+        watcher = DockerStateWatcher(docker_client, event_source, reactor)
         deployer = P2PNodeDeployer(options["hostname"].decode("ascii"),
-                                   volume_service)
+                                   volume_service, docker_client=watcher)
         loop = AgentLoopService(reactor=reactor, deployer=deployer,
                                 host=host, port=port)
+        # Containers starting or dying wake up the convergence loop:
+        watcher.notify_on_change(loop.local_state_changed)
         volume_service.setServiceParent(loop)
+        watcher.setServiceParent(loop)
         return main_for_service(reactor, loop)
 
 
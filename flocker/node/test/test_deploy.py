@@ -25,7 +25,7 @@ from .._deploy import (
     IStateChange, Sequentially, InParallel, StartApplication, StopApplication,
     CreateDataset, WaitForDataset, HandoffDataset, SetProxies, PushDataset,
     ResizeDataset, _link_environment, _to_volume_name, IDeployer,
-    DeleteDataset,
+    DeleteDataset, PullImages, PULL_CONCURRENCY,
 )
 from ...testtools import CustomException
 from .. import _deploy
@@ -1308,6 +1308,75 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         expected = Sequentially(changes=[SetProxies(ports=frozenset())])
         self.assertEqual(expected, result)
 
+    def test_unchanged_inputs_reuse_result(self):
+        """
+        ``P2PNodeDeployer.calculate_necessary_state_changes`` returns the
+        previous result if called again with equal inputs, without
+        calculating it again.
+        """
+        api = P2PNodeDeployer(u'node.example.com', create_volume_service(self),
+                              docker_client=FakeDockerClient(units={}),
+                              network=make_memory_network())
+        local_state = self.successResultOf(api.discover_local_state())
+        first = api.calculate_necessary_state_changes(
+            local_state, desired_configuration=Deployment(nodes=frozenset()),
+            current_cluster_state=EMPTY)
+        second = api.calculate_necessary_state_changes(
+            self.successResultOf(api.discover_local_state()),
+            desired_configuration=Deployment(nodes=frozenset()),
+            current_cluster_state=EMPTY)
+        self.assertEqual(
+            (second, api.calculation_hits, api.calculation_misses),
+            (first, 1, 1))
+        self.assertIs(first, second)
+
+    def test_changed_inputs_recalculate(self):
+        """
+        ``P2PNodeDeployer.calculate_necessary_state_changes`` calculates the
+        changes again if any of its inputs changed.
+        """
+        api = P2PNodeDeployer(u'node.example.com', create_volume_service(self),
+                              docker_client=FakeDockerClient(units={}),
+                              network=make_memory_network())
+        local_state = self.successResultOf(api.discover_local_state())
+        api.calculate_necessary_state_changes(
+            local_state, desired_configuration=Deployment(nodes=frozenset()),
+            current_cluster_state=EMPTY)
+        application = Application(
+            name=u'mysql-hybridcluster',
+            image=DockerImage(repository=u'clusterhq/mysql'),
+            ports=frozenset([Port(internal_port=3306, external_port=1001)]))
+        desired = Deployment(nodes=frozenset([
+            Node(hostname=u'node1.example.com',
+                 applications=frozenset([application]))]))
+        result = api.calculate_necessary_state_changes(
+            local_state, desired_configuration=desired,
+            current_cluster_state=EMPTY)
+        self.assertEqual(
+            (result, api.calculation_hits, api.calculation_misses),
+            (Sequentially(changes=[SetProxies(ports=frozenset([
+                Proxy(ip=u'node1.example.com', port=1001)]))]), 0, 2))
+
+    def test_changed_proxies_recalculate(self):
+        """
+        ``P2PNodeDeployer.calculate_necessary_state_changes`` calculates the
+        changes again if the proxies on the node changed.
+        """
+        network = make_memory_network()
+        api = P2PNodeDeployer(u'node.example.com', create_volume_service(self),
+                              docker_client=FakeDockerClient(units={}),
+                              network=network)
+        local_state = self.successResultOf(api.discover_local_state())
+        api.calculate_necessary_state_changes(
+            local_state, desired_configuration=Deployment(nodes=frozenset()),
+            current_cluster_state=EMPTY)
+        network.create_proxy_to(ip=u'192.0.2.100', port=3306)
+        result = api.calculate_necessary_state_changes(
+            local_state, desired_configuration=Deployment(nodes=frozenset()),
+            current_cluster_state=EMPTY)
+        self.assertEqual(
+            result, Sequentially(changes=[SetProxies(ports=frozenset())]))
+
     def test_application_needs_stopping(self):
         """
         ``P2PNodeDeployer.calculate_necessary_state_changes`` specifies that an
@@ -1361,9 +1430,11 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             self.successResultOf(api.discover_local_state()),
             desired_configuration=desired,
             current_cluster_state=EMPTY)
-        expected = Sequentially(changes=[InParallel(
-            changes=[StartApplication(application=application,
-                                      hostname="node.example.com")])])
+        expected = Sequentially(changes=[
+            PullImages(images=frozenset([application.image.full_name])),
+            InParallel(
+                changes=[StartApplication(application=application,
+                                          hostname="node.example.com")])])
         self.assertEqual(expected, result)
 
     def test_only_this_node(self):
@@ -1509,6 +1580,8 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         volume = APPLICATION_WITH_VOLUME.volume
 
         expected = Sequentially(changes=[
+            PullImages(
+                images=frozenset([APPLICATION_WITH_VOLUME.image.full_name])),
             InParallel(changes=[CreateDataset(dataset=volume.dataset)]),
             InParallel(changes=[StartApplication(
                 application=APPLICATION_WITH_VOLUME,
@@ -1653,6 +1726,8 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         volume = APPLICATION_WITH_VOLUME.volume
 
         expected = Sequentially(changes=[
+            PullImages(
+                images=frozenset([APPLICATION_WITH_VOLUME.image.full_name])),
             InParallel(changes=[WaitForDataset(dataset=volume.dataset)]),
             InParallel(changes=[ResizeDataset(dataset=volume.dataset)]),
             InParallel(changes=[StartApplication(
@@ -1852,6 +1927,8 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         )
 
         expected = Sequentially(changes=[
+            PullImages(images=frozenset([
+                APPLICATION_WITH_VOLUME_SIZE.image.full_name])),
             InParallel(
                 changes=[ResizeDataset(
                     dataset=APPLICATION_WITH_VOLUME_SIZE.volume.dataset,
@@ -2006,6 +2083,8 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         volume = APPLICATION_WITH_VOLUME_SIZE.volume
 
         expected = Sequentially(changes=[
+            PullImages(images=frozenset([
+                APPLICATION_WITH_VOLUME_SIZE.image.full_name])),
             InParallel(changes=[WaitForDataset(dataset=volume.dataset)]),
             InParallel(changes=[ResizeDataset(dataset=volume.dataset)]),
             InParallel(changes=[StartApplication(
@@ -2045,11 +2124,15 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             desired_configuration=desired,
             current_cluster_state=EMPTY)
 
-        expected = Sequentially(changes=[InParallel(changes=[
-            Sequentially(changes=[StopApplication(application=application),
-                                  StartApplication(application=application,
-                                                   hostname="n.example.com")]),
-        ])])
+        expected = Sequentially(changes=[
+            PullImages(images=frozenset([application.image.full_name])),
+            InParallel(changes=[
+                Sequentially(changes=[
+                    StopApplication(application=application),
+                    StartApplication(application=application,
+                                     hostname="n.example.com")]),
+            ]),
+        ])
         self.assertEqual(expected, result)
 
     def test_not_local_not_running_applications_stopped(self):
@@ -2162,6 +2245,8 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         )
 
         expected = Sequentially(changes=[
+            PullImages(
+                images=frozenset([another_application.image.full_name])),
             InParallel(changes=[PushDataset(
                 dataset=volume.dataset, hostname=another_node.hostname)]),
             InParallel(changes=[StopApplication(
@@ -2233,6 +2318,7 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
         )
 
         expected = Sequentially(changes=[
+            PullImages(images=frozenset([new_postgres_app.image.full_name])),
             InParallel(changes=[
                 CreateDataset(dataset=new_postgres_app.volume.dataset)]),
             InParallel(changes=[
@@ -2292,13 +2378,16 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             current_cluster_state=EMPTY,
         )
 
-        expected = Sequentially(changes=[InParallel(changes=[
-            Sequentially(changes=[
-                StopApplication(application=old_postgres_app),
-                StartApplication(application=new_postgres_app,
-                                 hostname="node1.example.com")
-                ]),
-        ])])
+        expected = Sequentially(changes=[
+            PullImages(images=frozenset([new_postgres_app.image.full_name])),
+            InParallel(changes=[
+                Sequentially(changes=[
+                    StopApplication(application=old_postgres_app),
+                    StartApplication(application=new_postgres_app,
+                                     hostname="node1.example.com")
+                    ]),
+            ]),
+        ])
 
         self.assertEqual(expected, result)
 
@@ -2362,13 +2451,16 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             current_cluster_state=EMPTY,
         )
 
-        expected = Sequentially(changes=[InParallel(changes=[
-            Sequentially(changes=[
-                StopApplication(application=old_postgres_app),
-                StartApplication(application=new_postgres_app,
-                                 hostname="node1.example.com")
-                ]),
-        ])])
+        expected = Sequentially(changes=[
+            PullImages(images=frozenset([new_postgres_app.image.full_name])),
+            InParallel(changes=[
+                Sequentially(changes=[
+                    StopApplication(application=old_postgres_app),
+                    StartApplication(application=new_postgres_app,
+                                     hostname="node1.example.com")
+                    ]),
+            ]),
+        ])
 
         self.assertEqual(expected, result)
 
@@ -2430,13 +2522,16 @@ class DeployerCalculateNecessaryStateChangesTests(SynchronousTestCase):
             current_cluster_state=EMPTY,
         )
 
-        expected = Sequentially(changes=[InParallel(changes=[
-            Sequentially(changes=[
-                StopApplication(application=old_wordpress_app),
-                StartApplication(application=new_wordpress_app,
-                                 hostname="node1.example.com")
-                ]),
-        ])])
+        expected = Sequentially(changes=[
+            PullImages(images=frozenset([new_wordpress_app.image.full_name])),
+            InParallel(changes=[
+                Sequentially(changes=[
+                    StopApplication(application=old_wordpress_app),
+                    StartApplication(application=new_wordpress_app,
+                                     hostname="node1.example.com")
+                    ]),
+            ]),
+        ])
 
         self.assertEqual(expected, result)
 
@@ -3116,6 +3211,107 @@ class CreateDatasetTests(SynchronousTestCase):
             _to_volume_name(volume.dataset.dataset_id)))
 
 
+class PullImagesTests(SynchronousTestCase):
+    """
+    Tests for ``PullImages``.
+    """
+    def make_deployer(self, docker_client):
+        """
+        :param docker_client: The ``IDockerClient`` for the deployer.
+
+        :return: A ``P2PNodeDeployer`` using the given Docker client.
+        """
+        return P2PNodeDeployer(
+            u'example.com', create_volume_service(self),
+            docker_client=docker_client, network=make_memory_network())
+
+    def test_pulls(self):
+        """
+        ``PullImages.run()`` pulls all the images.
+        """
+        docker = FakeDockerClient()
+        images = frozenset([u"busybox:latest", u"clusterhq/flocker:1.0"])
+        self.successResultOf(
+            PullImages(images=images).run(self.make_deployer(docker)))
+        self.assertEqual(images, docker.pulled_images)
+
+    def test_bounded_concurrency(self):
+        """
+        ``PullImages.run()`` pulls at most ``PULL_CONCURRENCY`` images at
+        once.
+        """
+        pulls = []
+
+        class SlowDockerClient(FakeDockerClient):
+            def pull(self, image_name):
+                d = Deferred()
+                pulls.append(d)
+                return d
+
+        images = frozenset(
+            u"image%d:latest" % (i,) for i in range(PULL_CONCURRENCY + 1))
+        result = PullImages(images=images).run(
+            self.make_deployer(SlowDockerClient()))
+        started = len(pulls)
+        pulls[0].callback(None)
+        self.assertEqual(
+            (PULL_CONCURRENCY, PULL_CONCURRENCY + 1),
+            (started, len(pulls)))
+        for d in pulls[1:]:
+            d.callback(None)
+        self.successResultOf(result)
+
+    @validate_logging(
+        lambda test, logger: logger.flush_tracebacks(CustomException))
+    def test_failures_logged(self, logger):
+        """
+        Failed pulls don't result in a failed result from
+        ``PullImages.run()``, but are logged.
+        """
+        class FailingDockerClient(FakeDockerClient):
+            def pull(self, image_name):
+                return fail(CustomException())
+
+        self.patch(_deploy, "_logger", logger)
+        self.successResultOf(
+            PullImages(images=frozenset([u"busybox:latest"])).run(
+                self.make_deployer(FailingDockerClient())))
+
+    def test_pull_before_stop(self):
+        """
+        ``P2PNodeDeployer.calculate_necessary_state_changes`` pulls the
+        images of applications to start before stopping any applications.
+        """
+        unit = Unit(name=u'site-example.com',
+                    container_name=u'site-example.com',
+                    container_image=u'clusterhq/wordpress:latest',
+                    activation_state=u'active')
+        docker = FakeDockerClient(units={unit.name: unit})
+        api = self.make_deployer(docker)
+        application = Application(
+            name=u"mysql-hybridcluster",
+            image=DockerImage(repository=u'clusterhq/mysql', tag=u'5.6'))
+        desired = Deployment(nodes=frozenset([
+            Node(hostname=u'example.com',
+                 applications=frozenset([application]))]))
+
+        result = api.calculate_necessary_state_changes(
+            self.successResultOf(api.discover_local_state()),
+            desired_configuration=desired,
+            current_cluster_state=EMPTY)
+        to_stop = Application(
+            name=unit.name,
+            image=DockerImage.from_string(unit.container_image))
+        self.assertEqual(
+            Sequentially(changes=[
+                PullImages(images=frozenset([u"clusterhq/mysql:5.6"])),
+                InParallel(changes=[StopApplication(application=to_stop)]),
+                InParallel(changes=[StartApplication(
+                    application=application, hostname=u'example.com')]),
+            ]),
+            result)
+
+
 class DeleteDatasetTests(TestCase):
     """
     Tests for ``DeleteDataset``.
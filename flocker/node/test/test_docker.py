@@ -2,15 +2,29 @@
 
 """Tests for :module:`flocker.node._docker`."""
 
+from threading import Event, current_thread
+
 from zope.interface.verify import verifyObject
 
+from eliot.testing import validate_logging, assertHasMessage
+
+from docker import Client
+
 from twisted.trial.unittest import TestCase
+from twisted.python.failure import Failure
 from twisted.python.filepath import FilePath
+from twisted.internet.defer import Deferred, CancelledError, gatherResults
+from twisted.internet.task import Clock
 
-from ...testtools import random_name, make_with_init_tests
+from ...testtools import random_name, make_with_init_tests, loop_until
 from .._docker import (
-    IDockerClient, FakeDockerClient, AlreadyExists, PortMap, Unit,
-    Environment, Volume)
+    IDockerClient, IDockerEventSource, FakeDockerClient,
+    FakeDockerEventSource, DockerStateWatcher, AlreadyExists, NeverCreated,
+    PortMap, Unit, Environment, Volume, DockerClient, LONG_LANE, SHORT_LANE,
+    LOG_DOCKER_OPERATION, MINIMUM_POLL_DELAY, MAXIMUM_POLL_DELAY,
+    RESUBSCRIBE_DELAY, _parse_events, _iter_events, _backoff)
+from .. import _docker
+from ..testtools import fake_docker_server_for_test, fake_container
 
 from ...control._model import RestartAlways, RestartNever, RestartOnFailure
 
@@ -41,6 +55,17 @@ def make_idockerclient_tests(fixture):
             d.addCallback(lambda _: client.remove(name))
             return d
 
+        def test_pull(self):
+            """
+            ``pull`` fires with ``None`` once the image is available, also
+            if it was already available.
+            """
+            client = fixture(self)
+            d = client.pull(u"busybox:latest")
+            d.addCallback(lambda _: client.pull(u"busybox:latest"))
+            d.addCallback(self.assertIs, None)
+            return d
+
         def test_no_double_add(self):
             """Adding a unit with name that already exists results in error."""
             client = fixture(self)
@@ -237,6 +262,45 @@ class FakeIDockerClientTests(
     """
 
 
+class FakeDockerServerIDockerClientTests(
+        make_idockerclient_tests(
+            lambda test: DockerClient(
+                base_url=fake_docker_server_for_test(test).base_url))):
+    """
+    ``IDockerClient`` tests for ``DockerClient`` talking to a
+    ``FakeDockerServer``.
+    """
+
+
+def running_watcher(test, client=None, event_source=None):
+    """
+    Create a ``DockerStateWatcher`` that is running until the test ends.
+
+    :param test: The ``TestCase`` using the watcher.
+    :param IDockerClient client: The client to wrap, by default a
+        ``FakeDockerClient``.
+    :param IDockerEventSource event_source: The event source, by default
+        a ``FakeDockerEventSource``.
+
+    :return: The running ``DockerStateWatcher``.
+    """
+    if client is None:
+        client = FakeDockerClient()
+    if event_source is None:
+        event_source = FakeDockerEventSource()
+    watcher = DockerStateWatcher(client, event_source, reactor=Clock())
+    watcher.startService()
+    test.addCleanup(watcher.stopService)
+    return watcher
+
+
+class DockerStateWatcherIDockerClientTests(
+        make_idockerclient_tests(running_watcher)):
+    """
+    ``IDockerClient`` tests for ``DockerStateWatcher``.
+    """
+
+
 class FakeDockerClientImplementationTests(TestCase):
     """
     Tests for implementation details of ``FakeDockerClient``.
@@ -256,6 +320,14 @@ class FakeDockerClientImplementationTests(TestCase):
                               container_image=u'flocker/flocker:v1.0.0')}
         self.assertEqual(units, FakeDockerClient(units=units)._units)
 
+    def test_pulled_images(self):
+        """
+        ``FakeDockerClient.pulled_images`` records the images pulled.
+        """
+        client = FakeDockerClient()
+        client.pull(u"busybox:latest")
+        self.assertEqual({u"busybox:latest"}, client.pulled_images)
+
 
 class PortMapInitTests(
         make_with_init_tests(
@@ -415,3 +487,659 @@ class VolumeInitTests(
     """
     Tests for ``Volume.__init__``.
     """
+
+
+class ParseEventsTests(TestCase):
+    """
+    Tests for ``_parse_events``.
+    """
+    def test_empty(self):
+        """
+        An empty response contains no events.
+        """
+        self.assertEqual([], _parse_events(u""))
+
+    def test_concatenated(self):
+        """
+        Concatenated JSON objects, optionally separated by whitespace, are
+        parsed into a list of events.
+        """
+        self.assertEqual(
+            [{u"id": u"a", u"status": u"die"},
+             {u"id": u"b", u"status": u"start"},
+             {u"id": u"c", u"status": u"stop"}],
+            _parse_events(
+                u'{"id": "a", "status": "die"}{"id": "b", "status": "start"}'
+                u'\n{"id": "c", "status": "stop"}\n'))
+
+
+class IterEventsTests(TestCase):
+    """
+    Tests for ``_iter_events``.
+    """
+    def test_split_objects(self):
+        """
+        Events split across chunks are parsed once all their chunks have
+        arrived.
+        """
+        self.assertEqual(
+            [{u"id": u"a"}, {u"id": u"b"}],
+            list(_iter_events([b'{"id"', b': "a"}\n{"id": "b', b'"}\n'])))
+
+    def test_incomplete(self):
+        """
+        An incomplete trailing event is ignored.
+        """
+        self.assertEqual(
+            [{u"id": u"a"}], list(_iter_events([b'{"id": "a"}{"id": '])))
+
+
+class BackoffTests(TestCase):
+    """
+    Tests for ``_backoff``.
+    """
+    def test_exponential(self):
+        """
+        The delays double, up to the maximum.
+        """
+        self.assertEqual([1, 2, 4, 5, 5],
+                         list(_backoff(minimum=1, maximum=5, timeout=17)))
+
+    def test_bounded(self):
+        """
+        The delays stop once their total would exceed the timeout.
+        """
+        self.assertEqual([1, 2], list(_backoff(minimum=1, maximum=5,
+                                               timeout=6)))
+
+
+class WaitUntilReadyTests(TestCase):
+    """
+    Tests for ``DockerClient._wait_until_ready``.
+    """
+    def setUp(self):
+        self.client = DockerClient()
+        self.sleeps = []
+        self.patch(_docker, "sleep", self.sleeps.append)
+        self.events = []
+
+        def wait_for_event(container_id, statuses, since):
+            self.events.append((container_id, statuses, since))
+            return self.event_reported
+        self.patch(self.client, "_wait_for_event", wait_for_event)
+
+    def wait(self, checks):
+        """
+        Wait for a container that becomes ready on the given check.
+
+        :param int checks: The number of readiness checks after which the
+            container is ready.
+
+        :return: The result of ``_wait_until_ready``.
+        """
+        results = [False] * (checks - 1) + [True]
+        return self.client._wait_until_ready(
+            lambda: results.pop(0) if results else False,
+            u"123", {u"create"}, 1000)
+
+    def test_ready(self):
+        """
+        A container that is ready immediately is not waited for.
+        """
+        self.event_reported = True
+        self.assertEqual((True, [], []), (self.wait(1), self.events,
+                                          self.sleeps))
+
+    def test_event(self):
+        """
+        If a container isn't ready immediately, it is checked again once
+        Docker reports one of the given events for it.
+        """
+        self.event_reported = True
+        self.assertEqual(
+            (True, [(u"123", {u"create"}, 1000)], []),
+            (self.wait(2), self.events, self.sleeps))
+
+    def test_fallback(self):
+        """
+        If no event is reported the container is polled with exponentially
+        increasing delays.
+        """
+        self.event_reported = False
+        self.assertEqual(
+            (True, [MINIMUM_POLL_DELAY, MINIMUM_POLL_DELAY * 2]),
+            (self.wait(3), self.sleeps))
+
+    def test_gives_up(self):
+        """
+        If the container never becomes ready, polling eventually gives up.
+        """
+        self.event_reported = False
+        self.assertEqual(
+            (False, MAXIMUM_POLL_DELAY),
+            (self.wait(10 ** 6), max(self.sleeps)))
+
+
+class DockerClientLaneTests(TestCase):
+    """
+    Tests for the thread pool lanes of ``DockerClient``.
+
+    These don't need a Docker server since no Docker API calls are made.
+    """
+    def test_lanes_are_separate(self):
+        """
+        A long operation occupying all threads of the long lane does not
+        prevent short operations from running.
+        """
+        client = DockerClient(long_operation_threads=1)
+        release = Event()
+        self.addCleanup(release.set)
+        blocked = client._run_in_lane(LONG_LANE, u"stop", release.wait, 10)
+        short = client._run_in_lane(
+            SHORT_LANE, u"inspect", lambda: current_thread().name)
+
+        def short_done(name):
+            self.assertEqual(
+                (False, True), (blocked.called, b"docker-short" in name))
+            release.set()
+            return blocked
+        short.addCallback(short_done)
+        return short
+
+    def test_statistics(self):
+        """
+        ``DockerClient.statistics`` records the number of succeeded and
+        failed operations of each type.
+        """
+        client = DockerClient()
+        d = gatherResults([
+            client._run_in_lane(SHORT_LANE, u"list", lambda: None),
+            client._run_in_lane(SHORT_LANE, u"list", lambda: None),
+            self.assertFailure(
+                client._run_in_lane(LONG_LANE, u"add", lambda: 1 / 0),
+                ZeroDivisionError),
+        ])
+
+        def check(_):
+            list_statistics = client.statistics[u"list"]
+            add_statistics = client.statistics[u"add"]
+            self.assertEqual(
+                ((0, 2, 0, True), (0, 0, 1, True)),
+                tuple((stats.pending, stats.succeeded, stats.failed,
+                       stats.maximum_pending >= 1)
+                      for stats in (list_statistics, add_statistics)))
+        d.addCallback(check)
+        return d
+
+    def test_round_trips(self):
+        """
+        ``DockerClient.statistics`` records the number of Docker API
+        requests made by operations.
+        """
+        self.patch(Client, "request", lambda *args, **kwargs: None)
+        client = DockerClient()
+
+        def two_requests():
+            client._client.request("GET", "http://example.invalid/")
+            client._client.request("GET", "http://example.invalid/")
+        d = client._run_in_lane(SHORT_LANE, u"inspect", two_requests)
+        d.addCallback(lambda _: client._run_in_lane(
+            SHORT_LANE, u"inspect", two_requests))
+        d.addCallback(lambda _: self.assertEqual(
+            4, client.statistics[u"inspect"].round_trips))
+        return d
+
+    def assert_operation_logged(self, logger):
+        """
+        A message is logged for a finished operation.
+        """
+        assertHasMessage(self, logger, LOG_DOCKER_OPERATION,
+                         dict(operation=u"exists", lane=SHORT_LANE,
+                              queue_depth=0, succeeded=True, round_trips=0))
+
+    @validate_logging(assert_operation_logged)
+    def test_logged(self, logger):
+        """
+        Each finished operation is logged with its type, lane and timings.
+        """
+        client = DockerClient()
+        self.patch(client, "logger", logger)
+        return client._run_in_lane(SHORT_LANE, u"exists", lambda: True)
+
+
+class DockerClientConnectionTests(TestCase):
+    """
+    Tests for the connections ``DockerClient`` makes to the Docker daemon,
+    using a ``FakeDockerServer``.
+    """
+    def setUp(self):
+        self.server = fake_docker_server_for_test(
+            self, {u"1": fake_container(u"1", u"flocker--app1"),
+                   u"2": fake_container(u"2", u"flocker--app2"),
+                   u"3": fake_container(u"3", u"other")})
+        self.client = DockerClient(base_url=self.server.base_url)
+
+    def test_connection_reused(self):
+        """
+        Consecutive requests are sent over the same connection.
+        """
+        for container_id in [u"1", u"2", u"1"]:
+            self.client._client.inspect_container(container_id)
+        self.assertEqual((1, 3),
+                         (self.server.connections, self.server.requests))
+
+    def test_list(self):
+        """
+        ``DockerClient.list`` returns the units in its namespace.
+        """
+        d = self.client.list()
+        d.addCallback(lambda units: self.assertEqual(
+            [u"app1", u"app2"], sorted(unit.name for unit in units)))
+        return d
+
+    def test_pull_cached(self):
+        """
+        ``DockerClient.pull`` doesn't ask Docker about an image it already
+        made sure is present.
+        """
+        d = self.client.pull(u"busybox:latest")
+
+        def pulled(_):
+            requests = self.server.requests
+            pulling = self.client.pull(u"busybox:latest")
+            pulling.addCallback(
+                lambda _: self.assertEqual(requests, self.server.requests))
+            return pulling
+        d.addCallback(pulled)
+        return d
+
+    def test_add_image_removed(self):
+        """
+        ``DockerClient.add`` pulls the image again if it was removed after
+        an earlier pull.
+        """
+        d = self.client.pull(u"busybox:latest")
+        d.addCallback(lambda _: self.server.images.clear())
+        d.addCallback(lambda _: self.client.add(u"app4", u"busybox:latest"))
+        d.addCallback(lambda _: self.assertEqual(
+            {u"busybox:latest"}, self.server.images))
+        return d
+
+    def test_add_never_created(self):
+        """
+        If Docker never reports a newly created container as existing,
+        ``DockerClient.add`` fails with ``NeverCreated`` without trying to
+        start it.
+        """
+        self.patch(self.client, "_wait_until_ready", lambda *args: False)
+        d = self.assertFailure(self.client.add(u"app4", u"busybox"),
+                               NeverCreated)
+        d.addCallback(lambda _: self.assertEqual(
+            [], [container for container in self.server.containers.values()
+                 if container[u"Name"] == u"/flocker--app4"
+                 and container[u"State"][u"Running"]]))
+        return d
+
+
+class ControllableListClient(FakeDockerClient):
+    """
+    A ``FakeDockerClient`` whose ``list`` results are only delivered when
+    the test says so.
+
+    :ivar list listings: The pending ``Deferred`` of each ``list`` call.
+    """
+    def __init__(self, units=None):
+        FakeDockerClient.__init__(self, units)
+        self.listings = []
+
+    def list(self):
+        d = Deferred()
+        self.listings.append(d)
+        return d
+
+    def finish_listing(self):
+        """
+        Fire the oldest pending ``list`` result with the current units.
+        """
+        self.listings.pop(0).callback(set(self._units.values()))
+
+
+class DockerStateWatcherTests(TestCase):
+    """
+    Tests for ``DockerStateWatcher``.
+    """
+    def setUp(self):
+        self.units = {u"app": Unit(name=u"app", container_name=u"app",
+                                   activation_state=u"active",
+                                   container_image=u"busybox:latest")}
+        self.client = FakeDockerClient(units=self.units)
+        self.events = FakeDockerEventSource()
+
+    def watcher(self, client=None):
+        """
+        :param client: The client to wrap, by default ``self.client``.
+
+        :return: A ``DockerStateWatcher`` of ``self.events`` that is not
+            running yet, using a ``Clock`` as reactor.
+        """
+        if client is None:
+            client = self.client
+        self.clock = Clock()
+        return DockerStateWatcher(client, self.events, reactor=self.clock)
+
+    def start(self, watcher):
+        """
+        Start a watcher and stop it when the test ends.
+        """
+        watcher.startService()
+        self.addCleanup(watcher.stopService)
+
+    def assert_listed(self, watcher, expected):
+        """
+        ``watcher.list()`` fires with the given units.
+        """
+        self.assertEqual(expected, self.successResultOf(watcher.list()))
+
+    def change_behind_watchers_back(self):
+        """
+        Make the active unit inactive without telling anyone.
+
+        :return: The new ``Unit``.
+        """
+        self.units[u"app"] = Unit(name=u"app", container_name=u"app",
+                                  activation_state=u"inactive",
+                                  container_image=u"busybox:latest")
+        return self.units[u"app"]
+
+    def test_interface(self):
+        """
+        ``FakeDockerEventSource`` and ``DockerClient`` provide
+        ``IDockerEventSource``.
+        """
+        self.assertEqual(
+            (True, True),
+            (verifyObject(IDockerEventSource, self.events),
+             verifyObject(IDockerEventSource, DockerClient())))
+
+    def test_synchronised_on_start(self):
+        """
+        Starting the watcher subscribes to events and fills ``units`` from
+        a full listing.
+        """
+        watcher = self.watcher()
+        self.start(watcher)
+        self.assertEqual((True, True, self.units),
+                         (self.events.subscribed, watcher.synchronised,
+                          watcher.units))
+
+    def test_list_from_memory(self):
+        """
+        Once synchronised, ``list`` returns the units in memory rather than
+        listing them again.
+        """
+        watcher = self.watcher()
+        self.start(watcher)
+        original = self.units[u"app"]
+        self.change_behind_watchers_back()
+        self.assert_listed(watcher, {original})
+
+    def test_list_before_start(self):
+        """
+        ``list`` asks the wrapped client while the watcher isn't
+        synchronised.
+        """
+        watcher = self.watcher()
+        changed = self.change_behind_watchers_back()
+        self.assert_listed(watcher, {changed})
+
+    def test_state_event_refreshes(self):
+        """
+        An event that may change the state of a container updates the
+        units.
+        """
+        watcher = self.watcher()
+        self.start(watcher)
+        changed = self.change_behind_watchers_back()
+        self.events.event(u"abc", u"die")
+        self.assert_listed(watcher, {changed})
+
+    def test_other_event_ignored(self):
+        """
+        Events that don't change the state of containers are ignored.
+        """
+        watcher = self.watcher()
+        self.start(watcher)
+        original = self.units[u"app"]
+        self.change_behind_watchers_back()
+        self.events.event(u"abc", u"export")
+        self.assert_listed(watcher, {original})
+
+    def test_change_notified(self):
+        """
+        Callbacks passed to ``notify_on_change`` are called when an event
+        changes the units, but not if the units stay the same.
+        """
+        watcher = self.watcher()
+        self.start(watcher)
+        notified = []
+        watcher.notify_on_change(lambda: notified.append(True))
+        self.events.event(u"abc", u"start")
+        self.change_behind_watchers_back()
+        self.events.event(u"abc", u"die")
+        self.assertEqual([True], notified)
+
+    def test_add_refreshes(self):
+        """
+        A unit added through the watcher is listed immediately.
+        """
+        watcher = self.watcher()
+        self.start(watcher)
+        self.successResultOf(watcher.add(u"new", u"busybox:latest"))
+        self.assertEqual(
+            [u"app", u"new"],
+            sorted(unit.name for unit in
+                   self.successResultOf(watcher.list())))
+
+    def test_remove_refreshes(self):
+        """
+        A unit removed through the watcher is no longer listed.
+        """
+        watcher = self.watcher()
+        self.start(watcher)
+        self.successResultOf(watcher.remove(u"app"))
+        self.assert_listed(watcher, set())
+
+    def test_list_waits_for_refresh(self):
+        """
+        ``list`` waits for a refresh in progress.
+        """
+        client = ControllableListClient(self.units)
+        watcher = self.watcher(client)
+        self.start(watcher)
+        client.finish_listing()
+        self.events.event(u"abc", u"die")
+        d = watcher.list()
+        self.assertNoResult(d)
+        changed = self.change_behind_watchers_back()
+        client.finish_listing()
+        self.assertEqual({changed}, self.successResultOf(d))
+
+    def test_refresh_repeated_for_events_during_refresh(self):
+        """
+        If an event arrives while a listing is in progress, another listing
+        is made once it is done, since the first may have missed the change.
+        """
+        client = ControllableListClient(self.units)
+        watcher = self.watcher(client)
+        self.start(watcher)
+        client.finish_listing()
+        self.events.event(u"abc", u"die")
+        self.events.event(u"abc", u"destroy")
+        d = watcher.list()
+        client.finish_listing()
+        changed = self.change_behind_watchers_back()
+        client.finish_listing()
+        self.assertEqual(({changed}, []),
+                         (self.successResultOf(d), client.listings))
+
+    def test_refresh_failure(self):
+        """
+        If a refresh fails, calls to ``list`` waiting for it fail too.
+        """
+        client = ControllableListClient(self.units)
+        watcher = self.watcher(client)
+        watcher.logger = None
+        self.start(watcher)
+        client.finish_listing()
+        self.events.event(u"abc", u"die")
+        d = watcher.list()
+        self.patch(_docker, "write_failure", lambda *args: None)
+        client.listings.pop().errback(ZeroDivisionError())
+        self.failureResultOf(d, ZeroDivisionError)
+
+    def test_disconnect_unsynchronises(self):
+        """
+        When the subscription ends the watcher is no longer synchronised,
+        so ``list`` asks the wrapped client.
+        """
+        watcher = self.watcher()
+        self.start(watcher)
+        self.events.disconnect()
+        changed = self.change_behind_watchers_back()
+        self.assertEqual((False, {changed}),
+                         (watcher.synchronised,
+                          self.successResultOf(watcher.list())))
+
+    def test_resubscribe(self):
+        """
+        After the subscription ended the watcher subscribes again and
+        resynchronises with a full listing.
+        """
+        watcher = self.watcher()
+        self.start(watcher)
+        self.events.disconnect()
+        changed = self.change_behind_watchers_back()
+        self.clock.advance(RESUBSCRIBE_DELAY)
+        self.assertEqual(
+            (2, True, True, {u"app": changed}),
+            (len(self.events.subscriptions), self.events.subscribed,
+             watcher.synchronised, watcher.units))
+
+    def assert_subscription_failure_logged(self, logger):
+        """
+        The failure of the subscription was logged.
+        """
+        self.assertEqual(1, len(logger.flushTracebacks(ZeroDivisionError)))
+
+    @validate_logging(assert_subscription_failure_logged)
+    def test_resubscribe_after_failure(self, logger):
+        """
+        The watcher subscribes again after the subscription failed, logging
+        the failure.
+        """
+        watcher = self.watcher()
+        watcher.logger = logger
+        self.start(watcher)
+        self.events.disconnect(Failure(ZeroDivisionError()))
+        self.clock.advance(RESUBSCRIBE_DELAY)
+        self.assertEqual((2, True), (len(self.events.subscriptions),
+                                     watcher.synchronised))
+
+    def test_stop(self):
+        """
+        Stopping the watcher ends the subscription and it doesn't subscribe
+        again.
+        """
+        watcher = self.watcher()
+        watcher.startService()
+        watcher.stopService()
+        self.clock.advance(RESUBSCRIBE_DELAY)
+        self.assertEqual((1, False, False),
+                         (len(self.events.subscriptions),
+                          self.events.subscribed, watcher.synchronised))
+
+    @validate_logging(assert_subscription_failure_logged)
+    def test_failure_while_stopping_logged(self, logger):
+        """
+        If the subscription fails with something other than cancellation
+        while the watcher is stopping, the failure is logged and the watcher
+        doesn't subscribe again.
+        """
+        subscriptions = []
+
+        def subscribe(event_received):
+            d = Deferred(lambda d: d.errback(ZeroDivisionError()))
+            subscriptions.append(d)
+            return d
+        self.patch(self.events, "subscribe", subscribe)
+        watcher = self.watcher()
+        watcher.logger = logger
+        watcher.startService()
+        watcher.stopService()
+        self.clock.advance(RESUBSCRIBE_DELAY)
+        self.assertEqual(1, len(subscriptions))
+
+    @validate_logging(None)
+    def test_stop_not_logged(self, logger):
+        """
+        The cancellation of the subscription when the watcher is stopped is
+        not logged.
+        """
+        watcher = self.watcher()
+        watcher.logger = logger
+        watcher.startService()
+        watcher.stopService()
+        self.assertEqual([], logger.flushTracebacks(CancelledError))
+
+    def test_stop_while_disconnected(self):
+        """
+        Stopping the watcher while waiting to subscribe again means it
+        doesn't.
+        """
+        watcher = self.watcher()
+        watcher.startService()
+        self.events.disconnect()
+        watcher.stopService()
+        self.clock.advance(RESUBSCRIBE_DELAY)
+        self.assertEqual(1, len(self.events.subscriptions))
+
+
+class DockerClientEventsTests(TestCase):
+    """
+    Tests for ``DockerClient`` as an ``IDockerEventSource``, using a
+    ``FakeDockerServer``.
+    """
+    def test_events_delivered(self):
+        """
+        Events of containers are delivered to the subscriber until the
+        subscription is cancelled.
+        """
+        server = fake_docker_server_for_test(self)
+        server.images.add(u"busybox:latest")
+        client = DockerClient(base_url=server.base_url)
+        received = []
+        subscription = client.subscribe(received.append)
+        self.addCleanup(self.cancel, subscription)
+        d = client.add(u"app", u"busybox:latest")
+        d.addCallback(lambda _: loop_until(
+            lambda: [u"create", u"start"] == [
+                event[u"status"] for event in received]))
+        return d
+
+    def cancel(self, subscription):
+        """
+        Cancel a subscription.
+        """
+        subscription.cancel()
+        self.failureResultOf(subscription, CancelledError)
+
+    def test_cancel(self):
+        """
+        Cancelling the subscription ends it.
+        """
+        server = fake_docker_server_for_test(self)
+        client = DockerClient(base_url=server.base_url)
+        self.cancel(client.subscribe(lambda event: None))
+        # The thread notices at the end of the current window:
+        return loop_until(
+            lambda: client.statistics[u"events"].pending == 0)
@@ -20,11 +20,14 @@ from .._loop import (
     build_cluster_status_fsm, ClusterStatusInputs, _ClientStatusUpdate,
     _StatusUpdate, _ConnectedToControlService, ConvergenceLoopInputs,
     ConvergenceLoopStates, build_convergence_loop_fsm, AgentLoopService,
-    ClusterStatus, ConvergenceLoop, LOG_SEND_TO_CONTROL_SERVICE
+    ClusterStatus, ConvergenceLoop, LOG_SEND_TO_CONTROL_SERVICE,
+    HEARTBEAT_INTERVAL,
     )
 from ..testtools import ControllableDeployer, ControllableAction
 from ...control import NodeState, Deployment, Node, Manifestation, Dataset
-from ...control._protocol import NodeStateCommand, _AgentLocator, AgentAMP
+from ...control._protocol import (
+    NodeStateCommand, NodeStateHeartbeatCommand, _AgentLocator, AgentAMP,
+)
 from ...control.test.test_protocol import iconvergence_agent_tests_factory
 
 
@@ -569,6 +572,272 @@ class ConvergenceLoopFSMTests(SynchronousTestCase):
              [(NodeStateCommand, dict(node_state=local_state2))]))
 
 
+class EventDrivenConvergenceLoopTests(SynchronousTestCase):
+    """
+    Tests for the scheduling of iterations by the FSM created by
+    ``build_convergence_loop_fsm``.
+    """
+    def setUp(self):
+        self.local_state = NodeState(hostname=b'192.0.2.123')
+        self.configuration = Deployment(
+            nodes=frozenset([self.local_state.to_node()]))
+        self.reactor = Clock()
+        # Every iteration discovers the same local state and finishes
+        # immediately:
+        self.deployer = ControllableDeployer(
+            [succeed(self.local_state) for i in range(10)],
+            [ControllableAction(result=succeed(None)) for i in range(10)])
+        self.client = FakeAMPClient()
+        self.client.register_response(
+            NodeStateCommand, dict(node_state=self.local_state),
+            {"result": None})
+        self.loop = build_convergence_loop_fsm(
+            self.reactor, self.deployer, minimum_poll_interval=1.0,
+            maximum_poll_interval=3.0)
+
+    def status_update(self):
+        """
+        Send a status update to the loop.
+        """
+        self.loop.receive(_ClientStatusUpdate(
+            client=self.client, configuration=self.configuration,
+            state=self.configuration))
+
+    def delays(self):
+        """
+        :return: The delays until the scheduled calls.
+        """
+        return [call.getTime() - self.reactor.seconds()
+                for call in self.reactor.getDelayedCalls()]
+
+    def test_sleeping(self):
+        """
+        A FSM completing an iteration sleeps until the next one, which is
+        scheduled after the minimum poll interval.
+        """
+        self.status_update()
+        self.assertEqual((self.loop.state, self.delays()),
+                         (ConvergenceLoopStates.SLEEPING, [1.0]))
+
+    def test_backoff(self):
+        """
+        Every iteration which discovers unchanged local state doubles the
+        delay until the next iteration.
+        """
+        self.status_update()
+        self.reactor.advance(1.0)
+        self.assertEqual((len(self.deployer.calculate_inputs), self.delays()),
+                         (2, [2.0]))
+
+    def test_backoff_maximum(self):
+        """
+        The delay between iterations is never longer than the maximum poll
+        interval.
+        """
+        self.status_update()
+        self.reactor.advance(1.0)
+        self.reactor.advance(2.0)
+        self.assertEqual((len(self.deployer.calculate_inputs), self.delays()),
+                         (3, [3.0]))
+
+    def test_local_state_changed_resets_backoff(self):
+        """
+        An iteration which discovers different local state than the previous
+        one schedules the next iteration after the minimum poll interval.
+        """
+        self.status_update()
+        self.reactor.advance(1.0)
+        changed_state = self.local_state.set("used_ports", [1234])
+        self.client.register_response(
+            NodeStateCommand, dict(node_state=changed_state),
+            {"result": None})
+        self.deployer.local_states[0] = succeed(changed_state)
+        self.reactor.advance(2.0)
+        self.assertEqual(self.delays(), [1.0])
+
+    def test_status_update_while_sleeping(self):
+        """
+        A status update received while sleeping immediately starts a new
+        iteration, using the new information.
+        """
+        self.status_update()
+        self.configuration = Deployment(nodes=frozenset())
+        self.status_update()
+        self.assertEqual(
+            (len(self.deployer.calculate_inputs),
+             self.deployer.calculate_inputs[-1][1], self.delays()),
+            (2, self.configuration, [1.0]))
+
+    def test_local_state_changed_while_sleeping(self):
+        """
+        A ``LOCAL_STATE_CHANGED`` input received while sleeping immediately
+        starts a new iteration.
+        """
+        self.status_update()
+        self.loop.receive(ConvergenceLoopInputs.LOCAL_STATE_CHANGED)
+        self.assertEqual((len(self.deployer.calculate_inputs), self.delays()),
+                         (2, [1.0]))
+
+    def test_change_while_converging(self):
+        """
+        If a ``LOCAL_STATE_CHANGED`` input is received during an iteration,
+        the next iteration is scheduled without delay.
+        """
+        action = ControllableAction(result=Deferred())
+        self.deployer.calculated_actions[0] = action
+        self.status_update()
+        self.loop.receive(ConvergenceLoopInputs.LOCAL_STATE_CHANGED)
+        action.result.callback(None)
+        self.assertEqual(self.delays(), [0])
+
+    def test_stop_while_sleeping(self):
+        """
+        A FSM that is stopped while sleeping cancels the next iteration.
+        """
+        self.status_update()
+        self.loop.receive(ConvergenceLoopInputs.STOP)
+        self.assertEqual((self.loop.state, self.delays()),
+                         (ConvergenceLoopStates.STOPPED, []))
+
+    def test_local_state_changed_while_stopped(self):
+        """
+        A ``LOCAL_STATE_CHANGED`` input is ignored by a stopped FSM.
+        """
+        self.loop.receive(ConvergenceLoopInputs.LOCAL_STATE_CHANGED)
+        self.assertEqual((self.loop.state, self.deployer.calculate_inputs),
+                         (ConvergenceLoopStates.STOPPED, []))
+
+
+class LocalStateReportingTests(SynchronousTestCase):
+    """
+    Tests for how the FSM created by ``build_convergence_loop_fsm`` sends
+    local state to the control service.
+    """
+    def setUp(self):
+        self.local_state = NodeState(hostname=b'192.0.2.123')
+        self.changed_state = self.local_state.set("used_ports", [1234])
+        self.configuration = Deployment(
+            nodes=frozenset([self.local_state.to_node()]))
+        self.reactor = Clock()
+        self.deployer = ControllableDeployer(
+            [succeed(self.local_state) for i in range(10)],
+            [ControllableAction(result=succeed(None)) for i in range(10)])
+        self.client = self.client_for_token(u"token")
+        self.loop = build_convergence_loop_fsm(self.reactor, self.deployer)
+
+    def client_for_token(self, token, current=True):
+        """
+        Create a fake AMP client for a control service supporting heartbeats.
+
+        :param unicode token: The state token returned by the control
+            service.
+        :param bool current: Response to heartbeats.
+
+        :return FakeAMPClient: The client.
+        """
+        client = FakeAMPClient()
+        for state in [self.local_state, self.changed_state]:
+            client.register_response(
+                NodeStateCommand, dict(node_state=state),
+                {"state_token": token})
+        client.register_response(
+            NodeStateHeartbeatCommand,
+            dict(hostname=self.local_state.hostname, state_token=token),
+            {"current": current})
+        return client
+
+    def status_update(self, client=None):
+        """
+        Send a status update to the loop.
+
+        :param client: The client to use, by default ``self.client``.
+        """
+        self.loop.receive(_ClientStatusUpdate(
+            client=client or self.client, configuration=self.configuration,
+            state=self.configuration))
+
+    def test_unchanged_not_sent(self):
+        """
+        Local state identical to the state the control service acknowledged
+        is not sent again.
+        """
+        self.status_update()
+        self.reactor.advance(1.0)
+        self.assertEqual(
+            (len(self.deployer.calculate_inputs), self.client.calls),
+            (2, [(NodeStateCommand, dict(node_state=self.local_state))]))
+
+    def test_changed_sent(self):
+        """
+        Local state that differs from the state the control service
+        acknowledged is sent.
+        """
+        self.status_update()
+        self.deployer.local_states[0] = succeed(self.changed_state)
+        self.reactor.advance(1.0)
+        self.assertEqual(
+            self.client.calls,
+            [(NodeStateCommand, dict(node_state=self.local_state)),
+             (NodeStateCommand, dict(node_state=self.changed_state))])
+
+    def test_new_client_sent(self):
+        """
+        Local state is sent again when a new connection to the control
+        service is used.
+        """
+        self.status_update()
+        client2 = self.client_for_token(u"token2")
+        self.status_update(client2)
+        self.assertEqual(
+            client2.calls,
+            [(NodeStateCommand, dict(node_state=self.local_state))])
+
+    def test_heartbeat(self):
+        """
+        Once the heartbeat interval has passed since the state was sent, a
+        heartbeat with the token returned by the control service is sent
+        instead of unchanged local state.
+        """
+        self.status_update()
+        self.reactor.advance(HEARTBEAT_INTERVAL)
+        self.status_update()
+        self.assertEqual(
+            self.client.calls,
+            [(NodeStateCommand, dict(node_state=self.local_state)),
+             (NodeStateHeartbeatCommand,
+              dict(hostname=self.local_state.hostname,
+                   state_token=u"token"))])
+
+    def test_heartbeat_interval(self):
+        """
+        The heartbeat interval can be passed to
+        ``build_convergence_loop_fsm``.
+        """
+        self.loop = build_convergence_loop_fsm(
+            self.reactor, self.deployer, heartbeat_interval=5.0)
+        self.status_update()
+        self.reactor.advance(5.0)
+        self.status_update()
+        self.assertEqual(
+            self.client.calls[1:],
+            [(NodeStateHeartbeatCommand,
+              dict(hostname=self.local_state.hostname,
+                   state_token=u"token"))])
+
+    def test_heartbeat_not_current(self):
+        """
+        If the response to a heartbeat indicates the control service doesn't
+        have the current state the state is sent again.
+        """
+        self.client = self.client_for_token(u"token", current=False)
+        self.status_update()
+        self.reactor.advance(HEARTBEAT_INTERVAL)
+        self.status_update()
+        self.assertEqual(
+            self.client.calls[2:],
+            [(NodeStateCommand, dict(node_state=self.local_state))])
+
+
 class AgentLoopServiceTests(SynchronousTestCase):
     """
     Tests for ``AgentLoopService``.
@@ -664,6 +933,19 @@ class AgentLoopServiceTests(SynchronousTestCase):
         self.assertEqual(fsm.inputted, [_StatusUpdate(configuration=config,
                                                       state=state)])
 
+    def test_local_state_changed(self):
+        """
+        When ``local_state_changed()`` is called a
+        ``ConvergenceLoopInputs.LOCAL_STATE_CHANGED`` input is passed to the
+        convergence loop FSM.
+        """
+        service = AgentLoopService(
+            reactor=None, deployer=object(), host=u"example.com", port=1234)
+        service.convergence_loop = fsm = StubFSM()
+        service.local_state_changed()
+        self.assertEqual(fsm.inputted,
+                         [ConvergenceLoopInputs.LOCAL_STATE_CHANGED])
+
 
 def _build_service(test):
     """
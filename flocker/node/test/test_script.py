@@ -23,12 +23,14 @@ from ..script import (
     ChangeStateOptions, ChangeStateScript,
     ReportStateOptions, ReportStateScript)
 from .. import script as script_module
-from .._docker import FakeDockerClient, Unit
+from .._docker import (
+    FakeDockerClient, FakeDockerEventSource, DockerStateWatcher, Unit,
+)
 from ...control._model import (
     Application, Deployment, DockerImage, Node, AttachedVolume, Dataset,
     Manifestation)
 from ...control._config import dataset_id_from_name
-from .._loop import AgentLoopService
+from .._loop import AgentLoopService, ConvergenceLoopInputs
 from .._deploy import P2PNodeDeployer
 
 from ...volume.testtools import create_volume_service
@@ -413,6 +415,14 @@ class ReportStateScriptMainTests(SynchronousTestCase):
         self.assertEqual(safe_load(content.getvalue()), expected)
 
 
+def make_zfs_agent_script():
+    """
+    :return: A ``ZFSAgentScript`` that uses fake Docker objects.
+    """
+    return ZFSAgentScript(docker_client=FakeDockerClient(),
+                          event_source=FakeDockerEventSource())
+
+
 class ZFSAgentScriptTests(SynchronousTestCase):
     """
     Tests for ``ZFSAgentScript``.
@@ -424,14 +434,14 @@ class ZFSAgentScriptTests(SynchronousTestCase):
         service = Service()
         options = ZFSAgentOptions()
         options.parseOptions([b"1.2.3.4", b"example.com"])
-        ZFSAgentScript().main(MemoryCoreReactor(), options, service)
+        make_zfs_agent_script().main(MemoryCoreReactor(), options, service)
         self.assertTrue(service.running)
 
     def test_no_immediate_stop(self):
         """
         The ``Deferred`` returned from ``ZFSAgentScript`` is not fired.
         """
-        script = ZFSAgentScript()
+        script = make_zfs_agent_script()
         options = ZFSAgentOptions()
         options.parseOptions([b"1.2.3.4", b"example.com"])
         self.assertNoResult(script.main(MemoryCoreReactor(), options,
@@ -446,7 +456,7 @@ class ZFSAgentScriptTests(SynchronousTestCase):
         options.parseOptions([b"--destination-port", b"1234", b"1.2.3.4",
                               b"example.com"])
         test_reactor = MemoryCoreReactor()
-        ZFSAgentScript().main(test_reactor, options, service)
+        make_zfs_agent_script().main(test_reactor, options, service)
         parent_service = service.parent
         # P2PNodeDeployer is difficult to compare automatically, so do so
         # manually:
@@ -461,6 +471,30 @@ class ZFSAgentScriptTests(SynchronousTestCase):
                                            port=1234),
                           P2PNodeDeployer, b"1.2.3.4", service, True))
 
+    def test_deployer_uses_state_watcher(self):
+        """
+        The deployer of the convergence loop talks to Docker through a
+        running ``DockerStateWatcher`` subscribed to the Docker events,
+        whose changes wake up the convergence loop.
+        """
+        events = FakeDockerEventSource()
+        options = ZFSAgentOptions()
+        options.parseOptions([b"1.2.3.4", b"example.com"])
+        service = Service()
+        ZFSAgentScript(docker_client=FakeDockerClient(),
+                       event_source=events).main(
+            MemoryCoreReactor(), options, service)
+        loop = service.parent
+        woken = []
+        self.patch(loop.convergence_loop, "receive", woken.append)
+        watcher = loop.deployer.docker_client
+        self.successResultOf(watcher.add(u"app", u"busybox:latest"))
+        self.assertEqual(
+            (DockerStateWatcher, True, True,
+             [ConvergenceLoopInputs.LOCAL_STATE_CHANGED]),
+            (watcher.__class__, bool(watcher.running), events.subscribed,
+             woken))
+
 
 class ZFSAgentOptionsTests(make_volume_options_tests(
         ZFSAgentOptions, [b"1.2.3.4", b"example.com"])):
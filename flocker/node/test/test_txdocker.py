@@ -0,0 +1,109 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for :module:`flocker.node._txdocker`.
+"""
+
+from twisted.trial.unittest import TestCase
+
+from ...testtools import random_name
+from .._txdocker import TwistedDockerClient, DockerAPIError
+from ..testtools import fake_docker_server_for_test
+from .test_docker import make_idockerclient_tests
+
+
+def make_client(test_case, server):
+    """
+    Create a ``TwistedDockerClient`` whose connections are closed when the
+    test finishes.
+
+    :param test_case: The ``TestCase`` using the client.
+    :param FakeDockerServer server: The server to talk to.
+
+    :return: The ``TwistedDockerClient``.
+    """
+    client = TwistedDockerClient(base_url=server.base_url)
+    test_case.addCleanup(client.close)
+    return client
+
+
+class TwistedDockerClientIDockerClientTests(
+        make_idockerclient_tests(
+            lambda test: make_client(
+                test, fake_docker_server_for_test(test)))):
+    """
+    ``IDockerClient`` tests for ``TwistedDockerClient`` talking to a
+    ``FakeDockerServer``.
+    """
+
+
+class TwistedDockerClientTests(TestCase):
+    """
+    Tests for ``TwistedDockerClient``.
+    """
+    def setUp(self):
+        self.server = fake_docker_server_for_test(self)
+        self.client = make_client(self, self.server)
+
+    def test_pulls_missing_image(self):
+        """
+        ``TwistedDockerClient.add`` pulls the image if Docker doesn't have
+        it.
+        """
+        name = random_name()
+        d = self.client.add(name, u"busybox")
+        self.addCleanup(self.client.remove, name)
+        d.addCallback(lambda _: self.assertEqual(
+            {u"busybox:latest"}, self.server.images))
+        return d
+
+    def test_pull_cached(self):
+        """
+        ``TwistedDockerClient.pull`` doesn't ask Docker about an image it
+        already made sure is present.
+        """
+        d = self.client.pull(u"busybox:latest")
+
+        def pulled(_):
+            requests = self.server.requests
+            pulling = self.client.pull(u"busybox:latest")
+            pulling.addCallback(
+                lambda _: self.assertEqual(requests, self.server.requests))
+            return pulling
+        d.addCallback(pulled)
+        return d
+
+    def test_add_image_removed(self):
+        """
+        ``TwistedDockerClient.add`` pulls the image again if it was removed
+        after an earlier pull.
+        """
+        name = random_name()
+        d = self.client.pull(u"busybox:latest")
+        d.addCallback(lambda _: self.server.images.clear())
+        d.addCallback(lambda _: self.client.add(name, u"busybox:latest"))
+        self.addCleanup(self.client.remove, name)
+        d.addCallback(lambda _: self.assertEqual(
+            {u"busybox:latest"}, self.server.images))
+        return d
+
+    def test_connections_reused(self):
+        """
+        Consecutive requests are sent over the same connection.
+        """
+        d = self.client.exists(random_name())
+        d.addCallback(lambda _: self.client.exists(random_name()))
+        d.addCallback(lambda _: self.client.list())
+        d.addCallback(lambda _: self.assertEqual(
+            (1, 3), (self.server.connections, self.server.requests)))
+        return d
+
+    def test_api_error(self):
+        """
+        Error responses from Docker, other than those the ``IDockerClient``
+        methods handle, result in a ``DockerAPIError``.
+        """
+        d = self.client._request(b"GET", u"/nonexistent")
+        d = self.assertFailure(d, DockerAPIError)
+        d.addCallback(lambda error: self.assertEqual(404, error.code))
+        return d
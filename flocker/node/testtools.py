@@ -8,7 +8,17 @@ import errno
 import os
 import pwd
 import socket
+from BaseHTTPServer import BaseHTTPRequestHandler
+from json import dumps, loads
+from shutil import rmtree
+from SocketServer import ThreadingMixIn, UnixStreamServer
+from tempfile import mkdtemp
+from threading import Lock, Thread, current_thread
+from time import sleep, time
+from types import GeneratorType
 from unittest import skipUnless
+from urlparse import urlparse, parse_qsl
+from uuid import uuid4
 
 from zope.interface import implementer
 
@@ -108,3 +118,326 @@ class ControllableDeployer(object):
         self.calculate_inputs.append(
             (local_state, desired_configuration, cluster_state))
         return self.calculated_actions.pop(0)
+
+
+def fake_container(container_id, name, image=u"busybox:latest"):
+    """
+    Create the data Docker returns when inspecting a running container.
+
+    :param unicode container_id: The ID of the container.
+    :param unicode name: The name of the container, e.g.
+        ``u"flocker--myapp"``.
+    :param unicode image: The image of the container.
+
+    :return: ``dict`` in the format of Docker's inspect API.
+    """
+    return {
+        u"Id": container_id,
+        u"Name": u"/" + name,
+        u"State": {u"Running": True},
+        u"Config": {u"Image": image, u"CpuShares": 0, u"Memory": 0},
+        u"HostConfig": {
+            u"PortBindings": None,
+            u"Binds": None,
+            u"RestartPolicy": {u"Name": u"", u"MaximumRetryCount": 0},
+        },
+    }
+
+
+class _FakeDockerHandler(BaseHTTPRequestHandler):
+    """
+    Serve the Docker API requests of a ``FakeDockerServer``.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.fake_docker._accepted(self.request)
+
+    def _dispatch(self):
+        url = urlparse(self.path)
+        length = int(self.headers.getheader(b"content-length") or 0)
+        body = self.rfile.read(length) if length else b""
+        code, result = self.server.fake_docker._handle(
+            self.command, url.path.split(u"/")[2:],
+            dict(parse_qsl(url.query)), loads(body) if body else None)
+        if isinstance(result, GeneratorType):
+            self._stream(code, result)
+            return
+        body = b"" if result is None else dumps(result)
+        self.send_response(code)
+        self.send_header(b"Content-Type", b"application/json")
+        self.send_header(b"Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, code, chunks):
+        """
+        Send a response with chunked transfer encoding.
+
+        :param int code: The response code.
+        :param chunks: Iterator of ``bytes`` to send as chunks, each as
+            soon as it is available.
+        """
+        self.send_response(code)
+        self.send_header(b"Content-Type", b"application/json")
+        self.send_header(b"Transfer-Encoding", b"chunked")
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except socket.error:
+            # The client went away or the server was stopped.
+            self.close_connection = 1
+
+    do_GET = do_POST = do_DELETE = _dispatch
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingUnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+    # Clients that don't reuse connections open them quickly:
+    request_queue_size = 128
+
+
+def _full_image_name(image):
+    """
+    :param unicode image: An image name which may lack a tag.
+
+    :return: The image name including a tag, e.g. ``u"busybox:latest"`` for
+        ``u"busybox"``.
+    """
+    if u":" in image.rsplit(u"/", 1)[-1]:
+        return image
+    return image + u":latest"
+
+
+class FakeDockerServer(object):
+    """
+    A Docker daemon lookalike listening on a Unix socket, which implements
+    the parts of the Docker API used by Flocker in memory: creating,
+    starting, stopping, removing, listing and inspecting containers and
+    inspecting and pulling images, and reporting the events of containers
+    changed through it.
+
+    Like Docker, events are streamed as they happen until the end of the
+    requested time range, or indefinitely if it has no end.
+
+    :ivar dict containers: Maps container IDs to their inspection data,
+        e.g. as created by ``fake_container``.
+    :ivar set images: The full names of the images that have been pulled.
+    :ivar list events: The events that happened, as ``dict`` like those
+        returned by the Docker events API.
+    :ivar int connections: The number of connections accepted.
+    :ivar int requests: The number of requests served.
+    """
+    def __init__(self, path, containers=None):
+        """
+        :param bytes path: The path of the Unix socket to listen on.
+        :param dict containers: See ``containers``.
+        """
+        if containers is None:
+            containers = {}
+        self.path = path
+        self.containers = containers
+        self.images = set()
+        self.events = []
+        self.connections = 0
+        self.requests = 0
+        self._lock = Lock()
+        self._server = None
+        self._stopped = False
+        self._sockets = []
+        self._threads = []
+
+    @property
+    def base_url(self):
+        """
+        The URL to pass to ``DockerClient`` to talk to this server.
+        """
+        return u"unix://" + self.path
+
+    def _accepted(self, connection):
+        with self._lock:
+            self.connections += 1
+            self._sockets.append(connection)
+            self._threads.append(current_thread())
+
+    def _find(self, reference):
+        """
+        :param unicode reference: The ID or name of a container.
+
+        :return: The inspection data of the container or ``None``.
+        """
+        if reference in self.containers:
+            return self.containers[reference]
+        for data in self.containers.values():
+            if data[u"Name"] == u"/" + reference:
+                return data
+        return None
+
+    def _handle(self, method, segments, params, body):
+        """
+        Handle a request.
+
+        :param bytes method: The HTTP method.
+        :param list segments: The segments of the request path after the
+            API version.
+        :param dict params: The query arguments.
+        :param body: The decoded JSON body of the request, or ``None``.
+
+        :return: Tuple of the response code and the result to encode as
+            the JSON body of the response, a generator of ``bytes`` chunks
+            of the body to stream, or ``None`` for no body.
+        """
+        if (method, segments) == (b"GET", [u"events"]):
+            return 200, self._events(params)
+        with self._lock:
+            self.requests += 1
+            route = (method, segments[0], segments[-1], len(segments))
+            if route == (b"GET", u"containers", u"json", 2):
+                return 200, [
+                    {u"Id": container_id, u"Names": [data[u"Name"]]}
+                    for container_id, data in self.containers.items()]
+            if route == (b"POST", u"containers", u"create", 2):
+                return self._create(params[u"name"], body)
+            if route == (b"GET", u"images", u"json", len(segments)):
+                name = _full_image_name(u"/".join(segments[1:-1]))
+                return (200, {}) if name in self.images else (404, None)
+            if route == (b"POST", u"images", u"create", 2):
+                image = params[u"fromImage"]
+                if params.get(u"tag"):
+                    image += u":" + params[u"tag"]
+                self.images.add(_full_image_name(image))
+                return 200, {u"status": u"Downloaded newer image"}
+            if segments[0] != u"containers" or len(segments) not in (2, 3):
+                return 404, None
+            data = self._find(segments[1])
+            if data is None:
+                return 404, None
+            if route == (b"GET", u"containers", u"json", 3):
+                return 200, data
+            if route == (b"POST", u"containers", u"start", 3):
+                data[u"State"][u"Running"] = True
+                self._event(data, u"start")
+                return 204, None
+            if route == (b"POST", u"containers", u"stop", 3):
+                if not data[u"State"][u"Running"]:
+                    return 304, None
+                data[u"State"][u"Running"] = False
+                self._event(data, u"die")
+                return 204, None
+            if method == b"DELETE" and len(segments) == 2:
+                del self.containers[data[u"Id"]]
+                self._event(data, u"destroy")
+                return 204, None
+            return 404, None
+
+    def _event(self, data, status):
+        """
+        Record an event of a container.
+
+        :param dict data: The inspection data of the container.
+        :param unicode status: The status of the event, e.g. ``u"die"``.
+        """
+        self.events.append({u"id": data[u"Id"], u"status": status,
+                            u"from": data[u"Config"][u"Image"],
+                            u"time": int(time())})
+
+    def _events(self, params):
+        """
+        Stream the events in the time range given by the ``since`` and
+        ``until`` query arguments.
+
+        :param dict params: The query arguments.
+
+        :return: Generator of the ``bytes`` of each event.
+        """
+        since = int(params.get(u"since", 0))
+        until = int(params.get(u"until", 0)) or None
+        with self._lock:
+            self.requests += 1
+        sent = 0
+        while not self._stopped and (until is None or time() < until + 1):
+            with self._lock:
+                new, sent = self.events[sent:], len(self.events)
+            for event in new:
+                if until is not None and event[u"time"] > until:
+                    return
+                if since <= event[u"time"]:
+                    yield dumps(event)
+            sleep(0.01)
+
+    def _create(self, name, config):
+        """
+        Create a container.
+
+        :param unicode name: The name of the container.
+        :param dict config: The configuration of the container.
+
+        :return: See ``_handle``.
+        """
+        if _full_image_name(config[u"Image"]) not in self.images:
+            return 404, None
+        if self._find(name) is not None:
+            return 409, None
+        container_id = uuid4().hex * 2
+        data = fake_container(container_id, name, config[u"Image"])
+        data[u"State"][u"Running"] = False
+        data[u"Config"][u"Memory"] = config.get(u"Memory") or 0
+        data[u"Config"][u"CpuShares"] = config.get(u"CpuShares") or 0
+        data[u"HostConfig"].update(config.get(u"HostConfig") or {})
+        self.containers[container_id] = data
+        self._event(data, u"create")
+        return 201, {u"Id": container_id}
+
+    def start(self):
+        """
+        Start serving in a background thread.
+        """
+        self._server = _ThreadingUnixServer(self.path, _FakeDockerHandler)
+        self._server.fake_docker = self
+        thread = Thread(target=self._server.serve_forever, args=(0.01,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """
+        Stop serving, closing any open connections and removing the socket.
+        """
+        self._stopped = True
+        self._server.shutdown()
+        self._server.server_close()
+        os.remove(self.path)
+        with self._lock:
+            for connection in self._sockets:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            threads = self._threads[:]
+        for thread in threads:
+            thread.join(1)
+
+
+def fake_docker_server_for_test(test_case, containers=None):
+    """
+    Start a ``FakeDockerServer`` which is stopped when the test finishes.
+
+    :param test_case: The ``TestCase`` using the server.
+    :param dict containers: See ``FakeDockerServer.containers``.
+
+    :return: The running ``FakeDockerServer``.
+    """
+    # Unix socket paths are limited in length, so the test's own temporary
+    # directory may be too deep:
+    directory = mkdtemp()
+    test_case.addCleanup(rmtree, directory)
+    server = FakeDockerServer(directory + b"/docker.sock", containers)
+    server.start()
+    test_case.addCleanup(server.stop)
+    return server
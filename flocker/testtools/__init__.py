@@ -47,17 +47,45 @@ from ..common.script import (
 @implementer(IProcessTransport)
 class FakeProcessTransport(object):
     """
-    Mock process transport to observe signals sent to a process.
+    Mock process transport to observe signals sent to a process and its
+    standard input and output.
 
     @ivar signals: L{list} of signals sent to process.
+    @ivar stdin: L{bytes} written to the process's standard input.
+    @ivar stdin_closed: Whether the process's standard input was closed.
+    @ivar paused: Whether reading the process's output is paused.
+    @ivar producer: The producer registered for the process's standard
+        input, or L{None}.
     """
 
     def __init__(self):
         self.signals = []
+        self.stdin = b""
+        self.stdin_closed = False
+        self.paused = False
+        self.producer = None
 
     def signalProcess(self, signal):
         self.signals.append(signal)
 
+    def write(self, data):
+        self.stdin += data
+
+    def closeStdin(self):
+        self.stdin_closed = True
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
 
 class SpawnProcessArguments(namedtuple(
                             'ProcessData',
@@ -0,0 +1,123 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+# -*- test-case-name: flocker.volume.test.test_compression -*-
+
+"""
+On-the-wire compression of the data pushed between volume managers.
+"""
+
+from __future__ import absolute_import
+
+import bz2
+import zlib
+
+from zope.interface import implementer
+
+from characteristic import attributes
+
+from .filesystems.interfaces import IFilesystemReceiver
+
+
+# Supported compression algorithms, most preferred first.  Each maps to a
+# pair of callables, one creating a compressor for a compression level and
+# one creating a decompressor.
+_ALGORITHMS = {
+    b"zlib": (zlib.compressobj, zlib.decompressobj),
+    b"bz2": (bz2.BZ2Compressor, bz2.BZ2Decompressor),
+}
+COMPRESSION_ALGORITHMS = (b"zlib", b"bz2")
+
+DEFAULT_COMPRESSION_LEVEL = 6
+
+
+@attributes(["algorithm", "level"])
+class Compression(object):
+    """
+    How to compress the data pushed to another volume manager.
+
+    :ivar bytes algorithm: One of ``COMPRESSION_ALGORITHMS``.
+    :ivar int level: The compression level, from 1 (fastest) to 9 (smallest
+        output).
+    """
+    def __init__(self):
+        """
+        :raises ValueError: If the algorithm or level is not supported.
+        """
+        if self.algorithm not in _ALGORITHMS:
+            raise ValueError(
+                "Unknown compression algorithm", self.algorithm)
+        if not 1 <= self.level <= 9:
+            raise ValueError("Compression level must be 1-9", self.level)
+
+
+@implementer(IFilesystemReceiver)
+class CompressingReceiver(object):
+    """
+    Compress the data written to it before passing it on to another
+    receiver.
+    """
+    def __init__(self, receiver, compression):
+        """
+        :param IFilesystemReceiver receiver: The receiver of the compressed
+            data, typically the stdin of a remote ``flocker-volume
+            receive``.
+        :param Compression compression: How to compress the data.
+        """
+        self._receiver = receiver
+        compressor, _ = _ALGORITHMS[compression.algorithm]
+        self._compressor = compressor(compression.level)
+
+    def write(self, data):
+        compressed = self._compressor.compress(data)
+        # The compressor buffers until it has a worthwhile amount of
+        # output.
+        if compressed:
+            self._receiver.write(compressed)
+
+    def registerProducer(self, producer, streaming):
+        self._receiver.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self._receiver.unregisterProducer()
+
+    def finish(self):
+        self._receiver.write(self._compressor.flush())
+        return self._receiver.finish()
+
+
+@implementer(IFilesystemReceiver)
+class DecompressingReceiver(object):
+    """
+    Decompress the data written to it before passing it on to another
+    receiver.
+    """
+    def __init__(self, receiver, algorithm):
+        """
+        :param IFilesystemReceiver receiver: The receiver of the
+            decompressed data.
+        :param bytes algorithm: The algorithm the data was compressed with,
+            one of ``COMPRESSION_ALGORITHMS``.
+        """
+        self._receiver = receiver
+        _, decompressor = _ALGORITHMS[algorithm]
+        self._decompressor = decompressor()
+
+    def write(self, data):
+        decompressed = self._decompressor.decompress(data)
+        if decompressed:
+            self._receiver.write(decompressed)
+
+    def registerProducer(self, producer, streaming):
+        self._receiver.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self._receiver.unregisterProducer()
+
+    def finish(self):
+        # Only zlib holds back output until it is told there's no more
+        # input.  A truncated stream just results in less output, which the
+        # wrapped receiver notices.
+        if hasattr(self._decompressor, "flush"):
+            remainder = self._decompressor.flush()
+            if remainder:
+                self._receiver.write(remainder)
+        return self._receiver.finish()
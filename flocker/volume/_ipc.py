@@ -4,10 +4,11 @@
 Inter-process communication for the volume manager.
 
 Specific volume managers ("nodes") may wish to push data to other
-nodes. In the current iteration this is done over SSH using a blocking
-API. In some future iteration this will be replaced with an actual
-well-specified communication protocol between daemon processes using
-Twisted's event loop (https://clusterhq.atlassian.net/browse/FLOC-154).
+nodes. In the current iteration this is done over SSH, streaming the
+data to the remote command's stdin. In some future iteration this will be
+replaced with an actual well-specified communication protocol between
+daemon processes using Twisted's event loop
+(https://clusterhq.atlassian.net/browse/FLOC-154).
 """
 
 from contextlib import contextmanager
@@ -17,11 +18,12 @@ from characteristic import with_cmp
 
 from zope.interface import Interface, implementer
 
-from twisted.internet.defer import succeed
+from twisted.internet.defer import maybeDeferred, succeed
 from twisted.python.filepath import FilePath
 
 from ..common._ipc import ProcessNode
 from .service import DEFAULT_CONFIG_PATH
+from ._compression import COMPRESSION_ALGORITHMS, DecompressingReceiver
 from .filesystems.zfs import Snapshot
 
 
@@ -72,6 +74,47 @@ class IRemoteVolumeManager(Interface):
              update the volume on the remote volume manager.
         """
 
+    def receive_stream(volume, compression=None, resume=False):
+        """
+        Start receiving a volume's contents without blocking.
+
+        :param Volume volume: The volume which will be pushed to the
+            remote volume manager.
+
+        :param compression: ``None``, or the ``bytes`` name of the algorithm
+            the data is compressed with, one of those returned by
+            ``compressions``.
+
+        :param bool resume: If true the data continues the stream identified
+            by ``resume_token``.
+
+        :return: A ``Deferred`` that fires with an ``IFilesystemReceiver``
+            provider to which the data written by ``IFilesystem.send`` can
+            be written, which will update the volume on the remote volume
+            manager.
+        """
+
+    def resume_token(volume):
+        """
+        Find out whether a previous push of the given volume was interrupted.
+
+        :param Volume volume: The volume which will be pushed to the
+            remote volume manager.
+
+        :return: A ``Deferred`` that fires with the ``bytes`` resume token
+            for the interrupted stream (see ``IFilesystem.resume_token``),
+            or ``None``.
+        """
+
+    def compressions():
+        """
+        Find out which compression algorithms the remote volume manager can
+        receive.
+
+        :return: A ``Deferred`` that fires with a ``list`` of the ``bytes``
+            names of the supported algorithms.
+        """
+
     def acquire(volume):
         """
         Tell the remote volume manager to acquire the given volume.
@@ -115,25 +158,90 @@ class RemoteVolumeManager(object):
         Run ``flocker-volume snapshots`` on the destination and parse the
         output into a ``list`` of ``Snapshot`` instances.
         """
-        data = self._destination.get_output(
+        getting = self._destination.get_output_async(
             [b"flocker-volume",
              b"--config", self._config_path.path,
              b"snapshots",
              volume.node_id.encode("ascii"),
              volume.name.to_bytes()]
         )
-        return succeed([
+        getting.addCallback(lambda data: [
             Snapshot(name=name)
             for name
             in data.splitlines()
         ])
+        return getting
+
+    def _receive_command(self, volume, compression=None, resume=False):
+        """
+        :param Volume volume: The volume which will be pushed.
+        :param compression: See ``IRemoteVolumeManager.receive_stream``.
+        :param resume: See ``IRemoteVolumeManager.receive_stream``.
+
+        :return: The ``flocker-volume receive`` command for the volume, as
+            a ``list`` of ``bytes``.
+        """
+        command = [b"flocker-volume",
+                   b"--config", self._config_path.path,
+                   b"receive"]
+        # Only pass the newer options when needed, so that older versions
+        # of flocker-volume can still receive uncompressed streams.
+        if compression is not None:
+            command.extend([b"--compression", compression])
+        if resume:
+            command.append(b"--resume")
+        return command + [volume.node_id.encode(b"ascii"),
+                          volume.name.to_bytes()]
 
     def receive(self, volume):
-        return self._destination.run([b"flocker-volume",
-                                      b"--config", self._config_path.path,
-                                      b"receive",
-                                      volume.node_id.encode(b"ascii"),
-                                      volume.name.to_bytes()])
+        return self._destination.run(self._receive_command(volume))
+
+    def receive_stream(self, volume, compression=None, resume=False):
+        """
+        Run ``flocker-volume receive`` on the destination, writing the data
+        to its stdin.
+        """
+        return maybeDeferred(
+            self._destination.run_streaming,
+            self._receive_command(volume, compression, resume))
+
+    def resume_token(self, volume):
+        """
+        Run ``flocker-volume resume_token`` on the destination.
+
+        If that fails, e.g. because the remote ``flocker-volume`` is too old
+        to support it, there is assumed to be nothing to resume.
+        """
+        getting = self._destination.get_output_async(
+            [b"flocker-volume",
+             b"--config", self._config_path.path,
+             b"resume_token",
+             volume.node_id.encode(b"ascii"),
+             volume.name.to_bytes()])
+
+        def failed(reason):
+            reason.trap(IOError)
+            return None
+        getting.addCallbacks(lambda data: data.strip() or None, failed)
+        return getting
+
+    def compressions(self):
+        """
+        Run ``flocker-volume compressions`` on the destination.
+
+        If that fails, e.g. because the remote ``flocker-volume`` is too old
+        to support it, no compression is supported.
+        """
+        getting = self._destination.get_output_async(
+            [b"flocker-volume",
+             b"--config", self._config_path.path,
+             b"compressions"])
+
+        def failed(reason):
+            reason.trap(IOError)
+            return []
+        getting.addCallbacks(lambda data: data.split(), failed)
+        return getting
 
     def acquire(self, volume):
         return self._destination.get_output(
@@ -178,6 +286,19 @@ class LocalVolumeManager(object):
         input_file.seek(0, 0)
         self._service.receive(volume.node_id, volume.name, input_file)
 
+    def receive_stream(self, volume, compression=None, resume=False):
+        receiving = self._service.receive_stream(
+            volume.node_id, volume.name, resume=resume)
+        if compression is not None:
+            receiving.addCallback(DecompressingReceiver, compression)
+        return receiving
+
+    def resume_token(self, volume):
+        return self._service.resume_token(volume.node_id, volume.name)
+
+    def compressions(self):
+        return succeed(list(COMPRESSION_ALGORITHMS))
+
     def acquire(self, volume):
         self._service.acquire(volume.node_id, volume.name)
         return self._service.node_id
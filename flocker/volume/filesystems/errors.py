@@ -10,3 +10,10 @@ class MaximumSizeTooSmall(Exception):
     A maximum size was specified for a filesystem which is smaller than the
     smallest allowed value.
     """
+
+
+class StaleResumeToken(Exception):
+    """
+    A resume token was given for a stream which can no longer be sent, e.g.
+    because the data it was based on changed.
+    """
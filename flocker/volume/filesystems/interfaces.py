@@ -6,6 +6,8 @@ from __future__ import absolute_import
 
 from zope.interface import Attribute, Interface
 
+from twisted.internet.interfaces import IConsumer
+
 
 class FilesystemAlreadyExists(Exception):
     """
@@ -41,6 +43,22 @@ class IFilesystemSnapshots(Interface):
         """
 
 
+class IFilesystemReceiver(IConsumer):
+    """
+    A consumer of the data produced by ``IFilesystem.send`` which stores it
+    in a filesystem.
+    """
+
+    def finish():
+        """
+        Indicate that all the data has been written.
+
+        :return: ``Deferred`` that fires once the data has been stored in
+            the filesystem, or errbacks if it could not be, e.g. because
+            it was incomplete or garbage.
+        """
+
+
 class IFilesystem(Interface):
     """
     A filesystem that is part of a pool.
@@ -106,6 +124,68 @@ class IFilesystem(Interface):
             filesystem.
         """
 
+    def send(consumer, remote_snapshots=None, resume_token=None):
+        """
+        Write the contents of the filesystem to a consumer without blocking.
+
+        Unlike ``reader`` this is suitable for use in the reactor thread.
+        A streaming ``IPushProducer`` is registered with the consumer while
+        the data is being written, so the consumer can pause it, and
+        unregistered before the returned ``Deferred`` fires.
+
+        :param IConsumer consumer: The consumer to write the data to.
+
+        :param remote_snapshots: See ``reader``.
+
+        :param resume_token: ``None``, or ``bytes`` returned by
+            ``resume_token`` on the receiving filesystem, in which case only
+            the rest of the stream the receiver was interrupted in is
+            written.
+
+        :return: ``Deferred`` that fires once all the data has been written,
+            or errbacks if it could not be read or the stream can't be
+            resumed.
+        """
+
+    def receive(resume=False):
+        """
+        Prepare to receive new contents for the filesystem without blocking.
+
+        Unlike ``writer`` this is suitable for use in the reactor thread.
+        The same ownership rules apply.
+
+        If the data turns out to be incomplete, what was received is kept so
+        that the transfer can be resumed, see ``resume_token``.
+
+        :param bool resume: If true the data continues the stream a previous
+            receive was interrupted in, otherwise any such incomplete data is
+            discarded.
+
+        :return: ``Deferred`` that fires with an ``IFilesystemReceiver``
+            to write the output of :meth:`IFilesystem.send` to.
+        """
+
+    def resume_token():
+        """
+        Describe the data kept by an interrupted receive.
+
+        :return: ``Deferred`` that fires with ``bytes`` to pass to ``send``
+            on the sending filesystem to resume the interrupted stream, or
+            ``None`` if there is nothing to resume.
+        """
+
+    def can_resume(resume_token):
+        """
+        Determine whether ``send`` can resume a stream.
+
+        :param bytes resume_token: Result of ``resume_token`` on the
+            receiving filesystem.
+
+        :return: ``Deferred`` that fires with ``True`` if the rest of the
+            stream can be sent, ``False`` if the whole stream has to be sent
+            again, e.g. because the data it was based on changed.
+        """
+
     def __eq__(other):
         """True if and only if underlying OS filesystem is the same."""
 
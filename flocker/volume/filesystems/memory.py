@@ -6,19 +6,23 @@ from __future__ import absolute_import
 
 from errno import ENOENT
 from contextlib import contextmanager
-from tarfile import TarFile
+from hashlib import sha1
+from tarfile import TarFile, TarError, BLOCKSIZE, NUL
 from io import BytesIO
 
 from zope.interface import implementer
 
 from characteristic import with_init, with_cmp, with_repr
 
-from twisted.internet.defer import succeed, fail
+from twisted.internet.defer import Deferred, succeed, fail
+from twisted.internet.error import ConnectionLost
+from twisted.internet.interfaces import IPushProducer
 from twisted.application.service import Service
 
 from .interfaces import (
-    IFilesystemSnapshots, IStoragePool, IFilesystem,
+    IFilesystemSnapshots, IStoragePool, IFilesystem, IFilesystemReceiver,
     FilesystemAlreadyExists)
+from .errors import StaleResumeToken
 from .zfs import Snapshot
 
 from .._model import VolumeSize
@@ -58,6 +62,9 @@ class DirectoryFilesystem(object):
     taken.  No other state related to snapshots is tracked (eg, the state of
     the directory at the time of those snapshots is not recorded).
 
+    The data of an interrupted receive is kept in another file in the
+    directory until the rest of it is received.
+
     :ivar FilePath path: The directory where data for this "filesystem" is
         stored.
     """
@@ -100,14 +107,19 @@ class DirectoryFilesystem(object):
                 snapshot.name for snapshot in self._snapshots()] + [name])
         )
 
-    @contextmanager
-    def reader(self, remote_snapshots=None):
+    def _tarball(self, remote_snapshots):
         """
         Package up filesystem contents as a tarball.
+
+        :param remote_snapshots: See ``IFilesystem.reader``.
+
+        :return: The tarball as ``bytes``.
         """
         result = BytesIO()
         tarball = TarFile(fileobj=result, mode="w")
         for child in self.path.children():
+            if child == self._partial():
+                continue
             tarball.add(child.path, arcname=child.basename(), recursive=True)
         tarball.close()
 
@@ -122,17 +134,16 @@ class DirectoryFilesystem(object):
                     u"\n".join(snapshot.name for snapshot in remote_snapshots)
                 ).encode("ascii")
             )
-        result.seek(0, 0)
-        yield result
+        return result.getvalue()
 
-    @contextmanager
-    def writer(self):
-        """Expect written bytes to be a tarball."""
-        result = BytesIO()
-        yield result
-        result.seek(0, 0)
+    def _extract(self, data):
+        """
+        Replace the filesystem contents with those of a tarball.
+
+        :param bytes data: The tarball.
+        """
         try:
-            tarball = TarFile(fileobj=result, mode="r")
+            tarball = TarFile(fileobj=BytesIO(data), mode="r")
             if self.path.exists():
                 self.path.remove()
             self.path.createDirectory()
@@ -142,6 +153,224 @@ class DirectoryFilesystem(object):
             # https://clusterhq.atlassian.net/browse/FLOC-122
             pass
 
+    @contextmanager
+    def reader(self, remote_snapshots=None):
+        """
+        Package up filesystem contents as a tarball.
+        """
+        yield BytesIO(self._tarball(remote_snapshots))
+
+    @contextmanager
+    def writer(self):
+        """Expect written bytes to be a tarball."""
+        result = BytesIO()
+        yield result
+        self._extract(result.getvalue())
+
+    def _partial(self):
+        """
+        :return: The ``FilePath`` where the data of an interrupted receive
+            is kept.
+        """
+        return self.path.child(b".partial")
+
+    def send(self, consumer, remote_snapshots=None, resume_token=None):
+        """
+        Write the filesystem contents as a tarball.
+        """
+        data = self._tarball(remote_snapshots)
+        if resume_token is not None:
+            offset = _resume_offset(data, resume_token)
+            if offset is None:
+                return fail(StaleResumeToken(resume_token))
+            data = data[offset:]
+        return _BytesProducer(data).start(consumer)
+
+    def receive(self, resume=False):
+        """
+        Expect written bytes to be a tarball.
+        """
+        partial = self._partial()
+        if not resume and partial.exists():
+            partial.remove()
+        return succeed(_TarballReceiver(self))
+
+    def resume_token(self):
+        """
+        Identify the data of an interrupted receive by its length and hash.
+        """
+        partial = self._partial()
+        if not partial.exists():
+            return succeed(None)
+        data = partial.getContent()
+        return succeed(b"%d-%s" % (len(data), sha1(data).hexdigest()))
+
+    def can_resume(self, resume_token):
+        """
+        The stream can be resumed if the data received so far is the start
+        of a tarball of the current contents.
+        """
+        return succeed(
+            _resume_offset(self._tarball(None), resume_token) is not None)
+
+
+def _resume_offset(data, resume_token):
+    """
+    Find where to resume sending a stream.
+
+    :param bytes data: The whole stream.
+    :param bytes resume_token: A token created by
+        ``DirectoryFilesystem.resume_token``.
+
+    :return: The ``int`` offset in ``data`` to continue from, or ``None``
+        if the data received so far isn't the start of ``data``.
+    """
+    try:
+        offset, digest = resume_token.split(b"-", 1)
+        offset = int(offset)
+    except ValueError:
+        return None
+    if offset > len(data) or sha1(data[:offset]).hexdigest() != digest:
+        return None
+    return offset
+
+
+def _complete_tarball(data):
+    """
+    Determine whether a tarball was received in its entirety.
+
+    :param bytes data: The tarball, possibly followed by other data.
+
+    :return: ``True`` if the tarball's end-of-archive marker is present
+        after its last member, ``False`` otherwise.
+    """
+    offset = 0
+    end_marker = NUL * (2 * BLOCKSIZE)
+    if not data.startswith(end_marker):
+        try:
+            tarball = TarFile(fileobj=BytesIO(data), mode="r")
+            tarball.getmembers()
+        except TarError:
+            return False
+        offset = tarball.offset
+    return data[offset:offset + len(end_marker)] == end_marker
+
+
+@implementer(IPushProducer)
+class _BytesProducer(object):
+    """
+    Write ``bytes`` to a consumer in chunks, as fast as it accepts them.
+    """
+    def __init__(self, data, chunk_size=64 * 1024):
+        """
+        :param bytes data: The data to write.
+        :param int chunk_size: The maximum number of bytes to write at once.
+        """
+        self._data = data
+        self._chunk_size = chunk_size
+        self._offset = 0
+        self._paused = False
+        self._producing = False
+        self._consumer = None
+        self._done = None
+
+    def start(self, consumer):
+        """
+        Register with a consumer and write the data to it.
+
+        :param IConsumer consumer: The consumer.
+
+        :return: ``Deferred`` that fires once all the data was written, or
+            errbacks with ``ConnectionLost`` if the consumer stopped the
+            producer.
+        """
+        self._consumer = consumer
+        self._done = Deferred()
+        consumer.registerProducer(self, True)
+        self._produce()
+        return self._done
+
+    def _produce(self):
+        """
+        Write chunks until paused or done.
+        """
+        if self._producing:
+            # Resumed by the consumer while writing to it.
+            return
+        self._producing = True
+        try:
+            while (not self._paused and not self._done.called and
+                   self._offset < len(self._data)):
+                chunk = self._data[
+                    self._offset:self._offset + self._chunk_size]
+                self._offset += len(chunk)
+                self._consumer.write(chunk)
+        finally:
+            self._producing = False
+        if self._offset >= len(self._data) and not self._done.called:
+            self._consumer.unregisterProducer()
+            self._done.callback(None)
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._produce()
+
+    def stopProducing(self):
+        if not self._done.called:
+            self._consumer.unregisterProducer()
+            self._done.errback(ConnectionLost("The consumer stopped us."))
+
+
+@implementer(IFilesystemReceiver)
+class _TarballReceiver(object):
+    """
+    Receive the tarball written by ``DirectoryFilesystem.send``.
+
+    The data is appended to the filesystem's partial receive file, and only
+    extracted once a complete tarball has been received.
+    """
+    def __init__(self, filesystem):
+        """
+        :param DirectoryFilesystem filesystem: The filesystem to extract the
+            tarball into.
+        """
+        self._filesystem = filesystem
+        self._producer = None
+        path = filesystem.get_path()
+        if not path.exists():
+            path.makedirs()
+
+    def write(self, data):
+        with self._filesystem._partial().open("a") as partial:
+            partial.write(data)
+
+    def registerProducer(self, producer, streaming):
+        self._producer = producer
+        if not streaming:
+            # Nothing ever stops us from writing, so keep pulling.
+            while self._producer is producer:
+                producer.resumeProducing()
+
+    def unregisterProducer(self):
+        self._producer = None
+
+    def finish(self):
+        partial = self._filesystem._partial()
+        data = partial.getContent() if partial.exists() else b""
+        if not _complete_tarball(data):
+            return fail(ConnectionLost(
+                "Incomplete tarball, kept for resuming."))
+        self._filesystem._extract(data)
+        # Usually the directory was replaced by the extracted tarball, but
+        # not e.g. if the tarball was empty.
+        partial.changed()
+        if partial.exists():
+            partial.remove()
+        return succeed(None)
+
 
 @implementer(IStoragePool)
 class FilesystemStoragePool(Service):
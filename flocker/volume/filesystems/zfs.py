@@ -22,14 +22,17 @@ from eliot import Field, MessageType, Logger
 from twisted.python.failure import Failure
 from twisted.python.filepath import FilePath
 from twisted.internet.endpoints import ProcessEndpoint, connectProtocol
-from twisted.internet.protocol import Protocol
-from twisted.internet.defer import Deferred, succeed, gatherResults
-from twisted.internet.error import ConnectionDone, ProcessTerminated
+from twisted.internet.protocol import Protocol, ProcessProtocol
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.error import (
+    ConnectionDone, ProcessDone, ProcessTerminated, ProcessExitedAlready,
+)
+from twisted.internet.interfaces import IPushProducer
 from twisted.application.service import Service
 
 from .errors import MaximumSizeTooSmall
 from .interfaces import (
-    IFilesystemSnapshots, IStoragePool, IFilesystem,
+    IFilesystemSnapshots, IStoragePool, IFilesystem, IFilesystemReceiver,
     FilesystemAlreadyExists)
 
 from .._model import VolumeSize
@@ -51,6 +54,23 @@ class BadArguments(Exception):
     """The ``zfs`` command was called with incorrect arguments."""
 
 
+def _exit_failure(reason):
+    """
+    Convert the reason a ``zfs`` process ended with an error into the
+    failure to report.
+
+    :param Failure reason: The reason the process ended.
+
+    :return: A ``Failure`` of ``CommandFailed`` or ``BadArguments`` for
+        exit code 1 or 2 respectively, otherwise ``reason``.
+    """
+    if reason.check(ProcessTerminated) and reason.value.exitCode == 1:
+        return Failure(CommandFailed())
+    elif reason.check(ProcessTerminated) and reason.value.exitCode == 2:
+        return Failure(BadArguments())
+    return reason
+
+
 class _AccumulatingProtocol(Protocol):
     """
     Accumulate all received bytes.
@@ -66,12 +86,8 @@ class _AccumulatingProtocol(Protocol):
     def connectionLost(self, reason):
         if reason.check(ConnectionDone):
             self._result.callback(self._data)
-        elif reason.check(ProcessTerminated) and reason.value.exitCode == 1:
-            self._result.errback(CommandFailed())
-        elif reason.check(ProcessTerminated) and reason.value.exitCode == 2:
-            self._result.errback(BadArguments())
         else:
-            self._result.errback(reason)
+            self._result.errback(_exit_failure(reason))
         del self._result
 
 
@@ -95,6 +111,108 @@ def zfs_command(reactor, arguments):
     return d
 
 
+@implementer(IPushProducer)
+class _ZFSSendProtocol(ProcessProtocol):
+    """
+    Write the output of ``zfs send`` to a consumer, with the process
+    registered as its streaming producer so it stops reading the output
+    while the consumer is paused.
+
+    :ivar Deferred done: Fires when the process has ended successfully, or
+        errbacks as ``zfs_command`` does if it failed.
+    """
+    def __init__(self, consumer):
+        """
+        :param IConsumer consumer: The consumer to write the output to.
+        """
+        self._consumer = consumer
+        self.done = Deferred()
+
+    def connectionMade(self):
+        self.transport.closeStdin()
+        self._consumer.registerProducer(self, True)
+
+    def childDataReceived(self, fd, data):
+        if fd == 1:
+            self._consumer.write(data)
+
+    def pauseProducing(self):
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.transport.resumeProducing()
+
+    def stopProducing(self):
+        try:
+            self.transport.signalProcess("TERM")
+        except ProcessExitedAlready:
+            pass
+
+    def processEnded(self, reason):
+        self._consumer.unregisterProducer()
+        if reason.check(ProcessDone):
+            self.done.callback(None)
+        else:
+            self.done.errback(_exit_failure(reason))
+
+
+@implementer(IFilesystemReceiver)
+class _ZFSReceiveProtocol(ProcessProtocol):
+    """
+    Feed the data written to it to ``zfs receive``, mounting the
+    filesystem once it has been received.
+
+    Producers registered with it are paused while the process's input
+    buffer is full.
+    """
+    def __init__(self, reactor, filesystem):
+        """
+        :param reactor: A ``IReactorProcess`` provider.
+        :param Filesystem filesystem: The filesystem being received.
+        """
+        self._reactor = reactor
+        self._filesystem = filesystem
+        self._ended = Deferred()
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def registerProducer(self, producer, streaming):
+        self.transport.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self.transport.unregisterProducer()
+
+    def processEnded(self, reason):
+        if reason.check(ProcessDone):
+            self._ended.callback(None)
+        else:
+            self._ended.errback(_exit_failure(reason))
+
+    def finish(self):
+        self.transport.closeStdin()
+        filesystem = self._filesystem
+        self._ended.addCallback(lambda _: zfs_command(
+            self._reactor,
+            [b"set", b"mountpoint=" + filesystem.get_path().path,
+             filesystem.name]))
+        self._ended.addCallback(lambda _: None)
+        return self._ended
+
+
+def _spawn_zfs(reactor, protocol, arguments):
+    """
+    Start the ``zfs`` command-line tool with the given arguments, connected
+    to a process protocol.
+
+    :param reactor: A ``IReactorProcess`` provider.
+    :param ProcessProtocol protocol: The protocol to connect to the process.
+    :param arguments: A ``list`` of ``bytes``, command-line arguments to
+        ``zfs``.
+    """
+    reactor.spawnProcess(protocol, b"zfs", [b"zfs"] + arguments, os.environ)
+
+
 _ZFS_COMMAND = Field.forTypes(
     "zfs_command", [bytes], u"The command which was run.")
 _OUTPUT = Field.forTypes(
@@ -179,7 +297,7 @@ class Filesystem(object):
     implementation over time.
     """
     def __init__(self, pool, dataset, mountpoint=None, size=None,
-                 reactor=None):
+                 reactor=None, cache=None):
         """
         :param pool: The filesystem's pool name, e.g. ``b"hpool"``.
 
@@ -190,6 +308,9 @@ class Filesystem(object):
             filesystem is mounted.
 
         :param VolumeSize size: The capacity information for this filesystem.
+
+        :param _PoolCache cache: The cache of the state of the pool shared
+            with the ``StoragePool`` this filesystem belongs to, if any.
         """
         self.pool = pool
         self.dataset = dataset
@@ -198,6 +319,9 @@ class Filesystem(object):
         if reactor is None:
             from twisted.internet import reactor
         self._reactor = reactor
+        if cache is None:
+            cache = _PoolCache()
+        self._cache = cache
 
     def _exists(self):
         """
@@ -212,15 +336,36 @@ class Filesystem(object):
             return False
         return True
 
+    def _cached(self):
+        """
+        :return: The cached ``_PoolState`` if it includes this filesystem,
+            otherwise ``None``. A filesystem missing from the state may have
+            been created since by another process, e.g. by
+            ``flocker-volume receive``, so it has to be looked up again.
+        """
+        state = self._cache.state
+        if state is not None and any(info.dataset == self.dataset
+                                     for info in state.filesystems):
+            return state
+        return None
+
     def snapshots(self):
-        if self._exists():
-            zfs_snapshots = ZFSSnapshots(self._reactor, self)
-            d = zfs_snapshots.list()
-            d.addCallback(lambda snapshots:
-                          [Snapshot(name=name)
-                           for name in snapshots])
-            return d
-        return succeed([])
+        state = self._cached()
+        if state is not None:
+            return succeed([Snapshot(name=name)
+                            for name in state.snapshots.get(self.name, [])])
+        zfs_snapshots = ZFSSnapshots(self._reactor, self)
+        d = zfs_snapshots.list()
+        d.addCallback(lambda snapshots:
+                      [Snapshot(name=name)
+                       for name in snapshots])
+
+        def no_filesystem(reason):
+            # ``zfs list`` fails if the filesystem doesn't exist:
+            reason.trap(CommandFailed)
+            return []
+        d.addErrback(no_filesystem)
+        return d
 
     @property
     def name(self):
@@ -232,6 +377,35 @@ class Filesystem(object):
     def get_path(self):
         return self._mountpoint
 
+    def _send_identifier(self, snapshot, local_snapshots, remote_snapshots):
+        """
+        Choose what ``zfs send`` should send: an incremental stream based on
+        the latest snapshot the writer has, if any, otherwise a complete
+        stream.
+
+        :param bytes snapshot: The full name of the snapshot to send.
+        :param list local_snapshots: ``Snapshot`` instances of this
+            filesystem, ordered from oldest to newest.
+        :param list remote_snapshots: ``Snapshot`` instances available on
+            the writer, ordered from oldest to newest, or ``None``.
+
+        :return: ``list`` of ``bytes`` arguments for ``zfs send``.
+        """
+        if remote_snapshots is None:
+            remote_snapshots = []
+
+        latest_common_snapshot = _latest_common_snapshot(
+            remote_snapshots, local_snapshots)
+
+        if latest_common_snapshot is None:
+            return [snapshot]
+        return [
+            b"-i",
+            u"{}@{}".format(
+                self.name, latest_common_snapshot.name).encode("ascii"),
+            snapshot,
+        ]
+
     @contextmanager
     def reader(self, remote_snapshots=None):
         """
@@ -249,6 +423,7 @@ class Filesystem(object):
         # I'm just using UUIDs, and hopefully requirements will become
         # clearer as we iterate.
         snapshot = b"%s@%s" % (self.name, uuid4())
+        self._cache.invalidate()
         check_call([b"zfs", b"snapshot", snapshot])
 
         # Determine whether there is a shared snapshot which can be used as the
@@ -260,21 +435,8 @@ class Filesystem(object):
                 self
             ))
 
-        if remote_snapshots is None:
-            remote_snapshots = []
-
-        latest_common_snapshot = _latest_common_snapshot(
-            remote_snapshots, local_snapshots)
-
-        if latest_common_snapshot is None:
-            identifier = [snapshot]
-        else:
-            identifier = [
-                b"-i",
-                u"{}@{}".format(
-                    self.name, latest_common_snapshot.name).encode("ascii"),
-                snapshot,
-            ]
+        identifier = self._send_identifier(
+            snapshot, local_snapshots, remote_snapshots)
 
         process = Popen([b"zfs", b"send"] + identifier, stdout=PIPE)
         try:
@@ -313,6 +475,7 @@ class Filesystem(object):
             # If the filesystem doesn't already exist then this is a complete
             # data stream.
             cmd = [b"zfs", b"receive", self.name]
+        self._cache.invalidate()
         process = Popen(cmd, stdin=PIPE)
         succeeded = False
         try:
@@ -325,6 +488,133 @@ class Filesystem(object):
                         b"mountpoint=" + self._mountpoint.path,
                         self.name])
 
+    def send(self, consumer, remote_snapshots=None, resume_token=None):
+        if resume_token is not None:
+            # The token identifies the snapshot and how far the receiver
+            # got, so there's nothing else to decide.
+            protocol = _ZFSSendProtocol(consumer)
+            _spawn_zfs(self._reactor, protocol,
+                       [b"send", b"-t", resume_token])
+            return protocol.done
+
+        snapshot_name = bytes(uuid4())
+        zfs_snapshots = ZFSSnapshots(self._reactor, self)
+        d = zfs_snapshots.create(snapshot_name)
+        d.addCallback(lambda _: zfs_snapshots.list())
+
+        def got_snapshots(names):
+            identifier = self._send_identifier(
+                b"%s@%s" % (self.name, snapshot_name),
+                [Snapshot(name=name) for name in names], remote_snapshots)
+            protocol = _ZFSSendProtocol(consumer)
+            _spawn_zfs(self._reactor, protocol, [b"send"] + identifier)
+            return protocol.done
+        d.addCallback(got_snapshots)
+        return d
+
+    def _exists_async(self):
+        """
+        Determine whether this filesystem exists locally without blocking.
+
+        :return: ``Deferred`` that fires with ``True`` if there is a
+            filesystem with this name, ``False`` otherwise.
+        """
+        if self._cached() is not None:
+            return succeed(True)
+        d = zfs_command(self._reactor, [b"list", self.name])
+        d.addCallback(lambda _: True)
+
+        def no_filesystem(reason):
+            reason.trap(CommandFailed)
+            return False
+        d.addErrback(no_filesystem)
+        return d
+
+    def receive(self, resume=False):
+        d = self._exists_async()
+
+        def got_exists(exists):
+            d = self._resume_state(exists)
+            d.addCallback(got_state, exists)
+            return d
+
+        def got_state(state, exists):
+            resumable, token = state
+            if token is not None and not resume:
+                # A new stream can't be received while the state of an
+                # interrupted one is kept.
+                self._cache.invalidate()
+                d = zfs_command(
+                    self._reactor, [b"receive", b"-A", self.name])
+                d.addCallback(lambda _: start_receive(exists, resumable))
+                return d
+            return start_receive(exists, resumable)
+
+        def start_receive(exists, resumable):
+            arguments = [b"receive"]
+            # -s keeps the state of an interrupted receive, so that it can
+            # be resumed.  Versions of ZFS that can't resume reject it.
+            if resumable:
+                arguments.append(b"-s")
+            # See ``writer`` for why existence decides whether to force.
+            if exists:
+                arguments.append(b"-F")
+            arguments.append(self.name)
+            self._cache.invalidate()
+            protocol = _ZFSReceiveProtocol(self._reactor, self)
+            _spawn_zfs(self._reactor, protocol, arguments)
+            return protocol
+        d.addCallback(got_exists)
+        return d
+
+    def _resume_state(self, exists):
+        """
+        Find out whether ZFS can resume receives, and if so the token of an
+        interrupted receive into this filesystem.
+
+        :param bool exists: Whether this filesystem exists.  If it doesn't,
+            the pool's top-level filesystem is checked for resume support.
+
+        :return: ``Deferred`` that fires with a tuple of whether receives
+            can be resumed and the resume token, or ``None`` if there is no
+            interrupted receive.
+        """
+        d = zfs_command(
+            self._reactor,
+            [b"get", b"-H", b"-o", b"value", b"receive_resume_token",
+             self.name if exists else self.pool])
+
+        def got_token(output):
+            token = output.strip()
+            # ``zfs get`` shows unset properties as "-".
+            if token in (b"", b"-") or not exists:
+                return True, None
+            return True, token
+
+        def not_resumable(reason):
+            # The filesystem doesn't exist, or this version of ZFS doesn't
+            # have the property because it can't resume receives.
+            reason.trap(CommandFailed, BadArguments)
+            return False, None
+        d.addCallbacks(got_token, not_resumable)
+        return d
+
+    def resume_token(self):
+        d = self._resume_state(True)
+        d.addCallback(lambda state: state[1])
+        return d
+
+    def can_resume(self, resume_token):
+        # A dry run checks the snapshot the token refers to still exists.
+        d = zfs_command(self._reactor, [b"send", b"-n", b"-t", resume_token])
+        d.addCallback(lambda _: True)
+
+        def cannot_resume(reason):
+            reason.trap(CommandFailed, BadArguments)
+            return False
+        d.addErrback(cannot_resume)
+        return d
+
 
 @implementer(IFilesystemSnapshots)
 class ZFSSnapshots(object):
@@ -336,6 +626,7 @@ class ZFSSnapshots(object):
 
     def create(self, name):
         encoded_name = b"%s@%s" % (self._filesystem.name, name)
+        self._filesystem._cache.invalidate()
         d = zfs_command(self._reactor, [b"snapshot", encoded_name])
         d.addCallback(lambda _: None)
         return d
@@ -456,6 +747,10 @@ class StoragePool(Service):
         self._reactor = reactor
         self._name = name
         self._mount_root = mount_root
+        # The state of the pool found by the last ``enumerate``, which
+        # answers the snapshot queries of its filesystems until something
+        # is changed through this pool or its filesystems:
+        self._cache = _PoolCache()
 
     def startService(self):
         """
@@ -508,6 +803,7 @@ class StoragePool(Service):
                 b"-o", u"refquota={0}".format(
                     volume.size.maximum_size).encode("ascii")
             ])
+        self._cache.invalidate()
         d = zfs_command(self._reactor,
                         [b"create"] + properties + [filesystem.name])
         d.addErrback(self._check_for_out_of_space)
@@ -516,15 +812,24 @@ class StoragePool(Service):
 
     def destroy(self, volume):
         filesystem = self.get(volume)
+        # Snapshots may have been received by another process since the
+        # pool was listed, and all of them have to be destroyed:
+        self._cache.invalidate()
         d = filesystem.snapshots()
 
         # It would be better to have snapshot destruction logic as part of
         # IFilesystemSnapshots, but that isn't really necessary yet.
         def got_snapshots(snapshots):
-            return gatherResults(list(zfs_command(
+            self._cache.invalidate()
+            if not snapshots:
+                return
+            # Destroy all of them with one command using ZFS's
+            # ``fs@snap1,snap2`` syntax:
+            return zfs_command(
                 self._reactor,
-                [b"destroy", b"%s@%s" % (filesystem.name, snapshot.name)])
-                for snapshot in snapshots))
+                [b"destroy", b"%s@%s" % (
+                    filesystem.name,
+                    b",".join(snapshot.name for snapshot in snapshots))])
         d.addCallback(got_snapshots)
         d.addCallback(lambda _: zfs_command(
             self._reactor, [b"destroy", filesystem.name]))
@@ -540,6 +845,7 @@ class StoragePool(Service):
             ])
         else:
             properties.extend([u"refquota=none"])
+        self._cache.invalidate()
         d = zfs_command(self._reactor,
                         [b"set"] + properties + [filesystem.name])
         d.addErrback(self._check_for_out_of_space)
@@ -551,6 +857,7 @@ class StoragePool(Service):
         new_filesystem = self.get(volume)
         zfs_snapshots = ZFSSnapshots(self._reactor, parent_filesystem)
         snapshot_name = bytes(uuid4())
+        self._cache.invalidate()
         d = zfs_snapshots.create(snapshot_name)
         clone_command = [b"clone",
                          # Snapshot we're cloning from:
@@ -566,6 +873,7 @@ class StoragePool(Service):
     def change_owner(self, volume, new_volume):
         old_filesystem = self.get(volume)
         new_filesystem = self.get(new_volume)
+        self._cache.invalidate()
         d = zfs_command(self._reactor,
                         [b"rename", old_filesystem.name, new_filesystem.name])
         self._created(d, new_volume)
@@ -622,17 +930,21 @@ class StoragePool(Service):
         dataset = volume_to_dataset(volume)
         mount_path = self._mount_root.child(dataset)
         return Filesystem(
-            self._name, dataset, mount_path, volume.size)
+            self._name, dataset, mount_path, volume.size,
+            reactor=self._reactor, cache=self._cache)
 
     def enumerate(self):
-        listing = _list_filesystems(self._reactor, self._name)
+        generation = self._cache.generation
+        listing = _list_pool(self._reactor, self._name)
 
-        def listed(filesystems):
+        def listed(state):
+            self._cache.update(generation, state)
             result = set()
-            for entry in filesystems:
+            for entry in state.filesystems:
                 filesystem = Filesystem(
                     self._name, entry.dataset, FilePath(entry.mountpoint),
-                    VolumeSize(maximum_size=entry.refquota))
+                    VolumeSize(maximum_size=entry.refquota),
+                    reactor=self._reactor, cache=self._cache)
                 result.add(filesystem)
             return result
 
@@ -651,40 +963,107 @@ class _DatasetInfo(object):
     """
 
 
-def _list_filesystems(reactor, pool):
-    """Get a listing of all filesystems on a given pool.
+@attributes(["filesystems", "snapshots"], apply_immutable=True)
+class _PoolState(object):
+    """
+    The filesystems and snapshots of a pool, as found by ``_list_pool``.
+
+    :ivar frozenset filesystems: ``_DatasetInfo`` for each filesystem that
+        is a direct child of the pool.
+    :ivar dict snapshots: Maps the full names of filesystems (e.g.
+        ``b"hpool/myfs"``) to ``list`` of the names of their snapshots,
+        ordered from oldest to newest. Filesystems without snapshots may
+        be missing.
+    """
+
+
+class _PoolCache(object):
+    """
+    The most recently found state of a pool.
+
+    Only changes made through this process invalidate the cache, but
+    filesystems and snapshots are also created by other processes, in
+    particular ``flocker-volume receive`` when a volume is pushed here. So
+    the state may be missing filesystems and snapshots that exist, and users
+    of the cache must not rely on it being complete: ``Filesystem`` only
+    answers from it for filesystems it includes, and otherwise runs ``zfs``.
+
+    :ivar _PoolState state: The state, or ``None`` if it is unknown.
+    :ivar int generation: Incremented each time the state is invalidated.
+    """
+    def __init__(self):
+        self.state = None
+        self.generation = 0
+
+    def invalidate(self):
+        """
+        Forget the state, e.g. because the pool is about to be changed.
+        """
+        self.state = None
+        self.generation += 1
+
+    def update(self, generation, state):
+        """
+        Remember a newly found state, unless the cache was invalidated
+        since the query that found it was started.
+
+        :param int generation: The value of ``generation`` when the query
+            was started.
+        :param _PoolState state: The state found.
+        """
+        if generation == self.generation:
+            self.state = state
+
+
+def _list_pool(reactor, pool):
+    """
+    Get a listing of all filesystems and snapshots on a given pool with a
+    single ``zfs`` command.
+
+    :param reactor: A ``IReactorProcess`` provider.
+    :param bytes pool: The name of the pool.
 
-    :param pool: A `flocker.volume.filesystems.interface.IStoragePool`
-        provider.
-    :return: A ``Deferred`` that fires with an iterator, the elements
-        of which are ``tuples`` containing the name and mountpoint of each
-        filesystem.
+    :return: A ``Deferred`` that fires with a ``_PoolState``.
     """
     listing = zfs_command(
         reactor,
         [b"list",
-         # Descend the hierarchy to a depth of one (ie, list the direct
-         # children of the pool)
-         b"-d", b"1",
+         # Descend the whole hierarchy, since snapshots are children of
+         # the pool's children:
+         b"-r",
+         b"-t", b"filesystem,snapshot",
          # Omit the output header
          b"-H",
          # Output exact, machine-parseable values (eg 65536 instead of 64K)
          b"-p",
-         # Output each dataset's name, mountpoint and refquota
-         b"-o", b"name,mountpoint,refquota",
+         # Output each dataset's name, mountpoint, refquota and creation
+         # time
+         b"-o", b"name,mountpoint,refquota,creation",
+         # Sort by creation time so snapshots are listed oldest first
+         b"-s", b"creation",
          # Look at this pool
          pool])
 
     def listed(output, pool):
+        filesystems = set()
+        snapshots = {}
         for line in output.splitlines():
-            name, mountpoint, refquota = line.split(b'\t')
-            name = name[len(pool) + 1:]
-            if name:
+            name, mountpoint, refquota, creation = line.split(b'\t')
+            if b"@" in name:
+                filesystem, snapshot = name.split(b"@", 1)
+                snapshots.setdefault(filesystem, []).append(snapshot)
+                continue
+            dataset = name[len(pool) + 1:]
+            # Only the direct children of the pool are Flocker volumes:
+            if dataset and b"/" not in dataset:
                 refquota = int(refquota.decode("ascii"))
                 if refquota == 0:
                     refquota = None
-                yield _DatasetInfo(
-                    dataset=name, mountpoint=mountpoint, refquota=refquota)
+                filesystems.add(_DatasetInfo(
+                    dataset=dataset, mountpoint=mountpoint,
+                    refquota=refquota))
+        return _PoolState(filesystems=frozenset(filesystems),
+                          snapshots=snapshots)
 
     listing.addCallback(listed, pool)
     return listing
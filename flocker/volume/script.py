@@ -4,15 +4,21 @@
 
 import sys
 
-from twisted.python.usage import Options
+from twisted.python.usage import Options, UsageError
 from twisted.python.filepath import FilePath
 from twisted.internet.defer import succeed, maybeDeferred
+from twisted.protocols.basic import FileSender
 
 from zope.interface import implementer
 
 from .service import (
     DEFAULT_CONFIG_PATH, FLOCKER_MOUNTPOINT, FLOCKER_POOL,
     Volume, VolumeScript, ICommandLineVolumeScript, VolumeName,
+    finish_receiving,
+    )
+from ._compression import (
+    COMPRESSION_ALGORITHMS, DEFAULT_COMPRESSION_LEVEL, Compression,
+    DecompressingReceiver,
     )
 from ..common.script import (
     flocker_standard_options, FlockerScriptRunner
@@ -47,12 +53,26 @@ def flocker_volume_options(cls):
          "The ZFS pool to use for volumes."],
         ["mountpoint", None, FLOCKER_MOUNTPOINT.path,
          "The path where ZFS filesystems will be mounted."],
+        ["compression", None, None,
+         "Compress volume data pushed to other nodes with this algorithm "
+         "if they support it, one of: " +
+         ", ".join(COMPRESSION_ALGORITHMS) + ". "
+         "By default data is pushed uncompressed."],
+        ["compression-level", None, DEFAULT_COMPRESSION_LEVEL,
+         "The compression level, from 1 (fastest) to 9 (smallest).", int],
     ]
 
     original_postOptions = cls.postOptions
 
     def postOptions(self):
         self["config"] = FilePath(self["config"])
+        if self["compression"] is not None:
+            try:
+                self["compression"] = Compression(
+                    algorithm=self["compression"],
+                    level=self["compression-level"])
+            except ValueError as e:
+                raise UsageError("{}: {}".format(*e.args))
         original_postOptions(self)
 
     cls.postOptions = postOptions
@@ -110,17 +130,105 @@ class _ReceiveSubcommandOptions(Options):
 
     synopsis = "<owner-node-id> <name>"
 
+    optParameters = [
+        ["compression", None, None,
+         "The algorithm the data is compressed with, one of: " +
+         ", ".join(COMPRESSION_ALGORITHMS) + "."],
+    ]
+
+    optFlags = [
+        ["resume", None,
+         "The data continues a previously interrupted push, "
+         "see flocker-volume resume_token."],
+    ]
+
     def parseArgs(self, node_id, name):
         self["node_id"] = node_id.decode("ascii")
         self["name"] = name
 
+    def postOptions(self):
+        if (self["compression"] is not None and
+                self["compression"] not in COMPRESSION_ALGORITHMS):
+            raise UsageError(
+                "Unknown compression algorithm: {}".format(
+                    self["compression"]))
+
     def run(self, service):
         """Run the action for this sub-command.
 
         :param VolumeService service: The volume manager service to utilize.
         """
-        service.receive(self["node_id"], VolumeName.from_bytes(self["name"]),
-                        sys.stdin)
+        receiving = service.receive_stream(
+            self["node_id"], VolumeName.from_bytes(self["name"]),
+            resume=self["resume"])
+
+        def got_receiver(receiver):
+            if self["compression"] is not None:
+                receiver = DecompressingReceiver(
+                    receiver, self["compression"])
+            sending = FileSender().beginFileTransfer(sys.stdin, receiver)
+            return finish_receiving(sending, receiver)
+        receiving.addCallback(got_receiver)
+        return receiving
+
+
+class _ResumeTokenSubcommandOptions(Options):
+    """
+    Command line options for ``flocker-volume resume_token``.
+    """
+
+    longdesc = """\
+    Print the token identifying the data kept by an interrupted push of a
+    volume, if there is any.
+
+    Parameters:
+
+    * owner-node-id: The node ID of the volume manager that owns the volume.
+
+    * name: The name of the volume.
+    """
+
+    synopsis = "<owner-node-id> <name>"
+
+    def parseArgs(self, node_id, name):
+        self["node_id"] = node_id.decode("ascii")
+        self["name"] = name
+
+    def run(self, service):
+        """
+        Run the action for this sub-command.
+
+        :param VolumeService service: The volume manager service to utilize.
+        """
+        d = service.resume_token(self["node_id"],
+                                 VolumeName.from_bytes(self["name"]))
+
+        def got_token(token):
+            if token is not None:
+                sys.stdout.write(token + b"\n")
+                sys.stdout.flush()
+        d.addCallback(got_token)
+        return d
+
+
+class _CompressionsSubcommandOptions(Options):
+    """
+    Command line options for ``flocker-volume compressions``.
+    """
+
+    longdesc = """\
+    List the compression algorithms pushed volumes can be received with.
+    """
+
+    def run(self, service):
+        """
+        Run the action for this sub-command.
+
+        :param VolumeService service: The volume manager service to utilize.
+        """
+        for algorithm in COMPRESSION_ALGORITHMS:
+            sys.stdout.write(algorithm + b"\n")
+        sys.stdout.flush()
 
 
 class _AcquireSubcommandOptions(Options):
@@ -221,6 +329,10 @@ class VolumeOptions(Options):
          "Acquire a remotely owned volume."],
         ["clone_to", None, _CloneToSubcommandOptions,
          "Clone an existing volume."],
+        ["resume_token", None, _ResumeTokenSubcommandOptions,
+         "Identify the data kept by an interrupted push of a volume."],
+        ["compressions", None, _CompressionsSubcommandOptions,
+         "List the supported compression algorithms."],
     ]
 
 
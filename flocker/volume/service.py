@@ -18,15 +18,18 @@ from characteristic import attributes
 
 from twisted.internet.defer import maybeDeferred
 from twisted.internet.task import deferLater
+from twisted.python.failure import Failure
 from twisted.python.filepath import FilePath
 from twisted.application.service import Service
-from twisted.internet.defer import fail
+from twisted.internet.defer import fail, succeed
+from twisted.internet.interfaces import IConsumer
 
 # We might want to make these utilities shared, rather than in zfs
 # module... but in this case the usage is temporary and should go away as
 # part of https://clusterhq.atlassian.net/browse/FLOC-64
 from .filesystems.zfs import StoragePool
 from ._model import VolumeSize
+from ._compression import CompressingReceiver
 from ..common.script import ICommandLineScript
 
 DEFAULT_CONFIG_PATH = FilePath(b"/etc/flocker/volume.json")
@@ -97,17 +100,23 @@ class VolumeService(Service):
         volume manager. Only available once the service has started.
     """
 
-    def __init__(self, config_path, pool, reactor):
+    def __init__(self, config_path, pool, reactor, compression=None):
         """
         :param FilePath config_path: Path to the volume manager config file.
         :param pool: An object that is both a
             ``flocker.volume.filesystems.interface.IStoragePool`` provider
             and a ``twisted.application.service.IService`` provider.
         :param reactor: A ``twisted.internet.interface.IReactorTime`` provider.
+        :param compression: ``None``, or the ``Compression`` to use when
+            pushing to volume managers which support it.
         """
         self._config_path = config_path
         self.pool = pool
         self._reactor = reactor
+        self._compression = compression
+        # (destination, volume name) pairs whose last push failed, which are
+        # the only ones the destination may have an interrupted receive for:
+        self._interrupted_pushes = set()
 
     def startService(self):
         Service.startService(self)
@@ -280,11 +289,19 @@ class VolumeService(Service):
         enumerating.addCallback(enumerated)
         return enumerating
 
-    def push(self, volume, destination):
+    def push(self, volume, destination, progress=None):
         """
         Push the latest data in the volume to a remote destination.
 
-        This is a blocking API for now.
+        The data is streamed from the local filesystem to the destination
+        without blocking, pausing the local filesystem whenever the
+        destination falls behind, so several pushes can run concurrently
+        and memory use does not depend on the size of the volume.
+
+        If the previous push of the volume to the destination by this
+        service was interrupted, only the rest of it is sent if possible.
+        The data is compressed if this service was configured to and the
+        destination supports the algorithm.
 
         Only locally owned volumes (i.e. volumes whose ``uuid`` matches
         this service's) can be pushed.
@@ -294,23 +311,165 @@ class VolumeService(Service):
         :param IRemoteVolumeManager destination: The remote volume manager
             to push to.
 
+        :param progress: ``None``, or a callable which is called with the
+            total number of bytes pushed so far each time more data is
+            pushed.
+
         :raises ValueError: If the uuid of the volume is different than
             our own; only locally-owned volumes can be pushed.
+
+        :return: ``Deferred`` that fires once the destination has stored
+            all the data.
         """
         if volume.node_id != self.node_id:
             raise ValueError()
         fs = volume.get_filesystem()
+        key = (destination, volume.name)
+        retrying = key in self._interrupted_pushes
         getting_snapshots = destination.snapshots(volume)
 
         def got_snapshots(snapshots):
-            with destination.receive(volume) as receiver:
-                with fs.reader(snapshots) as contents:
-                    for chunk in iter(lambda: contents.read(1024 * 1024), b""):
-                        receiver.write(chunk)
+            # Only a retry can have anything to resume, so don't ask the
+            # destination otherwise:
+            if retrying:
+                getting_token = self._resumable_token(
+                    fs, destination, volume)
+            else:
+                getting_token = succeed(None)
+
+            def got_token(resume_token):
+                negotiating = self._negotiate_compression(destination)
+                negotiating.addCallback(
+                    lambda compression: self._stream(
+                        fs, destination, volume, snapshots, resume_token,
+                        compression, progress))
+                return negotiating
+            getting_token.addCallback(got_token)
+            return getting_token
 
         pushing = getting_snapshots.addCallback(got_snapshots)
+
+        def pushed(result):
+            if isinstance(result, Failure):
+                self._interrupted_pushes.add(key)
+            else:
+                self._interrupted_pushes.discard(key)
+            return result
+        pushing.addBoth(pushed)
         return pushing
 
+    def _resumable_token(self, fs, destination, volume):
+        """
+        Find out whether an interrupted push of a volume can be resumed.
+
+        :param IFilesystem fs: The volume's local filesystem.
+        :param IRemoteVolumeManager destination: The remote volume manager
+            being pushed to.
+        :param Volume volume: The volume being pushed.
+
+        :return: ``Deferred`` that fires with the destination's resume token
+            if the local filesystem can resume from it, otherwise ``None``.
+        """
+        getting_token = destination.resume_token(volume)
+
+        def got_token(resume_token):
+            if resume_token is None:
+                return None
+            checking = fs.can_resume(resume_token)
+            checking.addCallback(
+                lambda resumable: resume_token if resumable else None)
+            return checking
+        getting_token.addCallback(got_token)
+        return getting_token
+
+    def _negotiate_compression(self, destination):
+        """
+        Decide how to compress data pushed to a remote volume manager.
+
+        :param IRemoteVolumeManager destination: The remote volume manager
+            being pushed to.
+
+        :return: ``Deferred`` that fires with the configured ``Compression``
+            if the destination supports its algorithm, otherwise ``None``.
+        """
+        if self._compression is None:
+            return succeed(None)
+        getting_algorithms = destination.compressions()
+
+        def got_algorithms(algorithms):
+            if self._compression.algorithm in algorithms:
+                return self._compression
+            return None
+        getting_algorithms.addCallback(got_algorithms)
+        return getting_algorithms
+
+    def _stream(self, fs, destination, volume, snapshots, resume_token,
+                compression, progress):
+        """
+        Send a volume's data to a remote volume manager.
+
+        :param IFilesystem fs: The volume's local filesystem.
+        :param IRemoteVolumeManager destination: The remote volume manager
+            to push to.
+        :param Volume volume: The volume being pushed.
+        :param snapshots: The destination's snapshots of the volume.
+        :param resume_token: ``None``, or the token of the interrupted
+            stream to resume.
+        :param compression: ``None``, or the ``Compression`` to use.
+        :param progress: See ``push``.
+
+        :return: ``Deferred`` that fires once the destination has stored
+            all the data.
+        """
+        receiving = destination.receive_stream(
+            volume,
+            compression=None if compression is None else compression.algorithm,
+            resume=resume_token is not None)
+
+        def got_receiver(receiver):
+            if compression is not None:
+                receiver = CompressingReceiver(receiver, compression)
+            sending = fs.send(
+                _ProgressConsumer(receiver, progress), snapshots,
+                resume_token=resume_token)
+            return finish_receiving(sending, receiver)
+        receiving.addCallback(got_receiver)
+        return receiving
+
+    def receive_stream(self, volume_node_id, volume_name, resume=False):
+        """
+        Start receiving a volume's data without blocking.
+
+        Only remotely owned volumes (i.e. volumes whose ``uuid`` do not match
+        this service's) can be received.
+
+        :param unicode volume_node_id: The volume's owner's node ID.
+        :param VolumeName volume_name: The volume's name.
+        :param bool resume: See ``IFilesystem.receive``.
+
+        :raises ValueError: If the uuid of the volume matches our own;
+            remote nodes can't overwrite locally-owned volumes.
+
+        :return: ``Deferred`` that fires with an ``IFilesystemReceiver``
+            provider to write the data to.
+        """
+        if volume_node_id == self.node_id:
+            raise ValueError()
+        volume = Volume(node_id=volume_node_id, name=volume_name, service=self)
+        return volume.get_filesystem().receive(resume=resume)
+
+    def resume_token(self, volume_node_id, volume_name):
+        """
+        Describe the data kept by an interrupted receive of a volume.
+
+        :param unicode volume_node_id: The volume's owner's node ID.
+        :param VolumeName volume_name: The volume's name.
+
+        :return: See ``IFilesystem.resume_token``.
+        """
+        volume = Volume(node_id=volume_node_id, name=volume_name, service=self)
+        return volume.get_filesystem().resume_token()
+
     def receive(self, volume_node_id, volume_name, input_file):
         """
         Process a volume's data that can be read from a file-like object.
@@ -428,6 +587,58 @@ class Volume(object):
         return self.service.pool.get(self)
 
 
+def finish_receiving(sending, receiver):
+    """
+    Finish a receiver once sending to it is done, whether or not it
+    succeeded.
+
+    :param Deferred sending: Fires when all the data has been written to
+        the receiver, or errbacks if sending failed.
+    :param IFilesystemReceiver receiver: The receiver.
+
+    :return: ``Deferred`` that fires when the receiver has finished.  If
+        sending failed it errbacks with that failure, since the receiver
+        failing is just a consequence of it.
+    """
+    def sent(result):
+        finishing = receiver.finish()
+        if isinstance(result, Failure):
+            finishing.addBoth(lambda _: result)
+        return finishing
+    return sending.addBoth(sent)
+
+
+@implementer(IConsumer)
+class _ProgressConsumer(object):
+    """
+    Pass data and producer registrations through to another consumer,
+    counting the bytes written.
+
+    :ivar int written: The number of bytes written so far.
+    """
+    def __init__(self, consumer, progress=None):
+        """
+        :param IConsumer consumer: The consumer to pass everything to.
+        :param progress: ``None``, or a callable which is called with
+            ``written`` after each write.
+        """
+        self._consumer = consumer
+        self._progress = progress
+        self.written = 0
+
+    def write(self, data):
+        self._consumer.write(data)
+        self.written += len(data)
+        if self._progress is not None:
+            self._progress(self.written)
+
+    def registerProducer(self, producer, streaming):
+        self._consumer.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self._consumer.unregisterProducer()
+
+
 @implementer(ICommandLineScript)
 class VolumeScript(object):
     """
@@ -450,7 +661,8 @@ class VolumeScript(object):
         pool = StoragePool(reactor, options["pool"],
                            FilePath(options["mountpoint"]))
         service = cls._service_factory(
-            config_path=options["config"], pool=pool, reactor=reactor)
+            config_path=options["config"], pool=pool, reactor=reactor,
+            compression=options["compression"])
         try:
             service.startService()
         except CreateConfigurationError as e:
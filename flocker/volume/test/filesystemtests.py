@@ -9,11 +9,15 @@ instance as its first argument and returns some object to be used in a test.
 
 from __future__ import absolute_import
 
+from os import urandom
+
 from characteristic import attributes
+from zope.interface import implementer
 from zope.interface.verify import verifyObject
 
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import gatherResults
+from twisted.internet.defer import gatherResults, fail
+from twisted.internet.interfaces import IConsumer
 from twisted.application.service import IService
 
 from ...testtools import (
@@ -83,6 +87,109 @@ def copy(from_volume, to_volume):
     return getting_snapshots
 
 
+@implementer(IConsumer)
+class RecordingConsumer(object):
+    """
+    A consumer that remembers what was written to it and which producers
+    were registered.
+
+    :ivar bytes data: The data written.
+    :ivar list producers: ``(producer, streaming)`` for each registration.
+    :ivar bool registered: Whether a producer is currently registered.
+    """
+    def __init__(self):
+        self.data = b""
+        self.producers = []
+        self.registered = False
+
+    def write(self, data):
+        self.data += data
+
+    def registerProducer(self, producer, streaming):
+        self.producers.append((producer, streaming))
+        self.registered = True
+
+    def unregisterProducer(self):
+        self.registered = False
+
+
+def stream_copy(from_volume, to_volume):
+    """Copy contents of one volume to another using the non-blocking
+    ``IFilesystem.send`` and ``IFilesystem.receive`` APIs.
+
+    :param Volume from_volume: Volume to read from.
+    :param Volume to_volume: Volume to write to.
+
+    :return: ``Deferred`` that fires when the copy is done.
+    """
+    from_filesystem = from_volume.get_filesystem()
+    to_filesystem = to_volume.get_filesystem()
+    getting_snapshots = to_filesystem.snapshots()
+
+    def got_snapshots(snapshots):
+        receiving = to_filesystem.receive()
+
+        def got_receiver(receiver):
+            sending = from_filesystem.send(receiver, snapshots)
+            sending.addCallback(lambda _: receiver.finish())
+            return sending
+        receiving.addCallback(got_receiver)
+        return receiving
+    getting_snapshots.addCallback(got_snapshots)
+    return getting_snapshots
+
+
+def interrupted_copy(from_volume, to_volume):
+    """Start copying contents of one volume to another using the
+    non-blocking APIs, but only deliver the first half of the data, as if
+    the connection was lost.
+
+    A large file is added to the volume being copied first, so that half
+    of the data is certainly incomplete.
+
+    :param Volume from_volume: Volume to read from.
+    :param Volume to_volume: Volume to write to.
+
+    :return: ``Deferred`` that fires once the receiver has failed, or
+        errbacks if it didn't.
+    """
+    from_volume.get_filesystem().get_path().child(b"large").setContent(
+        urandom(1024 * 1024))
+    consumer = RecordingConsumer()
+    sending = from_volume.get_filesystem().send(consumer)
+    sending.addCallback(lambda _: to_volume.get_filesystem().receive())
+
+    def got_receiver(receiver):
+        receiver.write(consumer.data[:len(consumer.data) // 2])
+        finishing = receiver.finish()
+        finishing.addCallbacks(
+            lambda _: fail(AssertionError("Incomplete data was received.")),
+            lambda _: None)
+        return finishing
+    sending.addCallback(got_receiver)
+    return sending
+
+
+def resume_copy(from_volume, to_volume, resume_token):
+    """Copy the rest of the data of an interrupted copy.
+
+    :param Volume from_volume: Volume to read from.
+    :param Volume to_volume: Volume to write to.
+    :param bytes resume_token: The receiving filesystem's resume token.
+
+    :return: ``Deferred`` that fires when the copy is done.
+    """
+    receiving = to_volume.get_filesystem().receive(resume=True)
+
+    def got_receiver(receiver):
+        sending = from_volume.get_filesystem().send(
+            receiver, resume_token=resume_token)
+        sending.addCallback(lambda _: receiver.finish())
+        return sending
+    receiving.addCallback(got_receiver)
+    return receiving
+
+
 @attributes(["from_volume", "to_volume"])
 class CopyVolumes(object):
     """A pair of volumes that had data copied from one to the other.
@@ -97,7 +204,7 @@ MY_VOLUME = VolumeName(namespace=u"myns", dataset_id=u"myvolume")
 MY_VOLUME2 = VolumeName(namespace=u"myns", dataset_id=u"myvolume2")
 
 
-def create_and_copy(test, fixture):
+def create_and_copy(test, fixture, copy=copy):
     """
     Create a volume's filesystem on one pool, copy to another pool.
 
@@ -105,6 +212,8 @@ def create_and_copy(test, fixture):
         operation.
     :param fixture: Callable that takes ``TestCase`` and returns a
         ``IStoragePool`` provider.
+    :param copy: The function to copy the volume with, ``copy`` or
+        ``stream_copy``.
 
     :return: ``Deferred`` that fires with the two volumes in a
         ``CopyVolumes``.
@@ -487,6 +596,132 @@ def make_istoragepool_tests(fixture, snapshot_factory):
             d.addCallback(got_volumes)
             return d
 
+        def test_receive_new_filesystem(self):
+            """
+            Receiving what one pool's filesystem sends with
+            ``IFilesystem.send`` with another pool's
+            ``IFilesystem.receive`` creates that filesystem with the given
+            contents.
+            """
+            d = create_and_copy(self, fixture, stream_copy)
+
+            def got_volumes(copy_volumes):
+                assertVolumesEqual(
+                    self, copy_volumes.from_volume, copy_volumes.to_volume)
+            d.addCallback(got_volumes)
+            return d
+
+        def test_receive_update(self):
+            """
+            Sending an update of the contents of one pool's filesystem to
+            another pool's filesystem that was previously copied updates its
+            contents.
+            """
+            d = create_and_copy(self, fixture, stream_copy)
+
+            def got_volumes(copy_volumes):
+                path = copy_volumes.from_volume.get_filesystem().get_path()
+                path.child(b"anotherfile").setContent(b"hello")
+                path.child(b"file").remove()
+                copying = stream_copy(
+                    copy_volumes.from_volume, copy_volumes.to_volume)
+
+                def copied(ignored):
+                    assertVolumesEqual(
+                        self, copy_volumes.from_volume, copy_volumes.to_volume)
+                copying.addCallback(copied)
+                return copying
+            d.addCallback(got_volumes)
+            return d
+
+        def test_no_resume_token(self):
+            """
+            ``IFilesystem.resume_token`` returns ``None`` if no receive was
+            interrupted.
+            """
+            d = create_and_copy(self, fixture, stream_copy)
+            d.addCallback(lambda copy_volumes:
+                          copy_volumes.to_volume.get_filesystem()
+                          .resume_token())
+            d.addCallback(self.assertIs, None)
+            return d
+
+        def test_resume_interrupted_receive(self):
+            """
+            After an interrupted receive, ``IFilesystem.resume_token``
+            returns a token from which the sending filesystem can resume,
+            and receiving the rest of the stream with ``resume=True``
+            completes the copy.
+            """
+            d = create_and_copy(self, fixture, interrupted_copy)
+
+            def interrupted(copy_volumes):
+                from_filesystem = copy_volumes.from_volume.get_filesystem()
+                to_filesystem = copy_volumes.to_volume.get_filesystem()
+                getting_token = to_filesystem.resume_token()
+
+                def got_token(token):
+                    checking = from_filesystem.can_resume(token)
+                    checking.addCallback(self.assertTrue)
+                    checking.addCallback(lambda _: resume_copy(
+                        copy_volumes.from_volume, copy_volumes.to_volume,
+                        token))
+                    return checking
+                getting_token.addCallback(got_token)
+
+                def copied(ignored):
+                    assertVolumesEqual(
+                        self, copy_volumes.from_volume, copy_volumes.to_volume)
+                    return to_filesystem.resume_token()
+                getting_token.addCallback(copied)
+                getting_token.addCallback(self.assertIs, None)
+                return getting_token
+            d.addCallback(interrupted)
+            return d
+
+        def test_receive_discards_interrupted(self):
+            """
+            Receiving without ``resume=True`` after an interrupted receive
+            discards the data of the interrupted receive and copies the
+            whole stream.
+            """
+            d = create_and_copy(self, fixture, interrupted_copy)
+
+            def interrupted(copy_volumes):
+                copying = stream_copy(
+                    copy_volumes.from_volume, copy_volumes.to_volume)
+
+                def copied(ignored):
+                    assertVolumesEqual(
+                        self, copy_volumes.from_volume, copy_volumes.to_volume)
+                    return copy_volumes.to_volume.get_filesystem(
+                        ).resume_token()
+                copying.addCallback(copied)
+                copying.addCallback(self.assertIs, None)
+                return copying
+            d.addCallback(interrupted)
+            return d
+
+        def test_send_registers_producer(self):
+            """
+            ``IFilesystem.send`` registers a streaming producer with the
+            consumer while writing to it and unregisters it when done.
+            """
+            pool = fixture(self)
+            service = service_for_pool(self, pool)
+            volume = service.get(MY_VOLUME)
+            consumer = RecordingConsumer()
+            d = pool.create(volume)
+            d.addCallback(lambda filesystem: filesystem.send(consumer))
+
+            def sent(ignored):
+                self.assertEqual(
+                    ([True], False, True),
+                    ([streaming for _, streaming in consumer.producers],
+                     consumer.registered, len(consumer.data) > 0))
+            d.addCallback(sent)
+            return d
+
         def test_write_update_to_unchanged_filesystem(self):
             """
             Writing an update of the contents of one pool's filesystem to
@@ -0,0 +1,114 @@
+# Copyright Hybrid Logic Ltd.  See LICENSE file for details.
+
+"""
+Tests for :module:`flocker.volume._compression`.
+"""
+
+from os import urandom
+
+from zope.interface.verify import verifyObject
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from ..filesystems.interfaces import IFilesystemReceiver
+from .._compression import (
+    Compression, CompressingReceiver, DecompressingReceiver,
+    )
+from ...testtools import make_with_init_tests
+from .test_service import RecordingReceiver
+
+
+class CompressionInitializationTests(make_with_init_tests(
+        Compression, {"algorithm": b"zlib", "level": 6})):
+    """
+    Tests for :class:`Compression` initialization.
+    """
+
+
+class CompressionTests(SynchronousTestCase):
+    """
+    Tests for :class:`Compression`.
+    """
+    def test_unknown_algorithm(self):
+        """
+        ``Compression`` raises ``ValueError`` for an unknown algorithm.
+        """
+        self.assertRaises(ValueError, Compression, algorithm=b"lzma", level=6)
+
+    def test_invalid_level(self):
+        """
+        ``Compression`` raises ``ValueError`` for a level outside 1-9.
+        """
+        self.assertRaises(ValueError, Compression, algorithm=b"zlib", level=0)
+
+
+def make_compression_tests(algorithm):
+    """
+    Create tests for compressing and decompressing with an algorithm.
+
+    :param bytes algorithm: One of ``COMPRESSION_ALGORITHMS``.
+    """
+    class CompressionRoundTripTests(SynchronousTestCase):
+        """
+        Tests for ``CompressingReceiver`` and ``DecompressingReceiver``.
+        """
+        def setUp(self):
+            self.received = RecordingReceiver()
+            self.decompressing = DecompressingReceiver(
+                self.received, algorithm)
+            self.compressing = CompressingReceiver(
+                self.decompressing,
+                Compression(algorithm=algorithm, level=1))
+
+        def test_interface(self):
+            """
+            Both receivers provide ``IFilesystemReceiver``.
+            """
+            self.assertEqual(
+                (True, True),
+                (verifyObject(IFilesystemReceiver, self.compressing),
+                 verifyObject(IFilesystemReceiver, self.decompressing)))
+
+        def test_round_trip(self):
+            """
+            Data written to the ``CompressingReceiver`` arrives unchanged at
+            the receiver wrapped by the ``DecompressingReceiver`` once the
+            ``CompressingReceiver`` is finished.
+            """
+            data = urandom(100000) + b"x" * 100000
+            for i in range(0, len(data), 1000):
+                self.compressing.write(data[i:i + 1000])
+            self.successResultOf(self.compressing.finish())
+            self.assertEqual((True, data),
+                             (self.received.finished,
+                              self.received.data.getvalue()))
+
+        def test_compresses(self):
+            """
+            The ``CompressingReceiver`` writes less than it was given for
+            compressible data.
+            """
+            written = RecordingReceiver()
+            compressing = CompressingReceiver(
+                written, Compression(algorithm=algorithm, level=9))
+            compressing.write(b"x" * 100000)
+            self.successResultOf(compressing.finish())
+            self.assertTrue(len(written.data.getvalue()) < 1000)
+
+        def test_producer(self):
+            """
+            Producers registered with the ``CompressingReceiver`` are passed
+            through to the wrapped receivers.
+            """
+            producer = object()
+            self.compressing.registerProducer(producer, True)
+            self.compressing.unregisterProducer()
+            self.assertEqual([(producer, True)], self.received.producers)
+
+    CompressionRoundTripTests.__name__ = (
+        algorithm.capitalize() + "CompressionRoundTripTests")
+    return CompressionRoundTripTests
+
+
+ZlibCompressionTests = make_compression_tests(b"zlib")
+Bz2CompressionTests = make_compression_tests(b"bz2")
@@ -6,17 +6,24 @@ Tests for :module:`flocker.filesystems.memory`.
 
 from __future__ import absolute_import
 
+from io import BytesIO
+
 from twisted.internet.defer import succeed, fail
 from twisted.trial.unittest import SynchronousTestCase
 from twisted.python.filepath import FilePath
 
+from twisted.internet.error import ConnectionLost
+from twisted.protocols.basic import FileSender
+
 from .filesystemtests import (
     make_ifilesystemsnapshots_tests, make_istoragepool_tests,
+    RecordingConsumer,
 )
 from ..filesystems.memory import (
     CannedFilesystemSnapshots, FilesystemStoragePool,
-    DirectoryFilesystem,
+    DirectoryFilesystem, _BytesProducer,
 )
+from ..filesystems.errors import StaleResumeToken
 from ...testtools import (
     assert_equal_comparison, assert_not_equal_comparison
 )
@@ -95,3 +102,146 @@ class DirectoryFilesystemTests(SynchronousTestCase):
             repr(DirectoryFilesystem(
                 path=FilePath(b"/foo/bar"), size=123))
         )
+
+
+class DirectoryFilesystemResumeTests(SynchronousTestCase):
+    """
+    Tests for resuming interrupted receives of ``DirectoryFilesystem``.
+    """
+    def setUp(self):
+        self.origin = DirectoryFilesystem(path=FilePath(self.mktemp()))
+        self.origin.get_path().makedirs()
+        self.origin.get_path().child(b"afile").setContent(b"x" * 100000)
+        self.destination = DirectoryFilesystem(path=FilePath(self.mktemp()))
+        consumer = RecordingConsumer()
+        self.successResultOf(self.origin.send(consumer))
+        self.data = consumer.data
+
+    def interrupt(self):
+        """
+        Receive the first half of the origin's data at the destination.
+
+        :return: The destination's resume token.
+        """
+        receiver = self.successResultOf(self.destination.receive())
+        receiver.write(self.data[:len(self.data) // 2])
+        self.failureResultOf(receiver.finish(), ConnectionLost)
+        return self.successResultOf(self.destination.resume_token())
+
+    def test_partial_not_sent(self):
+        """
+        The data of an interrupted receive is not part of the data sent by
+        the filesystem.
+        """
+        self.interrupt()
+        self.destination.get_path().child(b"afile").setContent(b"x" * 100000)
+        consumer = RecordingConsumer()
+        self.successResultOf(self.destination.send(consumer))
+        self.assertEqual(self.data, consumer.data)
+
+    def test_resume_sends_rest(self):
+        """
+        ``DirectoryFilesystem.send`` with a resume token only sends the data
+        which wasn't received yet.
+        """
+        token = self.interrupt()
+        consumer = RecordingConsumer()
+        self.successResultOf(self.origin.send(consumer, resume_token=token))
+        self.assertEqual(self.data[len(self.data) // 2:], consumer.data)
+
+    def test_stale(self):
+        """
+        If the filesystem changed since the interrupted receive,
+        ``DirectoryFilesystem.can_resume`` returns ``False`` and ``send``
+        with the resume token fails with ``StaleResumeToken``.
+        """
+        token = self.interrupt()
+        self.origin.get_path().child(b"afile").setContent(b"y" * 100000)
+        self.assertEqual(
+            False, self.successResultOf(self.origin.can_resume(token)))
+        self.failureResultOf(
+            self.origin.send(RecordingConsumer(), resume_token=token),
+            StaleResumeToken)
+
+    def test_garbage_token(self):
+        """
+        ``DirectoryFilesystem.can_resume`` returns ``False`` for tokens it
+        didn't create.
+        """
+        self.assertEqual(
+            False, self.successResultOf(self.origin.can_resume(b"garbage")))
+
+    def test_pull_producer(self):
+        """
+        The receiver returned by ``DirectoryFilesystem.receive`` keeps
+        pulling from a non-streaming producer until it is unregistered.
+        """
+        receiver = self.successResultOf(self.destination.receive())
+        sending = FileSender().beginFileTransfer(BytesIO(self.data), receiver)
+        self.successResultOf(sending)
+        self.successResultOf(receiver.finish())
+        self.assertEqual(
+            b"x" * 100000,
+            self.destination.get_path().child(b"afile").getContent())
+
+
+class PausingConsumer(RecordingConsumer):
+    """
+    A consumer that pauses its producer after each write.
+    """
+    def write(self, data):
+        RecordingConsumer.write(self, data)
+        self.producers[-1][0].pauseProducing()
+
+
+class BytesProducerTests(SynchronousTestCase):
+    """
+    Tests for ``_BytesProducer``.
+    """
+    def test_write_all(self):
+        """
+        All the data is written in chunks and the producer is unregistered
+        before the ``Deferred`` fires.
+        """
+        consumer = RecordingConsumer()
+        d = _BytesProducer(b"abcdefg", chunk_size=3).start(consumer)
+        self.assertEqual((None, b"abcdefg", False),
+                         (self.successResultOf(d), consumer.data,
+                          consumer.registered))
+
+    def test_pause(self):
+        """
+        Nothing is written while the producer is paused.
+        """
+        consumer = PausingConsumer()
+        producer = _BytesProducer(b"abcdefg", chunk_size=3)
+        d = producer.start(consumer)
+        self.assertNoResult(d)
+        written = consumer.data
+        producer.resumeProducing()
+        self.assertEqual((b"abc", b"abcdef"), (written, consumer.data))
+
+    def test_resume(self):
+        """
+        Resuming the producer until all was written fires the ``Deferred``.
+        """
+        consumer = PausingConsumer()
+        producer = _BytesProducer(b"abcdefg", chunk_size=3)
+        d = producer.start(consumer)
+        producer.resumeProducing()
+        producer.resumeProducing()
+        self.assertEqual((None, b"abcdefg"),
+                         (self.successResultOf(d), consumer.data))
+
+    def test_stop(self):
+        """
+        Stopping the producer fails the ``Deferred`` with
+        ``ConnectionLost``.
+        """
+        consumer = PausingConsumer()
+        producer = _BytesProducer(b"abcdefg", chunk_size=3)
+        d = producer.start(consumer)
+        producer.stopProducing()
+        self.failureResultOf(d, ConnectionLost)
+        self.assertEqual((b"abc", False),
+                         (consumer.data, consumer.registered))
@@ -23,11 +23,13 @@ from ...testtools import (
 )
 
 from ..filesystems.zfs import (
-    _DatasetInfo,
+    _DatasetInfo, _PoolCache, _list_pool,
     zfs_command, CommandFailed, BadArguments, Filesystem, ZFSSnapshots,
     _sync_command_error_squashed, _latest_common_snapshot, ZFS_ERROR,
-    Snapshot,
+    Snapshot, StoragePool, volume_to_dataset,
 )
+from ..service import Volume, VolumeName
+from .filesystemtests import RecordingConsumer
 
 
 class FilesystemTests(SynchronousTestCase):
@@ -412,3 +414,607 @@ class DatasetInfoTests(SynchronousTestCase):
         """
         self.assertRaises(
             AttributeError, setattr, self.info, "refquota", 321)
+
+
+def finish_process(reactor, index, output=b"", status=0):
+    """
+    Make a process spawned by a ``FakeProcessReactor`` produce output and
+    exit.
+
+    :param FakeProcessReactor reactor: The reactor the process was spawned
+        with.
+    :param int index: The index of the process in ``reactor.processes``.
+    :param bytes output: What the process writes to its stdout.
+    :param int status: The exit status of the process.
+    """
+    process_protocol = reactor.processes[index].processProtocol
+    if output:
+        process_protocol.childDataReceived(1, output)
+    if status:
+        reason = ProcessTerminated(status)
+    else:
+        reason = ProcessDone(0)
+    process_protocol.processEnded(Failure(reason))
+
+
+POOL_LISTING = (
+    b"mypool\t/mypool\t0\t100\n"
+    b"mypool/fs1\t/flocker/fs1\t0\t101\n"
+    b"mypool/fs2\t/flocker/fs2\t65536\t102\n"
+    b"mypool/fs1@snap1\t-\t-\t103\n"
+    b"mypool/fs2/child\t/flocker/fs2/child\t0\t104\n"
+    b"mypool/fs1@snap2\t-\t-\t105\n"
+)
+
+
+class ListPoolTests(SynchronousTestCase):
+    """
+    Tests for ``_list_pool``.
+    """
+    def test_command(self):
+        """
+        ``_list_pool`` lists all filesystems and snapshots of the pool with
+        one ``zfs list`` command, sorted by creation time.
+        """
+        reactor = FakeProcessReactor()
+        _list_pool(reactor, b"mypool")
+        self.assertEqual(
+            [[b"zfs", b"list", b"-r", b"-t", b"filesystem,snapshot", b"-H",
+              b"-p", b"-o", b"name,mountpoint,refquota,creation",
+              b"-s", b"creation", b"mypool"]],
+            [process.args for process in reactor.processes])
+
+    def test_filesystems(self):
+        """
+        The result of ``_list_pool`` describes the direct children of the
+        pool.
+        """
+        reactor = FakeProcessReactor()
+        d = _list_pool(reactor, b"mypool")
+        finish_process(reactor, 0, POOL_LISTING)
+        self.assertEqual(
+            frozenset([
+                _DatasetInfo(dataset=b"fs1", mountpoint=b"/flocker/fs1",
+                             refquota=None),
+                _DatasetInfo(dataset=b"fs2", mountpoint=b"/flocker/fs2",
+                             refquota=65536)]),
+            self.successResultOf(d).filesystems)
+
+    def test_snapshots(self):
+        """
+        The result of ``_list_pool`` maps filesystems to the names of their
+        snapshots, oldest first.
+        """
+        reactor = FakeProcessReactor()
+        d = _list_pool(reactor, b"mypool")
+        finish_process(reactor, 0, POOL_LISTING)
+        self.assertEqual({b"mypool/fs1": [b"snap1", b"snap2"]},
+                         self.successResultOf(d).snapshots)
+
+
+class PoolCacheTests(SynchronousTestCase):
+    """
+    Tests for ``_PoolCache``.
+    """
+    def test_update(self):
+        """
+        ``_PoolCache.update`` remembers the state if the cache was not
+        invalidated since the given generation.
+        """
+        cache = _PoolCache()
+        cache.update(cache.generation, b"state")
+        self.assertEqual(b"state", cache.state)
+
+    def test_update_after_invalidate(self):
+        """
+        ``_PoolCache.update`` ignores a state found by a query that started
+        before the cache was invalidated.
+        """
+        cache = _PoolCache()
+        generation = cache.generation
+        cache.invalidate()
+        cache.update(generation, b"state")
+        self.assertIs(None, cache.state)
+
+    def test_invalidate(self):
+        """
+        ``_PoolCache.invalidate`` forgets the state.
+        """
+        cache = _PoolCache()
+        cache.update(cache.generation, b"state")
+        cache.invalidate()
+        self.assertIs(None, cache.state)
+
+
+class StoragePoolQueryTests(SynchronousTestCase):
+    """
+    Tests for the ``zfs`` commands ``StoragePool`` uses to query and
+    destroy filesystems.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.pool = StoragePool(self.reactor, b"mypool",
+                                FilePath(b"/flocker"))
+
+    def enumerate(self):
+        """
+        Enumerate the pool's filesystems, answering the ``zfs list`` with
+        ``POOL_LISTING``.
+
+        :return: The enumerated filesystems, keyed by dataset.
+        """
+        d = self.pool.enumerate()
+        finish_process(self.reactor, len(self.reactor.processes) - 1,
+                       POOL_LISTING)
+        return {filesystem.dataset: filesystem
+                for filesystem in self.successResultOf(d)}
+
+    def test_enumerate(self):
+        """
+        ``StoragePool.enumerate`` returns the pool's filesystems using a
+        single ``zfs`` command.
+        """
+        filesystems = self.enumerate()
+        self.assertEqual(
+            (1, [b"fs1", b"fs2"], FilePath(b"/flocker/fs2"), 65536),
+            (len(self.reactor.processes), sorted(filesystems),
+             filesystems[b"fs2"].get_path(),
+             filesystems[b"fs2"].size.maximum_size))
+
+    def test_snapshots_cached(self):
+        """
+        After enumeration, ``Filesystem.snapshots`` returns the snapshots
+        without running ``zfs`` again.
+        """
+        filesystems = self.enumerate()
+        self.assertEqual(
+            ([Snapshot(name=b"snap1"), Snapshot(name=b"snap2")], [], 1),
+            (self.successResultOf(filesystems[b"fs1"].snapshots()),
+             self.successResultOf(filesystems[b"fs2"].snapshots()),
+             len(self.reactor.processes)))
+
+    def test_snapshots_after_change(self):
+        """
+        Once the pool is changed, ``Filesystem.snapshots`` lists the
+        snapshots again.
+        """
+        filesystems = self.enumerate()
+        ZFSSnapshots(self.reactor, filesystems[b"fs1"]).create(b"snap3")
+        filesystems[b"fs1"].snapshots()
+        self.assertEqual(
+            [b"zfs", b"list", b"-H", b"-r", b"-t", b"snapshot", b"-o",
+             b"name", b"-s", b"creation", b"mypool/fs1"],
+            self.reactor.processes[-1].args)
+
+    def test_snapshots_not_cached(self):
+        """
+        ``Filesystem.snapshots`` of a filesystem that wasn't found by the
+        enumeration, e.g. because another process received it since, lists
+        the snapshots with ``zfs``.
+        """
+        self.enumerate()
+        filesystem = self.pool.get(self.volume(b"node.default.fs3"))
+        d = filesystem.snapshots()
+        finish_process(self.reactor, 1, b"mypool/node.default.fs3@snap1\n")
+        self.assertEqual(
+            ([Snapshot(name=b"snap1")],
+             [b"zfs", b"list", b"-H", b"-r", b"-t", b"snapshot", b"-o",
+              b"name", b"-s", b"creation", b"mypool/node.default.fs3"]),
+            (self.successResultOf(d), self.reactor.processes[1].args))
+
+    def test_receive_not_cached(self):
+        """
+        ``Filesystem.receive`` of a filesystem that wasn't found by the
+        enumeration checks with ``zfs`` whether it exists, since another
+        process may have received it since.
+        """
+        self.enumerate()
+        filesystem = self.pool.get(self.volume(b"node.default.fs3"))
+        filesystem.receive()
+        self.assertEqual([b"zfs", b"list", b"mypool/node.default.fs3"],
+                         self.reactor.processes[1].args)
+
+    def test_snapshots_no_filesystem(self):
+        """
+        ``Filesystem.snapshots`` of a filesystem that doesn't exist returns
+        an empty list.
+        """
+        filesystem = Filesystem(b"mypool", b"fs3", reactor=self.reactor)
+        d = filesystem.snapshots()
+        finish_process(self.reactor, 0, status=1)
+        self.assertEqual([], self.successResultOf(d))
+
+    def volume(self, dataset):
+        """
+        :param bytes dataset: The name of a dataset in ``POOL_LISTING``.
+
+        :return: A ``Volume`` stored in the dataset.
+        """
+        node_id, name = dataset.split(b".", 1)
+        return Volume(node_id=node_id.decode("ascii"),
+                      name=VolumeName.from_bytes(name), service=None)
+
+    def test_destroy_snapshots_at_once(self):
+        """
+        ``StoragePool.destroy`` destroys all snapshots of the filesystem
+        with a single command before destroying the filesystem.
+        """
+        volume = self.volume(b"node.default.fs1")
+        dataset = volume_to_dataset(volume)
+        listing = POOL_LISTING.replace(b"fs1", dataset)
+        d = self.pool.enumerate()
+        finish_process(self.reactor, 0, listing)
+        self.successResultOf(d)
+        d = self.pool.destroy(volume)
+        finish_process(
+            self.reactor, 1,
+            b"mypool/%s@snap1\nmypool/%s@snap2\n" % (dataset, dataset))
+        finish_process(self.reactor, 2)
+        finish_process(self.reactor, 3)
+        self.successResultOf(d)
+        self.assertEqual(
+            [[b"zfs", b"destroy",
+              b"mypool/" + dataset + b"@snap1,snap2"],
+             [b"zfs", b"destroy", b"mypool/" + dataset]],
+            [process.args for process in self.reactor.processes[2:]])
+
+    def test_destroy_lists_snapshots(self):
+        """
+        ``StoragePool.destroy`` lists the snapshots of the filesystem with
+        ``zfs`` rather than using the cached state of the pool, since
+        another process may have received more snapshots since.
+        """
+        volume = self.volume(b"node.default.fs1")
+        d = self.pool.enumerate()
+        finish_process(self.reactor, 0, POOL_LISTING)
+        self.successResultOf(d)
+        self.pool.destroy(volume)
+        self.assertEqual(
+            [b"zfs", b"list", b"-H", b"-r", b"-t", b"snapshot", b"-o",
+             b"name", b"-s", b"creation", b"mypool/node.default.fs1"],
+            self.reactor.processes[1].args)
+
+    def test_destroy_without_snapshots(self):
+        """
+        ``StoragePool.destroy`` of a filesystem without snapshots only
+        destroys the filesystem.
+        """
+        volume = self.volume(b"node.default.fs2")
+        d = self.pool.enumerate()
+        finish_process(self.reactor, 0, POOL_LISTING)
+        self.successResultOf(d)
+        self.pool.destroy(volume)
+        finish_process(self.reactor, 1)
+        self.assertEqual(
+            [[b"zfs", b"destroy", b"mypool/node.default.fs2"]],
+            [process.args for process in self.reactor.processes[2:]])
+
+
+class FilesystemSendTests(SynchronousTestCase):
+    """
+    Tests for ``Filesystem.send``.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.filesystem = Filesystem(b"mypool", b"myfs",
+                                     FilePath(b"/flocker/myfs"),
+                                     reactor=self.reactor)
+        self.consumer = RecordingConsumer()
+
+    def start_send(self, remote_snapshots=None, local=b"old\n"):
+        """
+        Start sending and finish the snapshot creation and listing.
+
+        :param remote_snapshots: Passed to ``send``.
+        :param bytes local: Lines of the snapshot listing, apart from the
+            one for the new snapshot.
+
+        :return: The ``Deferred`` returned by ``send``.
+        """
+        d = self.filesystem.send(self.consumer, remote_snapshots)
+        snapshot = self.reactor.processes[0].args[-1]
+        finish_process(self.reactor, 0)
+        listing = b"".join(
+            b"mypool/myfs@" + name + b"\n" for name in local.split())
+        finish_process(self.reactor, 1, listing + snapshot + b"\n")
+        return d
+
+    def test_full_stream(self):
+        """
+        Without common snapshots ``Filesystem.send`` takes a snapshot and
+        sends all of it with ``zfs send``.
+        """
+        self.start_send()
+        snapshot = self.reactor.processes[0].args[-1]
+        self.assertEqual(
+            ([b"zfs", b"snapshot"], [b"zfs", b"send", snapshot]),
+            (self.reactor.processes[0].args[:2],
+             self.reactor.processes[2].args))
+
+    def test_incremental_stream(self):
+        """
+        ``Filesystem.send`` sends an incremental stream based on the latest
+        snapshot the receiver has.
+        """
+        self.start_send([Snapshot(name=b"old")])
+        snapshot = self.reactor.processes[0].args[-1]
+        self.assertEqual(
+            [b"zfs", b"send", b"-i", b"mypool/myfs@old", snapshot],
+            self.reactor.processes[2].args)
+
+    def test_output_written(self):
+        """
+        The output of ``zfs send`` is written to the consumer, and the
+        ``Deferred`` fires once the process exits successfully.
+        """
+        d = self.start_send()
+        protocol = self.reactor.processes[2].processProtocol
+        protocol.childDataReceived(1, b"abc")
+        protocol.childDataReceived(2, b"ignored")
+        protocol.childDataReceived(1, b"def")
+        self.assertNoResult(d)
+        finish_process(self.reactor, 2)
+        self.assertEqual((None, b"abcdef"),
+                         (self.successResultOf(d), self.consumer.data))
+
+    def test_streaming_producer(self):
+        """
+        While sending, the process is registered as a streaming producer
+        that controls reading the process output.
+        """
+        d = self.start_send()
+        [(producer, streaming)] = self.consumer.producers
+        transport = self.reactor.processes[2].transport
+        producer.pauseProducing()
+        paused = transport.paused
+        producer.resumeProducing()
+        finish_process(self.reactor, 2)
+        self.successResultOf(d)
+        self.assertEqual(
+            (True, True, False, True, False),
+            (streaming, paused, transport.paused, transport.stdin_closed,
+             self.consumer.registered))
+
+    def test_stop_producing(self):
+        """
+        Stopping the producer terminates ``zfs send``.
+        """
+        self.start_send()
+        [(producer, _)] = self.consumer.producers
+        producer.stopProducing()
+        self.assertEqual([b"TERM"],
+                         self.reactor.processes[2].transport.signals)
+
+    def test_failure(self):
+        """
+        If ``zfs send`` fails, the ``Deferred`` errbacks.
+        """
+        d = self.start_send()
+        finish_process(self.reactor, 2, status=1)
+        self.failureResultOf(d, CommandFailed)
+
+
+class FilesystemResumeTests(SynchronousTestCase):
+    """
+    Tests for resuming interrupted receives of ``Filesystem``.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.filesystem = Filesystem(b"mypool", b"myfs",
+                                     FilePath(b"/flocker/myfs"),
+                                     reactor=self.reactor)
+
+    def test_send_resume_token(self):
+        """
+        ``Filesystem.send`` with a resume token sends the rest of the
+        interrupted stream with ``zfs send -t``, without taking a snapshot.
+        """
+        consumer = RecordingConsumer()
+        d = self.filesystem.send(consumer, resume_token=b"1-abc-def")
+        self.reactor.processes[0].processProtocol.childDataReceived(1, b"ab")
+        finish_process(self.reactor, 0)
+        self.successResultOf(d)
+        self.assertEqual(
+            ([[b"zfs", b"send", b"-t", b"1-abc-def"]], b"ab"),
+            ([process.args for process in self.reactor.processes],
+             consumer.data))
+
+    def test_resume_token(self):
+        """
+        ``Filesystem.resume_token`` returns the filesystem's
+        ``receive_resume_token`` property.
+        """
+        d = self.filesystem.resume_token()
+        finish_process(self.reactor, 0, b"1-abc-def\n")
+        self.assertEqual(
+            ([b"zfs", b"get", b"-H", b"-o", b"value",
+              b"receive_resume_token", b"mypool/myfs"], b"1-abc-def"),
+            (self.reactor.processes[0].args, self.successResultOf(d)))
+
+    def test_no_resume_token(self):
+        """
+        ``Filesystem.resume_token`` returns ``None`` if the
+        ``receive_resume_token`` property is unset.
+        """
+        d = self.filesystem.resume_token()
+        finish_process(self.reactor, 0, b"-\n")
+        self.assertIs(None, self.successResultOf(d))
+
+    def test_resume_token_failure(self):
+        """
+        ``Filesystem.resume_token`` returns ``None`` if the property can't be
+        retrieved, e.g. because the filesystem doesn't exist or ZFS is too
+        old to resume receives.
+        """
+        results = []
+        for status in (1, 2):
+            d = self.filesystem.resume_token()
+            finish_process(self.reactor, len(results), status=status)
+            results.append(self.successResultOf(d))
+        self.assertEqual([None, None], results)
+
+    def test_can_resume(self):
+        """
+        ``Filesystem.can_resume`` returns ``True`` if a dry run of
+        ``zfs send -t`` succeeds.
+        """
+        d = self.filesystem.can_resume(b"1-abc-def")
+        finish_process(self.reactor, 0)
+        self.assertEqual(
+            ([b"zfs", b"send", b"-n", b"-t", b"1-abc-def"], True),
+            (self.reactor.processes[0].args, self.successResultOf(d)))
+
+    def test_cannot_resume(self):
+        """
+        ``Filesystem.can_resume`` returns ``False`` if a dry run of
+        ``zfs send -t`` fails, e.g. because the snapshot was destroyed.
+        """
+        d = self.filesystem.can_resume(b"1-abc-def")
+        finish_process(self.reactor, 0, status=1)
+        self.assertEqual(False, self.successResultOf(d))
+
+
+class FilesystemReceiveTests(SynchronousTestCase):
+    """
+    Tests for ``Filesystem.receive``.
+    """
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.filesystem = Filesystem(b"mypool", b"myfs",
+                                     FilePath(b"/flocker/myfs"),
+                                     reactor=self.reactor)
+
+    def receiver(self, exists=True, token=b"-", resume=False,
+                 resumable=True):
+        """
+        Get a receiver, answering the existence check, the check for
+        resume support and, if needed, the discarding of an interrupted
+        receive.
+
+        :param bool exists: Whether the filesystem exists.
+        :param bytes token: The filesystem's ``receive_resume_token``.
+        :param bool resume: Passed to ``receive``.
+        :param bool resumable: Whether ZFS supports resuming receives.
+
+        :return: The receiver.
+        """
+        d = self.filesystem.receive(resume=resume)
+        finish_process(self.reactor, 0, status=0 if exists else 1)
+        if resumable:
+            finish_process(self.reactor, 1, token + b"\n")
+        else:
+            # Old versions of ZFS don't know the property:
+            finish_process(self.reactor, 1, status=2)
+        if exists and resumable and not resume and token != b"-":
+            finish_process(self.reactor, 2)
+        return self.successResultOf(d)
+
+    def test_new_filesystem(self):
+        """
+        A filesystem that doesn't exist yet is received with resumable
+        ``zfs receive -s`` if the pool supports it.
+        """
+        self.receiver(exists=False)
+        self.assertEqual(
+            ([b"zfs", b"list", b"mypool/myfs"],
+             [b"zfs", b"get", b"-H", b"-o", b"value",
+              b"receive_resume_token", b"mypool"],
+             [b"zfs", b"receive", b"-s", b"mypool/myfs"]),
+            tuple(process.args for process in self.reactor.processes))
+
+    def test_new_filesystem_not_resumable(self):
+        """
+        If ZFS can't resume receives, a filesystem that doesn't exist yet is
+        received with plain ``zfs receive``.
+        """
+        self.receiver(exists=False, resumable=False)
+        self.assertEqual(
+            [b"zfs", b"receive", b"mypool/myfs"],
+            self.reactor.processes[2].args)
+
+    def test_existing_filesystem_not_resumable(self):
+        """
+        If ZFS can't resume receives, an existing filesystem is received
+        with ``zfs receive -F``.
+        """
+        self.receiver(resumable=False)
+        self.assertEqual(
+            [b"zfs", b"receive", b"-F", b"mypool/myfs"],
+            self.reactor.processes[2].args)
+
+    def test_existing_filesystem(self):
+        """
+        An existing filesystem is received with ``zfs receive -s -F``, once
+        it was checked that there's no interrupted receive.
+        """
+        self.receiver()
+        self.assertEqual(
+            ([b"zfs", b"get", b"-H", b"-o", b"value",
+              b"receive_resume_token", b"mypool/myfs"],
+             [b"zfs", b"receive", b"-s", b"-F", b"mypool/myfs"]),
+            (self.reactor.processes[1].args, self.reactor.processes[2].args))
+
+    def test_discard_interrupted(self):
+        """
+        If an existing filesystem has the state of an interrupted receive,
+        it is discarded with ``zfs receive -A`` before receiving.
+        """
+        self.receiver(token=b"1-abc-def")
+        self.assertEqual(
+            ([b"zfs", b"receive", b"-A", b"mypool/myfs"],
+             [b"zfs", b"receive", b"-s", b"-F", b"mypool/myfs"]),
+            (self.reactor.processes[2].args, self.reactor.processes[3].args))
+
+    def test_resume(self):
+        """
+        When resuming, the state of an interrupted receive is kept.
+        """
+        self.receiver(token=b"1-abc-def", resume=True)
+        self.assertEqual(
+            [[b"zfs", b"list", b"mypool/myfs"],
+             [b"zfs", b"get", b"-H", b"-o", b"value",
+              b"receive_resume_token", b"mypool/myfs"],
+             [b"zfs", b"receive", b"-s", b"-F", b"mypool/myfs"]],
+            [process.args for process in self.reactor.processes])
+
+    def test_consumer(self):
+        """
+        Data and producers are passed on to the standard input of
+        ``zfs receive``.
+        """
+        receiver = self.receiver()
+        producer = object()
+        receiver.registerProducer(producer, True)
+        receiver.write(b"abc")
+        transport = self.reactor.processes[2].transport
+        registered = transport.producer
+        receiver.unregisterProducer()
+        self.assertEqual((b"abc", producer, None),
+                         (transport.stdin, registered, transport.producer))
+
+    def test_finish(self):
+        """
+        ``finish`` closes the standard input of ``zfs receive`` and, once it
+        succeeded, sets the mountpoint of the filesystem.
+        """
+        receiver = self.receiver()
+        d = receiver.finish()
+        stdin_closed = self.reactor.processes[2].transport.stdin_closed
+        finish_process(self.reactor, 2)
+        finish_process(self.reactor, 3)
+        self.assertEqual(
+            (True, None,
+             [b"zfs", b"set", b"mountpoint=/flocker/myfs", b"mypool/myfs"]),
+            (stdin_closed, self.successResultOf(d),
+             self.reactor.processes[3].args))
+
+    def test_failure(self):
+        """
+        If ``zfs receive`` fails the ``Deferred`` returned by ``finish``
+        errbacks and the mountpoint is not set.
+        """
+        receiver = self.receiver()
+        d = receiver.finish()
+        finish_process(self.reactor, 2, status=1)
+        self.failureResultOf(d, CommandFailed)
+        self.assertEqual(3, len(self.reactor.processes))
@@ -8,6 +8,7 @@ from __future__ import absolute_import
 
 from zope.interface.verify import verifyObject
 
+from twisted.internet.defer import Deferred
 from twisted.internet.task import Clock
 from twisted.python.filepath import FilePath
 from twisted.trial.unittest import TestCase
@@ -19,6 +20,7 @@ from .._ipc import (
     IRemoteVolumeManager, RemoteVolumeManager, LocalVolumeManager,
     standard_node, SSH_PRIVATE_KEY_PATH)
 from ..testtools import ServicePair
+from .._compression import Compression, CompressingReceiver
 from ...common import FakeNode
 from ...common._ipc import ProcessNode
 
@@ -109,6 +111,91 @@ def make_iremote_volume_manager(fixture):
 
             return created
 
+        def test_receive_stream_creates_files(self):
+            """
+            The receiver returned by ``receive_stream`` recreates the files
+            sent to it by the origin's filesystem.
+            """
+            service_pair = fixture(self)
+            created = service_pair.from_service.create(
+                service_pair.from_service.get(MY_VOLUME)
+            )
+
+            def do_push(volume):
+                root = volume.get_filesystem().get_path()
+                root.child(b"afile.txt").setContent(b"WORKS!")
+
+                receiving = service_pair.remote.receive_stream(volume)
+
+                def got_receiver(receiver):
+                    d = volume.get_filesystem().send(receiver)
+                    d.addCallback(lambda _: receiver.finish())
+                    return d
+                return receiving.addCallback(got_receiver)
+            created.addCallback(do_push)
+
+            def pushed(_):
+                to_volume = Volume(node_id=service_pair.from_service.node_id,
+                                   name=MY_VOLUME,
+                                   service=service_pair.to_service)
+                root = to_volume.get_filesystem().get_path()
+                self.assertEqual(root.child(b"afile.txt").getContent(),
+                                 b"WORKS!")
+            created.addCallback(pushed)
+            return created
+
+        def test_receive_stream_compressed(self):
+            """
+            The receiver returned by ``receive_stream`` decompresses data
+            compressed with one of the algorithms returned by
+            ``compressions``.
+            """
+            service_pair = fixture(self)
+            created = service_pair.from_service.create(
+                service_pair.from_service.get(MY_VOLUME)
+            )
+
+            def do_push(volume):
+                root = volume.get_filesystem().get_path()
+                root.child(b"afile.txt").setContent(b"WORKS!")
+                algorithm = self.successResultOf(
+                    service_pair.remote.compressions())[0]
+
+                receiving = service_pair.remote.receive_stream(
+                    volume, compression=algorithm)
+
+                def got_receiver(receiver):
+                    receiver = CompressingReceiver(
+                        receiver, Compression(algorithm=algorithm, level=1))
+                    d = volume.get_filesystem().send(receiver)
+                    d.addCallback(lambda _: receiver.finish())
+                    return d
+                return receiving.addCallback(got_receiver)
+            created.addCallback(do_push)
+
+            def pushed(_):
+                to_volume = Volume(node_id=service_pair.from_service.node_id,
+                                   name=MY_VOLUME,
+                                   service=service_pair.to_service)
+                root = to_volume.get_filesystem().get_path()
+                self.assertEqual(root.child(b"afile.txt").getContent(),
+                                 b"WORKS!")
+            created.addCallback(pushed)
+            return created
+
+        def test_resume_token_nothing_interrupted(self):
+            """
+            ``resume_token`` returns a ``Deferred`` that fires with ``None``
+            if no push of the volume was interrupted.
+            """
+            service_pair = fixture(self)
+            created = service_pair.from_service.create(
+                service_pair.from_service.get(MY_VOLUME)
+            )
+            created.addCallback(service_pair.remote.resume_token)
+            created.addCallback(self.assertIs, None)
+            return created
+
         def test_creates_files(self):
             """``receive`` recreates files pushed from origin."""
             service_pair = fixture(self)
@@ -355,6 +442,124 @@ class RemoteVolumeManagerTests(TestCase):
                           b"receive", self.volume.node_id.encode("ascii"),
                           b"myns.myvol"])
 
+    def test_receive_stream_destination_run(self):
+        """
+        ``RemoteVolumeManager.receive_stream`` runs ``flocker-volume``
+        remotely with the ``receive`` command, and the data written to the
+        receiver it returns is written to that command's stdin.
+        """
+        node = FakeNode()
+
+        remote = RemoteVolumeManager(node, FilePath(b"/path/to/json"))
+        receiver = self.successResultOf(remote.receive_stream(self.volume))
+        receiver.write(b"some data")
+        self.successResultOf(receiver.finish())
+        self.assertEqual(
+            ([b"flocker-volume", b"--config", b"/path/to/json",
+              b"receive", self.volume.node_id.encode("ascii"),
+              b"myns.myvol"], b"some data"),
+            (node.remote_command, node.stdin.read()))
+
+    def test_receive_stream_options(self):
+        """
+        ``RemoteVolumeManager.receive_stream`` tells ``flocker-volume
+        receive`` about the compression algorithm and whether to resume.
+        """
+        node = FakeNode()
+
+        remote = RemoteVolumeManager(node, FilePath(b"/path/to/json"))
+        remote.receive_stream(self.volume, compression=b"bz2", resume=True)
+        self.assertEqual(node.remote_command,
+                         [b"flocker-volume", b"--config", b"/path/to/json",
+                          b"receive", b"--compression", b"bz2", b"--resume",
+                          self.volume.node_id.encode("ascii"),
+                          b"myns.myvol"])
+
+    def test_resume_token_destination_run(self):
+        """
+        ``RemoteVolumeManager.resume_token`` calls ``flocker-volume``
+        remotely with the ``resume_token`` command, and returns its output.
+        """
+        node = FakeNode([b"1234-abcd\n"])
+
+        remote = RemoteVolumeManager(node, FilePath(b"/path/to/json"))
+        token = self.successResultOf(remote.resume_token(self.volume))
+        self.assertEqual(
+            ([b"flocker-volume", b"--config", b"/path/to/json",
+              b"resume_token", self.volume.node_id.encode("ascii"),
+              b"myns.myvol"], b"1234-abcd"),
+            (node.remote_command, token))
+
+    def test_resume_token_none(self):
+        """
+        ``RemoteVolumeManager.resume_token`` returns ``None`` if
+        ``flocker-volume resume_token`` outputs nothing.
+        """
+        remote = RemoteVolumeManager(FakeNode([b""]))
+        self.assertIs(
+            None, self.successResultOf(remote.resume_token(self.volume)))
+
+    def test_resume_token_unsupported(self):
+        """
+        ``RemoteVolumeManager.resume_token`` returns ``None`` if
+        ``flocker-volume resume_token`` fails, e.g. because the remote
+        ``flocker-volume`` doesn't have that command.
+        """
+        remote = RemoteVolumeManager(FakeNode([IOError("Bad exit")]))
+        self.assertIs(
+            None, self.successResultOf(remote.resume_token(self.volume)))
+
+    def test_compressions_destination_run(self):
+        """
+        ``RemoteVolumeManager.compressions`` calls ``flocker-volume``
+        remotely with the ``compressions`` command, and returns the
+        algorithms it lists.
+        """
+        node = FakeNode([b"zlib\nbz2\n"])
+
+        remote = RemoteVolumeManager(node, FilePath(b"/path/to/json"))
+        algorithms = self.successResultOf(remote.compressions())
+        self.assertEqual(
+            ([b"flocker-volume", b"--config", b"/path/to/json",
+              b"compressions"], [b"zlib", b"bz2"]),
+            (node.remote_command, algorithms))
+
+    def test_compressions_unsupported(self):
+        """
+        ``RemoteVolumeManager.compressions`` returns an empty list if
+        ``flocker-volume compressions`` fails, e.g. because the remote
+        ``flocker-volume`` doesn't have that command.
+        """
+        remote = RemoteVolumeManager(FakeNode([IOError("Bad exit")]))
+        self.assertEqual([], self.successResultOf(remote.compressions()))
+
+    def test_queries_do_not_block(self):
+        """
+        ``RemoteVolumeManager.snapshots``, ``resume_token`` and
+        ``compressions`` run their commands with ``get_output_async`` rather
+        than blocking until the output is available.
+        """
+        pending = []
+
+        class AsyncOnlyNode(FakeNode):
+            def get_output(self, remote_command):
+                raise AssertionError("get_output blocks")
+
+            def get_output_async(self, remote_command):
+                pending.append(Deferred())
+                return pending[-1]
+
+        remote = RemoteVolumeManager(AsyncOnlyNode())
+        results = [remote.snapshots(self.volume),
+                   remote.resume_token(self.volume),
+                   remote.compressions()]
+        self.assertNoResult(results[0])
+        for d, output in zip(pending, [b"abc\n", b"1-abc\n", b"zlib\n"]):
+            d.callback(output)
+        self.assertEqual(
+            [[Snapshot(name=b"abc")], b"1-abc", [b"zlib"]],
+            [self.successResultOf(result) for result in results])
+
     def test_acquire_destination_run(self):
         """
         ``RemoteVolumeManager.acquire()`` calls ``flocker-volume`` remotely
@@ -4,10 +4,15 @@
 Tests for :module:`flocker.volume.script`.
 """
 
+import sys
+import zlib
+from io import BytesIO
+
 from twisted.trial.unittest import SynchronousTestCase
+from twisted.internet.task import Clock
 from twisted.python.filepath import FilePath
 from twisted.application.service import Service
-from twisted.python.usage import Options
+from twisted.python.usage import Options, UsageError
 
 from ...testtools import (
     StandardOptionsTestsMixin
@@ -18,6 +23,9 @@ from ..testtools import (
 from ..script import (
     VolumeOptions, VolumeManagerScript, flocker_volume_options
 )
+from ..service import VolumeService, VolumeName, Volume
+from ..filesystems.memory import FilesystemStoragePool
+from .._compression import COMPRESSION_ALGORITHMS
 
 
 class VolumeManagerScriptMainTests(SynchronousTestCase):
@@ -61,3 +69,112 @@ class StandardVolumeOptionsTests(make_volume_options_tests(VolumeOptions)):
     """
     Tests for ``VolumeService`` specific arguments of ``VolumeOptions``.
     """
+
+
+class ReceiveSubcommandTests(SynchronousTestCase):
+    """
+    Tests for ``flocker-volume receive``, ``flocker-volume resume_token`` and
+    ``flocker-volume compressions``.
+    """
+    def setUp(self):
+        pool = FilesystemStoragePool(FilePath(self.mktemp()))
+        self.service = VolumeService(
+            FilePath(self.mktemp()), pool, reactor=Clock())
+        self.service.startService()
+        origin = self.successResultOf(self.service.create(
+            self.service.get(VolumeName.from_bytes(b"myns.origin"))))
+        self.content = b"hello" * 10000
+        origin.get_filesystem().get_path().child(b"afile").setContent(
+            self.content)
+        with origin.get_filesystem().reader() as reader:
+            self.data = reader.read()
+        self.node_id = b"ce28a7b2-9aaa-4c54-9a7d-0a2bbd5e1c71"
+        self.volume = Volume(node_id=self.node_id.decode("ascii"),
+                             name=VolumeName.from_bytes(b"myns.myvol"),
+                             service=self.service)
+
+    def run_subcommand(self, arguments, stdin=b""):
+        """
+        Run a ``flocker-volume`` sub-command.
+
+        :param arguments: ``list`` of command-line arguments.
+        :param bytes stdin: The data to read from standard input.
+
+        :return: ``tuple`` of the result the sub-command's ``Deferred``
+            fired with and what was written to standard output.
+        """
+        options = VolumeOptions()
+        options.parseOptions(arguments)
+        self.patch(sys, "stdin", BytesIO(stdin))
+        stdout = BytesIO()
+        self.patch(sys, "stdout", stdout)
+        result = VolumeManagerScript().main(object(), options, self.service)
+        return self.successResultOf(result), stdout.getvalue()
+
+    def test_receive(self):
+        """
+        ``flocker-volume receive`` writes the data read from standard input
+        to the volume's filesystem.
+        """
+        self.run_subcommand(
+            [b"receive", self.node_id, b"myns.myvol"], self.data)
+        self.assertEqual(
+            self.content,
+            self.volume.get_filesystem().get_path().child(
+                b"afile").getContent())
+
+    def test_receive_compressed(self):
+        """
+        ``flocker-volume receive --compression`` decompresses the data read
+        from standard input.
+        """
+        self.run_subcommand(
+            [b"receive", b"--compression", b"zlib", self.node_id,
+             b"myns.myvol"], zlib.compress(self.data))
+        self.assertEqual(
+            self.content,
+            self.volume.get_filesystem().get_path().child(
+                b"afile").getContent())
+
+    def test_receive_unknown_compression(self):
+        """
+        ``flocker-volume receive`` rejects unknown compression algorithms.
+        """
+        self.assertRaises(
+            UsageError, VolumeOptions().parseOptions,
+            [b"receive", b"--compression", b"lzma", self.node_id,
+             b"myns.myvol"])
+
+    def test_resume(self):
+        """
+        After an interrupted receive, ``flocker-volume resume_token`` prints
+        a token and ``flocker-volume receive --resume`` receives the rest of
+        the data.
+        """
+        half = len(self.data) // 2
+        receiving = self.service.receive_stream(
+            self.volume.node_id, self.volume.name)
+        receiver = self.successResultOf(receiving)
+        receiver.write(self.data[:half])
+        self.failureResultOf(receiver.finish())
+
+        _, token = self.run_subcommand(
+            [b"resume_token", self.node_id, b"myns.myvol"])
+        self.run_subcommand(
+            [b"receive", b"--resume", self.node_id, b"myns.myvol"],
+            self.data[half:])
+        _, after = self.run_subcommand(
+            [b"resume_token", self.node_id, b"myns.myvol"])
+        self.assertEqual(
+            (True, b"", self.content),
+            (token.endswith(b"\n") and len(token) > 1, after,
+             self.volume.get_filesystem().get_path().child(
+                 b"afile").getContent()))
+
+    def test_compressions(self):
+        """
+        ``flocker-volume compressions`` prints the supported compression
+        algorithms, one per line.
+        """
+        _, output = self.run_subcommand([b"compressions"])
+        self.assertEqual(list(COMPRESSION_ALGORITHMS), output.splitlines())
@@ -5,9 +5,10 @@
 from __future__ import absolute_import
 
 from io import BytesIO
+from os import urandom
 import sys
+import zlib
 import json
-from contextlib import contextmanager
 
 from uuid import uuid4
 from StringIO import StringIO
@@ -16,6 +17,8 @@ from zope.interface import implementer
 from zope.interface.verify import verifyObject
 
 from twisted.application.service import IService, Service
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.error import ConnectionLost
 from twisted.internet.task import Clock
 from twisted.python.filepath import FilePath, Permissions
 from twisted.trial.unittest import SynchronousTestCase, TestCase
@@ -26,7 +29,9 @@ from ..service import (
     VolumeSize,
     )
 from ..script import VolumeOptions
+from .._compression import Compression
 
+from ..filesystems.interfaces import IFilesystemReceiver
 from ..filesystems.memory import FilesystemStoragePool
 from ..filesystems.zfs import StoragePool
 from .._ipc import RemoteVolumeManager, LocalVolumeManager
@@ -235,6 +240,136 @@ MY_VOLUME = VolumeName(namespace=u"myns", dataset_id=u"myvolume")
 MY_VOLUME2 = VolumeName(namespace=u"myns", dataset_id=u"myvolume2")
 
 
+@implementer(IFilesystemReceiver)
+class RecordingReceiver(object):
+    """
+    An ``IFilesystemReceiver`` which records what was done to it.
+
+    :ivar BytesIO data: The data written.
+    :ivar list producers: ``(producer, streaming)`` pairs registered.
+    :ivar bool finished: Whether ``finish`` was called.
+    """
+    def __init__(self):
+        self.data = BytesIO()
+        self.producers = []
+        self.finished = False
+
+    def write(self, data):
+        self.data.write(data)
+
+    def registerProducer(self, producer, streaming):
+        self.producers.append((producer, streaming))
+
+    def unregisterProducer(self):
+        pass
+
+    def finish(self):
+        self.finished = True
+        return succeed(None)
+
+
+class FakeVolumeManager(object):
+    """
+    A fake ``IRemoteVolumeManager`` which records pushed data, supports no
+    compression and never has anything to resume.
+
+    :ivar list receivers: The receivers returned by ``receive_stream``.
+    :ivar int resume_token_queries: The number of ``resume_token`` calls.
+    """
+    def __init__(self, receiver_factory=RecordingReceiver, snapshots=()):
+        """
+        :param receiver_factory: Zero-argument callable creating the
+            receivers returned by ``receive_stream``.
+        :param snapshots: The ``Snapshot`` instances returned by
+            ``snapshots``.
+        """
+        self._receiver_factory = receiver_factory
+        self._snapshots = list(snapshots)
+        self.receivers = []
+        self.resume_token_queries = 0
+
+    def snapshots(self, volume):
+        return succeed(self._snapshots)
+
+    def receive_stream(self, volume, compression=None, resume=False):
+        self.receivers.append(self._receiver_factory())
+        return succeed(self.receivers[-1])
+
+    def resume_token(self, volume):
+        self.resume_token_queries += 1
+        return succeed(None)
+
+    def compressions(self):
+        return succeed([])
+
+
+class FailingReceiver(RecordingReceiver):
+    """
+    A ``RecordingReceiver`` which fails to store the data, as if the
+    connection to the remote volume manager was lost.
+    """
+    def finish(self):
+        RecordingReceiver.finish(self)
+        return fail(ConnectionLost())
+
+
+@implementer(IFilesystemReceiver)
+class InterruptingReceiver(object):
+    """
+    Pass on only a limited amount of data to another receiver, then stop
+    the producer, as if the connection to the remote volume manager was
+    lost.
+    """
+    def __init__(self, receiver, limit):
+        """
+        :param IFilesystemReceiver receiver: The receiver to pass data to.
+        :param int limit: How many bytes to pass on.
+        """
+        self._receiver = receiver
+        self._remaining = limit
+        self._producer = None
+
+    def write(self, data):
+        if self._remaining <= 0:
+            return
+        self._receiver.write(data[:self._remaining])
+        self._remaining -= len(data)
+        if self._remaining <= 0:
+            self._producer.stopProducing()
+
+    def registerProducer(self, producer, streaming):
+        self._producer = producer
+        self._receiver.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self._receiver.unregisterProducer()
+
+    def finish(self):
+        return self._receiver.finish()
+
+
+class InterruptingVolumeManager(LocalVolumeManager):
+    """
+    A ``LocalVolumeManager`` whose first push is interrupted part way
+    through.
+    """
+    def __init__(self, service, limit):
+        """
+        :param VolumeService service: The service to communicate with.
+        :param int limit: How many bytes of the first push to receive.
+        """
+        LocalVolumeManager.__init__(self, service)
+        self._limit = limit
+
+    def receive_stream(self, volume, compression=None, resume=False):
+        receiving = LocalVolumeManager.receive_stream(
+            self, volume, compression, resume)
+        if self._limit is not None:
+            receiving.addCallback(InterruptingReceiver, self._limit)
+            self._limit = None
+        return receiving
+
+
 class VolumeServiceAPITests(TestCase):
     """Tests for the ``VolumeService`` API."""
 
@@ -437,9 +572,11 @@ class VolumeServiceAPITests(TestCase):
         with filesystem.reader() as reader:
             data = reader.read()
         node = FakeNode([
-            # Hard-code the knowledge that first `flocker-volume snapshots` is
-            # run.  It doesn't need to produce any particular output for this
-            # test, it just needs to not fail.
+            # Hard-code the knowledge that first `flocker-volume snapshots`
+            # and then `flocker-volume resume_token` are run.  They don't
+            # need to produce any particular output for this test, they just
+            # need to not fail.
+            b"",
             b"",
         ])
 
@@ -453,20 +590,6 @@ class VolumeServiceAPITests(TestCase):
         snapshot in common with the local volume manager results in an
         incremental data stream.
         """
-
-        class FakeVolumeManager(object):
-            def __init__(self):
-                self.written = []
-
-            def snapshots(self, volume):
-                return volume.get_filesystem().snapshots()
-
-            @contextmanager
-            def receive(self, volume):
-                writer = BytesIO()
-                yield writer
-                self.written.append(writer)
-
         pool = FilesystemStoragePool(FilePath(self.mktemp()))
         service = VolumeService(FilePath(self.mktemp()), pool, reactor=Clock())
         service.startService()
@@ -474,14 +597,318 @@ class VolumeServiceAPITests(TestCase):
         filesystem = volume.get_filesystem()
         filesystem.snapshot(b"stuff")
 
-        remote_manager = FakeVolumeManager()
+        remote_manager = FakeVolumeManager(
+            snapshots=self.successResultOf(filesystem.snapshots()))
 
         self.successResultOf(service.push(volume, remote_manager))
 
-        writer = remote_manager.written.pop()
+        [receiver] = remote_manager.receivers
         self.assertEqual(
             [b"incremental stream based on", b"stuff"],
-            writer.getvalue().splitlines()[-2:])
+            receiver.data.getvalue().splitlines()[-2:])
+
+    def _push_fixture(self, compression=None, content=b"x" * (1024 * 1024)):
+        """
+        Create a service with a locally-owned volume containing some data.
+
+        :param compression: Passed to ``VolumeService``.
+        :param bytes content: The data in the volume.
+
+        :return: ``tuple`` of the ``VolumeService`` and the ``Volume``.
+        """
+        pool = FilesystemStoragePool(FilePath(self.mktemp()))
+        service = VolumeService(FilePath(self.mktemp()), pool,
+                                reactor=Clock(), compression=compression)
+        service.startService()
+        volume = self.successResultOf(service.create(service.get(MY_VOLUME)))
+        volume.get_filesystem().get_path().child(b"foo").setContent(content)
+        return service, volume
+
+    def test_push_progress(self):
+        """
+        The ``progress`` callable passed to ``VolumeService.push`` is called
+        with the increasing total number of bytes pushed, ending with the
+        size of the whole stream.
+        """
+        service, volume = self._push_fixture()
+        node = FakeNode([b"", b""])
+        reported = []
+
+        self.successResultOf(service.push(
+            volume, RemoteVolumeManager(node), progress=reported.append))
+
+        self.assertEqual(
+            (True, sorted(reported), len(node.stdin.read())),
+            (len(reported) > 1, reported, reported[-1]))
+
+    def test_push_flow_control(self):
+        """
+        ``VolumeService.push`` registers the filesystem's producer with the
+        destination's receiver, so the receiver can pause it.
+        """
+        service, volume = self._push_fixture()
+
+        class PausingReceiver(RecordingReceiver):
+            def registerProducer(self, producer, streaming):
+                RecordingReceiver.registerProducer(self, producer, streaming)
+                producer.pauseProducing()
+
+        manager = FakeVolumeManager(receiver_factory=PausingReceiver)
+        pushing = service.push(volume, manager)
+        self.assertNoResult(pushing)
+        [receiver] = manager.receivers
+        written = receiver.data.tell()
+        [(producer, streaming)] = receiver.producers
+        producer.resumeProducing()
+        self.successResultOf(pushing)
+        self.assertEqual((True, 0), (streaming, written))
+
+    def test_push_send_fails(self):
+        """
+        If sending the filesystem fails, the destination's receiver is still
+        finished and the ``Deferred`` returned by ``VolumeService.push``
+        fails with the sending failure.
+        """
+        service, volume = self._push_fixture()
+
+        class StoppingReceiver(RecordingReceiver):
+            def write(self, data):
+                self.producers[-1][0].stopProducing()
+
+            def finish(self):
+                RecordingReceiver.finish(self)
+                return fail(IOError("Bad exit"))
+
+        manager = FakeVolumeManager(receiver_factory=StoppingReceiver)
+        pushing = service.push(volume, manager)
+        self.failureResultOf(pushing, ConnectionLost)
+        self.assertEqual([True], [r.finished for r in manager.receivers])
+
+    def test_concurrent_pushes(self):
+        """
+        A push does not wait for an earlier one to finish.
+        """
+        service, volume = self._push_fixture()
+        other = self.successResultOf(service.create(service.get(MY_VOLUME2)))
+        finishing = []
+
+        class ManualReceiver(RecordingReceiver):
+            def finish(self):
+                finishing.append(Deferred())
+                return finishing[-1]
+
+        manager = FakeVolumeManager(receiver_factory=ManualReceiver)
+        first = service.push(volume, manager)
+        second = service.push(other, manager)
+        self.assertEqual(2, len(finishing))
+        finishing[1].callback(None)
+        self.successResultOf(second)
+        self.assertNoResult(first)
+        finishing[0].callback(None)
+        self.successResultOf(first)
+
+    def test_push_compressed(self):
+        """
+        If the ``VolumeService`` is configured with a ``Compression`` whose
+        algorithm the destination supports, the pushed data is compressed
+        with it and the destination is told which algorithm was used.
+        """
+        service, volume = self._push_fixture(
+            compression=Compression(algorithm=b"zlib", level=9))
+        with volume.get_filesystem().reader() as reader:
+            data = reader.read()
+        node = FakeNode([b"", b"zlib\nbz2\n"])
+
+        self.successResultOf(service.push(volume, RemoteVolumeManager(node)))
+
+        compressed = node.stdin.read()
+        self.assertEqual(
+            (True, [b"--compression", b"zlib"], data),
+            (len(compressed) < len(data) / 100, node.remote_command[4:6],
+             zlib.decompress(compressed)))
+
+    def test_push_compression_unsupported(self):
+        """
+        If the destination doesn't support the configured compression
+        algorithm the pushed data is not compressed.
+        """
+        service, volume = self._push_fixture(
+            compression=Compression(algorithm=b"bz2", level=1))
+        with volume.get_filesystem().reader() as reader:
+            data = reader.read()
+        node = FakeNode([b"", b"zlib\n"])
+
+        self.successResultOf(service.push(volume, RemoteVolumeManager(node)))
+
+        self.assertEqual(
+            (b"receive", data),
+            (node.remote_command[3], node.stdin.read()))
+
+    def _interrupted_push(self, compression=None,
+                          content=b"x" * (1024 * 1024)):
+        """
+        Push a volume to another volume service, interrupting the push
+        half way through.
+
+        :param compression: Passed to ``VolumeService``.
+        :param bytes content: The data in the volume.
+
+        :return: ``tuple`` of the local ``VolumeService``, the ``Volume``,
+            the ``InterruptingVolumeManager`` pushed to, the remote
+            ``VolumeService`` and the number of bytes pushed.
+        """
+        service, volume = self._push_fixture(compression, content)
+        remote_service = VolumeService(
+            FilePath(self.mktemp()),
+            FilesystemStoragePool(FilePath(self.mktemp())), reactor=Clock())
+        remote_service.startService()
+        with volume.get_filesystem().reader() as reader:
+            limit = len(reader.read()) // 2
+        manager = InterruptingVolumeManager(remote_service, limit)
+
+        self.failureResultOf(service.push(volume, manager), ConnectionLost)
+        return service, volume, manager, remote_service, limit
+
+    def test_push_resumes_interrupted(self):
+        """
+        If a push was interrupted, the next push to the same destination
+        only sends the rest of the data, after which the destination has
+        all of it.
+        """
+        service, volume, manager, remote_service, limit = (
+            self._interrupted_push())
+        token = self.successResultOf(
+            remote_service.resume_token(volume.node_id, volume.name))
+        with volume.get_filesystem().reader() as reader:
+            total = len(reader.read())
+        reported = []
+
+        self.successResultOf(service.push(
+            volume, manager, progress=reported.append))
+
+        remote_volume = Volume(node_id=volume.node_id, name=volume.name,
+                               service=remote_service)
+        self.assertEqual(
+            (True, total - limit, b"x" * (1024 * 1024), None),
+            (token is not None, reported[-1],
+             remote_volume.get_filesystem().get_path().child(
+                 b"foo").getContent(),
+             self.successResultOf(
+                 remote_service.resume_token(volume.node_id, volume.name))))
+
+    def test_push_resumes_compressed(self):
+        """
+        An interrupted compressed push can be resumed.
+        """
+        # Incompressible data, so the compressor writes as it goes along
+        # rather than all at the end:
+        content = urandom(1024 * 1024)
+        service, volume, manager, remote_service, _ = self._interrupted_push(
+            compression=Compression(algorithm=b"zlib", level=9),
+            content=content)
+        with volume.get_filesystem().reader() as reader:
+            total = len(reader.read())
+        reported = []
+
+        self.successResultOf(service.push(
+            volume, manager, progress=reported.append))
+
+        remote_volume = Volume(node_id=volume.node_id, name=volume.name,
+                               service=remote_service)
+        self.assertEqual(
+            (True, content),
+            (reported[-1] < total,
+             remote_volume.get_filesystem().get_path().child(
+                 b"foo").getContent()))
+
+    def test_push_first_not_resumed(self):
+        """
+        A push which doesn't follow an interrupted push to the same
+        destination doesn't ask the destination for a resume token.
+        """
+        service, volume = self._push_fixture()
+        destination = FakeVolumeManager()
+
+        self.successResultOf(service.push(volume, destination))
+        self.successResultOf(service.push(volume, destination))
+        self.assertEqual(0, destination.resume_token_queries)
+
+    def test_push_retry_resumes(self):
+        """
+        A push following an interrupted push to the same destination asks
+        the destination for a resume token, but once a push succeeded the
+        following one doesn't.
+        """
+        service, volume = self._push_fixture()
+        receivers = [FailingReceiver, RecordingReceiver, RecordingReceiver]
+        destination = FakeVolumeManager(
+            receiver_factory=lambda: receivers.pop(0)())
+
+        self.failureResultOf(service.push(volume, destination),
+                             ConnectionLost)
+        self.successResultOf(service.push(volume, destination))
+        queried_on_retry = destination.resume_token_queries
+        self.successResultOf(service.push(volume, destination))
+        self.assertEqual(
+            (1, 1), (queried_on_retry, destination.resume_token_queries))
+
+    def test_push_restarts_stale(self):
+        """
+        If the data was changed since an interrupted push, so it can no
+        longer be resumed, the next push sends all of it again.
+        """
+        service, volume, manager, remote_service, _ = (
+            self._interrupted_push())
+        volume.get_filesystem().get_path().child(b"foo").setContent(b"new")
+        with volume.get_filesystem().reader() as reader:
+            total = len(reader.read())
+        reported = []
+
+        self.successResultOf(service.push(
+            volume, manager, progress=reported.append))
+
+        remote_volume = Volume(node_id=volume.node_id, name=volume.name,
+                               service=remote_service)
+        self.assertEqual(
+            (total, b"new"),
+            (reported[-1],
+             remote_volume.get_filesystem().get_path().child(
+                 b"foo").getContent()))
+
+    def test_receive_stream_local_node_id(self):
+        """
+        If a volume with the same node ID as the service is received with
+        ``VolumeService.receive_stream``, ``ValueError`` is raised.
+        """
+        pool = FilesystemStoragePool(FilePath(self.mktemp()))
+        service = VolumeService(FilePath(self.mktemp()), pool, reactor=Clock())
+        service.startService()
+
+        self.assertRaises(ValueError, service.receive_stream,
+                          service.node_id, MY_VOLUME)
+
+    def test_receive_stream_creates_files(self):
+        """
+        ``VolumeService.receive_stream`` returns a ``Deferred`` firing with
+        an ``IFilesystemReceiver`` which creates the volume's filesystem from
+        the data written to it.
+        """
+        service, volume = self._push_fixture()
+        manager_node_id = unicode(uuid4())
+        new_name = VolumeName(namespace=u"myns", dataset_id=u"newvolume")
+
+        receiver = self.successResultOf(
+            service.receive_stream(manager_node_id, new_name))
+        self.successResultOf(volume.get_filesystem().send(receiver))
+        self.successResultOf(receiver.finish())
+
+        new_volume = Volume(node_id=manager_node_id, name=new_name,
+                            service=service)
+        root = new_volume.get_filesystem().get_path()
+        self.assertEqual(
+            (True, b"x" * (1024 * 1024)),
+            (IFilesystemReceiver.providedBy(receiver),
+             root.child(b"foo").getContent()))
 
     def test_receive_local_node_id(self):
         """
@@ -1062,6 +1489,24 @@ class VolumeScriptCreateVolumeServiceTests(SynchronousTestCase):
             (service.running, service._config_path, service.pool)
         )
 
+    def test_compression(self):
+        """
+        ``VolumeScript._create_volume_service`` configures the
+        ``VolumeService`` to compress pushed data as given by the
+        ``options`` argument.
+        """
+        options = VolumeOptions()
+        options.parseOptions([
+            b"--config", FilePath(self.mktemp()).path,
+            b"--compression", b"bz2",
+            b"--compression-level", b"3",
+        ])
+
+        service = VolumeScript._create_volume_service(
+            StringIO(), object(), options)
+        self.assertEqual(Compression(algorithm=b"bz2", level=3),
+                         service._compression)
+
     def test_service_factory(self):
         """
         ``VolumeScript._create_volume_service`` uses
@@ -1072,7 +1517,8 @@ class VolumeScriptCreateVolumeServiceTests(SynchronousTestCase):
         script = VolumeScript(object())
         self.patch(
             VolumeScript, "_service_factory",
-            staticmethod(lambda config_path, pool, reactor: expected))
+            staticmethod(
+                lambda config_path, pool, reactor, compression: expected))
 
         options = VolumeOptions()
         options.parseOptions([])
@@ -15,9 +15,11 @@ from twisted.python.filepath import FilePath
 from twisted.internet.task import Clock
 from twisted.internet import reactor
 from twisted.trial.unittest import SynchronousTestCase
+from twisted.python.usage import UsageError
 
 from ..common import ProcessNode
 from ._ipc import RemoteVolumeManager
+from ._compression import Compression, DEFAULT_COMPRESSION_LEVEL
 
 from .filesystems.zfs import StoragePool
 from .service import VolumeService
@@ -110,9 +112,16 @@ class MutatingProcessNode(ProcessNode):
     def run(self, remote_command):
         return ProcessNode.run(self, self._mutate(remote_command))
 
+    def run_streaming(self, remote_command):
+        return ProcessNode.run_streaming(self, self._mutate(remote_command))
+
     def get_output(self, remote_command):
         return ProcessNode.get_output(self, self._mutate(remote_command))
 
+    def get_output_async(self, remote_command):
+        return ProcessNode.get_output_async(
+            self, self._mutate(remote_command))
+
 
 @attributes(["from_service", "to_service", "remote"])
 class ServicePair(object):
@@ -212,6 +221,54 @@ def make_volume_options_tests(make_options, extra_arguments=None):
             parseOptions(options, [b"--mountpoint", mountpoint])
             self.assertEqual(mountpoint, options["mountpoint"])
 
+        def test_default_compression(self):
+            """
+            By default pushed data is not compressed.
+            """
+            options = make_options()
+            parseOptions(options, [])
+            self.assertIs(None, options["compression"])
+
+        def test_compression(self):
+            """
+            The options class accepts ``--compression`` and
+            ``--compression-level`` parameters, combined into a
+            ``Compression``.
+            """
+            options = make_options()
+            parseOptions(options, [b"--compression", b"zlib",
+                                   b"--compression-level", b"9"])
+            self.assertEqual(Compression(algorithm=b"zlib", level=9),
+                             options["compression"])
+
+        def test_default_compression_level(self):
+            """
+            The compression level defaults to ``DEFAULT_COMPRESSION_LEVEL``.
+            """
+            options = make_options()
+            parseOptions(options, [b"--compression", b"bz2"])
+            self.assertEqual(
+                Compression(algorithm=b"bz2",
+                            level=DEFAULT_COMPRESSION_LEVEL),
+                options["compression"])
+
+        def test_unknown_compression(self):
+            """
+            An unknown compression algorithm results in a ``UsageError``.
+            """
+            options = make_options()
+            self.assertRaises(UsageError, parseOptions, options,
+                              [b"--compression", b"lzma"])
+
+        def test_invalid_compression_level(self):
+            """
+            A compression level outside 1-9 results in a ``UsageError``.
+            """
+            options = make_options()
+            self.assertRaises(UsageError, parseOptions, options,
+                              [b"--compression", b"zlib",
+                               b"--compression-level", b"10"])
+
     dummy_options = make_options()
     VolumeOptionsTests.__name__ = dummy_options.__class__.__name__ + "Tests"
     return VolumeOptionsTests